@@ -3,7 +3,6 @@ import base64
 import os
 import shutil
 import re
-from pathlib import Path
 from typing import Any
 from .call_window import CallWindow
 
@@ -20,9 +19,13 @@ from PyQt6.QtMultimedia import QMediaPlayer, QAudioOutput
 from PyQt6.QtMultimediaWidgets import QVideoWidget
 
 from common.config import SERVER_HOST, SERVER_PORT
+from common.attachment_paths import locate_attachment
 from .network import NetworkThread, make_packet
 from .ui_layout import setup_chatwindow_ui
 
+# Bản avatar server dựng sẵn dùng cho danh sách chat (sidebar 32px, panel 80px)
+AVATAR_LIST_SIZE = 64
+
 class ChatWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -40,6 +43,9 @@ class ChatWindow(QMainWindow):
         
         self._user_avatar_cache: dict[tuple[str, int], QPixmap] = {}
         self._avatar_cache: dict[str, QPixmap] = {} # cache avatar tròn nhỏ
+        # hash -> base64 (bản 64px) của avatar đã tải; server chỉ gửi hash
+        self._avatar_blobs: dict[str, str] = {}
+        self._avatar_requested: set[str] = set()
         
         # Biến lưu cửa sổ gọi hiện tại
         self.current_call_window: CallWindow | None = None
@@ -52,6 +58,7 @@ class ChatWindow(QMainWindow):
         self.default_avatar_small = getattr(self, "avatar_small", None)
         self.default_avatar_large = getattr(self, "avatar_large", None)
         self.main_avatar_b64: str | None = None
+        self.main_avatar_hash: str | None = None
 
         self._connect_to_server()
         self._connect_signals()
@@ -501,6 +508,7 @@ class ChatWindow(QMainWindow):
         # Chat list interactions
         self.chat_list.delete_requested.connect(self.on_delete_from_context)
         self.chat_list.attachment_open_requested.connect(self.on_chat_attachment_open)
+        self.chat_list.load_more_requested.connect(self.on_load_more_history)
 
         # Click avatar ở info panel -> đổi avatar nhóm (mousePress)
         if hasattr(self, "lbl_partner_avatar"):
@@ -695,6 +703,7 @@ class ChatWindow(QMainWindow):
             self.lbl_user_info.setText("Chưa đăng nhập")
         if getattr(self, "lbl_chat_status", None):
             self.lbl_chat_status.setText("Đã đăng xuất")
+        self.main_avatar_hash = None
         self._set_current_user_avatar_from_b64(None)
         self._update_info_panel(None)
         if hasattr(self, "main_stack") and hasattr(self, "login_panel"):
@@ -929,6 +938,30 @@ class ChatWindow(QMainWindow):
         except OSError:
             pass
 
+    def _request_avatars(self, hashes, size: int = AVATAR_LIST_SIZE):
+        if not (getattr(self, "sock", None) and hashes):
+            return
+        pkt = make_packet("get_avatars", {"hashes": list(hashes), "size": size})
+        try:
+            self.sock.sendall(pkt)
+        except OSError:
+            pass
+
+    def _apply_avatar_blobs(self):
+        """
+        Gắn avatar_b64 cho các conversation từ cache theo hash,
+        hash nào chưa có thì hỏi server (mỗi hash chỉ hỏi 1 lần).
+        """
+        missing = set()
+        for conv in self.conversations or []:
+            h = conv.get("avatar_hash")
+            conv["avatar_b64"] = self._avatar_blobs.get(h) if h else None
+            if h and h not in self._avatar_blobs and h not in self._avatar_requested:
+                missing.add(h)
+        if missing:
+            self._avatar_requested.update(missing)
+            self._request_avatars(sorted(missing))
+
     def request_group_history(self, conv_id: int):
         if not (getattr(self, "sock", None) and self.current_username):
             return
@@ -944,6 +977,29 @@ class ChatWindow(QMainWindow):
             if getattr(self, "lbl_chat_status", None):
                 self.lbl_chat_status.setText(f"❌ Lỗi yêu cầu lịch sử nhóm: {e}")
 
+    def on_load_more_history(self, before_id: int):
+        """Cuộn lên đầu khung chat -> xin trang tin nhắn cũ hơn before_id."""
+        if not (getattr(self, "sock", None) and self.current_username):
+            return
+        if self.current_group_id:
+            pkt = make_packet("load_group_history", {
+                "conversation_id": self.current_group_id,
+                "username": self.current_username,
+                "before_id": before_id,
+            })
+        elif self.current_partner_username:
+            pkt = make_packet("load_history", {
+                "from": self.current_username,
+                "to": self.current_partner_username,
+                "before_id": before_id,
+            })
+        else:
+            return
+        try:
+            self.sock.sendall(pkt)
+        except OSError:
+            self.chat_list.finish_loading_more()
+
     def on_server_message(self, msg: dict):
         action = msg.get("action")
         data = msg.get("data") or {}
@@ -975,8 +1031,7 @@ class ChatWindow(QMainWindow):
                 self.request_conversations()
                 return
 
-            base_dir = Path(__file__).resolve().parents[1]
-            img_path = base_dir / "server" / "storage" / "images" / filename
+            img_path = locate_attachment("image", filename)
 
             self.chat_list.add_image_bubble(
                 msg_id,
@@ -1000,8 +1055,7 @@ class ChatWindow(QMainWindow):
                     self.request_conversations()
                     return
 
-                base_dir = Path(__file__).resolve().parents[1]
-                img_path = base_dir / "server" / "storage" / "images" / filename
+                img_path = locate_attachment("image", filename)
 
                 self.chat_list.add_image_bubble(
                     msg_id,
@@ -1030,19 +1084,17 @@ class ChatWindow(QMainWindow):
                 self.request_conversations()
                 return
 
-            base_dir = Path(__file__).resolve().parents[1]
-
             if file_type == "video":
-                folder = Path("videos")
+                msg_type = "video"
                 add_fn = self.chat_list.add_video_bubble
             elif file_type == "image":
-                folder = Path("images")
+                msg_type = "image"
                 add_fn = self.chat_list.add_image_bubble
             else:
-                folder = Path("files")
+                msg_type = "file"
                 add_fn = self.chat_list.add_file_bubble
 
-            full_path = base_dir / "server" / "storage" / folder / filename
+            full_path = locate_attachment(msg_type, filename)
 
             add_fn(
                 msg_id,
@@ -1066,19 +1118,17 @@ class ChatWindow(QMainWindow):
                     self.request_conversations()
                     return
 
-                base_dir = Path(__file__).resolve().parents[1]
-
                 if file_type == "video":
-                    folder = Path("videos")
+                    msg_type = "video"
                     add_fn = self.chat_list.add_video_bubble
                 elif file_type == "image":
-                    folder = Path("images")
+                    msg_type = "image"
                     add_fn = self.chat_list.add_image_bubble
                 else:
-                    folder = Path("files")
+                    msg_type = "file"
                     add_fn = self.chat_list.add_file_bubble
 
-                full_path = base_dir / "server" / "storage" / folder / filename
+                full_path = locate_attachment(msg_type, filename)
 
                 add_fn(
                     msg_id,
@@ -1095,13 +1145,14 @@ class ChatWindow(QMainWindow):
         elif action == "update_group_avatar_result":
             if data.get("ok"):
                 conv_id = int(data.get("conversation_id") or 0)
-                avatar_b64 = data.get("avatar_b64")
+                avatar_hash = data.get("avatar_hash")
 
                 # cập nhật vào list conversations
                 for it in self.conversations or []:
                     if it.get("is_group") and it.get("conversation_id") == conv_id:
-                        it["avatar_b64"] = avatar_b64
+                        it["avatar_hash"] = avatar_hash
                         break
+                self._apply_avatar_blobs()
 
                 self._update_group_info_panel(conv_id)
                 self.request_conversations()
@@ -1113,11 +1164,12 @@ class ChatWindow(QMainWindow):
 
         elif action == "group_avatar_changed":
             conv_id = data.get("conversation_id")
-            avatar_b64 = data.get("avatar_b64")
+            avatar_hash = data.get("avatar_hash")
 
             for conv in self.conversations:
                 if conv.get("conversation_id") == conv_id:
-                    conv["avatar_b64"] = avatar_b64
+                    conv["avatar_hash"] = avatar_hash
+            self._apply_avatar_blobs()
 
             if self.current_group_id == conv_id:
                 self._update_group_info_panel(conv_id)
@@ -1228,8 +1280,7 @@ class ChatWindow(QMainWindow):
                 filename = data.get("filename") or ""
                 mid = data.get("message_id")
                 if self.current_group_id == conv_id and filename:
-                    base_dir = Path(__file__).resolve().parents[1]
-                    img_path = base_dir / "server" / "storage" / "images" / filename
+                    img_path = locate_attachment("image", filename)
                     self.chat_list.add_image_bubble(
                         mid,
                         self.current_username,
@@ -1251,16 +1302,15 @@ class ChatWindow(QMainWindow):
                 file_type = (data.get("file_type") or "file").lower()
                 mid = data.get("message_id")
                 if self.current_group_id == conv_id and filename:
-                    base_dir = Path(__file__).resolve().parents[1]
-                    storage = Path("files")
+                    msg_type = "file"
                     add_fn = self.chat_list.add_file_bubble
                     if file_type == "video":
-                        storage = Path("videos")
+                        msg_type = "video"
                         add_fn = self.chat_list.add_video_bubble
                     elif file_type == "image":
-                        storage = Path("images")
+                        msg_type = "image"
                         add_fn = self.chat_list.add_image_bubble
-                    full_path = base_dir / "server" / "storage" / storage / filename
+                    full_path = locate_attachment(msg_type, filename)
                     add_fn(
                         mid,
                         self.current_username,
@@ -1277,6 +1327,7 @@ class ChatWindow(QMainWindow):
 
         elif action == "group_history_result":
             if not data.get("ok"):
+                self.chat_list.finish_loading_more()
                 self.lbl_chat_status.setText(
                     "❌ Lỗi tải lịch sử nhóm: " + str(data.get("error"))
                 )
@@ -1284,16 +1335,19 @@ class ChatWindow(QMainWindow):
 
             conv_id = int(data.get("conversation_id") or 0)
             msgs = data.get("messages", [])
+            is_older_page = data.get("before_id") is not None
 
-            self.current_group_id = conv_id
-            self.current_partner_username = None
-            self.current_group_is_owner = bool(data.get("is_owner", False))
-            self.chat_list.clear()
-
-            base_dir = Path(__file__).resolve().parents[1]
-            images_dir = base_dir / "server" / "storage" / "images"
-            videos_dir = base_dir / "server" / "storage" / "videos"
-            files_dir  = base_dir / "server" / "storage" / "files"
+            if is_older_page:
+                # trang cũ hơn của đoạn chat đang mở -> chèn lên đầu
+                if conv_id != self.current_group_id:
+                    self.chat_list.finish_loading_more()
+                    return
+                self.chat_list.begin_prepend()
+            else:
+                self.current_group_id = conv_id
+                self.current_partner_username = None
+                self.current_group_is_owner = bool(data.get("is_owner", False))
+                self.chat_list.clear()
 
             for m in msgs:
                 mid = m.get("id")
@@ -1306,19 +1360,19 @@ class ChatWindow(QMainWindow):
                     avatar_pix = self._get_user_avatar_pixmap(sender, 28)
 
                 if msg_type == "image":
-                    img_path = images_dir / content
+                    img_path = locate_attachment("image", content)
                     self.chat_list.add_image_bubble(
                         mid, sender, self.current_username, str(img_path),
                         True, avatar_pix,
                     )
                 elif msg_type == "video":
-                    vpath = videos_dir / content
+                    vpath = locate_attachment("video", content)
                     self.chat_list.add_video_bubble(
                         mid, sender, self.current_username, str(vpath),
                         True, avatar_pix,
                     )
                 elif msg_type == "file":
-                    fpath = files_dir / content
+                    fpath = locate_attachment("file", content)
                     self.chat_list.add_file_bubble(
                         mid, sender, self.current_username, str(fpath),
                         True, avatar_pix,
@@ -1329,6 +1383,11 @@ class ChatWindow(QMainWindow):
                         True, avatar_pix,
                     )
 
+            if is_older_page:
+                self.chat_list.end_prepend(bool(data.get("has_more")))
+                return
+            self.chat_list.has_more_history = bool(data.get("has_more"))
+
             self._update_group_info_panel(conv_id)
             self._update_group_buttons_state()
             self.lbl_chat_status.setText(f"✅ Đã tải {len(msgs)} tin nhắn trong nhóm #{conv_id}")
@@ -1354,9 +1413,11 @@ class ChatWindow(QMainWindow):
             self.lbl_chat_status.setText("")
             self.current_partner_username = None
 
-            # Avatar của chính mình (base64 trong DB)
-            avatar_b64 = data.get("avatar_b64")
-            self._set_current_user_avatar_from_b64(avatar_b64)
+            # Avatar của chính mình: server chỉ gửi hash, tải ảnh gốc riêng
+            self.main_avatar_hash = data.get("avatar_hash")
+            self._set_current_user_avatar_from_b64(None)
+            if self.main_avatar_hash:
+                self._request_avatars([self.main_avatar_hash], size=0)
 
             self._update_info_panel(None)
             self.request_conversations()
@@ -1414,23 +1475,28 @@ class ChatWindow(QMainWindow):
 
         elif action == "history_result":
             if not data.get("ok"):
+                self.chat_list.finish_loading_more()
                 self.lbl_chat_status.setText("❌ Lỗi tải lịch sử: " + str(data.get("error")))
                 return
 
             msgs = data.get("messages", [])
             partner = data.get("with")
+            is_older_page = data.get("before_id") is not None
 
-            self.current_partner_username = partner
-            self.le_to_user.setText(partner or "")
-            if partner and hasattr(self.sidebar, "set_active_username"):
-                self.sidebar.set_active_username(f"user:{partner}")
-            self._update_info_panel(partner)
+            if is_older_page:
+                # trang cũ hơn của đoạn chat đang mở -> chèn lên đầu
+                if partner != self.current_partner_username or self.current_group_id:
+                    self.chat_list.finish_loading_more()
+                    return
+                self.chat_list.begin_prepend()
+            else:
+                self.current_partner_username = partner
+                self.le_to_user.setText(partner or "")
+                if partner and hasattr(self.sidebar, "set_active_username"):
+                    self.sidebar.set_active_username(f"user:{partner}")
+                self._update_info_panel(partner)
 
-            self.chat_list.clear()
-            base_dir = Path(__file__).resolve().parents[1]
-            images_dir = base_dir / "server" / "storage" / "images"
-            videos_dir = base_dir / "server" / "storage" / "videos"
-            files_dir  = base_dir / "server" / "storage" / "files"
+                self.chat_list.clear()
 
             for m in msgs:
                 mid = m.get("id")
@@ -1439,7 +1505,7 @@ class ChatWindow(QMainWindow):
                 content = m.get("content") or ""
 
                 if msg_type == "image":
-                    img_path = images_dir / content
+                    img_path = locate_attachment("image", content)
                     self.chat_list.add_image_bubble(
                         mid,
                         sender,
@@ -1447,7 +1513,7 @@ class ChatWindow(QMainWindow):
                         str(img_path),
                     )
                 elif msg_type == "video":
-                    vpath = videos_dir / content
+                    vpath = locate_attachment("video", content)
                     self.chat_list.add_video_bubble(
                         mid,
                         sender,
@@ -1455,7 +1521,7 @@ class ChatWindow(QMainWindow):
                         str(vpath),
                     )
                 elif msg_type == "file":
-                    fpath = files_dir / content
+                    fpath = locate_attachment("file", content)
                     self.chat_list.add_file_bubble(
                         mid,
                         sender,
@@ -1471,6 +1537,11 @@ class ChatWindow(QMainWindow):
                         content,
                     )
 
+            if is_older_page:
+                self.chat_list.end_prepend(bool(data.get("has_more")))
+                return
+            self.chat_list.has_more_history = bool(data.get("has_more"))
+
             self.lbl_chat_status.setText(f"✅ Đã tải {len(msgs)} tin nhắn với {partner}")
             self.request_conversations()
 
@@ -1514,6 +1585,7 @@ class ChatWindow(QMainWindow):
 
             self.conversations = data.get("items", []) or []
             self._user_avatar_cache.clear()
+            self._apply_avatar_blobs()
             if hasattr(self.sidebar, "set_conversations"):
                 self.sidebar.set_conversations(self.conversations)
 
@@ -1600,11 +1672,6 @@ class ChatWindow(QMainWindow):
                     empty_text = "Chưa có link nào."
                 self.list_attachments.addItem(empty_text)
             else:
-                base_dir = Path(__file__).resolve().parents[1]
-                images_dir = base_dir / "server" / "storage" / "images"
-                videos_dir = base_dir / "server" / "storage" / "videos"
-                files_dir  = base_dir / "server" / "storage" / "files"
-
                 for m in items:
                     msg_id = m.get("id")
                     created_at = m.get("created_at") or ""
@@ -1625,11 +1692,11 @@ class ChatWindow(QMainWindow):
 
                     path = None
                     if msg_type == "image":
-                        path = str(images_dir / content)
+                        path = str(locate_attachment("image", content))
                     elif msg_type == "video":
-                        path = str(videos_dir / content)
+                        path = str(locate_attachment("video", content))
                     elif msg_type == "file":
-                        path = str(files_dir / content)
+                        path = str(locate_attachment("file", content))
                     elif filter_kind == "links":
                         link_url = self._extract_first_url(content) or content
                         if not link_url:
@@ -1670,10 +1737,31 @@ class ChatWindow(QMainWindow):
                     "❌ Xóa đoạn chat thất bại: " + str(data.get("error"))
                 )
 
+        elif action == "avatars_result":
+            items = data.get("items") or {}
+            if int(data.get("size") or 0) == 0:
+                # ảnh gốc: chỉ dùng cho avatar của chính mình
+                b64 = items.get(self.main_avatar_hash) if self.main_avatar_hash else None
+                if b64:
+                    self._set_current_user_avatar_from_b64(b64)
+                return
+
+            self._avatar_blobs.update(items)
+            if not items:
+                return
+            self._apply_avatar_blobs()
+            self._user_avatar_cache.clear()
+            if hasattr(self.sidebar, "set_conversations"):
+                self.sidebar.set_conversations(self.conversations)
+            if self.current_group_id:
+                self._update_group_info_panel(self.current_group_id)
+            else:
+                self._update_info_panel(self.current_partner_username)
+
         elif action == "update_avatar_result":
             if data.get("ok"):
-                avatar_b64 = data.get("avatar_b64")
-                self._set_current_user_avatar_from_b64(avatar_b64)
+                # ảnh đã preview lúc chọn file, chỉ cần nhớ hash mới
+                self.main_avatar_hash = data.get("avatar_hash")
                 self.lbl_auth_status.setText("✅ Cập nhật avatar thành công")
             else:
                 self.lbl_auth_status.setText(
@@ -1683,18 +1771,24 @@ class ChatWindow(QMainWindow):
         elif action == "avatar_changed":
             # Khi bất kỳ user nào đổi avatar
             uname = data.get("username")
-            avatar_b64 = data.get("avatar_b64")
+            avatar_hash = data.get("avatar_hash")
             if not uname:
                 return
 
             # Cập nhật trong danh sách conversation
             for conv in self.conversations:
                 if conv.get("partner_username") == uname:
-                    conv["avatar_b64"] = avatar_b64
+                    conv["avatar_hash"] = avatar_hash
+            self._apply_avatar_blobs()
+            self._user_avatar_cache.clear()
 
-            # Nếu chính mình
-            if uname == self.current_username:
-                self._set_current_user_avatar_from_b64(avatar_b64)
+            # Nếu chính mình (đổi từ máy khác)
+            if uname == self.current_username and avatar_hash != self.main_avatar_hash:
+                self.main_avatar_hash = avatar_hash
+                if avatar_hash:
+                    self._request_avatars([avatar_hash], size=0)
+                else:
+                    self._set_current_user_avatar_from_b64(None)
 
             # Nếu đang mở đoạn chat với user đó
             if self.current_partner_username == uname:
@@ -259,9 +259,11 @@ class MessageList(QListWidget):
     Danh sách tin nhắn.
     Chuột phải -> menu "Gỡ tin nhắn này".
     Double click vào bubble file / video / ảnh -> emit signal cho ChatWindow xử lý.
+    Cuộn lên đầu danh sách -> emit load_more_requested(id tin cũ nhất) để tải trang cũ hơn.
     """
-    delete_requested = pyqtSignal(int)           # message_id
+    delete_requested = pyqtSignal(object)        # message_id (Snowflake 64 bit)
     attachment_open_requested = pyqtSignal(str, str)  # path, kind: image/video/file
+    load_more_requested = pyqtSignal(object)     # before_id
 
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -273,6 +275,69 @@ class MessageList(QListWidget):
 
         self.itemDoubleClicked.connect(self._on_item_double_clicked)
 
+        # phân trang lịch sử
+        self.has_more_history = False
+        self._loading_more = False
+        self._prepend_row: int | None = None
+        self.verticalScrollBar().valueChanged.connect(self._on_scroll_changed)
+
+    # ---- Phân trang: chèn trang cũ hơn lên đầu ----
+
+    def clear(self):
+        super().clear()
+        self.has_more_history = False
+        self._loading_more = False
+        self._prepend_row = None
+
+    def begin_prepend(self):
+        """
+        Các add_*_bubble sau lời gọi này sẽ được chèn lên đầu list
+        (theo đúng thứ tự gọi) thay vì nối vào cuối.
+        """
+        self._prepend_row = 0
+
+    def end_prepend(self, has_more: bool):
+        inserted = self._prepend_row or 0
+        self._prepend_row = None
+        self._loading_more = False
+        self.has_more_history = has_more
+        # giữ nguyên tin đang xem ở đầu khung sau khi chèn thêm tin cũ phía trên
+        anchor = self.item(inserted)
+        if inserted and anchor is not None:
+            self.scrollToItem(anchor, QAbstractItemView.ScrollHint.PositionAtTop)
+
+    def finish_loading_more(self):
+        """Đã có phản hồi (lỗi / chat đã đổi / gửi không được): cho phép xin trang cũ lần nữa."""
+        self._loading_more = False
+
+    def oldest_message_id(self) -> int | None:
+        for idx in range(self.count()):
+            data = self.item(idx).data(Qt.ItemDataRole.UserRole) or {}
+            if data.get("id") is not None:
+                return data["id"]
+        return None
+
+    def _place_item(self, item: QListWidgetItem, widget: QWidget):
+        if self._prepend_row is not None:
+            self.insertItem(self._prepend_row, item)
+            self._prepend_row += 1
+            self.setItemWidget(item, widget)
+            return
+        self.addItem(item)
+        self.setItemWidget(item, widget)
+        self.scrollToBottom()
+
+    def _on_scroll_changed(self, value: int):
+        if value != self.verticalScrollBar().minimum():
+            return
+        if not self.has_more_history or self._loading_more:
+            return
+        before_id = self.oldest_message_id()
+        if before_id is None:
+            return
+        self._loading_more = True
+        self.load_more_requested.emit(before_id)
+
     # ---- Thêm bubble các loại ----
 
     def add_bubble(
@@ -295,7 +360,7 @@ class MessageList(QListWidget):
         if is_group and not is_me:
             widget = _wrap_group_bubble(base_widget, sender_username, avatar_pix)
 
-        item = QListWidgetItem(self)
+        item = QListWidgetItem()
         item.setSizeHint(widget.sizeHint())
         item.setData(Qt.ItemDataRole.UserRole, {
             "id": msg_id,
@@ -305,9 +370,7 @@ class MessageList(QListWidget):
             "path": None,
             "content": content,
         })
-        self.addItem(item)
-        self.setItemWidget(item, widget)
-        self.scrollToBottom()
+        self._place_item(item, widget)
 
 
     def add_image_bubble(
@@ -328,7 +391,7 @@ class MessageList(QListWidget):
         if is_group and not is_me:
              widget = _wrap_group_bubble(base_widget, sender_username, avatar_pix)
 
-        item = QListWidgetItem(self)
+        item = QListWidgetItem()
         item.setSizeHint(widget.sizeHint())
         item.setData(Qt.ItemDataRole.UserRole, {
             "id": msg_id,
@@ -338,9 +401,7 @@ class MessageList(QListWidget):
             "path": image_path,
             "content": image_path,
         })
-        self.addItem(item)
-        self.setItemWidget(item, widget)
-        self.scrollToBottom()
+        self._place_item(item, widget)
 
 
     def add_file_bubble(
@@ -360,7 +421,7 @@ class MessageList(QListWidget):
         if is_group and not is_me:
             widget = _wrap_group_bubble(base_widget, sender_username, avatar_pix)
 
-        item = QListWidgetItem(self)
+        item = QListWidgetItem()
         item.setSizeHint(widget.sizeHint())
         item.setData(Qt.ItemDataRole.UserRole, {
             "id": msg_id,
@@ -370,9 +431,7 @@ class MessageList(QListWidget):
             "path": file_path,
             "content": file_path,
         })
-        self.addItem(item)
-        self.setItemWidget(item, widget)
-        self.scrollToBottom()
+        self._place_item(item, widget)
 
 
     def add_video_bubble(
@@ -392,7 +451,7 @@ class MessageList(QListWidget):
         if is_group and not is_me:
             widget = _wrap_group_bubble(base_widget, sender_username, avatar_pix)
 
-        item = QListWidgetItem(self)
+        item = QListWidgetItem()
         item.setSizeHint(widget.sizeHint())
         item.setData(Qt.ItemDataRole.UserRole, {
             "id": msg_id,
@@ -402,9 +461,7 @@ class MessageList(QListWidget):
             "path": file_path,
             "content": file_path,
         })
-        self.addItem(item)
-        self.setItemWidget(item, widget)
-        self.scrollToBottom()
+        self._place_item(item, widget)
 
 
     # ---- Chuột phải: gỡ tin ----
@@ -120,7 +120,7 @@ class ConversationSidebar(QWidget):
     def _get_avatar_for_conv(self, conv: dict) -> QPixmap | None:
         """
         Trả về avatar tròn 32x32 cho 1 convo (user hoặc group).
-        - Nếu có avatar_b64 -> decode + bo tròn.
+        - Nếu có avatar_b64 (đã tải theo avatar_hash) -> decode + bo tròn, cache theo hash.
         - Nếu không có -> dùng default_avatar nhưng vẫn bo tròn.
         """
         size = 32
@@ -152,8 +152,9 @@ class ConversationSidebar(QWidget):
                 return make_round(self._default_avatar)
             return None
 
-        if b64 in self._avatar_cache:
-            return self._avatar_cache[b64]
+        key = conv.get("avatar_hash") or b64
+        if key in self._avatar_cache:
+            return self._avatar_cache[key]
 
         try:
             raw = base64.b64decode(b64)
@@ -163,7 +164,7 @@ class ConversationSidebar(QWidget):
                 return make_round(self._default_avatar)
 
             rounded = make_round(pix)
-            self._avatar_cache[b64] = rounded
+            self._avatar_cache[key] = rounded
             return rounded
         except Exception:
             return make_round(self._default_avatar)
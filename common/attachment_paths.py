@@ -0,0 +1,81 @@
+# common/attachment_paths.py
+#
+# Đường dẫn file đính kèm (ảnh / video / file) suy ra từ 1 dòng messages:
+# content của tin ảnh / video / file chỉ là tên file. Dùng chung cho server
+# (server/attachments.py: upload, xóa, GC, migrate) và client (đọc file khi
+# chạy cùng máy với server) - client không import gì từ server/.
+#
+# Bố cục chia 2 tầng theo md5 của tên file để mỗi thư mục chỉ vài nghìn file:
+#   server/storage/images/3f/a2/1_2_anh.jpg
+# Bản cũ để phẳng (storage/images/1_2_anh.jpg), được chuyển dần sang bố cục
+# mới; trong lúc chuyển locate_attachment() tìm cả 2 chỗ.
+
+import hashlib
+import os
+from pathlib import Path
+
+from common.config import STORAGE_DIR as _STORAGE_DIR
+
+STORAGE_DIR = Path(_STORAGE_DIR)
+IMAGES_DIR = STORAGE_DIR / "images"
+VIDEOS_DIR = STORAGE_DIR / "videos"
+FILES_DIR = STORAGE_DIR / "files"
+
+# msg_type -> thư mục chứa file
+ATTACHMENT_DIRS = {
+    "image": IMAGES_DIR,
+    "photo": IMAGES_DIR,
+    "video": VIDEOS_DIR,
+    "file": FILES_DIR,
+    "document": FILES_DIR,
+}
+
+FANOUT_LEVELS = 2           # số tầng thư mục con, mỗi tầng 2 ký tự hex (256 nhánh)
+
+
+def fanout(name: str) -> Path:
+    """Thư mục con (tương đối) của 1 tên file, vd. Path("3f/a2")."""
+    digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+    return Path(*(digest[2 * i:2 * i + 2] for i in range(FANOUT_LEVELS)))
+
+
+def _folder(msg_type: str | None, content: str | None) -> Path | None:
+    folder = ATTACHMENT_DIRS.get((msg_type or "").lower())
+    if folder is None or not content or os.path.basename(content) != content:
+        return None
+    return folder
+
+
+def attachment_path(msg_type: str | None, content: str | None) -> Path | None:
+    """
+    Đường dẫn (bố cục mới) của file kèm tin; None nếu tin không kèm file
+    (hoặc content không phải tên file). Dùng để ghi file mới.
+    """
+    folder = _folder(msg_type, content)
+    if folder is None:
+        return None
+    return folder / fanout(content) / content
+
+
+def attachment_locations(msg_type: str | None, content: str | None) -> list[Path]:
+    """Mọi chỗ file có thể đang nằm: [bố cục mới, thư mục phẳng cũ]."""
+    folder = _folder(msg_type, content)
+    if folder is None:
+        return []
+    return [folder / fanout(content) / content, folder / content]
+
+
+def locate_attachment(msg_type: str | None, content: str | None) -> Path | None:
+    """
+    Đường dẫn file đang tồn tại để đọc. Chưa chuyển thì nằm ở thư mục phẳng;
+    thử lại bố cục mới lần cuối phòng khi file vừa được chuyển giữa 2 lần kiểm tra.
+    Không thấy đâu -> trả về đường dẫn bố cục mới (caller tự báo thiếu file).
+    """
+    locations = attachment_locations(msg_type, content)
+    if not locations:
+        return None
+    new, flat = locations
+    for path in (new, flat, new):
+        if path.exists():
+            return path
+    return new
@@ -1,5 +1,7 @@
 # common/config.py
 
+import os
+
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 5555
 
@@ -23,7 +25,186 @@ DB_NODES = [
     }
 ]
 
+# Backend lưu trữ (server/storage_backend.py): "mysql" (pymysql, DB_NODES ở trên)
+# hoặc "sqlite" (sqlite3 stdlib, mỗi node 1 file trong SQLITE_DB_DIR - chạy nhúng / CI / benchmark)
+DB_BACKEND = os.environ.get("CHAT_DB_BACKEND", "mysql")
+SQLITE_DB_DIR = os.environ.get("CHAT_SQLITE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server", "sqlite"
+)
+SQLITE_BUSY_TIMEOUT_S = 5.0         # chờ lock ghi của SQLite tối đa (giây)
+
+# Bản đồ shard (consistent hashing + virtual node), lưu ở file JSON và
+# tự nạp lại khi file đổi. Xem common/shard_map.py và server/shard_tool.py.
+# CHAT_SHARD_MAP / CHAT_JOURNAL_DIR / CHAT_ARCHIVE_DIR / CHAT_STORAGE_DIR / CHAT_LOG_DIR
+# đổi chỗ các file do server ghi (vd. test trỏ vào thư mục tạm, không đụng cây repo)
+SHARD_MAP_PATH = os.environ.get("CHAT_SHARD_MAP") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "shard_map.json"
+)
+SHARD_MAP_RELOAD_S = 2.0
+SHARD_VNODES = 128
+# Khi chưa có file shard map: "modulo" (mặc định) giữ nguyên vị trí dữ liệu
+# của cụm đang chạy (chia % như trước). "consistent" chỉ dùng cho cụm MỚI chưa
+# có tin nào (CHAT_SHARD_BOOTSTRAP=consistent); cụm cũ muốn chuyển sang thì dùng
+#   python -m server.shard_tool plan|apply --strategy consistent
+# (ghim conversation cũ tại chỗ rồi mới đổi, xem server/shard_tool.py).
+SHARD_BOOTSTRAP_STRATEGY = os.environ.get("CHAT_SHARD_BOOTSTRAP", "modulo")
+
+_shard_store = None
+
+
+def get_shard_store():
+    global _shard_store
+    if _shard_store is None:
+        from common.shard_map import ShardMap, ShardMapStore
+        _shard_store = ShardMapStore(
+            SHARD_MAP_PATH,
+            lambda: ShardMap(
+                [n["name"] for n in DB_NODES],
+                version=1,
+                strategy=SHARD_BOOTSTRAP_STRATEGY,
+                vnodes=SHARD_VNODES,
+            ),
+            reload_interval=SHARD_MAP_RELOAD_S,
+        )
+    return _shard_store
+
+
+def get_node_by_name(name: str):
+    for node in DB_NODES:
+        if node["name"] == name:
+            return node
+    raise KeyError(f"Không có node '{name}' trong DB_NODES")
+
+
 # Hàm chọn node dựa trên conversation_id (sharding logic)
 def select_node_for_conversation(conversation_id: int):
-    idx = conversation_id % len(DB_NODES)
-    return DB_NODES[idx]
+    name = get_shard_store().get().node_for(conversation_id)
+    return get_node_by_name(name)
+
+# Message id kiểu Snowflake (server/id_generator.py).
+# Mỗi tiến trình server PHẢI có SERVER_WORKER_ID riêng (0..1023).
+SERVER_WORKER_ID = int(os.environ.get("CHAT_WORKER_ID", "1"))
+ID_EPOCH_MS = 1704067200000         # 2024-01-01 00:00:00 UTC
+
+# Gom nhiều insert_message trên cùng node thành 1 transaction (group commit).
+# Tắt mặc định; bật khi nhóm chat đông khiến MySQL bị nghẽn vì fsync mỗi tin.
+MESSAGE_BATCH_ENABLED = False
+MESSAGE_BATCH_MAX_SIZE = 100        # số tin tối đa trong 1 batch
+MESSAGE_BATCH_MAX_DELAY_MS = 5      # thời gian chờ gom tối đa (ms)
+
+# Thời gian chờ tối đa cho 1 node khi đọc/ghi song song trên nhiều node (giây)
+DB_NODE_TIMEOUT_S = 3.0
+DB_CONNECT_TIMEOUT_S = 3
+
+# Health check + circuit breaker cho từng node DB (server/node_health.py)
+HEALTH_PROBE_INTERVAL_S = 2.0
+HEALTH_PROBE_TIMEOUT_S = 1
+HEALTH_FAILURE_THRESHOLD = 2        # số lần lỗi kết nối liên tiếp trước khi ngắt node
+HEALTH_RETRY_S = 5.0                # (không có thread probe) thử lại node bị ngắt sau ... giây
+# Ghi vào shard đang lỗi được lưu tạm ở đây, replay khi node sống lại
+WRITE_JOURNAL_DIR = os.environ.get("CHAT_JOURNAL_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server", "journal"
+)
+
+# Ring buffer tin nhắn mới nhất trong RAM (server/message_cache.py).
+# Mặc định TẮT: chỉ đúng khi 1 tiến trình server phục vụ toàn bộ lệnh ghi
+# (tin ghi qua tiến trình khác / sửa tay trong DB sẽ không thấy). Triển khai
+# 1 tiến trình thì bật bằng CHAT_HISTORY_CACHE=1 (bật cả cache trang bên dưới).
+_HISTORY_CACHE_OPT_IN = os.environ.get("CHAT_HISTORY_CACHE", "0") == "1"
+HISTORY_RING_ENABLED = _HISTORY_CACHE_OPT_IN
+HISTORY_RING_SIZE = 256                     # số tin tối đa giữ cho mỗi conversation
+HISTORY_CACHE_MAX_BYTES = 64 * 1024 * 1024  # tổng dung lượng ước lượng (tin + username), vượt thì bỏ theo LRU
+# Cache trang lịch sử đã encode JSON sẵn (server/payload_cache.py), cùng điều kiện như trên
+HISTORY_PAYLOAD_CACHE_ENABLED = _HISTORY_CACHE_OPT_IN
+HISTORY_PAYLOAD_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Archive tin cũ sang segment nén trên đĩa (server/message_archive.py);
+# lịch sử cuộn qua mốc archive thì tự đọc tiếp từ segment.
+# Mặc định TẮT: segment + danh sách segment / tombstone trong RAM nằm trên đĩa
+# local của 1 máy server -> tiến trình / máy khác không thấy lịch sử đã archive
+# (và GC file đính kèm chạy ở máy khác coi file của các tin đó là mồ côi).
+# Chỉ bật bằng CHAT_ARCHIVE=1 khi 1 tiến trình server duy nhất chạy cả GC.
+# Tắt sau khi đã archive: segment cũ vẫn được đọc (chỉ đọc), archiver không chạy.
+ARCHIVE_ENABLED = os.environ.get("CHAT_ARCHIVE", "0") == "1"
+ARCHIVE_AFTER_DAYS = 180            # tin cũ hơn ... ngày thì chuyển khỏi bảng messages
+ARCHIVE_DIR = os.environ.get("CHAT_ARCHIVE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server", "archive"
+)
+ARCHIVE_BLOCK_ROWS = 256            # số tin / block nén (đơn vị của sparse index)
+ARCHIVE_BATCH_ROWS = 2000           # số tin tối đa / segment / lần đọc DB
+ARCHIVE_INTERVAL_S = 3600.0         # chu kỳ chạy archiver nền
+
+# Tìm kiếm tin nhắn (FULLTEXT trên từng shard, gộp kết quả theo thời gian)
+MESSAGE_SEARCH_TIMEOUT_S = 1.5      # chờ tối đa mỗi shard; shard chậm hơn thì trả kết quả thiếu
+MESSAGE_SEARCH_MAX_RESULTS = 50
+MESSAGE_SEARCH_FT_MIN_TOKEN = 3     # = innodb_ft_min_token_size; từ ngắn hơn thì dùng LIKE
+
+# Index tìm user trong RAM (server/user_index.py): nạp lúc khởi động,
+# định kỳ lấy thêm user mới do tiến trình server khác tạo
+USER_INDEX_REFRESH_S = 30.0
+
+# Thư mục file upload: đính kèm (common/attachment_paths.py), avatar, avatar nhóm
+STORAGE_DIR = os.environ.get("CHAT_STORAGE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server", "storage"
+)
+
+# Kho avatar theo hash nội dung (server/avatar_store.py); DB chỉ giữ hash
+AVATAR_DIR = os.path.join(STORAGE_DIR, "avatars")
+AVATAR_VARIANT_SIZES = (32, 64)             # bản thu nhỏ dựng sẵn (cần Pillow)
+AVATAR_CACHE_MAX_BYTES = 8 * 1024 * 1024    # base64 avatar giữ trong RAM
+AVATAR_FETCH_MAX = 200                      # số hash tối đa trong 1 lệnh get_avatars
+
+# Đo thời gian từng câu SQL theo hàm db_access (server/query_stats.py)
+QUERY_STATS_ENABLED = True
+SLOW_QUERY_MS = 200                 # chậm hơn ngưỡng này -> ghi slow log
+SLOW_QUERY_LOG_PATH = os.path.join(
+    os.environ.get("CHAT_LOG_DIR") or os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server", "logs"
+    ),
+    "slow_queries.jsonl",
+)
+SLOW_QUERY_TOP_N = 20               # admin_slow_queries trả mặc định bao nhiêu câu
+
+# Chuyển conversation giữa các node (server/shard_migrate.py)
+MIGRATE_BATCH_SIZE = 500
+MIGRATE_MAX_ROWS_PER_S = 2000       # giới hạn tốc độ copy/xóa để không ảnh hưởng traffic
+
+# Hàng đợi việc nền trên primary (server/job_queue.py): xóa tin của nhóm /
+# đoạn chat đã xóa, xóa tin của user bị ban
+JOB_WORKERS = 2
+JOB_POLL_S = 2.0
+JOB_LEASE_S = 60                    # worker không báo tiến độ quá lâu -> job được nhận lại
+JOB_MAX_ATTEMPTS = 5
+JOB_KEEP_FINISHED_S = 7 * 24 * 3600  # giữ job xong / lỗi để admin xem
+JOB_DELETE_CHUNK = 500              # số tin xóa mỗi chunk
+JOB_CHUNK_PAUSE_S = 0.05            # nghỉ giữa 2 chunk để không giữ lock / I/O liên tục
+
+# Export / import 1 conversation ra file .jsonl.gz (server/conversation_export.py)
+EXPORT_BATCH_ROWS = 1000            # số dòng đọc / ghi mỗi lần
+EXPORT_BLOB_CHUNK_BYTES = 192 * 1024  # file đính kèm chia thành các dòng base64 cỡ này
+
+# Dọn file đính kèm không còn tin nào trỏ tới (server/attachment_gc.py)
+ATTACHMENT_GC_BATCH = 1000          # số tin đọc / số file xét mỗi lô
+ATTACHMENT_GC_MAX_ROWS_PER_S = 5000  # tốc độ đọc messages lúc đánh dấu
+ATTACHMENT_GC_MAX_FILES_PER_S = 500  # tốc độ stat / xóa file lúc quét thư mục
+ATTACHMENT_GC_MIN_AGE_S = 3600      # file mới hơn ngần này không xóa (upload chưa kịp insert tin)
+# chuyển file đính kèm từ thư mục phẳng sang bố cục chia thư mục (server/attachments.py)
+ATTACHMENT_LAYOUT_MIGRATE_FILES_PER_S = 200
+
+# Pool thread ghi file upload (server/disk_writer.py)
+UPLOAD_WRITER_WORKERS = 4
+UPLOAD_FSYNC_POLICY = os.environ.get("CHAT_UPLOAD_FSYNC", "batch")  # "none" | "file" | "batch"
+UPLOAD_FSYNC_BATCH_MS = 10.0        # "batch": chờ tối đa ngần này để gom file vào 1 lô fsync
+UPLOAD_FSYNC_BATCH_MAX = 32         # "batch": số file tối đa / lô
+UPLOAD_WRITER_QUEUE = 256           # hàng đợi đầy -> upload mới phải chờ (đĩa đang chậm)
+UPLOAD_COMPLETION_WORKERS = 4       # thread lưu tin + phản hồi sau khi file upload đã ghi xong
+
+# Replicate bảng users qua outbox (server/replication.py)
+REPLICATION_POLL_S = 1.0
+REPLICATION_MAX_BACKOFF_S = 60
+# id outbox (AUTO_INCREMENT) cấp lúc INSERT nhưng commit có thể lệch thứ tự:
+# watermark read-your-writes chỉ tiến tới dòng đã cũ hơn ngần này (giây),
+# coi như mọi transaction cấp id trước nó đã commit xong
+REPLICATION_COMMIT_SAFETY_S = 0.5
+# Replica chỉ được dùng để đọc nếu relay đã bắt kịp trong khoảng này (giây)
+READ_REPLICA_MAX_LAG_S = 5.0
@@ -0,0 +1,192 @@
+# common/shard_map.py
+#
+# Bản đồ shard: conversation_id -> tên node DB.
+# Dùng consistent hashing với virtual node để khi thêm/bớt node chỉ
+# ~1/N số conversation phải chuyển chỗ (thay vì ~2/3 như chia modulo).
+# Bản đồ có version, lưu ra file JSON và tự nạp lại khi file thay đổi.
+
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class ShardMap:
+    """
+    strategy:
+      - "consistent": vòng hash, mỗi node có `vnodes` điểm trên vòng
+      - "modulo":     cách cũ conversation_id % len(nodes), giữ cho dữ liệu cũ
+    Tra cứu O(log n) bằng bisect trên vòng đã sort.
+
+    overrides: {conversation_id: node} ghim riêng 1 conversation vào 1 node
+               (dùng khi đổi topology / sau khi migrate).
+    migrating: {conversation_id: node} conversation đang được chuyển, server
+               ghi kép (dual-write) sang node này: node đích trước cutover,
+               node nguồn sau cutover (cho tới khi mọi server nạp map mới).
+    """
+
+    def __init__(self, nodes: list[str], version: int = 1,
+                 strategy: str = "consistent", vnodes: int = 128,
+                 overrides: dict[int, str] | None = None,
+                 migrating: dict[int, str] | None = None):
+        if not nodes:
+            raise ValueError("ShardMap cần ít nhất 1 node")
+        if strategy not in ("consistent", "modulo"):
+            raise ValueError(f"strategy không hợp lệ: {strategy}")
+        self.nodes = list(nodes)
+        self.version = int(version)
+        self.strategy = strategy
+        self.vnodes = int(vnodes)
+        self.overrides = {int(k): v for k, v in (overrides or {}).items()}
+        self.migrating = {int(k): v for k, v in (migrating or {}).items()}
+
+        ring = []
+        if strategy == "consistent":
+            for name in self.nodes:
+                for i in range(self.vnodes):
+                    ring.append((_hash(f"{name}#{i}"), name))
+            ring.sort()
+        self._ring_keys = [h for h, _ in ring]
+        self._ring_nodes = [n for _, n in ring]
+
+    def node_for(self, conversation_id: int) -> str:
+        pinned = self.overrides.get(conversation_id)
+        if pinned is not None:
+            return pinned
+        return self.ring_node_for(conversation_id)
+
+    def ring_node_for(self, conversation_id: int) -> str:
+        """Node theo hash / modulo, bỏ qua overrides."""
+        if self.strategy == "modulo":
+            return self.nodes[conversation_id % len(self.nodes)]
+        idx = bisect.bisect(self._ring_keys, _hash(str(conversation_id)))
+        if idx == len(self._ring_keys):
+            idx = 0
+        return self._ring_nodes[idx]
+
+    def migration_target(self, conversation_id: int) -> str | None:
+        return self.migrating.get(conversation_id)
+
+    def next_version(self, **changes) -> "ShardMap":
+        """Tạo bản đồ version kế tiếp, thay các field trong `changes`."""
+        data = self.to_dict()
+        data.update(changes)
+        data["version"] = self.version + 1
+        return ShardMap.from_dict(data)
+
+    # ---------- persist ----------
+
+    def to_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "strategy": self.strategy,
+            "vnodes": self.vnodes,
+            "nodes": self.nodes,
+            "overrides": {str(k): v for k, v in sorted(self.overrides.items())},
+            "migrating": {str(k): v for k, v in sorted(self.migrating.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ShardMap":
+        return cls(
+            nodes=data["nodes"],
+            version=data.get("version", 1),
+            strategy=data.get("strategy", "consistent"),
+            vnodes=data.get("vnodes", 128),
+            overrides=data.get("overrides"),
+            migrating=data.get("migrating"),
+        )
+
+    def save(self, path: str):
+        """
+        Ghi ra file tạm rồi os.replace để tiến trình khác không đọc phải file dở.
+        Tên tạm riêng cho mỗi lần ghi (nhiều tiến trình / thread cùng save).
+        """
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "ShardMap":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+class ShardMapStore:
+    """
+    Giữ ShardMap hiện hành, kiểm tra mtime file tối đa mỗi `reload_interval`
+    giây và nạp lại nếu có version mới (hot reload, không cần restart server).
+    """
+
+    def __init__(self, path: str, default_factory, reload_interval: float = 2.0):
+        self.path = path
+        self._default_factory = default_factory
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._map: ShardMap | None = None
+        self._mtime: float | None = None
+        self._checked_at = 0.0
+
+    def get(self) -> ShardMap:
+        now = time.monotonic()
+        if self._map is not None and now - self._checked_at < self.reload_interval:
+            return self._map
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                mtime = None
+
+            if mtime is None:
+                if self._map is None:
+                    self._map = self._default_factory()
+                    try:
+                        self._map.save(self.path)
+                        self._mtime = os.path.getmtime(self.path)
+                    except OSError as e:
+                        print(f"[SHARD] Không ghi được shard map: {e}")
+                return self._map
+
+            if mtime != self._mtime:
+                try:
+                    new_map = ShardMap.load(self.path)
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"[SHARD] Shard map lỗi, giữ bản cũ: {e}")
+                    if self._map is None:
+                        self._map = self._default_factory()
+                    return self._map
+                if self._map is None or new_map.version >= self._map.version:
+                    if self._map is not None and new_map.version != self._map.version:
+                        print(f"[SHARD] Nạp shard map v{new_map.version}")
+                    self._map = new_map
+                self._mtime = mtime
+            return self._map
+
+    def publish(self, new_map: ShardMap):
+        """Lưu bản đồ mới (version phải tăng) và dùng ngay."""
+        self.get()
+        with self._lock:
+            if self._map is not None and new_map.version <= self._map.version:
+                raise ValueError(
+                    f"version mới ({new_map.version}) phải lớn hơn v{self._map.version}"
+                )
+            new_map.save(self.path)
+            self._map = new_map
+            self._mtime = os.path.getmtime(self.path)
+            self._checked_at = time.monotonic()
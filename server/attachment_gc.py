@@ -0,0 +1,238 @@
+# server/attachment_gc.py
+#
+# Dọn file đính kèm "mồ côi" trong storage/images|videos|files: file không còn
+# tin nào trỏ tới (tin bị xóa trước khi có job xóa nền, upload ghi đè tên,
+# import dở dang...). Mark-and-sweep chạy dần:
+#   1. mark:  đọc theo lô mọi tin kèm file trên mọi node + archive
+#             (db_access.iter_attachment_refs) -> tập đường dẫn đang được dùng
+#   2. sweep: duyệt thư mục theo lô, file không có trong tập và cũ hơn
+#             ATTACHMENT_GC_MIN_AGE_S là mồ côi
+# Cả 2 bước đều giới hạn tốc độ (dòng / file mỗi giây) để không tranh I/O với
+# server. Mặc định chỉ báo cáo (dry run), --delete mới xóa thật:
+#   python -m server.attachment_gc              (báo số file / bytes thu hồi được)
+#   python -m server.attachment_gc --delete
+# Admin cũng có thể chạy qua job nền (action admin_attachment_gc).
+#
+# Tập đánh dấu là set tên đầy đủ (chính xác, không dương tính giả như Bloom
+# filter): ~100 bytes / file, vài triệu file vẫn vừa RAM.
+# File upload sau lúc bắt đầu mark có mtime mới -> luôn được giữ lại. Không
+# chạy khi có conversation đang migrate (tin có thể nằm ở node chưa quét).
+
+import argparse
+import os
+import time
+
+from common.config import (
+    get_shard_store,
+    ATTACHMENT_GC_BATCH,
+    ATTACHMENT_GC_MAX_ROWS_PER_S,
+    ATTACHMENT_GC_MAX_FILES_PER_S,
+    ATTACHMENT_GC_MIN_AGE_S,
+)
+from server.attachments import ATTACHMENT_DIRS, attachment_locations
+from server.db_access import iter_attachment_refs, job_queue
+
+SAMPLE_SIZE = 20            # số file mồ côi liệt kê trong báo cáo dry run
+
+
+class AttachmentGCError(Exception):
+    pass
+
+
+class AttachmentGC:
+    def __init__(self, dry_run: bool = True,
+                 batch_size: int = ATTACHMENT_GC_BATCH,
+                 max_rows_per_sec: float = ATTACHMENT_GC_MAX_ROWS_PER_S,
+                 max_files_per_sec: float = ATTACHMENT_GC_MAX_FILES_PER_S,
+                 min_age_s: float = ATTACHMENT_GC_MIN_AGE_S,
+                 on_progress=None):
+        self.dry_run = dry_run
+        self.batch_size = max(1, batch_size)
+        self.max_rows_per_sec = max_rows_per_sec
+        self.max_files_per_sec = max_files_per_sec
+        self.min_age_s = min_age_s
+        self.on_progress = on_progress
+
+        self.progress = {
+            "phase": "init",
+            "dry_run": dry_run,
+            "rows_scanned": 0,
+            "referenced": 0,
+            "files_scanned": 0,
+            "orphans": 0,
+            "orphan_bytes": 0,
+            "deleted": 0,
+            "freed_bytes": 0,
+            "sample": [],
+        }
+
+    # ---------- tiện ích ----------
+
+    def _report(self):
+        p = self.progress
+        print(
+            f"[GC] {p['phase']}: {p['rows_scanned']} tin / {p['referenced']} file được dùng, "
+            f"đã xét {p['files_scanned']} file, mồ côi {p['orphans']} ({p['orphan_bytes']} bytes), "
+            f"đã xóa {p['deleted']} ({p['freed_bytes']} bytes)"
+        )
+        if self.on_progress is not None:
+            self.on_progress(dict(p))
+
+    @staticmethod
+    def _throttle(count: int, per_sec: float, batch_started: float):
+        if per_sec and per_sec > 0:
+            min_time = count / per_sec
+            spent = time.monotonic() - batch_started
+            if spent < min_time:
+                time.sleep(min_time - spent)
+
+    def _migrating(self) -> tuple[int, bool]:
+        shard_map = get_shard_store().get()
+        return shard_map.version, bool(shard_map.migrating)
+
+    # ---------- mark ----------
+
+    def mark(self) -> set[str]:
+        self.progress["phase"] = "mark"
+        referenced: set[str] = set()
+        started = time.monotonic()
+        for batch in iter_attachment_refs(self.batch_size):
+            for msg_type, content in batch:
+                # cả chỗ cũ (thư mục phẳng) lẫn mới: file có thể chưa được chuyển
+                referenced.update(str(p) for p in attachment_locations(msg_type, content))
+            self.progress["rows_scanned"] += len(batch)
+            self.progress["referenced"] = len(referenced) // 2     # 2 đường dẫn / file
+            self._report()
+            self._throttle(len(batch), self.max_rows_per_sec, started)
+            started = time.monotonic()
+        return referenced
+
+    # ---------- sweep ----------
+
+    @staticmethod
+    def _iter_files(root):
+        """Mọi file dưới root (kể cả thư mục con), không theo symlink."""
+        stack = [str(root)]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry
+            except FileNotFoundError:
+                continue
+
+    def _sweep_batch(self, entries, referenced: set[str], cutoff: float):
+        p = self.progress
+        for entry in entries:
+            if entry.path in referenced:
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if st.st_mtime > cutoff:
+                continue
+            p["orphans"] += 1
+            p["orphan_bytes"] += st.st_size
+            if len(p["sample"]) < SAMPLE_SIZE:
+                p["sample"].append(entry.path)
+            if self.dry_run:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            p["deleted"] += 1
+            p["freed_bytes"] += st.st_size
+
+    def sweep(self, referenced: set[str], cutoff: float):
+        self.progress["phase"] = "sweep"
+        for root in dict.fromkeys(ATTACHMENT_DIRS.values()):
+            batch = []
+            started = time.monotonic()
+            for entry in self._iter_files(root):
+                batch.append(entry)
+                if len(batch) < self.batch_size:
+                    continue
+                self._sweep_batch(batch, referenced, cutoff)
+                self.progress["files_scanned"] += len(batch)
+                self._report()
+                self._throttle(len(batch), self.max_files_per_sec, started)
+                batch = []
+                started = time.monotonic()
+            if batch:
+                self._sweep_batch(batch, referenced, cutoff)
+                self.progress["files_scanned"] += len(batch)
+                self._report()
+
+    # ---------- chạy ----------
+
+    def run(self) -> dict:
+        version, migrating = self._migrating()
+        if migrating:
+            raise AttachmentGCError("có conversation đang migrate, chạy lại sau")
+        # chốt mốc thời gian TRƯỚC khi mark: file ghi sau mốc này có thể chưa có tin
+        cutoff = time.time() - self.min_age_s
+        referenced = self.mark()
+        if self._migrating() != (version, False):
+            raise AttachmentGCError("shard map đổi trong lúc đánh dấu, chạy lại sau")
+        self.sweep(referenced, cutoff)
+        self.progress["phase"] = "done"
+        self._report()
+        return self.progress
+
+
+def _job_attachment_gc(job):
+    # chạy lại từ đầu khi job được nhận lại: mark-and-sweep vốn idempotent
+    gc = AttachmentGC(
+        dry_run=job.params.get("dry_run", True),
+        on_progress=lambda p: job.report(**p),
+    )
+    gc.run()
+
+
+job_queue.register("attachment_gc", _job_attachment_gc)
+
+
+def enqueue_attachment_gc(dry_run: bool = True) -> int:
+    """Chạy GC qua job nền, trả về id job (xem kết quả bằng admin_jobs)."""
+    return job_queue.enqueue("attachment_gc", {"dry_run": bool(dry_run)})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dọn file đính kèm không còn tin nào dùng")
+    parser.add_argument("--delete", action="store_true",
+                        help="xóa thật (mặc định chỉ báo cáo)")
+    parser.add_argument("--batch", type=int, default=ATTACHMENT_GC_BATCH)
+    parser.add_argument("--rows-rate", type=float, default=ATTACHMENT_GC_MAX_ROWS_PER_S,
+                        help="số tin đọc tối đa / giây (0 = không giới hạn)")
+    parser.add_argument("--files-rate", type=float, default=ATTACHMENT_GC_MAX_FILES_PER_S,
+                        help="số file xét tối đa / giây (0 = không giới hạn)")
+    parser.add_argument("--min-age", type=float, default=ATTACHMENT_GC_MIN_AGE_S,
+                        help="chỉ xóa file cũ hơn ... giây")
+    args = parser.parse_args(argv)
+
+    gc = AttachmentGC(
+        dry_run=not args.delete,
+        batch_size=args.batch,
+        max_rows_per_sec=args.rows_rate,
+        max_files_per_sec=args.files_rate,
+        min_age_s=args.min_age,
+    )
+    try:
+        result = gc.run()
+    except AttachmentGCError as e:
+        print(f"[GC] Dừng: {e}")
+        raise SystemExit(1)
+    for path in result["sample"]:
+        print(f"[GC]   {path}")
+    if gc.dry_run:
+        print(f"[GC] Dry run: thu hồi được {result['orphan_bytes']} bytes "
+              f"từ {result['orphans']} file (chạy lại với --delete để xóa)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# server/attachments.py
+#
+# File đính kèm (ảnh / video / file) phía server: upload, xóa, chuyển bố cục.
+# Cách suy ra đường dẫn từ 1 dòng messages nằm ở common/attachment_paths.py
+# (client dùng chung); server_main (upload, xóa tin), job xóa nền, GC và
+# export / import đều đi qua đây, không tự ghép đường dẫn.
+#
+# Bố cục chia 2 tầng theo md5 của tên file (storage/images/3f/a2/1_2_anh.jpg).
+# Bản cũ để phẳng (storage/images/1_2_anh.jpg); migrate_attachment_layout()
+# chạy nền lúc khởi động chuyển dần sang bố cục mới bằng os.replace (atomic,
+# cùng filesystem). Trong lúc chuyển, locate_attachment() tìm cả 2 chỗ.
+# Upload ghi qua save_attachment() -> pool ghi đĩa (server/disk_writer.py).
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+from common.attachment_paths import (
+    STORAGE_DIR,
+    IMAGES_DIR,
+    VIDEOS_DIR,
+    FILES_DIR,
+    ATTACHMENT_DIRS,
+    fanout,
+    attachment_path,
+    attachment_locations,
+    locate_attachment,
+)
+from common.config import (
+    ATTACHMENT_LAYOUT_MIGRATE_FILES_PER_S,
+    UPLOAD_WRITER_WORKERS,
+    UPLOAD_FSYNC_POLICY,
+    UPLOAD_FSYNC_BATCH_MS,
+    UPLOAD_FSYNC_BATCH_MAX,
+    UPLOAD_WRITER_QUEUE,
+)
+from server.disk_writer import DiskWriterPool
+
+
+def new_attachment_path(msg_type: str | None, content: str | None) -> Path | None:
+    """Như attachment_path nhưng tạo sẵn thư mục con (dùng khi upload)."""
+    path = attachment_path(msg_type, content)
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+_disk_writer: DiskWriterPool | None = None
+_disk_writer_lock = threading.Lock()
+
+
+def get_disk_writer() -> DiskWriterPool:
+    """Pool ghi file upload, tạo khi dùng lần đầu (client import module này không tạo thread)."""
+    global _disk_writer
+    with _disk_writer_lock:
+        if _disk_writer is None:
+            _disk_writer = DiskWriterPool(
+                workers=UPLOAD_WRITER_WORKERS,
+                fsync_policy=UPLOAD_FSYNC_POLICY,
+                batch_window_ms=UPLOAD_FSYNC_BATCH_MS,
+                batch_max=UPLOAD_FSYNC_BATCH_MAX,
+                max_queue=UPLOAD_WRITER_QUEUE,
+            )
+        return _disk_writer
+
+
+def save_attachment(msg_type: str | None, content: str | None, data: bytes) -> Future:
+    """
+    Ghi file upload vào chỗ của nó qua pool ghi đĩa. Trả về Future: insert tin
+    trong callback khi Future xong (server_main.SendOrder.then), không chặn
+    thread xử lý client. ValueError nếu tên file không hợp lệ.
+    """
+    path = new_attachment_path(msg_type, content)
+    if path is None:
+        raise ValueError("Tên file không hợp lệ")
+    return get_disk_writer().submit(path, data)
+
+
+def remove_attachment(msg_type: str | None, content: str | None) -> int:
+    """Xóa file của tin (nếu có), trả về số bytes đã giải phóng."""
+    # xóa bản phẳng trước: nếu migrate chuyển file ngay sau đó thì lần xóa
+    # bản mới phía sau vẫn bắt được
+    freed = 0
+    for path in reversed(attachment_locations(msg_type, content)):
+        try:
+            size = path.stat().st_size
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        freed += size
+    return freed
+
+
+def migrate_attachment_layout(max_files_per_sec: float = ATTACHMENT_LAYOUT_MIGRATE_FILES_PER_S) -> int:
+    """
+    Chuyển file còn nằm phẳng trong images / videos / files sang bố cục chia
+    thư mục. Server vẫn chạy bình thường trong lúc chuyển (đọc qua
+    locate_attachment). Chạy lại bao nhiêu lần cũng được; trả về số file đã chuyển.
+    """
+    moved = done = 0
+    started = time.monotonic()
+    for folder in dict.fromkeys(ATTACHMENT_DIRS.values()):
+        if not folder.is_dir():
+            continue
+        with os.scandir(folder) as it:
+            names = [e.name for e in it if e.is_file(follow_symlinks=False)]
+        for name in names:
+            flat = folder / name
+            target = folder / fanout(name) / name
+            try:
+                if target.exists():
+                    # đã có bản mới cùng tên (upload sau khi nâng cấp) -> bản phẳng là bản cũ
+                    os.remove(flat)
+                else:
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(flat, target)
+                    moved += 1
+            except FileNotFoundError:
+                continue    # vừa bị xóa
+            done += 1
+            if max_files_per_sec and max_files_per_sec > 0:
+                min_time = done / max_files_per_sec
+                spent = time.monotonic() - started
+                if spent < min_time:
+                    time.sleep(min_time - spent)
+    if moved:
+        print(f"[ATTACHMENTS] Đã chuyển {moved} file sang bố cục chia thư mục")
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chuyển file đính kèm sang bố cục chia thư mục")
+    parser.add_argument("--rate", type=float, default=ATTACHMENT_LAYOUT_MIGRATE_FILES_PER_S,
+                        help="số file chuyển tối đa / giây (0 = không giới hạn)")
+    args = parser.parse_args(argv)
+    migrate_attachment_layout(args.rate)
+
+
+if __name__ == "__main__":
+    main()
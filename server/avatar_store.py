@@ -0,0 +1,169 @@
+# server/avatar_store.py
+#
+# Kho avatar theo nội dung (content-addressed): mỗi ảnh lưu 1 lần dưới tên
+# sha256 của bytes gốc, DB (users.avatar_url / conversations.group_avatar)
+# chỉ giữ chuỗi hash 64 ký tự hex thay vì cả ảnh base64.
+#   - list_conversations chỉ gửi hash, client tự hỏi "get_avatars" với những
+#     hash chưa có trong cache của nó
+#   - bản thu nhỏ 32/64 px (vuông, cắt giữa) dựng sẵn lúc put(); cần Pillow,
+#     không có Pillow thì trả ảnh gốc (client vẫn tự scale như trước)
+#   - thư mục chia 2 cấp theo 4 ký tự đầu của hash để không dồn hết vào 1 thư mục
+# Bytes đã base64 của các bản hay hỏi được giữ trong RAM (LRU theo dung lượng).
+
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:     # Pillow là tùy chọn
+    Image = None
+
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_avatar_hash(value) -> bool:
+    return isinstance(value, str) and bool(_HASH_RE.match(value))
+
+
+class AvatarStore:
+    def __init__(self, root, variant_sizes=(32, 64), cache_max_bytes: int = 8 * 1024 * 1024):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.variant_sizes = tuple(variant_sizes)
+        self.cache_max_bytes = cache_max_bytes
+        self._lock = threading.Lock()
+        self._b64_cache: "OrderedDict[tuple, str]" = OrderedDict()
+        self._cache_bytes = 0
+
+    # ---------- đường dẫn ----------
+
+    def _dir(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4]
+
+    def _path(self, digest: str, size: int = 0) -> Path:
+        name = digest if not size else f"{digest}_{size}.png"
+        return self._dir(digest) / name
+
+    def exists(self, digest: str) -> bool:
+        return is_avatar_hash(digest) and self._path(digest).exists()
+
+    # ---------- ghi ----------
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes):
+        # tên tạm riêng cho mỗi lần ghi: 2 thread cùng put 1 ảnh không giẫm file tạm của nhau
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def put(self, raw: bytes) -> str:
+        """Lưu ảnh (bytes gốc), trả về hash. Ảnh đã có thì không ghi lại."""
+        digest = hashlib.sha256(raw).hexdigest()
+        path = self._path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._write_atomic(path, raw)
+        for size in self.variant_sizes:
+            self._make_variant(digest, raw, size)
+        return digest
+
+    def put_b64(self, avatar_b64: str) -> str | None:
+        """Chuyển giá trị base64 kiểu cũ trong DB sang kho, trả về hash (None nếu hỏng)."""
+        try:
+            raw = base64.b64decode(avatar_b64, validate=False)
+        except (binascii.Error, ValueError):
+            return None
+        if not raw:
+            return None
+        return self.put(raw)
+
+    def _make_variant(self, digest: str, raw: bytes, size: int) -> Path | None:
+        path = self._path(digest, size)
+        if path.exists():
+            return path
+        if Image is None:
+            return None
+        try:
+            with Image.open(io.BytesIO(raw)) as img:
+                img = ImageOps.exif_transpose(img)
+                if img.mode not in ("RGB", "RGBA"):
+                    img = img.convert("RGBA")
+                thumb = ImageOps.fit(img, (size, size), Image.LANCZOS)
+                buf = io.BytesIO()
+                thumb.save(buf, format="PNG", optimize=True)
+        except Exception as e:
+            # ảnh lỗi / định dạng lạ -> dùng ảnh gốc
+            print(f"[AVATAR] Không tạo được bản {size}px cho {digest[:12]}: {e}")
+            return None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._write_atomic(path, buf.getvalue())
+        return path
+
+    # ---------- đọc ----------
+
+    def get(self, digest: str, size: int = 0) -> bytes | None:
+        """
+        Bytes của avatar; size thuộc variant_sizes -> bản thu nhỏ (dựng nếu
+        chưa có), size khác -> ảnh gốc. None nếu không có hash này.
+        """
+        if not is_avatar_hash(digest):
+            return None
+        try:
+            raw = self._path(digest).read_bytes()
+        except FileNotFoundError:
+            return None
+        if size in self.variant_sizes:
+            path = self._make_variant(digest, raw, size)
+            if path is not None:
+                return path.read_bytes()
+        return raw
+
+    def get_b64(self, digest: str, size: int = 0) -> str | None:
+        if size not in self.variant_sizes:
+            size = 0
+        key = (digest, size)
+        with self._lock:
+            cached = self._b64_cache.get(key)
+            if cached is not None:
+                self._b64_cache.move_to_end(key)
+                return cached
+
+        data = self.get(digest, size)
+        if data is None:
+            return None
+        encoded = base64.b64encode(data).decode("ascii")
+
+        with self._lock:
+            if key not in self._b64_cache and len(encoded) <= self.cache_max_bytes:
+                self._b64_cache[key] = encoded
+                self._cache_bytes += len(encoded)
+                while self._cache_bytes > self.cache_max_bytes:
+                    _, old = self._b64_cache.popitem(last=False)
+                    self._cache_bytes -= len(old)
+        return encoded
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "cached": len(self._b64_cache),
+                "cached_bytes": self._cache_bytes,
+                "variants": Image is not None,
+            }
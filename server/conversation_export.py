@@ -0,0 +1,458 @@
+# server/conversation_export.py
+#
+# Export / import 1 conversation (kể cả nhóm rất lớn) ra 1 file .jsonl.gz:
+#   python -m server.conversation_export export --conversation 42 --out nhom42.jsonl.gz
+#   python -m server.conversation_export import --in nhom42.jsonl.gz [--new-ids]
+#
+# Mỗi dòng là 1 record JSON, theo thứ tự:
+#   header -> blob avatar (nhóm + member) -> user -> member -> "messages"
+#   -> message (id tăng dần, ngay sau tin ảnh / video / file là blob của nó)
+#   -> end
+# Blob = 1 dòng "blob" + nhiều dòng "chunk" (base64, EXPORT_BLOB_CHUNK_BYTES)
+# + 1 dòng "blob_end" có sha256 để kiểm tra khi import.
+#
+# Export đọc tin từ archive (server/message_archive.py) rồi từ bảng messages
+# bằng cursor không buffer (backend.stream_cursor = SSCursor với MySQL), ghi
+# thẳng ra gzip -> bộ nhớ không tăng theo số tin / dung lượng file đính kèm.
+# Import tạo conversation mới theo shard map HIỆN TẠI (cụm khác số node cũng
+# được), user ghép theo username (chưa có thì tạo, giữ password_hash).
+# Mặc định giữ nguyên id tin (khôi phục backup); --new-ids cấp id Snowflake
+# mới (nhân bản conversation ngay trong cụm đang có bản gốc) - chỉ cho nhóm:
+# chat 1-1 của 2 user là duy nhất, "bản sao" chính là bản gốc nên bị từ chối.
+
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+from common.config import (
+    EXPORT_BATCH_ROWS,
+    EXPORT_BLOB_CHUNK_BYTES,
+    select_node_for_conversation,
+)
+from server import db_access as db
+from server import replication
+from server.attachments import attachment_path, locate_attachment
+from server.avatar_store import is_avatar_hash
+from server.id_generator import next_message_id
+
+EXPORT_FORMAT_VERSION = 1
+
+
+class ExportError(Exception):
+    pass
+
+
+def _json_default(v):
+    if isinstance(v, datetime):
+        return v.isoformat(sep=" ")
+    return str(v)
+
+
+# ========== EXPORT ==========
+
+class _Writer:
+    def __init__(self, f):
+        self.f = f
+        self.records = 0
+        self.blobs = 0
+        self.blob_bytes = 0
+
+    def record(self, rtype: str, **fields):
+        self.f.write(json.dumps({"type": rtype, **fields}, ensure_ascii=False,
+                                default=_json_default))
+        self.f.write("\n")
+        self.records += 1
+
+    def blob(self, kind: str, name: str, path: Path | None = None, data: bytes | None = None,
+             **extra) -> bool:
+        """Ghi 1 blob từ file (đọc từng chunk) hoặc từ bytes có sẵn."""
+        if path is not None:
+            try:
+                size = path.stat().st_size
+                src = open(path, "rb")
+            except OSError:
+                return False
+        elif data is not None:
+            size = len(data)
+            src = None
+        else:
+            return False
+
+        self.record("blob", kind=kind, name=name, size=size, **extra)
+        digest = hashlib.sha256()
+        try:
+            if src is None:
+                for i in range(0, len(data), EXPORT_BLOB_CHUNK_BYTES):
+                    chunk = data[i:i + EXPORT_BLOB_CHUNK_BYTES]
+                    digest.update(chunk)
+                    self.record("chunk", data=base64.b64encode(chunk).decode("ascii"))
+            else:
+                while True:
+                    chunk = src.read(EXPORT_BLOB_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    self.record("chunk", data=base64.b64encode(chunk).decode("ascii"))
+        finally:
+            if src is not None:
+                src.close()
+        self.record("blob_end", sha256=digest.hexdigest())
+        self.blobs += 1
+        self.blob_bytes += size
+        return True
+
+
+def _load_users(conn, user_ids) -> list[dict]:
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT id, username, password_hash, display_name, avatar_url FROM users "
+            "WHERE id IN (" + ", ".join(["%s"] * len(user_ids)) + ")",
+            user_ids,
+        )
+        return list(cur.fetchall())
+
+
+def _iter_hot(conversation_id: int, after_id: int, batch_size: int):
+    conn = db.get_connection(select_node_for_conversation(conversation_id))
+    try:
+        cur = db.backend.stream_cursor(conn)
+        try:
+            cur.execute(
+                """
+                SELECT id, sender_id, msg_type, content, created_at
+                FROM messages
+                WHERE conversation_id = %s AND id > %s
+                ORDER BY id
+                """,
+                (conversation_id, after_id),
+            )
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+
+
+def _iter_messages(conversation_id: int, batch_size: int):
+    """Toàn bộ tin theo id tăng dần: phần đã archive trước, rồi stream bảng messages."""
+    top = 0
+    if db.message_archive is not None:
+        for m in db.message_archive.iter_rows(conversation_id, batch_size):
+            top = m["id"]
+            yield m
+    # generator -> chỉ mở cursor bảng messages khi đọc xong archive;
+    # dòng sót của lần archive bị ngắt (id <= top) bỏ qua
+    yield from _iter_hot(conversation_id, top, batch_size)
+
+
+def export_conversation(conversation_id: int, out_path, batch_size: int = EXPORT_BATCH_ROWS) -> dict:
+    out_path = Path(out_path)
+    primary = db.get_connection(replication.primary_node())
+    try:
+        with primary.cursor() as cur:
+            cur.execute(
+                "SELECT id, is_group, name, owner_id, group_avatar FROM conversations WHERE id = %s",
+                (conversation_id,),
+            )
+            conv = cur.fetchone()
+        if not conv:
+            raise ExportError(f"Không có conversation {conversation_id}")
+
+        member_ids = [m["id"] for m in db.get_members_of_conversation(conversation_id)]
+        users = _load_users(primary, member_ids)
+        exported_users = {u["id"] for u in users}
+
+        tmp = out_path.with_name(out_path.name + ".tmp")
+        started = time.monotonic()
+        n_messages = 0
+        missing_files = 0
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            w = _Writer(f)
+            w.record(
+                "header",
+                version=EXPORT_FORMAT_VERSION,
+                conversation_id=conversation_id,
+                is_group=int(conv["is_group"] or 0),
+                name=conv["name"],
+                owner_id=conv["owner_id"],
+                group_avatar=conv["group_avatar"] if is_avatar_hash(conv["group_avatar"]) else None,
+                exported_at=datetime.now(),
+            )
+            avatars = {conv["group_avatar"]} | {u["avatar_url"] for u in users}
+            for digest in sorted(h for h in avatars if is_avatar_hash(h)):
+                w.blob("avatar", digest, data=db.avatar_store.get(digest))
+            for u in users:
+                w.record("user", **u)
+            for uid in member_ids:
+                w.record("member", user_id=uid)
+            w.record("messages")
+
+            for m in _iter_messages(conversation_id, batch_size):
+                if m["sender_id"] not in exported_users:
+                    # người gửi đã rời nhóm: ghi user ngay trước tin đầu tiên của họ
+                    for u in _load_users(primary, [m["sender_id"]]):
+                        w.record("user", **u)
+                    exported_users.add(m["sender_id"])
+                w.record(
+                    "message",
+                    id=m["id"],
+                    sender_id=m["sender_id"],
+                    msg_type=m["msg_type"],
+                    content=m["content"],
+                    created_at=m["created_at"],
+                )
+                n_messages += 1
+                path = locate_attachment(m["msg_type"], m["content"])
+                if path is not None and not w.blob("attachment", m["content"], path=path,
+                                                   msg_type=m["msg_type"]):
+                    missing_files += 1
+            w.record("end", messages=n_messages, blobs=w.blobs)
+        os.replace(tmp, out_path)
+    finally:
+        primary.close()
+
+    result = {
+        "conversation_id": conversation_id,
+        "messages": n_messages,
+        "blobs": w.blobs,
+        "blob_bytes": w.blob_bytes,
+        "missing_files": missing_files,
+        "bytes": out_path.stat().st_size,
+        "seconds": round(time.monotonic() - started, 1),
+    }
+    print(f"[EXPORT] conv {conversation_id}: {n_messages} tin, {w.blobs} blob "
+          f"({missing_files} file thiếu) -> {out_path} ({result['bytes']} bytes)")
+    return result
+
+
+# ========== IMPORT ==========
+
+class _Importer:
+    def __init__(self, new_ids: bool, batch_size: int):
+        self.new_ids = new_ids
+        self.batch_size = max(1, batch_size)
+        self.header: dict | None = None
+        self.user_map: dict[int, int] = {}
+        self.new_users: dict[int, str | None] = {}
+        self.members: list[int] = []
+        self.conversation_id: int | None = None
+        self.node = None
+        self.pending: list[list] = []
+        self.messages = 0
+        self.skipped = 0
+        self.blobs = 0
+        self._blob: dict | None = None
+
+    # ---------- user / conversation ----------
+
+    def user(self, rec: dict):
+        existing = db.get_user_by_username(rec["username"])
+        if existing:
+            self.user_map[rec["id"]] = existing["id"]
+            return
+        new_id = db.create_user(rec["username"], rec["password_hash"], rec.get("display_name"))
+        if new_id is None:
+            # vừa có người tạo trùng username
+            self.user_map[rec["id"]] = db.get_user_by_username(rec["username"])["id"]
+            return
+        self.user_map[rec["id"]] = new_id
+        if is_avatar_hash(rec.get("avatar_url")):
+            self.new_users[new_id] = rec["avatar_url"]
+
+    def create_conversation(self):
+        h = self.header
+        members = [self.user_map[u] for u in self.members if u in self.user_map]
+        if h["is_group"]:
+            owner = self.user_map.get(h["owner_id"])
+            if owner is not None and owner not in members:
+                members.insert(0, owner)
+            self.conversation_id = db.create_group_conversation(h["name"], owner, members)
+            if h.get("group_avatar") and db.avatar_store.exists(h["group_avatar"]):
+                db.update_group_avatar(self.conversation_id, db.avatar_store.get(h["group_avatar"]))
+        else:
+            if len(members) != 2:
+                raise ExportError(f"Chat 1-1 cần đúng 2 member, file có {len(members)}")
+            self.conversation_id = db.get_or_create_private_conversation(*members)
+        for user_id, digest in self.new_users.items():
+            if db.avatar_store.exists(digest):
+                db.update_user_avatar(user_id, db.avatar_store.get(digest))
+        self.node = select_node_for_conversation(self.conversation_id)
+        print(f"[IMPORT] Conversation mới {self.conversation_id} trên {self.node['name']}")
+
+    # ---------- message ----------
+
+    def message(self, rec: dict):
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        sender = self.user_map.get(rec["sender_id"])
+        if sender is None:
+            raise ExportError(f"Tin {rec['id']}: không có user {rec['sender_id']} trong file")
+        msg_id = next_message_id() if self.new_ids else rec["id"]
+        self.pending.append([msg_id, self.conversation_id, sender,
+                             rec["msg_type"], rec["content"], rec["created_at"]])
+        self.messages += 1
+
+    def flush(self):
+        if not self.pending:
+            return
+        conn = db.get_connection(self.node)
+        try:
+            with conn.cursor() as cur:
+                inserted = cur.executemany(
+                    """
+                    INSERT IGNORE INTO messages
+                        (id, conversation_id, sender_id, msg_type, content, created_at)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    """,
+                    self.pending,
+                )
+            conn.commit()
+            # id đã có trên node (import lại cùng file, hoặc bản gốc còn đó mà quên --new-ids)
+            self.skipped += len(self.pending) - (inserted or 0)
+        finally:
+            conn.close()
+        self.pending = []
+
+    # ---------- blob ----------
+
+    def blob_start(self, rec: dict):
+        if rec["kind"] == "attachment":
+            target = attachment_path(rec.get("msg_type"), rec["name"])
+        else:
+            target = db.avatar_store.root / rec["name"]     # chỉ dùng làm chỗ ghi tạm
+        if target is None:
+            raise ExportError(f"Blob không hợp lệ: {rec['name']!r}")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + ".importing")
+        self._blob = {**rec, "target": target, "tmp": tmp,
+                      "f": open(tmp, "wb"), "sha": hashlib.sha256()}
+
+    def blob_chunk(self, rec: dict):
+        chunk = base64.b64decode(rec["data"])
+        self._blob["sha"].update(chunk)
+        self._blob["f"].write(chunk)
+
+    def blob_end(self, rec: dict):
+        b, self._blob = self._blob, None
+        b["f"].close()
+        if b["sha"].hexdigest() != rec["sha256"]:
+            os.remove(b["tmp"])
+            raise ExportError(f"Blob {b['name']!r} hỏng (sha256 không khớp)")
+
+        if b["kind"] == "avatar":
+            db.avatar_store.put(b["tmp"].read_bytes())
+            os.remove(b["tmp"])
+        else:
+            target = b["target"]
+            if target.exists() and _sha256_file(target) != rec["sha256"]:
+                # trùng tên với file khác đang có -> đổi tên, sửa content của tin vừa đọc
+                target = target.with_name(f"{self.conversation_id}_{target.name}")
+                if self.pending and self.pending[-1][4] == b["name"]:
+                    self.pending[-1][4] = target.name
+            if target.exists():
+                os.remove(b["tmp"])
+            else:
+                os.replace(b["tmp"], target)
+        self.blobs += 1
+
+    def finish(self):
+        self.flush()
+        if self.conversation_id is not None:
+            db.refresh_conversation_summary(self.conversation_id)
+
+
+def _sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def import_conversation(in_path, new_ids: bool = False,
+                        batch_size: int = EXPORT_BATCH_ROWS) -> dict:
+    imp = _Importer(new_ids, batch_size)
+    started = time.monotonic()
+    ended = False
+    with gzip.open(in_path, "rt", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            rtype = rec["type"]
+            if rtype == "header":
+                if rec.get("version") != EXPORT_FORMAT_VERSION:
+                    raise ExportError(f"Không hỗ trợ format version {rec.get('version')}")
+                if new_ids and not rec["is_group"]:
+                    # get_or_create_private_conversation trả về chat gốc -> mọi tin bị chèn lần 2
+                    raise ExportError("--new-ids chỉ dùng cho nhóm, không nhân bản được chat 1-1")
+                imp.header = rec
+            elif rtype == "blob":
+                imp.blob_start(rec)
+            elif rtype == "chunk":
+                imp.blob_chunk(rec)
+            elif rtype == "blob_end":
+                imp.blob_end(rec)
+            elif rtype == "user":
+                imp.user(rec)
+            elif rtype == "member":
+                imp.members.append(rec["user_id"])
+            elif rtype == "messages":
+                imp.create_conversation()
+            elif rtype == "message":
+                imp.message(rec)
+            elif rtype == "end":
+                ended = True
+    if not ended:
+        raise ExportError("File export bị cắt (không có record end)")
+    imp.finish()
+
+    result = {
+        "conversation_id": imp.conversation_id,
+        "messages": imp.messages,
+        "skipped": imp.skipped,
+        "blobs": imp.blobs,
+        "seconds": round(time.monotonic() - started, 1),
+    }
+    print(f"[IMPORT] conv {imp.conversation_id}: {imp.messages} tin "
+          f"({imp.skipped} bỏ qua vì trùng id), {imp.blobs} blob")
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export / import 1 conversation (.jsonl.gz)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_exp = sub.add_parser("export")
+    p_exp.add_argument("--conversation", type=int, required=True)
+    p_exp.add_argument("--out", required=True)
+    p_imp = sub.add_parser("import")
+    p_imp.add_argument("--in", dest="in_path", required=True)
+    p_imp.add_argument("--new-ids", action="store_true",
+                       help="cấp id tin mới (nhân bản nhóm trong cùng cụm, không dùng cho chat 1-1)")
+    for p in (p_exp, p_imp):
+        p.add_argument("--batch", type=int, default=EXPORT_BATCH_ROWS)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.cmd == "export":
+            export_conversation(args.conversation, args.out, args.batch)
+        else:
+            import_conversation(args.in_path, args.new_ids, args.batch)
+    except ExportError as e:
+        print(f"[EXPORT] Dừng: {e}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,259 @@
 # server/db_access.py
 
-import pymysql
-from common.config import DB_NODES, select_node_for_conversation
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from common.config import (
+    DB_NODES,
+    select_node_for_conversation,
+    MESSAGE_BATCH_ENABLED,
+    MESSAGE_BATCH_MAX_SIZE,
+    MESSAGE_BATCH_MAX_DELAY_MS,
+    DB_CONNECT_TIMEOUT_S,
+    HEALTH_PROBE_TIMEOUT_S,
+    WRITE_JOURNAL_DIR,
+    HISTORY_RING_ENABLED,
+    HISTORY_RING_SIZE,
+    HISTORY_CACHE_MAX_BYTES,
+    MESSAGE_SEARCH_TIMEOUT_S,
+    MESSAGE_SEARCH_MAX_RESULTS,
+    MESSAGE_SEARCH_FT_MIN_TOKEN,
+    USER_INDEX_REFRESH_S,
+    AVATAR_DIR,
+    AVATAR_VARIANT_SIZES,
+    AVATAR_CACHE_MAX_BYTES,
+    ARCHIVE_ENABLED,
+    ARCHIVE_AFTER_DAYS,
+    ARCHIVE_DIR,
+    ARCHIVE_BLOCK_ROWS,
+    ARCHIVE_BATCH_ROWS,
+    ARCHIVE_INTERVAL_S,
+    JOB_DELETE_CHUNK,
+    JOB_CHUNK_PAUSE_S,
+    ATTACHMENT_GC_BATCH,
+    get_shard_store,
+    get_node_by_name,
+)
+from server.write_batcher import ShardWriteBatcher
+from server.scatter_gather import scatter, gather_first, UNKNOWN as LOOKUP_UNKNOWN
+from server.id_generator import next_message_id, first_id_at
+from server import replication
+from server.read_router import pick_read_node
+from server.node_health import HealthMonitor, NodeUnavailableError
+from server.write_journal import WriteJournal
+from server.message_cache import RecentMessageCache
+from server.message_archive import MessageArchive
+from server.job_queue import JobQueue
+from server.attachments import ATTACHMENT_DIRS, remove_attachment
+from server.user_index import UserSearchIndex, CoalescedCalls
+from server.avatar_store import AvatarStore, is_avatar_hash
+from server import query_stats
+from server.storage_backend import get_backend
+from server import schema
+
+
+# pymysql (MySQL) hoặc sqlite3 (1 file / node), chọn bằng DB_BACKEND
+backend = get_backend()
+
+
+def _connect(node_config, timeout=DB_CONNECT_TIMEOUT_S):
+    return backend.connect(node_config, timeout)
+
+
+def _probe_node(node_config):
+    conn = _connect(node_config, HEALTH_PROBE_TIMEOUT_S)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+    finally:
+        conn.close()
+
+
+node_health = HealthMonitor(DB_NODES, _probe_node)
+
+# lỗi coi như "node không dùng được" -> chuyển sang chế độ degraded
+_NODE_DOWN_ERRORS = (NodeUnavailableError, backend.ConnectError)
 
 
 def get_connection(node_config):
-    return pymysql.connect(
-        host=node_config["host"],
-        port=node_config["port"],
-        user=node_config["user"],
-        password=node_config["password"],
-        database=node_config["database"],
-        cursorclass=pymysql.cursors.DictCursor,
-    )
+    """
+    Mở connection tới node, đi qua circuit breaker:
+    node đang bị ngắt thì raise NodeUnavailableError ngay, không chờ timeout.
+    """
+    name = node_config["name"]
+    node_health.before_connect(name)
+    try:
+        conn = _connect(node_config)
+    except backend.ConnectError as e:
+        node_health.record_failure(name, e)
+        # 1 kiểu lỗi cho caller (server_main) dù breaker đã mở hay chưa
+        raise NodeUnavailableError(name, e) from e
+    node_health.record_success(name)
+    return conn
+
+
+# ========== DEGRADED MODE (journal ghi cục bộ) ==========
+
+_journal: WriteJournal | None = None
+_journal_lock = threading.Lock()
+
+# node chưa chạy được migration (lỗi lúc khởi động): ghi vào đó đi journal,
+# probe sức khỏe thấy node sống lại thì chạy migration rồi mới replay
+_schema_pending: set[str] = set()
+_schema_lock = threading.Lock()
+
+
+def _get_journal() -> WriteJournal:
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = WriteJournal(WRITE_JOURNAL_DIR)
+        return _journal
+
+
+def _must_journal(node_cfg) -> bool:
+    """
+    Node đang lỗi, hoặc journal của node còn lệnh chưa replay
+    (ghi thẳng lúc này có thể vượt mặt lệnh cũ) -> phải ghi journal.
+    """
+    name = node_cfg["name"]
+    if name in _schema_pending:
+        return True     # chưa chạy được migration -> chưa ghi thẳng
+    journal = _get_journal()
+    with journal.lock(name):
+        return not node_health.is_available(name) or journal.pending(name)
+
+
+def _shard_execute(node_cfg, statements, conversation_id=None):
+    """
+    Chạy các lệnh ghi (idempotent) trên 1 node trong cùng transaction.
+    Node không dùng được -> nối vào journal cục bộ, replay khi node sống lại.
+    Trả về list rowcount, hoặc None nếu đã ghi journal.
+    """
+    if not _must_journal(node_cfg):
+        try:
+            conn = get_connection(node_cfg)
+            try:
+                counts = []
+                with conn.cursor() as cur:
+                    for sql, params in statements:
+                        cur.execute(sql, params)
+                        counts.append(cur.rowcount)
+                conn.commit()
+                return counts
+            finally:
+                conn.close()
+        except _NODE_DOWN_ERRORS as e:
+            print(f"[DEGRADED] {node_cfg['name']} lỗi, ghi vào journal: {e}")
+
+    journal = _get_journal()
+    for sql, params in statements:
+        journal.append(node_cfg["name"], sql, params, conversation_id)
+    return None
+
+
+def _on_node_recovered(node_name: str):
+    # node lỗi lúc khởi động: chạy migration trước, replay journal sau
+    if node_name in _schema_pending and not _apply_schema(get_node_by_name(node_name)):
+        return
+    if _summary_pending:
+        _repair_pending_summaries()
+    journal = _get_journal()
+    if not journal.pending(node_name):
+        return
+    touched = journal.replay(get_node_by_name(node_name), get_connection)
+    for conv_id in touched:
+        # lệnh ghi (vd. xóa tin) mới thực sự chạy lúc replay -> bỏ cache cũ
+        if recent_messages is not None:
+            recent_messages.drop(conv_id)
+        _notify_conversation_changed(conv_id)
+        try:
+            refresh_conversation_summary(conv_id)
+        except Exception as e:
+            print(f"[JOURNAL] Không làm mới được summary conv {conv_id}: {e}")
+
+
+def init_node_health():
+    """
+    Chạy thread probe sức khỏe các node và replay journal còn sót
+    (vd. server bị tắt khi node chưa kịp sống lại).
+    """
+    node_health.add_recover_listener(_on_node_recovered)
+    node_health.start()
+    for node in DB_NODES:
+        try:
+            _on_node_recovered(node["name"])
+        except Exception as e:
+            print(f"[JOURNAL] Chưa replay được journal của {node['name']}: {e}")
+
+
+def get_node_health_status() -> dict:
+    return {
+        "nodes": node_health.status(),
+        "journal": _get_journal().stats(),
+    }
+
+
+# ========== QUERY STATS (server/query_stats.py) ==========
+
+_EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "INSERT", "REPLACE")
+
+
+def get_query_stats() -> dict:
+    """Histogram thời gian theo hàm db_access kể từ lúc khởi động / reset."""
+    return query_stats.stats.snapshot()
+
+
+def _explain(conn, sql: str):
+    if sql.lstrip().split(None, 1)[0].upper() not in _EXPLAINABLE:
+        return None, "không EXPLAIN được loại câu này"
+    try:
+        rows = backend.explain(conn, sql)
+    except backend.Error as e:
+        return None, str(e)
+    # filtered (MySQL) là Decimal -> đổi sang str để json.dumps được
+    return [
+        {k: v if isinstance(v, (int, float, str, type(None))) else str(v) for k, v in row.items()}
+        for row in rows
+    ], None
+
+
+def get_slow_queries(limit: int, explain: bool = True) -> list[dict]:
+    """
+    Top `limit` câu chậm nhất (mỗi dạng câu 1 mẫu), kèm EXPLAIN chạy lại
+    trên đúng node đã chạy câu đó.
+    """
+    items = query_stats.stats.slowest(limit)
+    if not explain:
+        return items
+
+    by_node: dict[str, list[dict]] = {}
+    for it in items:
+        if it.get("truncated"):
+            it["explain_error"] = "câu SQL quá dài, đã bị cắt"
+            continue
+        by_node.setdefault(it["node"], []).append(it)
+
+    for name, entries in by_node.items():
+        try:
+            conn = get_connection(get_node_by_name(name))
+        except (KeyError, *_NODE_DOWN_ERRORS) as e:
+            for it in entries:
+                it["explain_error"] = str(e)
+            continue
+        try:
+            for it in entries:
+                plan, err = _explain(conn, it["sql"])
+                if plan is not None:
+                    it["explain"] = plan
+                else:
+                    it["explain_error"] = err
+        finally:
+            conn.rollback()
+            conn.close()
+    return items
 
 
 # ========== USER FUNCTIONS ==========
@@ -23,11 +264,14 @@ def create_user(username: str, password_hash: str, display_name: str | None = No
     Tạo user mới.
     Bảng users: id, username, password_hash, display_name, avatar_url, created_at...
     avatar_url để NULL nên không cần set ở đây.
+    Ghi lên node primary + outbox trong 1 transaction; các node còn lại
+    được OutboxRelay cập nhật bất đồng bộ (cùng id user).
+    Trả về id user mới, None nếu username đã có (vd. 2 người đăng ký cùng lúc).
     """
-    for node in DB_NODES:
-        conn = get_connection(node)
-        try:
-            with conn.cursor() as cur:
+    conn = get_connection(replication.primary_node())
+    try:
+        with conn.cursor() as cur:
+            try:
                 cur.execute(
                     """
                     INSERT INTO users (username, password_hash, display_name)
@@ -35,39 +279,93 @@ def create_user(username: str, password_hash: str, display_name: str | None = No
                     """,
                     (username, password_hash, display_name or username),
                 )
-            conn.commit()
-        finally:
-            conn.close()
+            except backend.IntegrityError:
+                conn.rollback()
+                return None
+            user_id = cur.lastrowid
+            replication.enqueue(
+                cur,
+                "user_upsert",
+                [user_id, username, password_hash, display_name or username],
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    _notify_outbox()
+    if user_index.ready:
+        user_index.add(user_id, username, display_name or username)
+    return user_id
 
 
 def get_user_by_username(username: str):
     """
     Lấy thông tin user theo username.
+    Hỏi song song tất cả node, lấy node đầu tiên trả về có dữ liệu.
+    None chỉ khi primary (nơi user được tạo) xác nhận không có; primary lỗi /
+    quá hạn mà chưa node nào thấy user -> NodeUnavailableError (thử lại sau),
+    vì replica trễ trả None không có nghĩa là username còn trống.
     """
-    for node in DB_NODES:
+    def _read(node):
         conn = get_connection(node)
         try:
             with conn.cursor() as cur:
                 cur.execute("SELECT * FROM users WHERE username = %s", (username,))
-                row = cur.fetchone()
-                if row:
-                    return row
+                return cur.fetchone()
         finally:
             conn.close()
-    return None
 
+    primary = replication.primary_node()["name"]
+    state, value = gather_first(_read, authoritative=primary)
+    if state == LOOKUP_UNKNOWN:
+        raise NodeUnavailableError(primary, value)
+    return value
 
-def search_users(keyword: str, limit: int = 20):
+
+user_index = UserSearchIndex()
+_search_user_calls = CoalescedCalls()
+_user_index_thread: threading.Thread | None = None
+
+
+def _load_users(after_id: int = 0) -> list[dict]:
+    conn = get_connection(replication.primary_node())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, username, display_name FROM users WHERE id > %s ORDER BY id",
+                (after_id,),
+            )
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+
+def _refresh_user_index_loop():
+    while True:
+        time.sleep(USER_INDEX_REFRESH_S)
+        try:
+            for r in _load_users(user_index.max_id):
+                user_index.add(r["id"], r["username"], r.get("display_name"))
+        except Exception as e:
+            print(f"[USER INDEX] Không làm mới được: {e}")
+
+
+def init_user_index():
     """
-    Tìm user theo username hoặc display_name có chứa keyword (LIKE %keyword%).
-    Dùng cho thanh search ở sidebar.
-    Tạm thời chỉ search trên node đầu tiên (giả định đã replicate).
+    Nạp toàn bộ users vào index tìm kiếm trong RAM và chạy thread
+    lấy thêm user mới định kỳ.
     """
-    keyword = (keyword or "").strip()
-    if not keyword:
-        return []
-
-    node = DB_NODES[0]
+    global _user_index_thread
+    user_index.load(_load_users())
+    print(f"[USER INDEX] Đã nạp {len(user_index)} user")
+    if _user_index_thread is None:
+        _user_index_thread = threading.Thread(
+            target=_refresh_user_index_loop, name="user-index", daemon=True
+        )
+        _user_index_thread.start()
+
+
+def _search_users_db(keyword: str, limit: int):
+    node = pick_read_node()
     conn = get_connection(node)
     try:
         like = f"%{keyword}%"
@@ -88,54 +386,282 @@ def search_users(keyword: str, limit: int = 20):
         conn.close()
 
 
-def update_user_avatar(user_id: int, avatar_b64: str):
+def search_users(keyword: str, limit: int = 20):
     """
-    Cập nhật avatar_url = chuỗi base64 cho user.
-    Ghi lên tất cả node trong cụm.
+    Tìm user theo username hoặc display_name có chứa keyword.
+    Dùng cho thanh search ở sidebar.
+    Bình thường trả lời từ index trong RAM (user_index, xếp hạng: trùng username >
+    prefix > chứa); khi index chưa nạp thì LIKE trên DB, các câu hỏi giống hệt
+    nhau đang chạy đồng thời được gộp làm 1 query.
     """
+    keyword = (keyword or "").strip()
+    if not keyword:
+        return []
+
+    if user_index.ready:
+        return user_index.search(keyword, limit)
+    return _search_user_calls.call(
+        (keyword.casefold(), limit), lambda: _search_users_db(keyword, limit)
+    )
+
+
+# ========== AVATAR (kho theo hash, server/avatar_store.py) ==========
+
+avatar_store = AvatarStore(AVATAR_DIR, AVATAR_VARIANT_SIZES, AVATAR_CACHE_MAX_BYTES)
+
+
+def avatar_ref(value: str | None) -> str | None:
+    """
+    Giá trị cột avatar_url / group_avatar -> hash gửi cho client.
+    Dòng chưa migrate (còn base64 kiểu cũ) thì đưa ảnh vào kho ngay.
+    """
+    if not value:
+        return None
+    if is_avatar_hash(value):
+        return value
+    return avatar_store.put_b64(value)
+
+
+def get_avatars_b64(hashes, size: int = 0) -> dict:
+    """{hash: base64} cho các hash có trong kho (hash lạ bị bỏ qua)."""
+    result = {}
+    for h in hashes:
+        b64 = avatar_store.get_b64(h, size)
+        if b64 is not None:
+            result[h] = b64
+    return result
+
+
+def update_user_avatar(user_id: int, raw: bytes) -> str:
+    """
+    Lưu ảnh vào kho avatar, cột users.avatar_url chỉ giữ hash.
+    Ghi trên primary, replicate sang các node khác qua outbox.
+    """
+    digest = avatar_store.put(raw)
+    conn = get_connection(replication.primary_node())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE users SET avatar_url = %s WHERE id = %s",
+                (digest, user_id),
+            )
+            replication.enqueue(cur, "user_avatar", [digest, user_id])
+        conn.commit()
+    finally:
+        conn.close()
+    _notify_outbox()
+    return digest
+
+
+def _migrate_avatar_column(table: str, column: str, op: str, batch_size: int) -> int:
+    conn = get_connection(replication.primary_node())
+    moved = 0
+    last_id = 0
+    try:
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    SELECT id, {column} AS avatar FROM {table}
+                    WHERE id > %s AND {column} IS NOT NULL AND CHAR_LENGTH({column}) <> 64
+                    ORDER BY id LIMIT %s
+                    """,
+                    (last_id, batch_size),
+                )
+                rows = cur.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            with conn.cursor() as cur:
+                for r in rows:
+                    digest = avatar_store.put_b64(r["avatar"])
+                    cur.execute(
+                        f"UPDATE {table} SET {column} = %s WHERE id = %s AND {column} = %s",
+                        (digest, r["id"], r["avatar"]),
+                    )
+                    if cur.rowcount:
+                        replication.enqueue(cur, op, [digest, r["id"]])
+                        moved += 1
+            conn.commit()
+    finally:
+        conn.close()
+    return moved
+
+
+def migrate_legacy_avatars(batch_size: int = 100):
+    """
+    Chuyển avatar base64 cũ trong users / conversations sang kho avatar.
+    Chạy nền lúc khởi động, chạy lại nhiều lần không sao (chỉ đụng dòng chưa là hash).
+    """
+    moved = _migrate_avatar_column("users", "avatar_url", "user_avatar", batch_size)
+    moved += _migrate_avatar_column("conversations", "group_avatar", "group_avatar", batch_size)
+    if moved:
+        _notify_outbox()
+        print(f"[AVATAR] Đã chuyển {moved} avatar base64 sang kho avatar")
+
+
+# ========== REPLICATION (outbox) ==========
+
+_outbox_relay: replication.OutboxRelay | None = None
+
+
+def init_replication():
+    """
+    Đối chiếu users + seed metadata sang replica (lần đầu) rồi mới chạy
+    thread relay. Bảng replication_outbox do init_schema() tạo.
+    """
+    replication.reconcile_users(get_connection)
+    replication.seed_replicas(get_connection)
+
+    global _outbox_relay
+    if _outbox_relay is None:
+        _outbox_relay = replication.OutboxRelay(get_connection)
+        _outbox_relay.start()
+
+
+def _notify_outbox():
+    if _outbox_relay is not None:
+        _outbox_relay.notify()
+
+
+def get_replication_status() -> list[dict]:
+    return replication.replication_status(get_connection)
+
+
+# ========== CONVERSATION & MESSAGE FUNCTIONS ==========
+
+
+def _member_nodes(conversation_id: int) -> list[dict]:
+    """
+    Node chứa metadata thành viên của conversation: chính là node chứa messages
+    (select_node_for_conversation), thêm node ghi kép nếu conversation đang migrate.
+    """
+    nodes = [select_node_for_conversation(conversation_id)]
+    mirror_node = _migration_target_node(conversation_id)
+    if mirror_node is not None:
+        nodes.append(mirror_node)
+    return nodes
+
+
+def _write_members(conversation_id: int, user_ids, remove: bool = False) -> int:
+    """
+    Thêm / xóa conversation_members trên node shard của conversation
+    (ghi kép sang node còn lại khi đang migrate).
+    Trả về số dòng thay đổi trên node shard chính.
+    """
+    if remove:
+        sql = "DELETE FROM conversation_members WHERE conversation_id = %s AND user_id = %s"
+    else:
+        sql = "INSERT IGNORE INTO conversation_members (conversation_id, user_id) VALUES (%s, %s)"
+
+    changed = 0
+    for i, node in enumerate(_member_nodes(conversation_id)):
+        counts = _shard_execute(
+            node, [(sql, (conversation_id, uid)) for uid in user_ids], conversation_id
+        )
+        if i == 0:
+            # ghi journal (node lỗi): coi như thành công, replay sau
+            changed = len(user_ids) if counts is None else sum(counts)
+    return changed
+
+
+def _index_add(cur, conversation_id: int, is_group: int, pairs):
+    """
+    Ghi index user -> conversation trên primary.
+    pairs: [(user_id, partner_id), ...] (partner_id = None với group).
+    """
+    for uid, partner_id in pairs:
+        cur.execute(
+            """
+            INSERT IGNORE INTO user_conversations
+                (user_id, conversation_id, is_group, partner_id)
+            VALUES (%s, %s, %s, %s)
+            """,
+            (uid, conversation_id, is_group, partner_id),
+        )
+
+
+def init_conversation_index(rebuild: bool = False):
+    """
+    Index user_conversations trên primary: lần đầu (bảng rỗng) hoặc khi
+    rebuild=True thì dựng lại từ conversation_members trên từng node shard
+    (mỗi node chỉ lấy các conversation mà shard map trỏ về nó).
+    Gọi sau init_replication() để node shard đã có members cũ.
+    """
+    conn = get_connection(replication.primary_node())
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM user_conversations LIMIT 1")
+            existing = cur.fetchone() is not None
+        conn.commit()
+    finally:
+        conn.close()
+
+    if existing and not rebuild:
+        return
+
+    members: dict[int, dict] = {}
     for node in DB_NODES:
         conn = get_connection(node)
         try:
             with conn.cursor() as cur:
                 cur.execute(
-                    "UPDATE users SET avatar_url = %s WHERE id = %s",
-                    (avatar_b64, user_id),
+                    """
+                    SELECT cm.conversation_id, cm.user_id, c.is_group
+                    FROM conversation_members cm
+                    JOIN conversations c ON c.id = cm.conversation_id
+                    """
                 )
-            conn.commit()
+                rows = cur.fetchall()
         finally:
             conn.close()
-
-
-# ========== CONVERSATION & MESSAGE FUNCTIONS ==========
+        for r in rows:
+            conv_id = r["conversation_id"]
+            if select_node_for_conversation(conv_id)["name"] != node["name"]:
+                continue
+            entry = members.setdefault(conv_id, {"is_group": r["is_group"], "users": []})
+            entry["users"].append(r["user_id"])
+
+    conn = get_connection(replication.primary_node())
+    try:
+        with conn.cursor() as cur:
+            if rebuild:
+                cur.execute("DELETE FROM user_conversations")
+            for conv_id, entry in members.items():
+                users = entry["users"]
+                if entry["is_group"]:
+                    pairs = [(uid, None) for uid in users]
+                else:
+                    pairs = [
+                        (uid, next((o for o in users if o != uid), None))
+                        for uid in users
+                    ]
+                _index_add(cur, conv_id, 1 if entry["is_group"] else 0, pairs)
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def _find_private_conversation(user1_id: int, user2_id: int):
     """
     Tìm conversation 1-1 giữa 2 user, KHÔNG tự tạo nếu chưa có.
+    Tra index user_conversations trên primary.
     Trả về conversation_id hoặc None.
     """
-    if user1_id > user2_id:
-        user1_id, user2_id = user2_id, user1_id
-
-    node = DB_NODES[0]
-    conn = get_connection(node)
+    conn = get_connection(replication.primary_node())
     try:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                SELECT c.id
-                FROM conversations c
-                JOIN conversation_members m1
-                    ON m1.conversation_id = c.id AND m1.user_id = %s
-                JOIN conversation_members m2
-                    ON m2.conversation_id = c.id AND m2.user_id = %s
-                WHERE c.is_group = 0
+                SELECT conversation_id
+                FROM user_conversations
+                WHERE user_id = %s AND partner_id = %s AND is_group = 0
                 LIMIT 1
                 """,
                 (user1_id, user2_id),
             )
             row = cur.fetchone()
-            return row["id"] if row else None
+            return row["conversation_id"] if row else None
     finally:
         conn.close()
 
@@ -143,7 +669,9 @@ def _find_private_conversation(user1_id: int, user2_id: int):
 def get_or_create_private_conversation(user1_id: int, user2_id: int) -> int:
     """
     Tìm hoặc tạo mới conversation 1-1 giữa 2 user.
-    Lưu conversations & members ở node đầu tiên.
+    - conversations (cấp id) + index user_conversations: primary, cùng transaction,
+      conversations replicate qua outbox
+    - conversation_members: node shard của conversation (cùng chỗ với messages)
     """
     existing = _find_private_conversation(user1_id, user2_id)
     if existing:
@@ -152,38 +680,116 @@ def get_or_create_private_conversation(user1_id: int, user2_id: int) -> int:
     if user1_id > user2_id:
         user1_id, user2_id = user2_id, user1_id
 
-    node = DB_NODES[0]
-    conn = get_connection(node)
+    conn = get_connection(replication.primary_node())
     try:
         with conn.cursor() as cur:
             cur.execute(
                 "INSERT INTO conversations (is_group, name) VALUES (0, NULL)"
             )
             conv_id = cur.lastrowid
-            cur.execute(
-                "INSERT INTO conversation_members (conversation_id, user_id) VALUES (%s, %s)",
-                (conv_id, user1_id),
-            )
-            cur.execute(
-                "INSERT INTO conversation_members (conversation_id, user_id) VALUES (%s, %s)",
-                (conv_id, user2_id),
-            )
+            replication.enqueue(cur, "conv_upsert", [conv_id, 0, None, None, None])
+            _index_add(cur, conv_id, 0, [(user1_id, user2_id), (user2_id, user1_id)])
         conn.commit()
-        return conv_id
     finally:
         conn.close()
+    _notify_outbox()
+
+    _write_members(conv_id, [user1_id, user2_id])
+    return conv_id
+
+
+# Ring buffer tin mới nhất theo conversation (None = tắt)
+recent_messages: RecentMessageCache | None = (
+    RecentMessageCache(HISTORY_RING_SIZE, HISTORY_CACHE_MAX_BYTES)
+    if HISTORY_RING_ENABLED else None
+)
+
+# Segment nén của tin đã archive (None = tắt, lịch sử chỉ đọc bảng messages).
+# Tắt archive nhưng thư mục đã có segment (từng bật) -> vẫn đọc, không archive thêm.
+message_archive: MessageArchive | None = (
+    MessageArchive(ARCHIVE_DIR, ARCHIVE_BLOCK_ROWS)
+    if ARCHIVE_ENABLED or (os.path.isdir(ARCHIVE_DIR) and os.listdir(ARCHIVE_DIR))
+    else None
+)
+
+
+# callback(conversation_id) mỗi khi tin nhắn của conversation thay đổi
+_conversation_listeners = []
 
 
-def get_messages_for_conversation(conversation_id: int, limit: int = 200):
+def on_conversation_changed(fn):
+    """Đăng ký callback khi có insert / xóa tin (vd. xóa cache trang lịch sử)."""
+    _conversation_listeners.append(fn)
+
+
+def _notify_conversation_changed(conversation_id: int):
+    for fn in _conversation_listeners:
+        try:
+            fn(conversation_id)
+        except Exception as e:
+            print(f"[DB] Listener conversation {conversation_id} lỗi: {e}")
+
+
+def _on_messages_written(rows: list[dict]):
+    """Sau khi tin mới đã ghi (thẳng / batcher / journal): cập nhật ring + summary."""
+    if recent_messages is not None:
+        for row in rows:
+            recent_messages.append(row["conversation_id"], row)
+    conv_ids = {row["conversation_id"] for row in rows}
+    for conv_id in conv_ids:
+        _notify_conversation_changed(conv_id)
+    try:
+        _summary_on_insert_batch(rows)
+    except Exception as e:
+        # tin đã ghi / đã vào journal: summary lỗi không được làm hỏng lệnh gửi
+        _summary_failed(conv_ids, e)
+        return
+    if _summary_pending:
+        _repair_pending_summaries()
+
+
+def get_messages_for_conversation(
+    conversation_id: int,
+    limit: int = 200,
+    before_id: int | None = None,
+    after_id: int | None = None,
+):
     """
     Lấy lịch sử tin nhắn cho một conversation, kèm username người gửi.
+    Phân trang theo keyset (dùng index (conversation_id, id)):
+      - không truyền cursor  -> `limit` tin mới nhất
+      - before_id            -> `limit` tin ngay trước before_id (cuộn lên)
+      - after_id             -> `limit` tin ngay sau after_id
+    Kết quả luôn sắp theo id tăng dần.
+    Trang nằm gọn trong ring buffer RAM (xem server/message_cache.py) thì
+    không hỏi MySQL; đọc từ MySQL xong thì nạp / nối thêm vào ring.
+    Bảng messages hết tin trước khi đủ trang -> đọc tiếp từ archive.
     """
+    token = None
+    if recent_messages is not None:
+        cached = recent_messages.window(conversation_id, limit, before_id, after_id)
+        if cached is not None:
+            return cached
+        token = recent_messages.token(conversation_id)
+
+    where = "m.conversation_id = %s"
+    params: list = [conversation_id]
+    order = "DESC"
+    if before_id is not None:
+        where += " AND m.id < %s"
+        params.append(before_id)
+    elif after_id is not None:
+        where += " AND m.id > %s"
+        params.append(after_id)
+        order = "ASC"
+    params.append(limit)
+
     node_cfg = select_node_for_conversation(conversation_id)
     conn = get_connection(node_cfg)
     try:
         with conn.cursor() as cur:
             cur.execute(
-                """
+                f"""
                 SELECT m.id,
                        m.sender_id,
                        u.username AS sender_username,
@@ -192,83 +798,934 @@ def get_messages_for_conversation(conversation_id: int, limit: int = 200):
                        m.created_at
                 FROM messages m
                 JOIN users u ON u.id = m.sender_id
-                WHERE m.conversation_id = %s
-                ORDER BY m.id ASC
+                WHERE {where}
+                ORDER BY m.id {order}
                 LIMIT %s
                 """,
-                (conversation_id, limit),
+                params,
             )
-            rows = cur.fetchall()
+            rows = list(cur.fetchall())
+            if order == "DESC":
+                rows.reverse()
+    finally:
+        conn.close()
+
+    if message_archive is not None:
+        rows = _merge_archived(conversation_id, rows, limit, before_id, after_id)
+
+    if recent_messages is not None:
+        complete = len(rows) < limit
+        if before_id is None and after_id is None:
+            recent_messages.prime(conversation_id, rows, complete, token)
+        elif before_id is not None:
+            recent_messages.extend_older(conversation_id, before_id, rows, complete, token)
+    return rows
+
+
+# ========== MESSAGE ARCHIVE ==========
+#
+# Tin cũ hơn ARCHIVE_AFTER_DAYS được chuyển (theo từng conversation, từ tin
+# cũ nhất trở đi, liên tục theo id) sang segment nén (server/message_archive.py).
+# Thứ tự: ghi segment + fsync -> rồi mới DELETE khỏi messages, nên lúc nào tin
+# cũng nằm ở ít nhất 1 chỗ; dừng giữa chừng thì lần chạy sau xóa nốt các dòng
+# có id <= max_id của archive. Summary (message_count, tin cuối) tính cả archive.
+
+
+def _merge_archived(conversation_id: int, rows: list[dict], limit: int,
+                    before_id: int | None, after_id: int | None) -> list[dict]:
+    """Nối trang đọc từ bảng messages với phần nằm trong archive (id tăng dần)."""
+    if after_id is not None:
+        top = message_archive.max_id(conversation_id)
+        if top is None or after_id >= top:
             return rows
+        archived = message_archive.read_after(conversation_id, after_id, limit)
+        # dòng id <= top còn trong messages là bản sót của lần archive bị ngắt
+        return (archived + [r for r in rows if r["id"] > top])[:limit]
+
+    if len(rows) >= limit:
+        return rows
+    bound = rows[0]["id"] if rows else before_id
+    return message_archive.read_before(conversation_id, bound, limit - len(rows)) + rows
+
+
+def _archive_conversation(node_cfg, conversation_id: int, cutoff_id: int,
+                          cutoff_time: datetime, batch_size: int) -> int:
+    """Chuyển phần tin cũ liên tục từ đầu lịch sử của 1 conversation, trả về số tin."""
+    moved = 0
+    while True:
+        top = message_archive.max_id(conversation_id) or 0
+        conn = get_connection(node_cfg)
+        try:
+            with conn.cursor() as cur:
+                if top:
+                    cur.execute(
+                        "DELETE FROM messages WHERE conversation_id = %s AND id <= %s",
+                        (conversation_id, top),
+                    )
+                cur.execute(
+                    """
+                    SELECT m.id,
+                           m.sender_id,
+                           u.username AS sender_username,
+                           m.msg_type,
+                           m.content,
+                           m.created_at
+                    FROM messages m
+                    LEFT JOIN users u ON u.id = m.sender_id
+                    WHERE m.conversation_id = %s AND m.id > %s
+                    ORDER BY m.id
+                    LIMIT %s
+                    """,
+                    (conversation_id, top, batch_size),
+                )
+                fetched = list(cur.fetchall())
+            conn.commit()
+
+            # dừng ở tin "mới" đầu tiên: archive luôn là đoạn đầu liên tục của lịch sử
+            rows = []
+            for r in fetched:
+                if r["id"] >= cutoff_id or not r["created_at"] or r["created_at"] >= cutoff_time:
+                    break
+                rows.append(r)
+            if not rows:
+                return moved
+
+            message_archive.append(conversation_id, rows)
+            with conn.cursor() as cur:
+                ids = [r["id"] for r in rows]
+                for i in range(0, len(ids), _IN_CHUNK):
+                    chunk = ids[i:i + _IN_CHUNK]
+                    cur.execute(
+                        f"DELETE FROM messages WHERE conversation_id = %s "
+                        f"AND id IN ({', '.join(['%s'] * len(chunk))})",
+                        [conversation_id, *chunk],
+                    )
+            conn.commit()
+        finally:
+            conn.close()
+
+        moved += len(rows)
+        if len(rows) < len(fetched) or len(fetched) < batch_size:
+            return moved
+
+
+_ARCHIVE_MIN_TIME = datetime(1970, 1, 1)
+
+
+def archive_old_messages(older_than_days: float = ARCHIVE_AFTER_DAYS,
+                         batch_size: int = ARCHIVE_BATCH_ROWS) -> dict:
+    """
+    Chạy archiver 1 lượt trên mọi node. Bỏ qua node đang lỗi / còn journal
+    và conversation đang migrate. Trả về {node: số tin đã chuyển}.
+    """
+    if not ARCHIVE_ENABLED or message_archive is None:
+        return {}
+    cutoff_time = datetime.now() - timedelta(days=older_than_days)
+    cutoff_id = first_id_at(int(cutoff_time.timestamp() * 1000))
+    result = {}
+    for node in DB_NODES:
+        if _must_journal(node):
+            continue
+        conn = get_connection(node)
+        try:
+            with conn.cursor() as cur:
+                # khoảng 2 đầu -> đi theo index (created_at, conversation_id) cả với
+                # planner SQLite; sau lượt đầu chỉ còn vài tin vừa quá hạn
+                cur.execute(
+                    """
+                    SELECT DISTINCT conversation_id
+                    FROM messages
+                    WHERE created_at >= %s AND created_at < %s
+                    """,
+                    (_ARCHIVE_MIN_TIME, cutoff_time),
+                )
+                conv_ids = [r["conversation_id"] for r in cur.fetchall()]
+            conn.commit()
+        finally:
+            conn.close()
+
+        moved = 0
+        for conv_id in conv_ids:
+            if select_node_for_conversation(conv_id)["name"] != node["name"]:
+                continue  # dòng sót lại sau migrate, shard_migrate tự dọn
+            if _migration_target_node(conv_id) is not None:
+                continue
+            try:
+                moved += _archive_conversation(node, conv_id, cutoff_id, cutoff_time, batch_size)
+            except _NODE_DOWN_ERRORS as e:
+                print(f"[ARCHIVE] {node['name']} lỗi, dừng lượt này: {e}")
+                break
+        result[node["name"]] = moved
+        if moved:
+            print(f"[ARCHIVE] {node['name']}: đã chuyển {moved} tin sang archive")
+    return result
+
+
+_archive_thread: threading.Thread | None = None
+_archive_last: dict = {}
+
+
+def _archive_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL_S)
+        try:
+            _archive_last.update(archive_old_messages(), finished_at=time.time())
+        except Exception as e:
+            print(f"[ARCHIVE] Lượt archive lỗi: {e}")
+
+
+def init_message_archive():
+    """Chạy thread archive định kỳ (lượt đầu sau ARCHIVE_INTERVAL_S)."""
+    global _archive_thread
+    if not ARCHIVE_ENABLED:
+        if message_archive is not None:
+            print(f"[ARCHIVE] Archive đang tắt, chỉ đọc segment sẵn có ở {ARCHIVE_DIR}")
+        return
+    if message_archive is None or _archive_thread is not None:
+        return
+    _archive_thread = threading.Thread(target=_archive_loop, name="message-archive", daemon=True)
+    _archive_thread.start()
+
+
+def iter_attachment_refs(batch_size: int = ATTACHMENT_GC_BATCH):
+    """
+    Sinh từng lô [(msg_type, content)] của mọi tin kèm file: lần lượt từng node
+    (theo id, đi theo khóa chính) rồi tới archive. Quét DB trước archive nên tin
+    bị archive giữa chừng vẫn được thấy ở 1 trong 2 nơi.
+    Node đang lỗi / còn journal chưa replay -> NodeUnavailableError: danh sách
+    thiếu thì không được dùng để xóa file.
+    """
+    types = list(ATTACHMENT_DIRS)
+    type_marks = ", ".join(["%s"] * len(types))
+    for node in DB_NODES:
+        if _must_journal(node):
+            raise NodeUnavailableError(node["name"], "journal chưa replay")
+        last_id = 0
+        while True:
+            conn = get_connection(node)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        f"""
+                        SELECT id, msg_type, content
+                        FROM messages
+                        WHERE id > %s AND msg_type IN ({type_marks})
+                        ORDER BY id
+                        LIMIT %s
+                        """,
+                        (last_id, *types, batch_size),
+                    )
+                    rows = cur.fetchall()
+                conn.commit()
+            finally:
+                conn.close()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            yield [(r["msg_type"], r["content"]) for r in rows]
+
+    if message_archive is None:
+        return
+    for conv_id in message_archive.conversation_ids():
+        batch = []
+        for r in message_archive.iter_rows(conv_id, batch_size):
+            if (r.get("msg_type") or "").lower() in ATTACHMENT_DIRS:
+                batch.append((r["msg_type"], r["content"]))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+
+def get_archive_status() -> dict:
+    if message_archive is None:
+        return {"enabled": False}
+    return {
+        "enabled": True,
+        "after_days": ARCHIVE_AFTER_DAYS,
+        "last_run": dict(_archive_last),
+        **message_archive.stats(),
+    }
+
+
+def _apply_schema(node) -> bool:
+    with _schema_lock:
+        try:
+            conn = get_connection(node)
+        except _NODE_DOWN_ERRORS as e:
+            print(f"[SCHEMA] {node['name']} chưa kết nối được, thử lại sau: {e}")
+            _schema_pending.add(node["name"])
+            return False
+        try:
+            schema.apply_migrations(conn, backend.name, node["name"])
+        finally:
+            conn.close()
+        _schema_pending.discard(node["name"])
+        return True
+
+
+def init_schema() -> list[str]:
+    """
+    Chạy các migration còn thiếu trên mọi node (server/schema.py).
+    Gọi đầu tiên lúc khởi động, trước mọi init_* khác (kể cả init_node_health).
+    Chạy lần lượt từng node, không qua scatter (ALTER trên bảng lớn lâu hơn
+    DB_NODE_TIMEOUT_S). Node không kết nối được thì bỏ qua, chạy lại khi node
+    sống lại (_on_node_recovered). Trả về các node còn chờ.
+    """
+    for node in DB_NODES:
+        _apply_schema(node)
+    return sorted(_schema_pending)
+
+
+# ========== MESSAGE SEARCH ==========
+
+MESSAGES_FULLTEXT_DDL = """
+CREATE FULLTEXT INDEX IF NOT EXISTS ft_messages_content
+ON messages (content)
+"""
+
+# loại tin có content là chữ người dùng gõ / tên file (ảnh, video chỉ là tên file sinh tự động)
+SEARCHABLE_MSG_TYPES = ("text", "link", "file", "document")
+
+# ký tự toán tử của BOOLEAN MODE, bỏ khỏi từ khóa người dùng
+_FT_OPERATORS = str.maketrans({c: " " for c in '+-<>()~*"@'})
+_IN_CHUNK = 1000
+
+
+def ensure_message_search_index():
+    """
+    Tạo FULLTEXT index cho messages.content trên từng node.
+    Bảng lớn có thể mất vài phút -> server gọi ở thread nền; trong lúc chưa có
+    index, search_messages tự chuyển sang LIKE.
+    """
+    if not backend.supports_fulltext:
+        return
+    for node in DB_NODES:
+        try:
+            conn = get_connection(node)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(MESSAGES_FULLTEXT_DDL)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"[SEARCH] Không tạo được FULLTEXT index trên {node['name']}: {e}")
+
+
+def _search_terms(query: str) -> list[str]:
+    return [t for t in (query or "").translate(_FT_OPERATORS).split() if t]
+
+
+ER_FT_MATCHING_KEY_NOT_FOUND = 1191
+
+
+def _like_pattern(term: str) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _search_sql(n_convs: int, terms: list[str], use_fulltext: bool) -> tuple[str, list]:
+    """
+    FULLTEXT chỉ nhận từ đủ dài (từ ngắn hơn MESSAGE_SEARCH_FT_MIN_TOKEN không
+    được index, đưa vào +từ* thì không dòng nào khớp) -> từ ngắn lọc thêm bằng LIKE.
+    """
+    conv_ph = ", ".join(["%s"] * n_convs)
+    type_ph = ", ".join(["%s"] * len(SEARCHABLE_MSG_TYPES))
+    conditions: list[str] = []
+    match_params: list = []
+    if use_fulltext:
+        long_terms = [t for t in terms if len(t) >= MESSAGE_SEARCH_FT_MIN_TOKEN]
+        like_terms = [t for t in terms if len(t) < MESSAGE_SEARCH_FT_MIN_TOKEN]
+        conditions.append("MATCH(m.content) AGAINST (%s IN BOOLEAN MODE)")
+        match_params.append(" ".join(f"+{t}*" for t in long_terms))
+    else:
+        like_terms = terms
+    conditions += ["m.content LIKE %s"] * len(like_terms)
+    match_params += [_like_pattern(t) for t in like_terms]
+    match = " AND ".join(conditions)
+    sql = f"""
+        SELECT m.id, m.conversation_id, m.sender_id,
+               m.msg_type, m.content, m.created_at
+        FROM messages m
+        WHERE m.conversation_id IN ({conv_ph})
+          AND m.msg_type IN ({type_ph})
+          AND {match}
+        ORDER BY m.id DESC
+        LIMIT %s
+    """
+    return sql, [*SEARCHABLE_MSG_TYPES, *match_params]
+
+
+def _search_node(node, conv_ids: list[int], terms: list[str], limit: int) -> list[dict]:
+    """
+    Tìm trên 1 shard, chỉ trong các conversation của user (IN theo từng khối),
+    mỗi khối lấy `limit` tin mới nhất -> gộp lại vẫn đủ top-k của node.
+    Từ khóa quá ngắn cho FULLTEXT, hoặc node chưa có FULLTEXT index -> LIKE.
+    """
+    use_fulltext = backend.supports_fulltext and any(
+        len(t) >= MESSAGE_SEARCH_FT_MIN_TOKEN for t in terms
+    )
+    rows: list[dict] = []
+
+    conn = get_connection(node)
+    try:
+        with conn.cursor() as cur:
+            i = 0
+            while i < len(conv_ids):
+                chunk = conv_ids[i:i + _IN_CHUNK]
+                sql, extra = _search_sql(len(chunk), terms, use_fulltext)
+                try:
+                    cur.execute(sql, [*chunk, *extra, limit])
+                except backend.Error as e:
+                    if not use_fulltext or e.args[0] != ER_FT_MATCHING_KEY_NOT_FOUND:
+                        raise
+                    use_fulltext = False
+                    continue
+                rows.extend(cur.fetchall())
+                i += _IN_CHUNK
     finally:
         conn.close()
 
+    rows.sort(key=lambda r: r["id"], reverse=True)
+    return rows[:limit]
+
+
+def search_messages(user_id: int, query: str, limit: int = MESSAGE_SEARCH_MAX_RESULTS,
+                    conversation_id: int | None = None) -> dict:
+    """
+    Tìm tin nhắn trong các conversation mà user tham gia.
+    - danh sách conversation lấy từ index user_conversations (primary)
+    - chia theo shard, hỏi song song các shard liên quan (scatter),
+      shard nào quá MESSAGE_SEARCH_TIMEOUT_S thì bỏ qua và đánh dấu partial
+    - gộp top-k theo id giảm dần (id Snowflake = thứ tự thời gian)
+    Trả về {"items": [...], "partial": bool}.
+    """
+    terms = _search_terms(query)
+    limit = max(1, min(limit, MESSAGE_SEARCH_MAX_RESULTS))
+    if not terms:
+        return {"items": [], "partial": False}
+
+    conn = get_connection(replication.primary_node())
+    try:
+        with conn.cursor() as cur:
+            sql = """
+                SELECT uc.conversation_id, uc.is_group,
+                       c.name AS group_name, p.username AS partner_username
+                FROM user_conversations uc
+                LEFT JOIN conversations c ON c.id = uc.conversation_id
+                LEFT JOIN users p ON p.id = uc.partner_id
+                WHERE uc.user_id = %s
+            """
+            params: list = [user_id]
+            if conversation_id is not None:
+                sql += " AND uc.conversation_id = %s"
+                params.append(conversation_id)
+            cur.execute(sql, params)
+            convs = {r["conversation_id"]: r for r in cur.fetchall()}
+    finally:
+        conn.close()
+    if not convs:
+        return {"items": [], "partial": False}
+
+    by_node: dict[str, list[int]] = {}
+    for conv_id in convs:
+        by_node.setdefault(select_node_for_conversation(conv_id)["name"], []).append(conv_id)
+
+    result = scatter(
+        lambda node: _search_node(node, by_node[node["name"]], terms, limit),
+        [get_node_by_name(name) for name in by_node],
+        timeout=MESSAGE_SEARCH_TIMEOUT_S,
+    )
+    for name, err in result.errors.items():
+        print(f"[SEARCH] {name} lỗi / quá hạn: {err}")
+
+    rows = [r for node_rows in result.results.values() for r in node_rows]
+    rows.sort(key=lambda r: r["id"], reverse=True)
+    rows = rows[:limit]
+
+    sender_ids = sorted({r["sender_id"] for r in rows})
+    senders = {}
+    if sender_ids:
+        conn = get_connection(pick_read_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, username FROM users WHERE id IN ("
+                    + ", ".join(["%s"] * len(sender_ids)) + ")",
+                    sender_ids,
+                )
+                senders = {u["id"]: u["username"] for u in cur.fetchall()}
+        finally:
+            conn.close()
+
+    items = []
+    for r in rows:
+        conv = convs[r["conversation_id"]]
+        items.append({
+            "id": r["id"],
+            "conversation_id": r["conversation_id"],
+            "is_group": bool(conv["is_group"]),
+            "group_name": conv.get("group_name"),
+            "partner_username": conv.get("partner_username"),
+            "sender_username": senders.get(r["sender_id"]),
+            "msg_type": r.get("msg_type") or "text",
+            "content": r["content"],
+            "created_at": _format_last_time(r.get("created_at")),
+        })
+    return {"items": items, "partial": bool(result.errors)}
+
+
+_write_batchers: dict[str, ShardWriteBatcher] = {}
+_write_batchers_lock = threading.Lock()
+
+
+def get_write_batcher(node_cfg) -> ShardWriteBatcher:
+    """
+    Lấy (hoặc tạo) batcher ghi tin nhắn cho 1 node.
+    """
+    name = node_cfg["name"]
+    with _write_batchers_lock:
+        batcher = _write_batchers.get(name)
+        if batcher is None:
+            batcher = ShardWriteBatcher(
+                node_cfg,
+                get_connection,
+                next_message_id,
+                max_batch=MESSAGE_BATCH_MAX_SIZE,
+                max_delay_ms=MESSAGE_BATCH_MAX_DELAY_MS,
+                on_flush=_on_messages_written,
+            )
+            _write_batchers[name] = batcher
+        return batcher
+
+
+def _migration_target_node(conversation_id: int):
+    """
+    Nếu conversation đang được migrate (xem server/shard_migrate.py)
+    thì trả về node cần ghi kép (node đích; sau cutover là node nguồn),
+    ngược lại None.
+    """
+    name = get_shard_store().get().migration_target(conversation_id)
+    return get_node_by_name(name) if name else None
+
+
+_INSERT_MESSAGE_IGNORE_SQL = """
+    INSERT IGNORE INTO messages
+        (id, conversation_id, sender_id, msg_type, content, created_at)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
 
-def insert_message(conversation_id: int, sender_id: int, msg_type: str, content: str) -> int:
+def _mirror_message(node_cfg, row: dict):
+    """
+    Ghi kép 1 tin sang node đích khi đang migrate, giữ nguyên id.
+    INSERT IGNORE vì tool migrate có thể đã copy dòng này rồi.
+    """
+    _shard_execute(
+        node_cfg,
+        [(_INSERT_MESSAGE_IGNORE_SQL,
+          (row["id"], row["conversation_id"], row["sender_id"],
+           row["msg_type"], row["content"], row["created_at"]))],
+        row["conversation_id"],
+    )
+
+
+def insert_message(conversation_id: int, sender_id: int, msg_type: str, content: str,
+                   message_id: int | None = None) -> int:
     """
     Lưu tin nhắn vào node được chọn theo conversation_id.
-    Trả về message_id.
+    Trả về message_id (Snowflake, duy nhất trên toàn cụm, xem server/id_generator.py).
+    message_id: id đã cấp sẵn bằng next_message_id() lúc nhận lệnh (upload lưu
+    tin sau khi ghi file xong vẫn giữ đúng thứ tự gửi).
+    Nếu bật MESSAGE_BATCH_ENABLED thì đi qua batcher của node (group commit).
+    Conversation đang migrate thì ghi thẳng + ghi kép sang node đích.
+    Node shard đang lỗi thì ghi vào journal cục bộ (chế độ degraded),
+    tin nhắn vẫn được trả id và hiện trong summary, replay khi node sống lại.
+    """
+    node_cfg = select_node_for_conversation(conversation_id)
+    mirror_node = _migration_target_node(conversation_id)
+    degraded = _must_journal(node_cfg)
+
+    # cấp id trước: batch lỗi giữa chừng (có thể đã commit) thì journal ghi
+    # lại đúng id này, INSERT IGNORE lúc replay không sinh tin trùng
+    msg_id = message_id if message_id is not None else next_message_id()
+    if MESSAGE_BATCH_ENABLED and mirror_node is None and not degraded:
+        try:
+            row = get_write_batcher(node_cfg).submit(
+                conversation_id, sender_id, msg_type, content, msg_id
+            )
+            return row["id"]
+        except _NODE_DOWN_ERRORS as e:
+            print(f"[DEGRADED] Batcher {node_cfg['name']} lỗi: {e}")
+            degraded = True
+
+    new_row = {
+        "id": msg_id,
+        "conversation_id": conversation_id,
+        "sender_id": sender_id,
+        "msg_type": msg_type,
+        "content": content,
+        "created_at": None,
+    }
+    if not degraded:
+        try:
+            conn = get_connection(node_cfg)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        INSERT INTO messages (id, conversation_id, sender_id, msg_type, content)
+                        VALUES (%s, %s, %s, %s, %s)
+                        """,
+                        (msg_id, conversation_id, sender_id, msg_type, content),
+                    )
+                    cur.execute("SELECT created_at FROM messages WHERE id = %s", (msg_id,))
+                    row = cur.fetchone()
+                conn.commit()
+            finally:
+                conn.close()
+            new_row["created_at"] = row["created_at"] if row else None
+        except _NODE_DOWN_ERRORS as e:
+            print(f"[DEGRADED] {node_cfg['name']} lỗi, ghi tin nhắn vào journal: {e}")
+            degraded = True
+
+    if degraded:
+        new_row["created_at"] = datetime.now()
+        _get_journal().append(
+            node_cfg["name"],
+            _INSERT_MESSAGE_IGNORE_SQL,
+            (msg_id, conversation_id, sender_id, msg_type, content, new_row["created_at"]),
+            conversation_id,
+        )
+
+    if mirror_node is not None:
+        _mirror_message(mirror_node, new_row)
+
+    _on_messages_written([new_row])
+    return msg_id
+
+
+# kết quả delete_message_for_user
+DELETE_DONE = "deleted"
+DELETE_QUEUED = "queued"        # node shard lỗi: đã vào journal, replay mới biết có xóa được không
+DELETE_NOT_FOUND = "not_found"  # không có tin / không phải người gửi
+
+
+def delete_message_for_user(conversation_id: int, message_id: int, sender_id: int) -> str:
+    """
+    Xóa tin nhắn theo id, chỉ khi đúng người gửi và đúng conversation_id.
+    Node shard đang lỗi: lệnh xóa vào journal (điều kiện sender_id được kiểm
+    lúc replay) và trả về DELETE_QUEUED; cache / summary được làm mới sau khi
+    replay (_on_node_recovered).
+    Tin đã archive thì ghi tombstone trong archive.
+    """
+    delete_sql = """
+        DELETE FROM messages
+        WHERE id = %s AND conversation_id = %s AND sender_id = %s
     """
+    params = (message_id, conversation_id, sender_id)
+    node_cfg = select_node_for_conversation(conversation_id)
+    counts = _shard_execute(node_cfg, [(delete_sql, params)], conversation_id)
+    status = DELETE_QUEUED if counts is None else (
+        DELETE_DONE if counts[0] > 0 else DELETE_NOT_FOUND
+    )
+
+    if message_archive is not None:
+        archived = message_archive.get(conversation_id, message_id)
+        if archived is not None and archived["sender_id"] == sender_id:
+            if message_archive.tombstone(conversation_id, message_id):
+                status = DELETE_DONE
+
+    mirror_node = _migration_target_node(conversation_id)
+    if status != DELETE_NOT_FOUND and mirror_node is not None:
+        _shard_execute(mirror_node, [(delete_sql, params)], conversation_id)
+
+    if status == DELETE_DONE:
+        if recent_messages is not None:
+            recent_messages.remove(conversation_id, message_id)
+        _notify_conversation_changed(conversation_id)
+        try:
+            _summary_on_delete(conversation_id, message_id)
+        except Exception as e:
+            _summary_failed({conversation_id}, e)
+    return status
+def get_message_by_id(conversation_id: int, message_id: int):
+    """
+    Lấy 1 bản ghi tin nhắn theo id + conversation_id (cả tin đã archive).
+    Dùng để biết msg_type, content trước khi xóa.
+    Node shard lỗi: chỉ tra được archive (không có -> None).
+    """
+    node_cfg = select_node_for_conversation(conversation_id)
+    row = None
+    try:
+        conn = get_connection(node_cfg)
+    except _NODE_DOWN_ERRORS:
+        conn = None
+    if conn is not None:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT id, sender_id, msg_type, content
+                    FROM messages
+                    WHERE id = %s AND conversation_id = %s
+                    """,
+                    (message_id, conversation_id),
+                )
+                row = cur.fetchone()
+        finally:
+            conn.close()
+
+    if row is None and message_archive is not None:
+        archived = message_archive.get(conversation_id, message_id)
+        if archived is not None:
+            row = {k: archived[k] for k in ("id", "sender_id", "msg_type", "content")}
+    return row
+
+
+
+# ========== CONVERSATION SUMMARY ==========
+#
+# Bảng conversation_summary (ở primary, cạnh bảng conversations) giữ sẵn
+# thông tin tin nhắn mới nhất của mỗi conversation để sidebar khỏi phải
+# MAX(m.created_at) trên toàn bộ messages mỗi lần list_conversations.
+# Được cập nhật trong insert_message / delete_message_for_user, best-effort:
+# primary lỗi thì conversation được ghi nhớ lại và tính lại bằng
+# refresh_conversation_summary khi primary sống lại (_on_node_recovered).
+
+SUMMARY_PREVIEW_LEN = 100
+
+# conversation có summary chưa cập nhật được (primary lỗi lúc ghi / xóa tin)
+_summary_pending: set[int] = set()
+_summary_pending_lock = threading.Lock()
+
+
+def _summary_failed(conv_ids, err: Exception):
+    print(f"[SUMMARY] Chưa cập nhật được summary conv {sorted(conv_ids)}, "
+          f"sẽ tính lại sau: {err}")
+    with _summary_pending_lock:
+        _summary_pending.update(conv_ids)
+
+
+def _repair_pending_summaries():
+    """Tính lại summary các conversation bị lỡ cập nhật; lỗi thì giữ lại lần sau."""
+    with _summary_pending_lock:
+        conv_ids = list(_summary_pending)
+        _summary_pending.clear()
+    for i, conv_id in enumerate(conv_ids):
+        try:
+            refresh_conversation_summary(conv_id)
+        except Exception as e:
+            print(f"[SUMMARY] Chưa tính lại được summary conv {conv_id}: {e}")
+            with _summary_pending_lock:
+                _summary_pending.update(conv_ids[i:])
+            return
+
+def make_message_preview(msg_type: str, content: str) -> str:
+    """
+    Tạo đoạn preview ngắn cho sidebar: text thì cắt bớt,
+    ảnh / video / file thì hiện dạng "[image] tên_file".
+    """
+    msg_type = (msg_type or "text").lower()
+    content = content or ""
+    if msg_type == "text":
+        return content[:SUMMARY_PREVIEW_LEN]
+    return f"[{msg_type}] {content}"[:SUMMARY_PREVIEW_LEN]
+
+
+def _summary_on_insert_batch(rows: list[dict]):
+    """
+    Cập nhật summary cho 1 loạt tin vừa ghi (1 transaction trên primary):
+    mỗi conversation lấy tin có id lớn nhất làm tin cuối, cộng dồn số tin.
+    Lô tới muộn (journal replay, batcher khác) không được đè tin cuối mới hơn:
+    các cột tin cuối chỉ đổi khi id lớn hơn. last_message_id gán SAU CÙNG vì
+    MySQL tính các phép gán ON DUPLICATE KEY UPDATE lần lượt từ trái sang phải.
+    """
+    per_conv: dict[int, tuple[dict, int]] = {}
+    for r in rows:
+        last, cnt = per_conv.get(r["conversation_id"], (None, 0))
+        if last is None or r["id"] > last["id"]:
+            last = r
+        per_conv[r["conversation_id"]] = (last, cnt + 1)
+
+    node = replication.primary_node()
+    conn = get_connection(node)
+    try:
+        with conn.cursor() as cur:
+            for conv_id, (last, cnt) in per_conv.items():
+                cur.execute(
+                    """
+                    INSERT INTO conversation_summary
+                        (conversation_id, last_message_id, last_time,
+                         last_sender_id, last_preview, message_count)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        last_time       = CASE WHEN VALUES(last_message_id) > COALESCE(last_message_id, 0)
+                                               THEN VALUES(last_time) ELSE last_time END,
+                        last_sender_id  = CASE WHEN VALUES(last_message_id) > COALESCE(last_message_id, 0)
+                                               THEN VALUES(last_sender_id) ELSE last_sender_id END,
+                        last_preview    = CASE WHEN VALUES(last_message_id) > COALESCE(last_message_id, 0)
+                                               THEN VALUES(last_preview) ELSE last_preview END,
+                        message_count   = message_count + VALUES(message_count),
+                        last_message_id = GREATEST(COALESCE(last_message_id, 0), VALUES(last_message_id))
+                    """,
+                    (
+                        conv_id,
+                        last["id"],
+                        last["created_at"],
+                        last["sender_id"],
+                        make_message_preview(last["msg_type"], last["content"]),
+                        cnt,
+                    ),
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _summary_on_delete(conversation_id: int, message_id: int):
+    """
+    Giảm message_count; nếu tin bị xóa là tin cuối thì lấy lại tin mới nhất
+    từ node chứa messages (chỉ đọc 1 dòng theo index, không quét cả bảng).
+    """
+    node = replication.primary_node()
+    conn = get_connection(node)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE conversation_summary
+                SET message_count = GREATEST(message_count - 1, 0)
+                WHERE conversation_id = %s
+                """,
+                (conversation_id,),
+            )
+            cur.execute(
+                "SELECT last_message_id FROM conversation_summary WHERE conversation_id = %s",
+                (conversation_id,),
+            )
+            row = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+
+    if row and row.get("last_message_id") == message_id:
+        refresh_conversation_summary(conversation_id)
+
+
+def _load_latest_message(conversation_id: int):
     node_cfg = select_node_for_conversation(conversation_id)
     conn = get_connection(node_cfg)
     try:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                INSERT INTO messages (conversation_id, sender_id, msg_type, content)
-                VALUES (%s, %s, %s, %s)
+                SELECT id, sender_id, msg_type, content, created_at
+                FROM messages
+                WHERE conversation_id = %s
+                ORDER BY id DESC
+                LIMIT 1
                 """,
-                (conversation_id, sender_id, msg_type, content),
+                (conversation_id,),
             )
-            msg_id = cur.lastrowid
+            latest = cur.fetchone()
+            cur.execute(
+                "SELECT COUNT(*) AS cnt FROM messages WHERE conversation_id = %s",
+                (conversation_id,),
+            )
+            cnt = (cur.fetchone() or {}).get("cnt", 0)
+    finally:
+        conn.close()
+
+    if message_archive is not None:
+        cnt += message_archive.count(conversation_id)
+        if latest is None:
+            latest = message_archive.latest(conversation_id)
+    return latest, cnt
+
+
+def refresh_conversation_summary(conversation_id: int):
+    """
+    Tính lại summary của 1 conversation từ bảng messages.
+    Nếu conversation không còn tin nào thì xóa dòng summary.
+    """
+    latest, count = _load_latest_message(conversation_id)
+
+    node = replication.primary_node()
+    conn = get_connection(node)
+    try:
+        with conn.cursor() as cur:
+            if not latest:
+                cur.execute(
+                    "DELETE FROM conversation_summary WHERE conversation_id = %s",
+                    (conversation_id,),
+                )
+            else:
+                cur.execute(
+                    """
+                    REPLACE INTO conversation_summary
+                        (conversation_id, last_message_id, last_time,
+                         last_sender_id, last_preview, message_count)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    """,
+                    (
+                        conversation_id,
+                        latest["id"],
+                        latest["created_at"],
+                        latest["sender_id"],
+                        make_message_preview(latest["msg_type"], latest["content"]),
+                        count,
+                    ),
+                )
         conn.commit()
-        return msg_id
     finally:
         conn.close()
 
 
-def delete_message_for_user(conversation_id: int, message_id: int, sender_id: int) -> bool:
-    """
-    Xóa tin nhắn theo id, chỉ khi đúng người gửi và đúng conversation_id.
-    """
-    node_cfg = select_node_for_conversation(conversation_id)
-    conn = get_connection(node_cfg)
+def delete_conversation_summary(conversation_id: int):
+    node = replication.primary_node()
+    conn = get_connection(node)
     try:
         with conn.cursor() as cur:
             cur.execute(
-                """
-                DELETE FROM messages
-                WHERE id = %s AND conversation_id = %s AND sender_id = %s
-                """,
-                (message_id, conversation_id, sender_id),
+                "DELETE FROM conversation_summary WHERE conversation_id = %s",
+                (conversation_id,),
             )
-            affected = cur.rowcount
         conn.commit()
-        return affected > 0
     finally:
         conn.close()
-def get_message_by_id(conversation_id: int, message_id: int):
+
+
+def init_conversation_summary(rebuild: bool = False):
     """
-    Lấy 1 bản ghi tin nhắn theo id + conversation_id.
-    Dùng để biết msg_type, content trước khi xóa.
+    Nếu bảng conversation_summary đang rỗng (lần đầu chạy) hoặc rebuild=True thì dựng lại
+    từ messages trên tất cả node.
     """
-    node_cfg = select_node_for_conversation(conversation_id)
-    conn = get_connection(node_cfg)
+    node0 = replication.primary_node()
+    conn = get_connection(node0)
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT id, sender_id, msg_type, content
-                FROM messages
-                WHERE id = %s AND conversation_id = %s
-                """,
-                (message_id, conversation_id),
-            )
-            row = cur.fetchone()
-            return row
+            cur.execute("SELECT COUNT(*) AS cnt FROM conversation_summary")
+            existing = (cur.fetchone() or {}).get("cnt", 0)
+            cur.execute("SELECT id FROM conversations")
+            conv_ids = [r["id"] for r in cur.fetchall()]
+        conn.commit()
     finally:
         conn.close()
 
+    if existing and not rebuild:
+        return
+
+    for conv_id in conv_ids:
+        refresh_conversation_summary(conv_id)
+
+
+def _format_last_time(last_time):
+    if hasattr(last_time, "isoformat"):
+        return last_time.isoformat(sep=" ", timespec="seconds")
+    return str(last_time) if last_time is not None else None
+
 
 
 def get_conversations_for_user(user_id: int):
@@ -277,64 +1734,48 @@ def get_conversations_for_user(user_id: int):
     kèm username + display_name của người còn lại,
     thời gian tin nhắn mới nhất (để sort giống Messenger)
     và avatar của partner.
+    Đi theo index user_conversations (user_id, ...) trên primary,
+    partner_id lưu sẵn trong index nên chỉ cần 1 câu query.
     """
-    node = DB_NODES[0]
+    node = replication.primary_node()
     conn = get_connection(node)
     try:
         with conn.cursor() as cur:
-            # Lấy danh sách conversation + last_time
             cur.execute(
                 """
-                SELECT c.id,
-                       MAX(m.created_at) AS last_time
-                FROM conversations c
-                JOIN conversation_members cm_self
-                    ON cm_self.conversation_id = c.id
-                   AND cm_self.user_id = %s
-                LEFT JOIN messages m ON m.conversation_id = c.id
-                WHERE c.is_group = 0
-                GROUP BY c.id
-                ORDER BY last_time IS NULL, last_time DESC, c.id DESC
+                SELECT uc.conversation_id,
+                       u.username,
+                       u.display_name,
+                       u.avatar_url,
+                       s.last_time,
+                       s.last_message_id,
+                       s.last_preview,
+                       s.message_count
+                FROM user_conversations uc
+                JOIN users u
+                    ON u.id = uc.partner_id
+                LEFT JOIN conversation_summary s
+                    ON s.conversation_id = uc.conversation_id
+                WHERE uc.user_id = %s
+                  AND uc.is_group = 0
+                ORDER BY s.last_time IS NULL, s.last_time DESC, uc.conversation_id DESC
                 """,
                 (user_id,),
             )
-            conv_rows = cur.fetchall()
+            rows = cur.fetchall()
             result = []
 
-            for row in conv_rows:
-                conv_id = row["id"]
-                last_time = row["last_time"]
-
-                # Tìm người còn lại trong đoạn chat 1-1
-                cur.execute(
-                    """
-                    SELECT u.username,
-                           u.display_name,
-                           u.avatar_url
-                    FROM conversation_members cm
-                    JOIN users u ON u.id = cm.user_id
-                    WHERE cm.conversation_id = %s
-                      AND cm.user_id <> %s
-                    LIMIT 1
-                    """,
-                    (conv_id, user_id),
-                )
-                partner = cur.fetchone()
-                if not partner:
-                    continue
-
-                if hasattr(last_time, "isoformat"):
-                    last_str = last_time.isoformat(sep=" ", timespec="seconds")
-                else:
-                    last_str = str(last_time) if last_time is not None else None
-
+            for row in rows:
                 result.append({
-                    "conversation_id": conv_id,
-                    "partner_username": partner["username"],
-                    "partner_display_name": partner["display_name"],
-                    "last_time": last_str,
+                    "conversation_id": row["conversation_id"],
+                    "partner_username": row["username"],
+                    "partner_display_name": row["display_name"],
+                    "last_time": _format_last_time(row["last_time"]),
+                    "last_message_id": row.get("last_message_id"),
+                    "last_preview": row.get("last_preview"),
+                    "message_count": row.get("message_count") or 0,
                     # thêm avatar gửi sang client
-                    "partner_avatar_url": partner.get("avatar_url"),
+                    "partner_avatar_url": row.get("avatar_url"),
                 })
 
             return result
@@ -342,58 +1783,85 @@ def get_conversations_for_user(user_id: int):
         conn.close()
 
 
-def delete_conversation_for_users(user1_id: int, user2_id: int) -> bool:
+def _delete_conversation_messages(conversation_id: int) -> int:
     """
-    Xóa toàn bộ conversation 1-1 giữa 2 user (tin nhắn + conversation + members).
-    Ảnh hưởng tới cả hai phía (cả 2 user đều mất lịch sử).
-    Trả về True nếu có conversation và đã xóa, False nếu không tìm thấy.
+    Xóa conversation_members ngay (mất quyền truy cập lập tức); messages, file
+    đính kèm và archive của conversation giao cho job nền xóa dần theo chunk.
+    Trả về id job.
     """
-    conv_id = _find_private_conversation(user1_id, user2_id)
-    if not conv_id:
-        return False
+    if recent_messages is not None:
+        recent_messages.drop(conversation_id)
+    _notify_conversation_changed(conversation_id)
+    for node_msg in _member_nodes(conversation_id):
+        _shard_execute(
+            node_msg,
+            [("DELETE FROM conversation_members WHERE conversation_id = %s",
+              (conversation_id,))],
+        )
+    return job_queue.enqueue(
+        "delete_conversation_messages",
+        {"conversation_id": conversation_id, "before_id": _job_id_bound()},
+    )
 
-    # Xóa messages trên node chứa messages
-    node_msg = select_node_for_conversation(conv_id)
-    conn_msg = get_connection(node_msg)
-    try:
-        with conn_msg.cursor() as cur:
-            cur.execute(
-                "DELETE FROM messages WHERE conversation_id = %s",
-                (conv_id,),
-            )
-        conn_msg.commit()
-    finally:
-        conn_msg.close()
 
-    # Xóa conversation + members ở node trung tâm
-    node0 = DB_NODES[0]
-    conn0 = get_connection(node0)
+def _delete_conversation_directory(conversation_id: int):
+    """
+    Xóa dòng conversations + index user_conversations trên primary,
+    replicate việc xóa qua outbox.
+    """
+    conn0 = get_connection(replication.primary_node())
     try:
         with conn0.cursor() as cur:
+            # members cũ (trước khi shard metadata) có thể còn ở primary
             cur.execute(
                 "DELETE FROM conversation_members WHERE conversation_id = %s",
-                (conv_id,),
+                (conversation_id,),
+            )
+            cur.execute(
+                "DELETE FROM user_conversations WHERE conversation_id = %s",
+                (conversation_id,),
             )
             cur.execute(
                 "DELETE FROM conversations WHERE id = %s",
-                (conv_id,),
+                (conversation_id,),
             )
+            replication.enqueue(cur, "conv_delete", [conversation_id])
         conn0.commit()
     finally:
         conn0.close()
+    _notify_outbox()
+
+
+def delete_conversation_for_users(user1_id: int, user2_id: int) -> bool:
+    """
+    Xóa toàn bộ conversation 1-1 giữa 2 user (tin nhắn + conversation + members).
+    Ảnh hưởng tới cả hai phía (cả 2 user đều mất lịch sử). Tin nhắn + file
+    được job nền xóa sau (xem _delete_conversation_messages).
+    Trả về True nếu có conversation và đã xóa, False nếu không tìm thấy.
+    """
+    conv_id = _find_private_conversation(user1_id, user2_id)
+    if not conv_id:
+        return False
+
+    # Xóa messages + members trên node shard
+    _delete_conversation_messages(conv_id)
+
+    # Xóa conversation + index ở primary
+    _delete_conversation_directory(conv_id)
 
+    delete_conversation_summary(conv_id)
     return True
 # ====== Avatar ======
 def create_group_conversation(name: str, member_ids: list[int]) -> int:
     """
     Tạo conversation nhóm (is_group = 1) và thêm tất cả member vào conversation_members.
-    Lưu ở node DB_NODES[0] giống 1-1.
+    Lưu giống 1-1: conversations + index ở primary, members ở node shard.
     """
     if not member_ids:
         raise ValueError("member_ids rỗng")
 
-    node = DB_NODES[0]
-    conn = get_connection(node)
+    unique_ids = list(dict.fromkeys(member_ids))
+    conn = get_connection(replication.primary_node())
     try:
         with conn.cursor() as cur:
             # tạo conversations
@@ -402,25 +1870,22 @@ def create_group_conversation(name: str, member_ids: list[int]) -> int:
                 (name,),
             )
             conv_id = cur.lastrowid
-
-            # thêm thành viên
-            unique_ids = set(member_ids)
-            for uid in unique_ids:
-                cur.execute(
-                    "INSERT INTO conversation_members (conversation_id, user_id) VALUES (%s, %s)",
-                    (conv_id, uid),
-                )
-
+            replication.enqueue(cur, "conv_upsert", [conv_id, 1, name, None, None])
+            _index_add(cur, conv_id, 1, [(uid, None) for uid in unique_ids])
         conn.commit()
-        return conv_id
     finally:
         conn.close()
+    _notify_outbox()
+
+    # thêm thành viên
+    _write_members(conv_id, unique_ids)
+    return conv_id
 def get_groups_for_user(user_id: int):
     """
     Lấy các conversation là nhóm mà user này tham gia,
     kèm luôn group_avatar (base64) và thời gian tin mới nhất.
     """
-    node = DB_NODES[0]
+    node = replication.primary_node()
     conn = get_connection(node)
     try:
         with conn.cursor() as cur:
@@ -430,35 +1895,58 @@ def get_groups_for_user(user_id: int):
                     c.id           AS conversation_id,
                     c.name         AS group_name,
                     c.group_avatar AS group_avatar,
-                    MAX(m.created_at) AS last_time
-                FROM conversations c
-                JOIN conversation_members cm
-                    ON cm.conversation_id = c.id
-                   AND cm.user_id = %s
-                LEFT JOIN messages m
-                    ON m.conversation_id = c.id
-                WHERE c.is_group = 1
-                GROUP BY c.id, c.name, c.group_avatar
-                ORDER BY last_time IS NULL, last_time DESC, c.id DESC
+                    s.last_time,
+                    s.last_message_id,
+                    s.last_preview,
+                    s.message_count
+                FROM user_conversations uc
+                JOIN conversations c
+                    ON c.id = uc.conversation_id
+                LEFT JOIN conversation_summary s
+                    ON s.conversation_id = c.id
+                WHERE uc.user_id = %s
+                  AND uc.is_group = 1
+                ORDER BY s.last_time IS NULL, s.last_time DESC, c.id DESC
                 """,
                 (user_id,),
             )
             rows = cur.fetchall()
             for r in rows:
-                lt = r.get("last_time")
-                if hasattr(lt, "isoformat"):
-                    r["last_time"] = lt.isoformat(sep=" ", timespec="seconds")
-                elif lt is not None:
-                    r["last_time"] = str(lt)
+                r["last_time"] = _format_last_time(r.get("last_time"))
+                r["message_count"] = r.get("message_count") or 0
             return rows
     finally:
         conn.close()
 
 
 
-def is_user_in_conversation(conv_id: int, user_id: int) -> bool:
-    node = DB_NODES[0]
-    conn = get_connection(node)
+def _is_member_from_index(conversation_id: int, user_id: int) -> bool:
+    """Chế độ degraded: node shard lỗi -> hỏi index user_conversations ở primary."""
+    conn = get_connection(replication.primary_node())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT 1
+                FROM user_conversations
+                WHERE user_id = %s AND conversation_id = %s
+                LIMIT 1
+                """,
+                (user_id, conversation_id),
+            )
+            return cur.fetchone() is not None
+    finally:
+        conn.close()
+
+
+def _is_member(conversation_id: int, user_id: int) -> bool:
+    node = select_node_for_conversation(conversation_id)
+    if _must_journal(node):
+        return _is_member_from_index(conversation_id, user_id)
+    try:
+        conn = get_connection(node)
+    except _NODE_DOWN_ERRORS:
+        return _is_member_from_index(conversation_id, user_id)
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -468,66 +1956,115 @@ def is_user_in_conversation(conv_id: int, user_id: int) -> bool:
                 WHERE conversation_id = %s AND user_id = %s
                 LIMIT 1
                 """,
-                (conv_id, user_id),
+                (conversation_id, user_id),
             )
             return cur.fetchone() is not None
     finally:
         conn.close()
 
 
-def get_members_of_conversation(conv_id: int):
-    """
-    Trả về list các user tham gia conv: [{user_id, username}, ...]
-    """
-    node = DB_NODES[0]
-    conn = get_connection(node)
+def is_user_in_conversation(conv_id: int, user_id: int) -> bool:
+    return _is_member(conv_id, user_id)
+
+
+def _load_members_from_index(conversation_id: int) -> list[dict]:
+    conn = get_connection(replication.primary_node())
     try:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                SELECT u.id AS user_id, u.username
-                FROM conversation_members cm
-                JOIN users u ON u.id = cm.user_id
-                WHERE cm.conversation_id = %s
+                SELECT uc.user_id, u.username, u.display_name
+                FROM user_conversations uc
+                JOIN users u ON u.id = uc.user_id
+                WHERE uc.conversation_id = %s
+                ORDER BY uc.user_id ASC
                 """,
-                (conv_id,),
+                (conversation_id,),
             )
             return cur.fetchall()
     finally:
         conn.close()
-def get_members_of_conversation(conversation_id: int):
+
+
+def _load_members(conversation_id: int) -> list[dict]:
     """
-    Lấy danh sách member của 1 conversation (group hoặc 1-1).
+    Đọc danh sách member từ node shard của conversation, JOIN users ngay tại đó
+    (users được replicate). User mới tạo mà replica chưa kịp nhận thì lấy bù
+    từ primary. Node shard lỗi -> đọc từ index user_conversations ở primary.
     """
-    node = DB_NODES[0]
-    conn = get_connection(node)
+    node = select_node_for_conversation(conversation_id)
+    try:
+        if _must_journal(node):
+            raise NodeUnavailableError(node["name"], "journal chưa replay")
+        conn = get_connection(node)
+    except _NODE_DOWN_ERRORS:
+        return _load_members_from_index(conversation_id)
     try:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                SELECT u.id, u.username, u.display_name
+                SELECT cm.user_id, u.username, u.display_name
                 FROM conversation_members cm
-                JOIN users u ON u.id = cm.user_id
+                LEFT JOIN users u ON u.id = cm.user_id
                 WHERE cm.conversation_id = %s
-                ORDER BY u.id ASC
+                ORDER BY cm.user_id ASC
                 """,
                 (conversation_id,),
             )
-            return cur.fetchall()
+            rows = cur.fetchall()
     finally:
         conn.close()
 
+    missing = [r["user_id"] for r in rows if r["username"] is None]
+    if missing:
+        conn = get_connection(replication.primary_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, username, display_name FROM users WHERE id IN ("
+                    + ", ".join(["%s"] * len(missing)) + ")",
+                    missing,
+                )
+                found = {u["id"]: u for u in cur.fetchall()}
+        finally:
+            conn.close()
+        for r in rows:
+            u = found.get(r["user_id"])
+            if u:
+                r["username"] = u["username"]
+                r["display_name"] = u["display_name"]
+    return [r for r in rows if r["username"] is not None]
+
+
+def get_members_of_conversation(conv_id: int):
+    """
+    Trả về list các user tham gia conv: [{user_id, username}, ...]
+    """
+    return [
+        {"user_id": r["user_id"], "username": r["username"]}
+        for r in _load_members(conv_id)
+    ]
+def get_members_of_conversation(conversation_id: int):
+    """
+    Lấy danh sách member của 1 conversation (group hoặc 1-1).
+    """
+    return [
+        {"id": r["user_id"], "username": r["username"], "display_name": r["display_name"]}
+        for r in _load_members(conversation_id)
+    ]
+
 
 def create_group_conversation(group_name: str, owner_id: int, member_ids: list[int]) -> int:
     """
     Tạo 1 conversation nhóm, thêm toàn bộ member.
     Lưu owner_id + group_avatar=NULL.
+    conversations + index user_conversations ở primary, members ở node shard.
     """
     if not member_ids:
         raise ValueError("member_ids rỗng")
 
-    node = DB_NODES[0]
-    conn = get_connection(node)
+    unique_ids = list(dict.fromkeys(member_ids))
+    conn = get_connection(replication.primary_node())
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -538,86 +2075,76 @@ def create_group_conversation(group_name: str, owner_id: int, member_ids: list[i
                 (group_name, owner_id),
             )
             conv_id = cur.lastrowid
-
-            for uid in member_ids:
-                cur.execute(
-                    """
-                    INSERT INTO conversation_members (conversation_id, user_id)
-                    VALUES (%s, %s)
-                    """,
-                    (conv_id, uid),
-                )
+            replication.enqueue(cur, "conv_upsert", [conv_id, 1, group_name, owner_id, None])
+            _index_add(cur, conv_id, 1, [(uid, None) for uid in unique_ids])
         conn.commit()
-        return conv_id
     finally:
         conn.close()
+    _notify_outbox()
+
+    _write_members(conv_id, unique_ids)
+    return conv_id
 
 
 
 
 def is_user_in_conversation(conversation_id: int, user_id: int) -> bool:
-    node = DB_NODES[0]
-    conn = get_connection(node)
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT 1
-                FROM conversation_members
-                WHERE conversation_id = %s AND user_id = %s
-                LIMIT 1
-                """,
-                (conversation_id, user_id),
-            )
-            return cur.fetchone() is not None
-    finally:
-        conn.close()
+    """
+    Kiểm tra membership trên node shard của conversation (cùng node với messages),
+    node shard lỗi thì dùng index user_conversations.
+    """
+    return _is_member(conversation_id, user_id)
 
 
 def add_user_to_conversation(conversation_id: int, user_id: int) -> bool:
-    node = DB_NODES[0]
-    conn = get_connection(node)
-    try:
-        with conn.cursor() as cur:
-            # dùng INSERT IGNORE để tránh lỗi trùng key
-            cur.execute(
-                """
-                INSERT IGNORE INTO conversation_members (conversation_id, user_id)
-                VALUES (%s, %s)
-                """,
-                (conversation_id, user_id),
-            )
-            affected = cur.rowcount
-        conn.commit()
-        return affected > 0
-    finally:
-        conn.close()
+    """
+    Thêm member trên node shard (INSERT IGNORE để tránh lỗi trùng key),
+    rồi cập nhật index user_conversations ở primary.
+    """
+    affected = _write_members(conversation_id, [user_id])
+    if affected > 0:
+        conn = get_connection(replication.primary_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT IGNORE INTO user_conversations
+                        (user_id, conversation_id, is_group, partner_id)
+                    SELECT %s, id, is_group, NULL
+                    FROM conversations
+                    WHERE id = %s
+                    """,
+                    (user_id, conversation_id),
+                )
+            conn.commit()
+        finally:
+            conn.close()
+    return affected > 0
 
 
 def remove_user_from_conversation(conversation_id: int, user_id: int) -> bool:
-    node = DB_NODES[0]
-    conn = get_connection(node)
+    affected = _write_members(conversation_id, [user_id], remove=True)
+    conn = get_connection(replication.primary_node())
     try:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                DELETE FROM conversation_members
-                WHERE conversation_id = %s AND user_id = %s
+                DELETE FROM user_conversations
+                WHERE user_id = %s AND conversation_id = %s
                 """,
-                (conversation_id, user_id),
+                (user_id, conversation_id),
             )
-            affected = cur.rowcount
         conn.commit()
-        return affected > 0
     finally:
         conn.close()
+    return affected > 0
 
 
 def find_group_by_name(group_name: str):
     """
     Tìm 1 group theo tên.
     """
-    node = DB_NODES[0]
+    node = pick_read_node()
     conn = get_connection(node)
     try:
         with conn.cursor() as cur:
@@ -633,30 +2160,36 @@ def find_group_by_name(group_name: str):
             return cur.fetchone()
     finally:
         conn.close()
-def update_group_avatar(conversation_id: int, avatar_b64: str):
+def update_group_avatar(conversation_id: int, raw: bytes) -> str:
     """
-    Cập nhật avatar cho group (lưu base64 string vào conversations.group_avatar).
+    Cập nhật avatar cho group: ảnh vào kho avatar, conversations.group_avatar giữ hash.
+    Bảng conversations ghi ở primary, replicate sang các node khác
+    (kể cả node shard của conversation) qua outbox.
     """
-    node_cfg = select_node_for_conversation(conversation_id)
-    conn = get_connection(node_cfg)
+    digest = avatar_store.put(raw)
+    conn = get_connection(replication.primary_node())
     try:
         with conn.cursor() as cur:
             cur.execute(
                 "UPDATE conversations SET group_avatar = %s WHERE id = %s",
-                (avatar_b64, conversation_id),
+                (digest, conversation_id),
             )
+            replication.enqueue(cur, "group_avatar", [digest, conversation_id])
         conn.commit()
     finally:
         conn.close()
+    _notify_outbox()
+    return digest
 
 
 def delete_group(conversation_id: int, owner_id: int) -> bool:
     """
     Xóa toàn bộ 1 group (messages, members, conversation) chỉ khi owner_id trùng owner của group.
     Trả về True nếu xóa thành công, False nếu không tìm thấy hoặc không phải owner.
+    Tin nhắn + file được job nền xóa sau (xem _delete_conversation_messages).
     """
     # kiểm tra owner trên node trung tâm
-    node0 = DB_NODES[0]
+    node0 = replication.primary_node()
     conn0 = get_connection(node0)
     try:
         with conn0.cursor() as cur:
@@ -672,42 +2205,20 @@ def delete_group(conversation_id: int, owner_id: int) -> bool:
     finally:
         conn0.close()
 
-    # xóa messages trên node chứa messages
-    node_msg = select_node_for_conversation(conversation_id)
-    conn_msg = get_connection(node_msg)
-    try:
-        with conn_msg.cursor() as cur:
-            cur.execute(
-                "DELETE FROM messages WHERE conversation_id = %s",
-                (conversation_id,),
-            )
-        conn_msg.commit()
-    finally:
-        conn_msg.close()
+    # xóa messages + members trên node shard
+    _delete_conversation_messages(conversation_id)
 
-    # xóa conversation_members + conversation ở node trung tâm
-    conn0 = get_connection(node0)
-    try:
-        with conn0.cursor() as cur:
-            cur.execute(
-                "DELETE FROM conversation_members WHERE conversation_id = %s",
-                (conversation_id,),
-            )
-            cur.execute(
-                "DELETE FROM conversations WHERE id = %s",
-                (conversation_id,),
-            )
-        conn0.commit()
-    finally:
-        conn0.close()
+    # xóa conversation + index ở primary
+    _delete_conversation_directory(conversation_id)
 
+    delete_conversation_summary(conversation_id)
     return True
 def get_conversation_owner(conversation_id: int):
     """
     Trả về owner_id của conversation (chỉ hợp lệ cho group).
     Trả về None nếu không tìm thấy hoặc không có owner.
     """
-    node = DB_NODES[0]
+    node = pick_read_node()
     conn = get_connection(node)
     try:
         with conn.cursor() as cur:
@@ -723,21 +2234,22 @@ def get_conversation_owner(conversation_id: int):
 def set_user_ban_status(username: str, banned: bool):
     """
     Cập nhật cờ is_banned cho user trong DB.
-    Nếu có nhiều node DB thì update hết các node trong DB_NODES.
+    Ghi trên primary, các node còn lại cập nhật qua outbox.
     """
     value = 1 if banned else 0
 
-    for node in DB_NODES:
-        conn = get_connection(node)
-        try:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "UPDATE users SET is_banned = %s WHERE username = %s",
-                    (value, username),
-                )
-            conn.commit()
-        finally:
-            conn.close()
+    conn = get_connection(replication.primary_node())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE users SET is_banned = %s WHERE username = %s",
+                (value, username),
+            )
+            replication.enqueue(cur, "user_ban", [value, username])
+        conn.commit()
+    finally:
+        conn.close()
+    _notify_outbox()
 
 
 def is_user_banned(username: str) -> bool:
@@ -747,7 +2259,7 @@ def is_user_banned(username: str) -> bool:
     if not username:
         return False
 
-    node = DB_NODES[0]
+    node = pick_read_node()
     conn = get_connection(node)
     try:
         with conn.cursor() as cur:
@@ -761,3 +2273,140 @@ def is_user_banned(username: str) -> bool:
             return bool(row.get("is_banned", 0))
     finally:
         conn.close()
+
+
+# ========== BACKGROUND JOBS ==========
+#
+# Xóa hàng loạt (nhóm / đoạn chat đã xóa, tin của user bị ban) chạy trong
+# server/job_queue.py: từng chunk JOB_DELETE_CHUNK tin, xóa file đính kèm
+# trước rồi mới xóa dòng (dừng giữa chừng thì chạy lại chunk đó, không sót file).
+
+job_queue = JobQueue(get_connection)
+
+
+def _job_id_bound() -> int:
+    """
+    Job chỉ xóa tin có id nhỏ hơn mốc này (tin đã có lúc enqueue): conversation_id
+    AUTO_INCREMENT có thể bị dùng lại sau khi MySQL restart, tin của
+    conversation mới không được bị xóa theo.
+    """
+    return first_id_at(int(time.time() * 1000) + 1000)
+
+
+def _delete_message_chunk(node_cfg, where: str, params) -> list[dict]:
+    """Xóa 1 chunk tin khớp `where` (kèm file), trả về các dòng đã xóa."""
+    conn = get_connection(node_cfg)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT id, conversation_id, msg_type, content
+                FROM messages
+                WHERE {where}
+                ORDER BY id
+                LIMIT %s
+                """,
+                (*params, JOB_DELETE_CHUNK),
+            )
+            rows = list(cur.fetchall())
+            if rows:
+                for r in rows:
+                    r["freed"] = remove_attachment(r["msg_type"], r["content"])
+                ids = [r["id"] for r in rows]
+                cur.execute(
+                    "DELETE FROM messages WHERE id IN (" + ", ".join(["%s"] * len(ids)) + ")",
+                    ids,
+                )
+        conn.commit()
+    finally:
+        conn.close()
+    return rows
+
+
+def _job_delete_conversation_messages(job):
+    conv_id = job.params["conversation_id"]
+    before_id = job.params["before_id"]
+    deleted = job.progress.get("deleted", 0)
+    freed = job.progress.get("freed_bytes", 0)
+
+    for node in _member_nodes(conv_id):
+        while True:
+            rows = _delete_message_chunk(
+                node, "conversation_id = %s AND id < %s", (conv_id, before_id)
+            )
+            if not rows:
+                break
+            deleted += len(rows)
+            freed += sum(r["freed"] for r in rows)
+            job.report(deleted=deleted, freed_bytes=freed)
+            time.sleep(JOB_CHUNK_PAUSE_S)
+
+    if message_archive is not None:
+        for i, r in enumerate(message_archive.iter_rows(conv_id, JOB_DELETE_CHUNK), 1):
+            freed += remove_attachment(r["msg_type"], r["content"])
+            deleted += 1
+            if i % JOB_DELETE_CHUNK == 0:
+                job.report(deleted=deleted, freed_bytes=freed)
+        message_archive.drop(conv_id)
+    job.report(deleted=deleted, freed_bytes=freed)
+
+
+def _job_purge_user_messages(job):
+    user_id = job.params["user_id"]
+    before_id = job.params["before_id"]
+    deleted = job.progress.get("deleted", 0)
+    freed = job.progress.get("freed_bytes", 0)
+    touched = set(job.progress.get("conversations", []))
+
+    for node in DB_NODES:
+        while True:
+            rows = _delete_message_chunk(node, "sender_id = %s AND id < %s", (user_id, before_id))
+            if not rows:
+                break
+            for r in rows:
+                if recent_messages is not None:
+                    recent_messages.remove(r["conversation_id"], r["id"])
+            chunk_convs = {r["conversation_id"] for r in rows}
+            for conv_id in chunk_convs:
+                _notify_conversation_changed(conv_id)
+            touched |= chunk_convs
+            deleted += len(rows)
+            freed += sum(r["freed"] for r in rows)
+            job.report(deleted=deleted, freed_bytes=freed, conversations=sorted(touched))
+            time.sleep(JOB_CHUNK_PAUSE_S)
+
+    for conv_id in touched:
+        refresh_conversation_summary(conv_id)
+    job.report(deleted=deleted, freed_bytes=freed, conversations=sorted(touched))
+
+
+job_queue.register("delete_conversation_messages", _job_delete_conversation_messages)
+job_queue.register("purge_user_messages", _job_purge_user_messages)
+
+
+def init_job_queue():
+    """Chạy worker; job dở dang từ lần chạy trước được nhận lại khi lease hết hạn."""
+    job_queue.start()
+
+
+def purge_user_messages(username: str) -> int | None:
+    """
+    Enqueue job xóa toàn bộ tin user đã gửi (trên mọi node, kèm file).
+    Tin đã archive không bị xóa. Trả về id job, None nếu không có user.
+    """
+    user = get_user_by_username(username)
+    if not user:
+        return None
+    return job_queue.enqueue(
+        "purge_user_messages", {"user_id": user["id"], "before_id": _job_id_bound()}
+    )
+
+
+def get_job_status(limit: int = 50) -> dict:
+    """Thống kê + các job gần nhất cho admin (thời gian đổi sang chuỗi để gửi JSON)."""
+    jobs = job_queue.recent(limit)
+    for j in jobs:
+        for key in ("created_at", "finished_at"):
+            if j[key] is not None:
+                j[key] = str(j[key])
+    return {**job_queue.stats(), "jobs": jobs}
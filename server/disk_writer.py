@@ -0,0 +1,203 @@
+# server/disk_writer.py
+#
+# Pool thread ghi file upload (ảnh / video / file) xuống đĩa thay cho
+# open(...).write() ngay trong thread xử lý client:
+#   - ghi ra file tạm cùng thư mục rồi os.replace -> người đọc không bao giờ
+#     thấy file ghi dở, server chết giữa chừng chỉ để lại file .tmp (GC dọn)
+#   - fsync theo UPLOAD_FSYNC_POLICY:
+#       "none"  không fsync (nhanh nhất, mất file vừa ghi nếu máy sập)
+#       "file"  fsync từng file + thư mục chứa nó trước khi báo xong
+#       "batch" gom các file tới gần nhau (tối đa UPLOAD_FSYNC_BATCH_MS /
+#               UPLOAD_FSYNC_BATCH_MAX file), ghi hết rồi mới fsync cả lô,
+#               mỗi thư mục chỉ fsync 1 lần (group commit như write_batcher)
+#   - hàng đợi có giới hạn: đĩa chậm thì submit() chặn lại (backpressure)
+# submit() trả về Future (kết quả = số bytes đã ghi); caller gắn callback
+# (server_main.SendOrder.then), chỉ báo "ok" cho client khi file đã an toàn.
+
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+
+FSYNC_POLICIES = ("none", "file", "batch")
+_SAMPLE_SIZE = 1000         # số lần ghi gần nhất giữ lại để tính thống kê
+
+
+class DiskWriterPool:
+    def __init__(self, workers: int = 4, fsync_policy: str = "batch",
+                 batch_window_ms: float = 10.0, batch_max: int = 32,
+                 max_queue: int = 256):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"fsync_policy không hợp lệ: {fsync_policy}")
+        self.workers = max(1, workers)
+        self.fsync_policy = fsync_policy
+        self.batch_window = max(0.0, batch_window_ms) / 1000.0
+        self.batch_max = max(1, batch_max) if fsync_policy == "batch" else 1
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, max_queue))
+        self._lock = threading.Lock()
+        # (thời điểm xong, bytes, ms chờ trong hàng đợi, ms ghi)
+        self._recent: deque = deque(maxlen=_SAMPLE_SIZE)
+        self._started = time.monotonic()
+        self.files_written = 0
+        self.bytes_written = 0
+        self.fsyncs = 0
+        self.errors = 0
+        self.dir_fsync_errors = 0
+
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f"disk-writer-{i}", daemon=True).start()
+
+    def submit(self, path, data: bytes) -> Future:
+        """Đưa 1 file vào hàng đợi ghi; Future xong khi file đã ở đúng chỗ (và đã fsync)."""
+        fut: Future = Future()
+        self._queue.put((os.fspath(path), data, fut, time.monotonic()))
+        return fut
+
+    def write(self, path, data: bytes) -> int:
+        """Như submit() nhưng chờ luôn kết quả."""
+        return self.submit(path, data).result()
+
+    # ---------- thread ghi ----------
+
+    def _collect(self) -> list:
+        first = self._queue.get()
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_max:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            try:
+                results = self._write(batch)
+            except Exception as e:
+                # lỗi không lường trước (lỗi từng file đã nằm trong results)
+                results = [e] * len(batch)
+            finished = time.monotonic()
+            write_ms = (finished - started) * 1000
+
+            with self._lock:
+                for (_, data, _, enqueued), res in zip(batch, results):
+                    if isinstance(res, Exception):
+                        self.errors += 1
+                        continue
+                    self.files_written += 1
+                    self.bytes_written += len(data)
+                    self._recent.append((finished, len(data), (started - enqueued) * 1000, write_ms))
+            for (_, _, fut, _), res in zip(batch, results):
+                if isinstance(res, Exception):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
+
+    def _fsync_fd(self, fd: int):
+        os.fsync(fd)
+        with self._lock:
+            self.fsyncs += 1
+
+    def _fsync_dir(self, path: str):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self._fsync_fd(fd)
+        finally:
+            os.close(fd)
+
+    def _write(self, batch: list) -> list:
+        """Ghi cả lô, trả về [số bytes | Exception] theo đúng thứ tự."""
+        results: list = [None] * len(batch)
+        staged = []     # (vị trí trong lô, file tạm, đích, file object còn mở)
+        for i, (path, data, _, _) in enumerate(batch):
+            tmp = os.path.join(
+                os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp"
+            )
+            try:
+                f = open(tmp, "wb")
+                try:
+                    f.write(data)
+                    f.flush()
+                    if self.fsync_policy == "file":
+                        self._fsync_fd(f.fileno())
+                except Exception:
+                    f.close()
+                    os.remove(tmp)
+                    raise
+            except Exception as e:
+                results[i] = e
+                continue
+            staged.append((i, tmp, path, f))
+
+        dirs = set()
+        for i, tmp, path, f in staged:
+            try:
+                try:
+                    if self.fsync_policy == "batch":
+                        self._fsync_fd(f.fileno())
+                finally:
+                    f.close()
+                os.replace(tmp, path)
+            except Exception as e:
+                results[i] = e
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                continue
+            results[i] = len(batch[i][1])
+            dirs.add(os.path.dirname(path))
+
+        # rename chỉ bền sau khi fsync thư mục chứa nó. File đã nằm đúng chỗ
+        # (người khác đọc được) nên fsync thư mục lỗi chỉ ghi nhận, không
+        # báo hỏng các file đó; lỗi ghi / rename đã được báo riêng từng file.
+        if self.fsync_policy != "none":
+            for d in dirs:
+                try:
+                    self._fsync_dir(d)
+                except OSError as e:
+                    with self._lock:
+                        self.dir_fsync_errors += 1
+                    print(f"[DISK] fsync thư mục {d} lỗi: {e}")
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            recent = list(self._recent)
+            totals = {
+                "workers": self.workers,
+                "fsync_policy": self.fsync_policy,
+                "queued": self._queue.qsize(),
+                "files_written": self.files_written,
+                "bytes_written": self.bytes_written,
+                "fsyncs": self.fsyncs,
+                "errors": self.errors,
+                "dir_fsync_errors": self.dir_fsync_errors,
+            }
+        uptime = time.monotonic() - self._started
+        totals["avg_mb_per_s"] = round(totals["bytes_written"] / uptime / 1e6, 3) if uptime > 0 else 0.0
+        if not recent:
+            return totals
+        queue_ms = sorted(r[2] for r in recent)
+        write_ms = sorted(r[3] for r in recent)
+        span = recent[-1][0] - recent[0][0]
+        return {
+            **totals,
+            # throughput theo các lần ghi gần nhất (không tính lúc rảnh trước đó)
+            "recent_mb_per_s": round(sum(r[1] for r in recent) / span / 1e6, 3) if span > 0 else None,
+            "queue_ms_p50": round(queue_ms[len(queue_ms) // 2], 2),
+            "queue_ms_p95": round(queue_ms[int(len(queue_ms) * 0.95)], 2),
+            "queue_ms_max": round(queue_ms[-1], 2),
+            "write_ms_p50": round(write_ms[len(write_ms) // 2], 2),
+            "write_ms_p95": round(write_ms[int(len(write_ms) * 0.95)], 2),
+        }
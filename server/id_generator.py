@@ -0,0 +1,87 @@
+# server/id_generator.py
+#
+# Sinh message_id duy nhất toàn cụm, tăng dần theo thời gian (kiểu Snowflake),
+# cấp ngay trong bộ nhớ, không cần hỏi DB:
+#
+#   | 41 bit: ms kể từ ID_EPOCH_MS | 10 bit: worker id | 12 bit: sequence |
+#
+# -> mỗi tiến trình server (worker) sinh được 4096 id / ms, id của các shard
+#    không bao giờ trùng nhau và sort theo id = sort theo thời gian gửi.
+
+import threading
+import time
+
+from common.config import ID_EPOCH_MS, SERVER_WORKER_ID
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id: int, epoch_ms: int = ID_EPOCH_MS):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id phải trong khoảng 0..{MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.epoch_ms = epoch_ms
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def _now_ms(self) -> int:
+        return int(time.time() * 1000)
+
+    def next_id(self) -> int:
+        with self._lock:
+            now = self._now_ms()
+            if now < self._last_ms:
+                # đồng hồ bị lùi (NTP chỉnh giờ): dùng tiếp mốc cũ thay vì sinh id trùng
+                now = self._last_ms
+
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # hết sequence trong ms này -> chờ sang ms kế
+                    while now <= self._last_ms:
+                        time.sleep(0.0001)
+                        now = max(self._now_ms(), self._last_ms)
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+            return (
+                ((now - self.epoch_ms) << (WORKER_BITS + SEQUENCE_BITS))
+                | (self.worker_id << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+    def next_ids(self, n: int) -> list[int]:
+        return [self.next_id() for _ in range(n)]
+
+
+def id_timestamp_ms(msg_id: int, epoch_ms: int = ID_EPOCH_MS) -> int:
+    """Lấy lại thời điểm (ms, unix) đã sinh ra id."""
+    return (msg_id >> (WORKER_BITS + SEQUENCE_BITS)) + epoch_ms
+
+
+def first_id_at(ts_ms: int, epoch_ms: int = ID_EPOCH_MS) -> int:
+    """id nhỏ nhất có thể sinh ra tại thời điểm ts_ms: id < first_id_at(t) <=> sinh trước t."""
+    return max(ts_ms - epoch_ms, 0) << (WORKER_BITS + SEQUENCE_BITS)
+
+
+def id_worker(msg_id: int) -> int:
+    return (msg_id >> SEQUENCE_BITS) & MAX_WORKER_ID
+
+
+_generator: SnowflakeGenerator | None = None
+_generator_lock = threading.Lock()
+
+
+def next_message_id() -> int:
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = SnowflakeGenerator(SERVER_WORKER_ID)
+    return _generator.next_id()
@@ -0,0 +1,285 @@
+# server/job_queue.py
+#
+# Hàng đợi việc nền bền vững (bảng background_jobs trên primary) cho các thao
+# tác nặng: xóa tin của nhóm / đoạn chat đã xóa, xóa tin của user bị ban...
+# Request chỉ enqueue rồi trả lời ngay; worker thread làm dần theo từng chunk.
+#
+#   - status: pending -> running -> done | failed
+#   - run_after: với pending = thời điểm được chạy (backoff khi lỗi),
+#     với running = hạn "thuê" (lease) của worker đang giữ job
+#   - worker gia hạn lease mỗi lần báo tiến độ; server chết giữa chừng thì
+#     lease hết hạn và job được worker khác / lần khởi động sau nhận lại
+# Handler phải idempotent (chạy lại từ đầu vẫn đúng) và gọi job.report() sau
+# mỗi chunk.
+
+import json
+import threading
+import time
+import uuid
+
+from common.config import (
+    JOB_WORKERS,
+    JOB_POLL_S,
+    JOB_LEASE_S,
+    JOB_MAX_ATTEMPTS,
+    JOB_KEEP_FINISHED_S,
+)
+from server.replication import primary_node
+
+MAX_BACKOFF_S = 300
+
+
+class JobLeaseLost(Exception):
+    """Job đã bị worker khác nhận lại (lease hết hạn) -> dừng, không ghi đè kết quả."""
+
+
+class Job:
+    def __init__(self, queue: "JobQueue", row: dict, token: str):
+        self._queue = queue
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.params = json.loads(row["params"])
+        self.progress = json.loads(row["progress"]) if row.get("progress") else {}
+        self.attempts = row["attempts"] + 1
+        self.token = token
+
+    def report(self, **progress):
+        """Lưu tiến độ + gia hạn lease. Gọi sau mỗi chunk."""
+        self.progress.update(progress)
+        if not self._queue._renew(self):
+            raise JobLeaseLost(f"job #{self.id}")
+
+
+class JobQueue:
+    def __init__(self, connect, workers: int = JOB_WORKERS,
+                 poll_interval: float = JOB_POLL_S, lease_s: int = JOB_LEASE_S,
+                 max_attempts: int = JOB_MAX_ATTEMPTS):
+        self._connect = connect
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self._handlers: dict = {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._last_purge = 0.0
+        self.done_total = 0
+        self.failed_total = 0
+
+    def register(self, kind: str, fn):
+        """fn(job) chạy 1 job loại kind."""
+        self._handlers[kind] = fn
+
+    # ---------- enqueue / đọc ----------
+
+    def enqueue(self, kind: str, params: dict) -> int:
+        if kind not in self._handlers:
+            raise ValueError(f"Loại job không hợp lệ: {kind}")
+        conn = self._connect(primary_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO background_jobs (kind, params) VALUES (%s, %s)",
+                    (kind, json.dumps(params, ensure_ascii=False, default=str)),
+                )
+                job_id = cur.lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+        self.notify()
+        return job_id
+
+    def get(self, job_id: int) -> dict | None:
+        rows = self._select("WHERE id = %s", (job_id,))
+        return rows[0] if rows else None
+
+    def recent(self, limit: int = 50) -> list[dict]:
+        return self._select("ORDER BY id DESC LIMIT %s", (limit,))
+
+    def _select(self, tail: str, params) -> list[dict]:
+        conn = self._connect(primary_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, kind, params, status, progress, attempts, last_error, "
+                    "created_at, finished_at FROM background_jobs " + tail,
+                    params,
+                )
+                rows = cur.fetchall()
+        finally:
+            conn.close()
+        for r in rows:
+            r["params"] = json.loads(r["params"])
+            r["progress"] = json.loads(r["progress"]) if r["progress"] else {}
+        return rows
+
+    # ---------- worker ----------
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+                self._purge_finished()
+            except Exception as e:
+                print(f"[JOBS] Lỗi worker: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def run_once(self) -> bool:
+        """Nhận và chạy 1 job đến hạn; False nếu không có job nào."""
+        job = self._claim()
+        if job is None:
+            return False
+        handler = self._handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise ValueError(f"không có handler cho {job.kind}")
+            handler(job)
+        except JobLeaseLost:
+            print(f"[JOBS] Job #{job.id} đã bị worker khác nhận lại, dừng")
+            return True
+        except Exception as e:
+            self._fail(job, e)
+            return True
+        self._finish(job)
+        return True
+
+    def _claim(self) -> Job | None:
+        token = uuid.uuid4().hex
+        conn = self._connect(primary_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT id, kind, params, status, progress, attempts
+                    FROM background_jobs
+                    WHERE status IN ('pending', 'running') AND run_after <= NOW(3)
+                    ORDER BY id
+                    LIMIT 10
+                    """
+                )
+                candidates = cur.fetchall()
+                for row in candidates:
+                    # chỉ 1 worker đổi được dòng này (điều kiện lặp lại trong UPDATE)
+                    cur.execute(
+                        """
+                        UPDATE background_jobs
+                        SET status = 'running',
+                            worker = %s,
+                            attempts = attempts + 1,
+                            run_after = NOW(3) + INTERVAL %s SECOND
+                        WHERE id = %s AND status = %s AND run_after <= NOW(3)
+                        """,
+                        (token, self.lease_s, row["id"], row["status"]),
+                    )
+                    if cur.rowcount == 1:
+                        conn.commit()
+                        if row["status"] == "running":
+                            print(f"[JOBS] Nhận lại job #{row['id']} ({row['kind']}) sau khi lease hết hạn")
+                        return Job(self, row, token)
+            conn.commit()
+            return None
+        finally:
+            conn.close()
+
+    def _update(self, job: Job, sql: str, params) -> bool:
+        conn = self._connect(primary_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql + " WHERE id = %s AND worker = %s", (*params, job.id, job.token))
+                ok = cur.rowcount == 1
+            conn.commit()
+            return ok
+        finally:
+            conn.close()
+
+    def _renew(self, job: Job) -> bool:
+        return self._update(
+            job,
+            "UPDATE background_jobs SET progress = %s, run_after = NOW(3) + INTERVAL %s SECOND",
+            (json.dumps(job.progress, default=str), self.lease_s),
+        )
+
+    def _finish(self, job: Job):
+        self._update(
+            job,
+            "UPDATE background_jobs SET status = 'done', progress = %s, finished_at = NOW(3)",
+            (json.dumps(job.progress, default=str),),
+        )
+        self.done_total += 1
+        print(f"[JOBS] Xong job #{job.id} {job.kind}: {job.progress}")
+
+    def _fail(self, job: Job, err: Exception):
+        self.failed_total += 1
+        if job.attempts >= self.max_attempts:
+            self._update(
+                job,
+                "UPDATE background_jobs SET status = 'failed', last_error = %s, "
+                "progress = %s, finished_at = NOW(3)",
+                (str(err)[:255], json.dumps(job.progress, default=str)),
+            )
+            print(f"[JOBS] Job #{job.id} {job.kind} thất bại hẳn sau {job.attempts} lần: {err}")
+            return
+        backoff = min(MAX_BACKOFF_S, 2 ** job.attempts)
+        self._update(
+            job,
+            "UPDATE background_jobs SET status = 'pending', last_error = %s, progress = %s, "
+            "run_after = NOW(3) + INTERVAL %s SECOND",
+            (str(err)[:255], json.dumps(job.progress, default=str), backoff),
+        )
+        print(f"[JOBS] Job #{job.id} {job.kind} lỗi (lần {job.attempts}), thử lại sau {backoff}s: {err}")
+
+    def _purge_finished(self):
+        """Dọn job đã xong / thất bại lâu rồi (tối đa 1 lần / giờ)."""
+        now = time.monotonic()
+        if now - self._last_purge < 3600:
+            return
+        self._last_purge = now
+        conn = self._connect(primary_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    DELETE FROM background_jobs
+                    WHERE status IN ('done', 'failed')
+                      AND finished_at < NOW(3) - INTERVAL %s SECOND
+                    """,
+                    (JOB_KEEP_FINISHED_S,),
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        conn = self._connect(primary_node())
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT status, COUNT(*) AS cnt FROM background_jobs GROUP BY status"
+                )
+                counts = {r["status"]: int(r["cnt"]) for r in cur.fetchall()}
+        finally:
+            conn.close()
+        return {
+            "workers": self.workers,
+            "counts": counts,
+            "done_total": self.done_total,
+            "failed_total": self.failed_total,
+        }
@@ -0,0 +1,311 @@
+# server/message_archive.py
+#
+# Kho lạnh cho tin nhắn cũ: archiver (db_access.archive_old_messages) chuyển
+# tin cũ hơn ARCHIVE_AFTER_DAYS khỏi bảng messages sang file trên đĩa:
+#
+#   <ARCHIVE_DIR>/<conv_id % 256 (hex)>/<conv_id>/
+#       <min_id>-<max_id>.seg   nhiều block nối tiếp, mỗi block = tối đa
+#                               block_rows dòng JSON nén zlib độc lập
+#       <min_id>-<max_id>.idx   sparse index: [first_id, last_id, offset, length]
+#                               cho từng block + min/max/count của segment
+#       deleted.ids             tin đã xóa sau khi archive (tombstone, 1 id / dòng)
+#
+# Segment chỉ ghi 1 lần (ghi file tạm -> fsync -> rename), file .idx ghi sau
+# cùng nên có .idx = segment đã hoàn chỉnh. Mỗi lần archive của 1 conversation
+# chỉ nhận các tin có id lớn hơn max_id hiện tại -> các segment nối tiếp nhau,
+# không chồng id. Đọc 1 trang = bisect trong sparse index + giải nén vài block.
+#
+# Danh sách segment / tombstone giữ trong RAM sau lần đọc đầu, segment nằm
+# trên đĩa local: chỉ đúng khi 1 tiến trình server duy nhất archive, xóa tin
+# và chạy GC file đính kèm -> mặc định tắt, bật bằng CHAT_ARCHIVE=1.
+
+import bisect
+import json
+import os
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+BLOCK_CACHE_SIZE = 64       # số block đã giải nén giữ trong RAM (LRU)
+
+
+class _Segment:
+    __slots__ = ("name", "min_id", "max_id", "count", "first_ids", "blocks")
+
+    def __init__(self, name: str, meta: dict):
+        self.name = name
+        self.min_id = meta["min_id"]
+        self.max_id = meta["max_id"]
+        self.count = meta["count"]
+        # blocks[i] = (first_id, last_id, offset, length)
+        self.blocks = [tuple(b) for b in meta["blocks"]]
+        self.first_ids = [b[0] for b in self.blocks]
+
+
+def _encode_row(row: dict) -> dict:
+    created = row.get("created_at")
+    return {
+        "id": row["id"],
+        "sender_id": row["sender_id"],
+        "sender_username": row.get("sender_username"),
+        "msg_type": row.get("msg_type"),
+        "content": row.get("content"),
+        "created_at": created.isoformat(sep=" ") if isinstance(created, datetime) else created,
+    }
+
+
+def _decode_row(row: dict) -> dict:
+    created = row.get("created_at")
+    if isinstance(created, str):
+        try:
+            row["created_at"] = datetime.fromisoformat(created)
+        except ValueError:
+            pass
+    return row
+
+
+class MessageArchive:
+    def __init__(self, root, block_rows: int = 256):
+        self.root = Path(root)
+        self.block_rows = max(1, block_rows)
+        self._lock = threading.Lock()
+        self._segments: dict[int, list[_Segment]] = {}
+        self._tombstones: dict[int, set[int]] = {}
+        self._blocks: "OrderedDict[tuple, list[dict]]" = OrderedDict()
+        self.segments_written = 0
+        self.rows_written = 0
+        self.block_reads = 0
+
+    # ---------- đường dẫn / manifest ----------
+
+    def _dir(self, conversation_id: int) -> Path:
+        return self.root / f"{conversation_id % 256:02x}" / str(conversation_id)
+
+    def _load_locked(self, conversation_id: int) -> list[_Segment]:
+        segs = self._segments.get(conversation_id)
+        if segs is not None:
+            return segs
+        segs = []
+        tomb: set[int] = set()
+        d = self._dir(conversation_id)
+        if d.is_dir():
+            for idx in d.glob("*.idx"):
+                try:
+                    meta = json.loads(idx.read_text(encoding="utf-8"))
+                except (OSError, ValueError) as e:
+                    print(f"[ARCHIVE] Bỏ qua index hỏng {idx}: {e}")
+                    continue
+                segs.append(_Segment(idx.stem, meta))
+            segs.sort(key=lambda s: s.min_id)
+            tomb_path = d / "deleted.ids"
+            if tomb_path.exists():
+                for line in tomb_path.read_text(encoding="utf-8").split():
+                    if line.isdigit():
+                        tomb.add(int(line))
+        self._segments[conversation_id] = segs
+        self._tombstones[conversation_id] = tomb
+        return segs
+
+    def max_id(self, conversation_id: int) -> int | None:
+        """id lớn nhất đã archive (None = conversation chưa có segment nào)."""
+        with self._lock:
+            segs = self._load_locked(conversation_id)
+            return segs[-1].max_id if segs else None
+
+    def conversation_ids(self) -> list[int]:
+        """Các conversation đang có thư mục archive."""
+        if not self.root.is_dir():
+            return []
+        return sorted(
+            int(d.name)
+            for bucket in self.root.iterdir() if bucket.is_dir()
+            for d in bucket.iterdir() if d.is_dir() and d.name.isdigit()
+        )
+
+    def count(self, conversation_id: int) -> int:
+        with self._lock:
+            segs = self._load_locked(conversation_id)
+            return sum(s.count for s in segs) - len(self._tombstones[conversation_id])
+
+    # ---------- ghi ----------
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes):
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def append(self, conversation_id: int, rows: list[dict]) -> int:
+        """
+        Ghi 1 segment mới từ rows (id tăng dần, lớn hơn max_id hiện tại).
+        Trả về số dòng đã ghi; chỉ sau khi hàm này trả về mới được xóa
+        các dòng đó khỏi bảng messages.
+        """
+        if not rows:
+            return 0
+        with self._lock:
+            segs = self._load_locked(conversation_id)
+            top = segs[-1].max_id if segs else 0
+            rows = [r for r in rows if r["id"] > top]
+            if not rows:
+                return 0
+
+            data = bytearray()
+            blocks = []
+            for i in range(0, len(rows), self.block_rows):
+                chunk = rows[i:i + self.block_rows]
+                raw = "\n".join(
+                    json.dumps(_encode_row(r), ensure_ascii=False, default=str) for r in chunk
+                ).encode("utf-8")
+                packed = zlib.compress(raw, 6)
+                blocks.append((chunk[0]["id"], chunk[-1]["id"], len(data), len(packed)))
+                data += packed
+
+            name = f"{rows[0]['id']}-{rows[-1]['id']}"
+            meta = {
+                "min_id": rows[0]["id"],
+                "max_id": rows[-1]["id"],
+                "count": len(rows),
+                "blocks": blocks,
+            }
+            d = self._dir(conversation_id)
+            d.mkdir(parents=True, exist_ok=True)
+            self._write_atomic(d / f"{name}.seg", bytes(data))
+            self._write_atomic(d / f"{name}.idx", json.dumps(meta).encode("utf-8"))
+            segs.append(_Segment(name, meta))
+            self.segments_written += 1
+            self.rows_written += len(rows)
+            return len(rows)
+
+    def tombstone(self, conversation_id: int, message_id: int) -> bool:
+        """Đánh dấu 1 tin đã archive là đã xóa. False nếu không có / đã xóa rồi."""
+        if self.get(conversation_id, message_id) is None:
+            return False
+        with self._lock:
+            tomb = self._tombstones[conversation_id]
+            if message_id in tomb:
+                return False
+            with open(self._dir(conversation_id) / "deleted.ids", "a", encoding="utf-8") as f:
+                f.write(f"{message_id}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            tomb.add(message_id)
+            return True
+
+    def drop(self, conversation_id: int):
+        """Xóa toàn bộ archive của conversation (xóa nhóm / xóa đoạn chat)."""
+        with self._lock:
+            self._segments.pop(conversation_id, None)
+            self._tombstones.pop(conversation_id, None)
+            for key in [k for k in self._blocks if k[0] == conversation_id]:
+                del self._blocks[key]
+            shutil.rmtree(self._dir(conversation_id), ignore_errors=True)
+
+    # ---------- đọc ----------
+
+    def _block(self, conversation_id: int, seg: _Segment, i: int) -> list[dict]:
+        key = (conversation_id, seg.name, i)
+        with self._lock:
+            rows = self._blocks.get(key)
+            if rows is not None:
+                self._blocks.move_to_end(key)
+                return rows
+        _, _, offset, length = seg.blocks[i]
+        with open(self._dir(conversation_id) / f"{seg.name}.seg", "rb") as f:
+            f.seek(offset)
+            raw = zlib.decompress(f.read(length)).decode("utf-8")
+        rows = [_decode_row(json.loads(line)) for line in raw.split("\n") if line]
+        with self._lock:
+            self.block_reads += 1
+            self._blocks[key] = rows
+            while len(self._blocks) > BLOCK_CACHE_SIZE:
+                self._blocks.popitem(last=False)
+        return rows
+
+    def _snapshot(self, conversation_id: int):
+        with self._lock:
+            segs = list(self._load_locked(conversation_id))
+            return segs, self._tombstones[conversation_id]
+
+    def read_before(self, conversation_id: int, before_id: int | None, limit: int) -> list[dict]:
+        """`limit` tin mới nhất có id < before_id (None = không chặn), id tăng dần."""
+        segs, tomb = self._snapshot(conversation_id)
+        out: list[dict] = []
+        for seg in reversed(segs):
+            if len(out) >= limit:
+                break
+            if before_id is not None and seg.min_id >= before_id:
+                continue
+            start = len(seg.blocks) - 1
+            if before_id is not None:
+                start = bisect.bisect_left(seg.first_ids, before_id) - 1
+            for i in range(start, -1, -1):
+                rows = [
+                    r for r in self._block(conversation_id, seg, i)
+                    if (before_id is None or r["id"] < before_id) and r["id"] not in tomb
+                ]
+                out[:0] = rows
+                if len(out) >= limit:
+                    break
+        return [dict(r) for r in out[-limit:]] if limit > 0 else []
+
+    def read_after(self, conversation_id: int, after_id: int, limit: int) -> list[dict]:
+        """`limit` tin cũ nhất có id > after_id, id tăng dần."""
+        segs, tomb = self._snapshot(conversation_id)
+        out: list[dict] = []
+        for seg in segs:
+            if len(out) >= limit:
+                break
+            if seg.max_id <= after_id:
+                continue
+            start = max(bisect.bisect_right(seg.first_ids, after_id) - 1, 0)
+            for i in range(start, len(seg.blocks)):
+                out.extend(
+                    r for r in self._block(conversation_id, seg, i)
+                    if r["id"] > after_id and r["id"] not in tomb
+                )
+                if len(out) >= limit:
+                    break
+        return [dict(r) for r in out[:limit]]
+
+    def iter_rows(self, conversation_id: int, batch_size: int = 1000):
+        """Toàn bộ tin đã archive (trừ tombstone) theo id tăng dần, đọc từng trang."""
+        after = 0
+        while True:
+            rows = self.read_after(conversation_id, after, batch_size)
+            if not rows:
+                return
+            yield from rows
+            after = rows[-1]["id"]
+
+    def get(self, conversation_id: int, message_id: int) -> dict | None:
+        segs, tomb = self._snapshot(conversation_id)
+        if message_id in tomb:
+            return None
+        for seg in segs:
+            if seg.min_id <= message_id <= seg.max_id:
+                i = bisect.bisect_right(seg.first_ids, message_id) - 1
+                for r in self._block(conversation_id, seg, i):
+                    if r["id"] == message_id:
+                        return dict(r)
+                return None
+        return None
+
+    def latest(self, conversation_id: int) -> dict | None:
+        rows = self.read_before(conversation_id, None, 1)
+        return rows[0] if rows else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "segments_written": self.segments_written,
+                "rows_written": self.rows_written,
+                "block_reads": self.block_reads,
+                "cached_blocks": len(self._blocks),
+            }
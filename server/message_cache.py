@@ -0,0 +1,271 @@
+# server/message_cache.py
+#
+# Ring buffer trong RAM giữ các tin MỚI NHẤT của từng conversation đang hoạt động:
+#   - nạp khi đọc trang mới nhất từ MySQL, cập nhật ngay khi insert/xóa tin
+#     đi qua tiến trình server này
+#   - mỗi conversation tối đa `per_conversation` tin (liên tục, mới nhất)
+#   - vượt tổng dung lượng `max_bytes` thì bỏ conversation ít dùng nhất (LRU)
+#   - username của người gửi giữ chung 1 bảng, đếm tham chiếu theo số tin
+#     trong các ring: hết tin của người đó thì bỏ, cũng tính vào `max_bytes`
+# Mở lại 1 đoạn chat -> trang mới nhất lấy từ RAM, chỉ cuộn lên trang cũ mới
+# phải hỏi MySQL.
+#
+# Chỉ đúng khi mọi lệnh ghi của conversation đi qua tiến trình này
+# (mặc định tắt; chỉ bật CHAT_HISTORY_CACHE=1 khi chạy 1 tiến trình server).
+
+import bisect
+import threading
+from collections import OrderedDict
+
+ROW_OVERHEAD_BYTES = 200    # ước lượng chi phí 1 dict row ngoài phần content
+USERNAME_OVERHEAD_BYTES = 100   # 1 mục sender_id -> username (ngoài độ dài tên)
+WRITE_STRIPES = 1024
+
+
+def _row_size(row: dict) -> int:
+    return ROW_OVERHEAD_BYTES + len(row.get("content") or "")
+
+
+def _username_size(name: str) -> int:
+    return USERNAME_OVERHEAD_BYTES + len(name)
+
+
+class _Ring:
+    __slots__ = ("ids", "rows", "complete", "size")
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.rows: list[dict] = []
+        # True = ring chứa toàn bộ lịch sử (không còn tin cũ hơn trong DB)
+        self.complete = False
+        self.size = 0
+
+
+class RecentMessageCache:
+    def __init__(self, per_conversation: int, max_bytes: int):
+        self.per_conversation = max(1, per_conversation)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._rings: "OrderedDict[int, _Ring]" = OrderedDict()
+        self._usernames: dict[int, str] = {}
+        self._user_refs: dict[int, int] = {}    # sender_id -> số tin trong các ring
+        self._bytes = 0
+        # bộ đếm ghi theo stripe (conversation_id % WRITE_STRIPES): prime() bỏ qua
+        # nếu có insert/xóa chen vào giữa lúc đọc DB và lúc nạp ring
+        self._write_seq = [0] * WRITE_STRIPES
+        self.hits = 0
+        self.misses = 0
+
+    # ---------- đọc ----------
+
+    def window(self, conversation_id: int, limit: int,
+               before_id: int | None = None, after_id: int | None = None):
+        """
+        Trả về list row (id tăng dần) giống get_messages_for_conversation,
+        hoặc None nếu ring không đủ dữ liệu để trả lời chắc chắn.
+        """
+        with self._lock:
+            ring = self._rings.get(conversation_id)
+            rows = self._window(ring, limit, before_id, after_id) if ring else None
+            if rows is None:
+                self.misses += 1
+                return None
+            usernames = self._usernames
+            if any(r["sender_id"] not in usernames for r in rows):
+                self.misses += 1
+                return None
+            self._rings.move_to_end(conversation_id)
+            self.hits += 1
+            return [{**r, "sender_username": usernames[r["sender_id"]]} for r in rows]
+
+    @staticmethod
+    def _window(ring: _Ring, limit: int, before_id, after_id):
+        ids = ring.ids
+        if after_id is not None:
+            # phải chắc không có tin nào nằm giữa after_id và tin cũ nhất của ring
+            if not ring.complete and (not ids or after_id < ids[0]):
+                return None
+            start = bisect.bisect_right(ids, after_id)
+            return ring.rows[start:start + limit]
+
+        end = len(ids) if before_id is None else bisect.bisect_left(ids, before_id)
+        if before_id is not None and not ring.complete and (not ids or before_id <= ids[0]):
+            return None
+        if end < limit and not ring.complete:
+            return None
+        return ring.rows[max(0, end - limit):end]
+
+    def token(self, conversation_id: int) -> int:
+        """Lấy trước khi đọc DB, truyền lại cho prime() / extend_older()."""
+        with self._lock:
+            return self._write_seq[conversation_id % WRITE_STRIPES]
+
+    # ---------- ghi ----------
+
+    def _bump_locked(self, conversation_id: int):
+        self._write_seq[conversation_id % WRITE_STRIPES] += 1
+
+    def _stale_locked(self, conversation_id: int, token: int) -> bool:
+        return self._write_seq[conversation_id % WRITE_STRIPES] != token
+
+    def prime(self, conversation_id: int, rows: list[dict], complete: bool, token: int):
+        """Nạp ring từ trang mới nhất vừa đọc ở DB (rows sắp theo id tăng dần)."""
+        with self._lock:
+            if self._stale_locked(conversation_id, token):
+                return
+            self._drop_locked(conversation_id)
+            ring = _Ring()
+            ring.complete = complete and len(rows) <= self.per_conversation
+            for r in rows[-self.per_conversation:]:
+                self._remember_user(r)
+                row = self._strip(r)
+                ring.ids.append(row["id"])
+                ring.rows.append(row)
+                ring.size += _row_size(row)
+                self._ref_locked(row)
+            self._rings[conversation_id] = ring
+            self._bytes += ring.size
+            self._evict_locked()
+
+    def extend_older(self, conversation_id: int, before_id: int,
+                     rows: list[dict], complete: bool, token: int):
+        """
+        Trang cũ hơn vừa đọc ở DB nối liền ngay trước ring (before_id = tin
+        cũ nhất trong ring) -> ghép vào đầu ring, trong giới hạn per_conversation.
+        """
+        with self._lock:
+            if self._stale_locked(conversation_id, token):
+                return
+            ring = self._rings.get(conversation_id)
+            if ring is None or not ring.ids or ring.ids[0] != before_id:
+                return
+            room = self.per_conversation - len(ring.ids)
+            if room <= 0:
+                return
+            take = rows[-room:]
+            for r in take:
+                self._remember_user(r)
+            stripped = [self._strip(r) for r in take]
+            added = sum(_row_size(r) for r in stripped)
+            ring.ids[:0] = [r["id"] for r in stripped]
+            ring.rows[:0] = stripped
+            for r in stripped:
+                self._ref_locked(r)
+            ring.size += added
+            self._bytes += added
+            ring.complete = complete and len(take) == len(rows)
+            self._evict_locked()
+
+    def append(self, conversation_id: int, row: dict):
+        """Tin mới của conversation (chỉ cập nhật nếu ring đang có trong RAM)."""
+        with self._lock:
+            self._bump_locked(conversation_id)
+            ring = self._rings.get(conversation_id)
+            if ring is None:
+                return
+            pos = bisect.bisect_left(ring.ids, row["id"])
+            if pos < len(ring.ids) and ring.ids[pos] == row["id"]:
+                return
+            self._remember_user(row)
+            row = self._strip(row)
+            ring.ids.insert(pos, row["id"])
+            ring.rows.insert(pos, row)
+            self._ref_locked(row)
+            ring.size += _row_size(row)
+            self._bytes += _row_size(row)
+            while len(ring.ids) > self.per_conversation:
+                ring.ids.pop(0)
+                old = ring.rows.pop(0)
+                ring.size -= _row_size(old)
+                self._bytes -= _row_size(old)
+                self._unref_locked(old)
+                ring.complete = False
+            self._rings.move_to_end(conversation_id)
+            self._evict_locked()
+
+    def remove(self, conversation_id: int, message_id: int):
+        with self._lock:
+            self._bump_locked(conversation_id)
+            ring = self._rings.get(conversation_id)
+            if ring is None:
+                return
+            pos = bisect.bisect_left(ring.ids, message_id)
+            if pos < len(ring.ids) and ring.ids[pos] == message_id:
+                ring.ids.pop(pos)
+                old = ring.rows.pop(pos)
+                ring.size -= _row_size(old)
+                self._bytes -= _row_size(old)
+                self._unref_locked(old)
+                if not ring.ids and not ring.complete:
+                    # hết tin trong ring mà DB có thể còn tin cũ -> bỏ ring
+                    self._drop_locked(conversation_id)
+
+    def drop(self, conversation_id: int):
+        with self._lock:
+            self._bump_locked(conversation_id)
+            self._drop_locked(conversation_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "conversations": len(self._rings),
+                "usernames": len(self._usernames),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    # ---------- nội bộ ----------
+
+    def _remember_user(self, row: dict):
+        """Gọi ngay trước khi thêm row vào ring (_ref_locked) để tên không bị giữ thừa."""
+        name = row.get("sender_username")
+        if not name:
+            return
+        old = self._usernames.get(row["sender_id"])
+        if old == name:
+            return
+        if old is not None:
+            self._bytes -= _username_size(old)
+        self._usernames[row["sender_id"]] = name
+        self._bytes += _username_size(name)
+
+    def _ref_locked(self, row: dict):
+        sender_id = row["sender_id"]
+        self._user_refs[sender_id] = self._user_refs.get(sender_id, 0) + 1
+
+    def _unref_locked(self, row: dict):
+        sender_id = row["sender_id"]
+        left = self._user_refs.get(sender_id, 0) - 1
+        if left > 0:
+            self._user_refs[sender_id] = left
+            return
+        self._user_refs.pop(sender_id, None)
+        name = self._usernames.pop(sender_id, None)
+        if name is not None:
+            self._bytes -= _username_size(name)
+
+    @staticmethod
+    def _strip(row: dict) -> dict:
+        return {
+            "id": row["id"],
+            "sender_id": row["sender_id"],
+            "msg_type": row.get("msg_type"),
+            "content": row.get("content"),
+            "created_at": row.get("created_at"),
+        }
+
+    def _release_locked(self, ring: _Ring):
+        self._bytes -= ring.size
+        for row in ring.rows:
+            self._unref_locked(row)
+
+    def _drop_locked(self, conversation_id: int):
+        ring = self._rings.pop(conversation_id, None)
+        if ring is not None:
+            self._release_locked(ring)
+
+    def _evict_locked(self):
+        while self._bytes > self.max_bytes and len(self._rings) > 1:
+            _, ring = self._rings.popitem(last=False)
+            self._release_locked(ring)
@@ -0,0 +1,174 @@
+# server/node_health.py
+#
+# Theo dõi sức khỏe từng node DB + circuit breaker:
+#   - closed : bình thường, mọi connection đi qua
+#   - open   : node lỗi kết nối liên tiếp >= ngưỡng -> get_connection báo lỗi
+#              NGAY (NodeUnavailableError) thay vì chờ hết connect timeout
+#   - thread probe nền "SELECT 1" định kỳ trên mọi node: phát hiện node chết
+#     sớm và đóng breaker lại khi node sống lại, sau đó gọi các callback
+#     on_recover (vd. replay journal ghi tạm, xem server/write_journal.py).
+# Khi chưa chạy thread probe (tool dòng lệnh), breaker open quá retry_after
+# giây sẽ cho 1 request đi qua để thử lại.
+
+import threading
+import time
+
+from common.config import (
+    HEALTH_PROBE_INTERVAL_S,
+    HEALTH_FAILURE_THRESHOLD,
+    HEALTH_RETRY_S,
+)
+
+
+class NodeUnavailableError(ConnectionError):
+    """Node DB đang bị circuit breaker chặn (đang lỗi)."""
+
+    def __init__(self, node_name: str, last_error=None):
+        super().__init__(f"node {node_name} đang lỗi: {last_error}")
+        self.node_name = node_name
+
+
+class NodeHealth:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.last_error: str | None = None
+        self.last_ok_at: float | None = None
+        self.last_probe_ms: float | None = None
+        self.trial_in_flight = False
+
+    def to_dict(self) -> dict:
+        now = time.monotonic()
+        return {
+            "node": self.name,
+            "state": self.state,
+            "failures": self.failures,
+            "open_for_s": round(now - self.opened_at, 1) if self.opened_at else 0.0,
+            "last_error": self.last_error,
+            "last_probe_ms": self.last_probe_ms,
+        }
+
+
+class HealthMonitor:
+    def __init__(self, nodes: list[dict], probe,
+                 failure_threshold: int = HEALTH_FAILURE_THRESHOLD,
+                 retry_after: float = HEALTH_RETRY_S,
+                 probe_interval: float = HEALTH_PROBE_INTERVAL_S):
+        self._nodes = nodes
+        self._probe = probe             # probe(node) -> None, raise nếu lỗi
+        self.failure_threshold = max(1, failure_threshold)
+        self.retry_after = retry_after
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._health = {n["name"]: NodeHealth(n["name"]) for n in nodes}
+        self._on_recover = []
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _get(self, name: str) -> NodeHealth:
+        with self._lock:
+            h = self._health.get(name)
+            if h is None:
+                h = self._health[name] = NodeHealth(name)
+            return h
+
+    def add_recover_listener(self, fn):
+        """
+        fn(node_name) được gọi khi node chuyển open -> closed, và sau mỗi lần
+        probe thành công (để làm nốt việc còn dở, vd. replay journal lỗi lần trước).
+        """
+        self._on_recover.append(fn)
+
+    # ---------- dùng trong get_connection ----------
+
+    def before_connect(self, name: str):
+        h = self._get(name)
+        with self._lock:
+            if h.state != "open":
+                return
+            running = self._thread is not None
+            waited = time.monotonic() - (h.opened_at or 0)
+            if not running and waited >= self.retry_after and not h.trial_in_flight:
+                h.trial_in_flight = True
+                return
+        raise NodeUnavailableError(name, h.last_error)
+
+    def record_success(self, name: str) -> bool:
+        """Trả về True nếu node vừa được đóng breaker lại."""
+        h = self._get(name)
+        recovered = False
+        with self._lock:
+            h.failures = 0
+            h.last_ok_at = time.monotonic()
+            h.trial_in_flight = False
+            if h.state == "open":
+                h.state = "closed"
+                h.opened_at = None
+                recovered = True
+        if recovered:
+            print(f"[HEALTH] {name} đã hoạt động lại")
+            self._fire_recover(name)
+        return recovered
+
+    def record_failure(self, name: str, err):
+        h = self._get(name)
+        with self._lock:
+            h.failures += 1
+            h.last_error = str(err)[:255]
+            h.trial_in_flight = False
+            if h.state == "open":
+                h.opened_at = time.monotonic()
+                return
+            if h.failures < self.failure_threshold:
+                return
+            h.state = "open"
+            h.opened_at = time.monotonic()
+        print(f"[HEALTH] {name} bị ngắt (circuit open): {err}")
+
+    def is_available(self, name: str) -> bool:
+        return self._get(name).state != "open"
+
+    def status(self) -> list[dict]:
+        with self._lock:
+            return [h.to_dict() for h in self._health.values()]
+
+    def _fire_recover(self, name: str):
+        for fn in self._on_recover:
+            try:
+                fn(name)
+            except Exception as e:
+                print(f"[HEALTH] on_recover({name}) lỗi: {e}")
+
+    # ---------- thread probe ----------
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="db-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def probe_once(self):
+        for node in self._nodes:
+            name = node["name"]
+            started = time.monotonic()
+            try:
+                self._probe(node)
+            except Exception as e:
+                self.record_failure(name, e)
+                continue
+            self._get(name).last_probe_ms = round((time.monotonic() - started) * 1000, 1)
+            if not self.record_success(name):
+                self._fire_recover(name)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.probe_once()
+            except Exception as e:
+                print(f"[HEALTH] Lỗi probe: {e}")
+            self._stop.wait(self.probe_interval)
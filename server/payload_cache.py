@@ -0,0 +1,82 @@
+# server/payload_cache.py
+#
+# Cache các trang lịch sử ĐÃ encode sẵn (bytes JSON) theo
+# (conversation_id, before_id, after_id, limit). User chuyển qua lại giữa các
+# đoạn chat liên tục -> mở lại 1 đoạn chat chỉ còn ghép bytes rồi sendall,
+# không dựng lại dict từng dòng / isoformat / json.dumps.
+#
+# Mọi insert / xóa tin của conversation xóa hết các trang của conversation đó
+# (db_access.on_conversation_changed). Giới hạn tổng dung lượng, bỏ theo LRU.
+
+import threading
+from collections import OrderedDict
+
+WRITE_STRIPES = 1024
+
+
+class PagePayloadCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pages: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._by_conv: dict[int, set] = {}
+        self._bytes = 0
+        # như message_cache: put() bỏ qua nếu có thay đổi chen vào lúc đang dựng trang
+        self._write_seq = [0] * WRITE_STRIPES
+        self.hits = 0
+        self.misses = 0
+
+    def token(self, conversation_id: int) -> int:
+        with self._lock:
+            return self._write_seq[conversation_id % WRITE_STRIPES]
+
+    def get(self, key: tuple) -> bytes | None:
+        with self._lock:
+            payload = self._pages.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key: tuple, payload: bytes, token: int):
+        conv_id = key[0]
+        with self._lock:
+            if self._write_seq[conv_id % WRITE_STRIPES] != token:
+                return
+            if len(payload) > self.max_bytes:
+                return
+            self._discard_locked(key)
+            self._pages[key] = payload
+            self._by_conv.setdefault(conv_id, set()).add(key)
+            self._bytes += len(payload)
+            while self._bytes > self.max_bytes:
+                old_key, _ = next(iter(self._pages.items()))
+                self._discard_locked(old_key)
+
+    def invalidate(self, conversation_id: int):
+        with self._lock:
+            self._write_seq[conversation_id % WRITE_STRIPES] += 1
+            for key in list(self._by_conv.get(conversation_id, ())):
+                self._discard_locked(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pages": len(self._pages),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _discard_locked(self, key: tuple):
+        payload = self._pages.pop(key, None)
+        if payload is None:
+            return
+        self._bytes -= len(payload)
+        keys = self._by_conv.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_conv[key[0]]
@@ -0,0 +1,201 @@
+# server/plan_check.py
+#
+# Kiểm tra kế hoạch thực thi của các câu query nóng (chạy tay hoặc trong CI):
+#   python -m server.plan_check            (SQLite tạm, không cần MySQL)
+#   python -m server.plan_check --keep     (giữ thư mục DB tạm để xem lại)
+#   python -m pytest tests                 (cùng kiểm tra, chạy trong pytest)
+#
+# Cách làm: dựng cụm SQLite rỗng trong thư mục tạm (schema từ server/schema.py),
+# chạy 1 kịch bản dùng đúng các hàm db_access (đăng ký, chat 1-1, nhóm, lịch sử,
+# tìm kiếm, xóa...), ghi lại mọi câu SQL qua listener của query_stats, rồi
+# EXPLAIN QUERY PLAN từng dạng câu trên node đã chạy nó.
+# Câu nào "SCAN <bảng>" (đọc cả bảng, không qua index) mà hàm gọi không nằm
+# trong INTENTIONAL_SCANS -> báo lỗi, exit code 1. Thiếu index thì thêm
+# migration mới trong server/schema.py.
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+# hàm được phép đọc cả bảng: dựng lại index / summary lúc khởi động,
+# seed / đối chiếu replica, migrate avatar, dọn outbox (chạy nền, theo lô), thống kê job
+INTENTIONAL_SCANS = {
+    "init_conversation_index",
+    "init_conversation_summary",
+    "init_user_index",
+    "_load_users",
+    "_copy_table",
+    "seed_replicas",
+    "reconcile_users",
+    "_migrate_avatar_column",
+    "purge_applied",
+    "replication_status",
+    "applied_versions",
+    "JobQueue.stats",
+    "JobQueue._select",
+}
+
+# SEARCH = đi theo index có điều kiện; SCAN = duyệt hết bảng (kể cả duyệt hết 1 covering index)
+_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+_PLANNED = ("SELECT", "UPDATE", "DELETE", "INSERT", "REPLACE", "WITH")
+
+
+def _full_scans(plan: list[dict]) -> list[str]:
+    scans = []
+    for step in plan:
+        m = _SCAN_RE.match(step.get("detail", ""))
+        # SCAN CONSTANT ROW / subquery tạm không phải đọc bảng
+        if m and not m.group(1).startswith(("CONSTANT", "sqlite_")):
+            scans.append(step["detail"])
+    return scans
+
+
+def run_workload(db):
+    """Kịch bản dùng các đường đọc / ghi chính của server."""
+    db.init_node_health()
+    db.init_schema()
+    db.init_conversation_summary()
+    db.init_replication()
+    db.init_conversation_index()
+    db.init_user_index()
+
+    ids = []
+    for name in ("alice", "bob", "carol", "dave"):
+        db.create_user(name, "x", name.title())
+        ids.append(db.get_user_by_username(name)["id"])
+    alice, bob, carol, dave = ids
+
+    private_id = db.get_or_create_private_conversation(alice, bob)
+    db.get_or_create_private_conversation(alice, bob)
+    msg_ids = [
+        db.insert_message(private_id, alice if i % 2 else bob, "text", f"tin nhắn số {i}")
+        for i in range(30)
+    ]
+    db.get_message_by_id(private_id, msg_ids[-1])
+
+    # bỏ ring cache để các trang lịch sử đọc từ DB
+    if db.recent_messages is not None:
+        db.recent_messages.drop(private_id)
+    db.get_messages_for_conversation(private_id, limit=10)
+    db.get_messages_for_conversation(private_id, limit=10, before_id=msg_ids[10])
+    db.get_messages_for_conversation(private_id, limit=10, after_id=msg_ids[5])
+
+    group_id = db.create_group_conversation("nhóm kiểm tra", alice, [bob, carol])
+    db.insert_message(group_id, carol, "text", "chào cả nhóm")
+    db.add_user_to_conversation(group_id, dave)
+    db.is_user_in_conversation(group_id, dave)
+    db.get_members_of_conversation(group_id)
+    db.get_conversation_owner(group_id)
+    db.remove_user_from_conversation(group_id, dave)
+    db.find_group_by_name("nhóm kiểm tra")
+
+    db.get_conversations_for_user(alice)
+    db.get_groups_for_user(carol)
+    db.search_users("ca")
+    db.search_messages(alice, "tin nhắn")
+
+    # archive toàn bộ (mốc = bây giờ) rồi đọc lịch sử qua archive
+    db.archive_old_messages(older_than_days=0)
+    if db.recent_messages is not None:
+        db.recent_messages.drop(private_id)
+    db.get_messages_for_conversation(private_id, limit=10)
+    db.get_messages_for_conversation(private_id, limit=10, after_id=msg_ids[5])
+
+    # bước đánh dấu của GC file đính kèm (chỉ đọc, không đụng thư mục storage)
+    from server.attachment_gc import AttachmentGC
+    AttachmentGC(dry_run=True, max_rows_per_sec=0, max_files_per_sec=0).mark()
+
+    db.delete_message_for_user(private_id, msg_ids[-1], alice)
+    db.refresh_conversation_summary(private_id)
+    db.set_user_ban_status("dave", True)
+    db.is_user_banned("dave")
+    db.purge_user_messages("dave")
+    db.delete_group(group_id, alice)
+    db.delete_conversation_for_users(alice, bob)
+    # chạy hết job xóa nền ngay trong tiến trình này
+    while db.job_queue.run_once():
+        pass
+    db.get_job_status()
+
+
+def check(db, statements: dict) -> list[dict]:
+    """EXPLAIN từng dạng câu đã chạy, trả về các câu full scan ngoài danh sách cho phép."""
+    failures = []
+    # thread nền (replication, batch writer) vẫn có thể thêm câu trong lúc kiểm tra
+    for (fp, node_name), (func, sql) in list(statements.items()):
+        if not sql.lstrip().upper().startswith(_PLANNED):
+            continue
+        conn = db.backend.connect(db.get_node_by_name(node_name), 5)
+        try:
+            plan = db.backend.explain(conn, sql)
+        except db.backend.Error as e:
+            print(f"[PLAN] Không EXPLAIN được ({func}): {e}")
+            continue
+        finally:
+            conn.close()
+        scans = _full_scans(plan)
+        if scans and func not in INTENTIONAL_SCANS:
+            failures.append({"func": func, "node": node_name, "scans": scans, "sql": fp})
+    return failures
+
+
+def collect(workdir: str):
+    """
+    Dựng cụm SQLite rỗng trong workdir, chạy run_workload và ghi lại mọi dạng
+    câu SQL đã chạy: trả về (db_access, {(fingerprint, node): (hàm, sql)}).
+    Gọi trước khi bất kỳ module nào import common.config / db_access.
+    Mọi file server ghi ra (shard map, journal, storage, log) cũng nằm trong
+    workdir; biến môi trường đã đặt sẵn (vd. tests/conftest.py) được giữ nguyên.
+    """
+    os.environ["CHAT_DB_BACKEND"] = "sqlite"
+    os.environ.setdefault("CHAT_ARCHIVE", "1")     # kịch bản có đọc lịch sử qua archive
+    os.environ.setdefault("CHAT_SQLITE_DIR", workdir)
+    os.environ.setdefault("CHAT_SHARD_MAP", os.path.join(workdir, "shard_map.json"))
+    for var, sub in (("CHAT_JOURNAL_DIR", "journal"), ("CHAT_ARCHIVE_DIR", "archive"),
+                     ("CHAT_STORAGE_DIR", "storage"), ("CHAT_LOG_DIR", "logs")):
+        os.environ.setdefault(var, os.path.join(workdir, sub))
+
+    from server import query_stats
+    from server import db_access as db
+
+    statements: dict[tuple, tuple] = {}
+
+    def remember(func, node, sql, elapsed_ms, rows):
+        key = (query_stats.fingerprint(sql), node)
+        statements.setdefault(key, (func, sql))
+
+    query_stats.stats.add_listener(remember)
+    run_workload(db)
+    return db, statements
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kiểm tra query nóng có dùng index")
+    parser.add_argument("--keep", action="store_true", help="không xóa thư mục DB tạm")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat_plan_check_")
+    try:
+        db, statements = collect(workdir)
+        failures = check(db, statements)
+    finally:
+        if args.keep:
+            print(f"[PLAN] DB tạm: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"[PLAN] Đã kiểm tra {len(statements)} dạng câu SQL")
+    for f in failures:
+        print(f"[PLAN] FULL SCAN {f['func']}@{f['node']}: {'; '.join(f['scans'])}")
+        print(f"       {f['sql'][:300]}")
+    if failures:
+        print(f"[PLAN] {len(failures)} câu đọc cả bảng - thêm index trong server/schema.py")
+        sys.exit(1)
+    print("[PLAN] OK: mọi query nóng đều dùng index")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# server/query_stats.py
+#
+# Đo thời gian từng câu SQL đi qua db_access:
+#   - cursor của từng backend (server/storage_backend.py) gọi timed_execute()
+#     cho mỗi execute(): gắn tên hàm gọi (hàm đầu tiên ngoài driver), node và số dòng
+#   - QueryStats gom theo hàm: số lần, tổng / max thời gian, histogram theo
+#     bucket cố định (ước lượng p50/p95/p99)
+#   - câu chậm hơn ngưỡng -> ghi 1 dòng JSONL vào slow log + giữ mẫu chậm nhất
+#     của từng "dạng câu" (bỏ literal) để admin xem kèm EXPLAIN
+# Chi phí thêm mỗi câu: vài lần đọc frame + 1 lock ngắn.
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from common.config import QUERY_STATS_ENABLED, SLOW_QUERY_MS, SLOW_QUERY_LOG_PATH
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+MAX_FINGERPRINTS = 500
+MAX_SQL_CHARS = 8000
+
+_SKIP_FILES: tuple[str, ...] = (os.path.abspath(__file__),)
+
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER_RE = re.compile(r"\b\d+\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def fingerprint(sql: str) -> str:
+    """Dạng chuẩn của câu SQL: bỏ literal, gộp IN (...) và khoảng trắng."""
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(...)", sql)
+    return _SPACE_RE.sub(" ", sql).strip()
+
+
+def _caller() -> str:
+    """Tên hàm gần nhất ngoài driver / backend / module này (hàm lồng -> tên hàm ngoài)."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if not code.co_filename.startswith(_SKIP_FILES):
+            name = getattr(code, "co_qualname", code.co_name)
+            return name.split(".<locals>.")[0]
+        frame = frame.f_back
+    return "?"
+
+
+class _FuncStats:
+    __slots__ = ("count", "errors", "rows", "total_ms", "max_ms", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def percentile(self, p: float) -> float | None:
+        """Cận trên của bucket chứa phân vị p (bucket cuối -> max_ms)."""
+        if not self.count:
+            return None
+        target = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else round(self.max_ms, 1)
+        return round(self.max_ms, 1)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "rows": self.rows,
+            "total_ms": round(self.total_ms, 1),
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 1),
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": {
+                (f"<={b}" if i < len(LATENCY_BUCKETS_MS) else f">{LATENCY_BUCKETS_MS[-1]}"): n
+                for i, (b, n) in enumerate(zip(LATENCY_BUCKETS_MS + (None,), self.buckets))
+                if n
+            },
+        }
+
+
+class QueryStats:
+    def __init__(self, slow_ms: float, slow_log_path=None, enabled: bool = True):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.slow_log_path = Path(slow_log_path) if slow_log_path else None
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._funcs: dict[str, _FuncStats] = {}
+        # fingerprint -> mẫu chậm nhất đã gặp (chỉ câu vượt ngưỡng slow_ms)
+        self._slowest: dict[str, dict] = {}
+        self._listeners = []
+        self.started_at = time.time()
+
+    def add_listener(self, fn):
+        """fn(func, node, sql, elapsed_ms, rows) sau mỗi câu SQL (vd. server/plan_check.py)."""
+        self._listeners.append(fn)
+
+    def record(self, func: str, node: str, sql: str, elapsed_ms: float,
+               rows: int, error: str | None = None):
+        with self._lock:
+            st = self._funcs.get(func)
+            if st is None:
+                st = self._funcs[func] = _FuncStats()
+            st.count += 1
+            st.total_ms += elapsed_ms
+            if elapsed_ms > st.max_ms:
+                st.max_ms = elapsed_ms
+            st.buckets[bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            if error is not None:
+                st.errors += 1
+            elif rows > 0:
+                st.rows += rows
+        for fn in self._listeners:
+            fn(func, node, sql, elapsed_ms, rows)
+
+        if elapsed_ms < self.slow_ms:
+            return
+
+        entry = {
+            "ts": round(time.time(), 3),
+            "func": func,
+            "node": node,
+            "ms": round(elapsed_ms, 1),
+            "rows": rows,
+            "sql": sql[:MAX_SQL_CHARS],
+            "truncated": len(sql) > MAX_SQL_CHARS,
+        }
+        if error is not None:
+            entry["error"] = error
+        self._remember_slow(fingerprint(sql[:MAX_SQL_CHARS]), entry)
+        self._write_slow_log(entry)
+
+    def _remember_slow(self, fp: str, entry: dict):
+        with self._lock:
+            old = self._slowest.get(fp)
+            if old is not None:
+                old["hits"] += 1
+                if entry["ms"] > old["ms"]:
+                    self._slowest[fp] = {**entry, "fingerprint": fp, "hits": old["hits"]}
+                return
+            if len(self._slowest) >= MAX_FINGERPRINTS:
+                fastest = min(self._slowest, key=lambda k: self._slowest[k]["ms"])
+                if self._slowest[fastest]["ms"] >= entry["ms"]:
+                    return
+                del self._slowest[fastest]
+            self._slowest[fp] = {**entry, "fingerprint": fp, "hits": 1}
+
+    def _write_slow_log(self, entry: dict):
+        print(f"[SLOW] {entry['ms']}ms {entry['func']}@{entry['node']} "
+              f"rows={entry['rows']}: {entry['sql'][:200]}")
+        if self.slow_log_path is None:
+            return
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        try:
+            with self._log_lock:
+                self.slow_log_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.slow_log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except OSError as e:
+            print(f"[SLOW] Không ghi được slow log: {e}")
+
+    # ---------- đọc ----------
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            funcs = {name: st.to_dict() for name, st in self._funcs.items()}
+        return {
+            "since": self.started_at,
+            "slow_ms": self.slow_ms,
+            "functions": dict(
+                sorted(funcs.items(), key=lambda kv: kv[1]["total_ms"], reverse=True)
+            ),
+        }
+
+    def slowest(self, n: int) -> list[dict]:
+        with self._lock:
+            items = [dict(e) for e in self._slowest.values()]
+        items.sort(key=lambda e: e["ms"], reverse=True)
+        return items[:n]
+
+    def reset(self):
+        with self._lock:
+            self._funcs.clear()
+            self._slowest.clear()
+            self.started_at = time.time()
+
+
+stats = QueryStats(SLOW_QUERY_MS, SLOW_QUERY_LOG_PATH, QUERY_STATS_ENABLED)
+
+
+def skip_frames_from(path: str):
+    """Backend đăng ký thư mục / file driver để _caller() bỏ qua khi tìm hàm gọi."""
+    global _SKIP_FILES
+    _SKIP_FILES = (*_SKIP_FILES, path)
+
+
+def timed_execute(cursor, node: str, run, describe):
+    """
+    Chạy run() (đúng 1 lần execute trên cursor), bấm giờ rồi ghi vào stats.
+    describe() trả về câu SQL đã chạy (chỉ gọi sau khi chạy xong).
+    """
+    st = stats
+    if not st.enabled:
+        return run()
+
+    started = time.perf_counter()
+    error = None
+    try:
+        return run()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"[:255]
+        raise
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        st.record(_caller(), node, describe(), elapsed_ms, cursor.rowcount, error)
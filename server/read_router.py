@@ -0,0 +1,72 @@
+# server/read_router.py
+#
+# Chia các truy vấn metadata chỉ-đọc (users, conversations)
+# ra các node replica thay vì dồn hết vào primary.
+#
+# Read-your-writes: mỗi connection client chạy trên 1 thread riêng
+# (server_main.handle_client), nên "session" = thread hiện tại.
+# Mỗi lần session ghi qua outbox, ta nhớ id outbox lớn nhất của từng replica
+# (watermark). Replica chỉ được chọn để đọc cho session đó khi relay đã áp
+# dụng tới watermark -> user vừa tạo nhóm / thêm thành viên không đọc phải
+# dữ liệu cũ.
+
+import itertools
+import threading
+import time
+
+from common.config import READ_REPLICA_MAX_LAG_S
+from server import replication
+
+_session = threading.local()
+_rr_counter = itertools.count()
+
+# do OutboxRelay cập nhật: {node_name: id outbox lớn nhất đã áp dụng liên tục}
+applied_upto: dict[str, int] = {}
+# {node_name: thời điểm (monotonic) gần nhất replica không còn dòng outbox nào chờ}
+caught_up_at: dict[str, float] = {}
+
+
+def reset_session():
+    """Gọi khi bắt đầu 1 connection client mới (thread mới)."""
+    _session.watermarks = {}
+
+
+def _watermarks() -> dict[str, int]:
+    wm = getattr(_session, "watermarks", None)
+    if wm is None:
+        wm = _session.watermarks = {}
+    return wm
+
+
+def note_write(outbox_ids: dict[str, int]):
+    """Ghi nhận session vừa ghi: {replica_name: outbox_id}."""
+    wm = _watermarks()
+    for name, oid in outbox_ids.items():
+        if oid > wm.get(name, 0):
+            wm[name] = oid
+
+
+def mark_applied(node_name: str, upto_id: int, caught_up: bool):
+    if upto_id > applied_upto.get(node_name, 0):
+        applied_upto[node_name] = upto_id
+    if caught_up:
+        caught_up_at[node_name] = time.monotonic()
+
+
+def _replica_ok(node: dict, now: float) -> bool:
+    name = node["name"]
+    if applied_upto.get(name, 0) < _watermarks().get(name, 0):
+        return False
+    seen = caught_up_at.get(name)
+    return seen is not None and now - seen <= READ_REPLICA_MAX_LAG_S
+
+
+def pick_read_node() -> dict:
+    """
+    Chọn node để đọc metadata: xoay vòng giữa primary và các replica
+    đủ mới cho session hiện tại. Không có replica nào đạt -> primary.
+    """
+    primary = replication.primary_node()
+    now = time.monotonic()
+    candidates = [primary] + [n for n in replication.replica_nodes() if _replica_ok(n, now)]
+    return candidates[next(_rr_counter) % len(candidates)]
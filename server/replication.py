@@ -0,0 +1,516 @@
+# server/replication.py
+#
+# Transactional outbox cho các bảng replicate (users, conversations):
+#   - thao tác ghi commit trên node primary (DB_NODES[0]) CÙNG transaction
+#     với 1 dòng replication_outbox cho mỗi node replica
+#   - thread OutboxRelay đọc outbox, áp dụng lên replica theo đúng thứ tự,
+#     retry với backoff khi replica lỗi
+#   - mọi op đều idempotent (upsert theo id / UPDATE gán giá trị) nên áp dụng
+#     lại sau khi crash giữa chừng không làm sai dữ liệu.
+
+import json
+import threading
+import time
+
+from common.config import (
+    DB_NODES,
+    REPLICATION_POLL_S,
+    REPLICATION_MAX_BACKOFF_S,
+    REPLICATION_COMMIT_SAFETY_S,
+)
+from server import read_router
+
+
+class ReplicationConflictError(Exception):
+    """Dòng trên replica mâu thuẫn với primary (vd. cùng username khác id)."""
+
+
+def _apply_user_upsert(cur, params: list):
+    """
+    Upsert user theo id, kèm kiểm tra username: replica có user KHÁC trùng id
+    hoặc trùng username (dữ liệu cũ lệch) thì raise thay vì ghi đè user đó.
+    Relay dừng ở dòng này (retry có backoff) cho tới khi reconcile_users sửa.
+    """
+    user_id, username, password_hash, display_name = params[:4]
+    cur.execute(
+        "SELECT id, username FROM users WHERE id = %s OR username = %s",
+        (user_id, username),
+    )
+    rows = cur.fetchall()
+    for r in rows:
+        if r["id"] != user_id or r["username"] != username:
+            raise ReplicationConflictError(
+                f"user #{user_id} '{username}' trùng với #{r['id']} '{r['username']}' trên replica"
+            )
+    if rows:
+        cur.execute(
+            "UPDATE users SET password_hash = %s, display_name = %s WHERE id = %s",
+            (password_hash, display_name, user_id),
+        )
+    else:
+        cur.execute(
+            """
+            INSERT INTO users (id, username, password_hash, display_name)
+            VALUES (%s, %s, %s, %s)
+            """,
+            (user_id, username, password_hash, display_name),
+        )
+
+
+# op -> câu SQL áp dụng trên replica (tham số lấy theo thứ tự trong params),
+# hoặc hàm (cur, params) cho op cần kiểm tra trước khi ghi
+REPLICATED_OPS = {
+    "user_upsert": _apply_user_upsert,
+    "user_avatar": "UPDATE users SET avatar_url = %s WHERE id = %s",
+    "user_ban": "UPDATE users SET is_banned = %s WHERE username = %s",
+    "conv_upsert": (
+        """
+        INSERT INTO conversations (id, is_group, name, owner_id, group_avatar)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            name         = VALUES(name),
+            owner_id     = VALUES(owner_id),
+            group_avatar = VALUES(group_avatar)
+        """
+    ),
+    "group_avatar": "UPDATE conversations SET group_avatar = %s WHERE id = %s",
+    # conversation_members nay nằm trên node shard của conversation
+    # (db_access._write_members); 2 op dưới chỉ còn dùng cho seed_replicas
+    # và các dòng outbox cũ chưa áp dụng.
+    "member_add": (
+        "INSERT IGNORE INTO conversation_members (conversation_id, user_id) VALUES (%s, %s)"
+    ),
+    "member_remove": (
+        "DELETE FROM conversation_members WHERE conversation_id = %s AND user_id = %s"
+    ),
+    "conv_delete": (
+        "DELETE FROM conversation_members WHERE conversation_id = %s",
+        "DELETE FROM conversations WHERE id = %s",
+    ),
+}
+
+
+def primary_node() -> dict:
+    return DB_NODES[0]
+
+
+def replica_nodes() -> list[dict]:
+    return DB_NODES[1:]
+
+
+def enqueue(cur, op: str, params: list):
+    """
+    Ghi 1 thao tác vào outbox, dùng CHUNG cursor / transaction với thao tác
+    trên primary -> hoặc cả hai cùng commit, hoặc không cái nào.
+    Đồng thời ghi nhận watermark cho session hiện tại (read-your-writes).
+    """
+    if op not in REPLICATED_OPS:
+        raise ValueError(f"op replicate không hợp lệ: {op}")
+    payload = json.dumps(params, ensure_ascii=False, default=str)
+    outbox_ids = {}
+    for node in replica_nodes():
+        cur.execute(
+            """
+            INSERT INTO replication_outbox (target_node, op, params)
+            VALUES (%s, %s, %s)
+            """,
+            (node["name"], op, payload),
+        )
+        outbox_ids[node["name"]] = cur.lastrowid
+    read_router.note_write(outbox_ids)
+
+
+def apply_op(cur, op: str, params: list):
+    stmts = REPLICATED_OPS[op]
+    if callable(stmts):
+        stmts(cur, params)
+        return
+    if isinstance(stmts, str):
+        stmts = (stmts,)
+    for sql in stmts:
+        cur.execute(sql, params[:sql.count("%s")])
+
+
+class OutboxRelay:
+    """
+    Thread nền đẩy outbox sang replica.
+    Với mỗi replica: áp dụng theo id tăng dần, gặp lỗi thì dừng replica đó
+    tới lượt sau (giữ đúng thứ tự, vd. upsert user trước khi đổi avatar).
+    """
+
+    def __init__(self, connect, batch_size: int = 200,
+                 poll_interval: float = REPLICATION_POLL_S,
+                 commit_safety: float = REPLICATION_COMMIT_SAFETY_S):
+        self._connect = connect
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.commit_safety = commit_safety
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.applied_total = 0
+        self.failed_total = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="outbox-relay", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def notify(self):
+        """Có dòng outbox mới -> đánh thức relay ngay, khỏi chờ hết poll_interval."""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[REPLICATION] Lỗi relay: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def run_once(self) -> int:
+        applied = 0
+        for node in replica_nodes():
+            applied += self._relay_to(node)
+        return applied
+
+    def _relay_to(self, node: dict) -> int:
+        primary = self._connect(primary_node())
+        try:
+            with primary.cursor() as cur:
+                # settled: dòng đủ cũ để mọi id nhỏ hơn chắc chắn đã commit
+                # (và đã nằm trong lô này hoặc đã áp dụng từ trước)
+                cur.execute(
+                    """
+                    SELECT id, op, params, attempts,
+                           created_at <= NOW(3) - INTERVAL %s SECOND AS settled
+                    FROM replication_outbox
+                    WHERE target_node = %s
+                      AND applied_at IS NULL
+                    ORDER BY id ASC
+                    LIMIT %s
+                    """,
+                    (self.commit_safety, node["name"], self.batch_size),
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    cur.execute(
+                        """
+                        SELECT COALESCE(MAX(id), 0) AS max_id FROM replication_outbox
+                        WHERE target_node = %s
+                          AND created_at <= NOW(3) - INTERVAL %s SECOND
+                        """,
+                        (node["name"], self.commit_safety),
+                    )
+                    max_id = (cur.fetchone() or {}).get("max_id", 0)
+                    primary.commit()
+                    read_router.mark_applied(node["name"], max_id, caught_up=True)
+                    return 0
+                # dòng đầu còn đang chờ backoff -> bỏ qua replica này lượt này
+                cur.execute(
+                    "SELECT next_attempt_at <= NOW(3) AS due FROM replication_outbox WHERE id = %s",
+                    (rows[0]["id"],),
+                )
+                if not (cur.fetchone() or {}).get("due"):
+                    return 0
+            primary.commit()
+
+            applied_ids = []
+            failed = None
+            try:
+                replica = self._connect(node)
+            except Exception as e:
+                replica = None
+                failed = (rows[0], e)
+
+            if replica is not None:
+                try:
+                    with replica.cursor() as rcur:
+                        for row in rows:
+                            try:
+                                apply_op(rcur, row["op"], json.loads(row["params"]))
+                                replica.commit()
+                            except Exception as e:
+                                replica.rollback()
+                                failed = (row, e)
+                                break
+                            applied_ids.append(row["id"])
+                finally:
+                    replica.close()
+
+            with primary.cursor() as cur:
+                if applied_ids:
+                    cur.execute(
+                        "UPDATE replication_outbox SET applied_at = NOW(3) WHERE id IN ("
+                        + ", ".join(["%s"] * len(applied_ids)) + ")",
+                        applied_ids,
+                    )
+                if failed:
+                    row, err = failed
+                    backoff = min(REPLICATION_MAX_BACKOFF_S, 2 ** min(row["attempts"], 10))
+                    cur.execute(
+                        """
+                        UPDATE replication_outbox
+                        SET attempts = attempts + 1,
+                            last_error = %s,
+                            next_attempt_at = NOW(3) + INTERVAL %s SECOND
+                        WHERE id = %s
+                        """,
+                        (str(err)[:255], backoff, row["id"]),
+                    )
+            primary.commit()
+        finally:
+            primary.close()
+
+        # id lớn hơn mà còn mới thì chưa tính: transaction cấp id nhỏ hơn
+        # có thể chưa commit (lượt sau / lượt rảnh sẽ nâng watermark)
+        settled = [r["id"] for r in rows[:len(applied_ids)] if r["settled"]]
+        if applied_ids:
+            read_router.mark_applied(
+                node["name"],
+                settled[-1] if settled else 0,
+                caught_up=not failed and len(rows) < self.batch_size,
+            )
+        self.applied_total += len(applied_ids)
+        if failed:
+            self.failed_total += 1
+            print(f"[REPLICATION] {node['name']} lỗi ở outbox #{failed[0]['id']}: {failed[1]}")
+        return len(applied_ids)
+
+
+def replication_status(connect) -> list[dict]:
+    """
+    Độ trễ replicate theo từng replica:
+    số dòng outbox chưa áp dụng + tuổi (giây) của dòng cũ nhất.
+    """
+    conn = connect(primary_node())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT target_node,
+                       COUNT(*) AS pending,
+                       TIMESTAMPDIFF(MICROSECOND, MIN(created_at), NOW(3)) / 1000000 AS lag_s,
+                       MAX(attempts) AS max_attempts
+                FROM replication_outbox
+                WHERE applied_at IS NULL
+                GROUP BY target_node
+                """
+            )
+            rows = {r["target_node"]: r for r in cur.fetchall()}
+    finally:
+        conn.close()
+
+    result = []
+    for node in replica_nodes():
+        r = rows.get(node["name"]) or {}
+        result.append({
+            "node": node["name"],
+            "pending": int(r.get("pending") or 0),
+            "lag_s": float(r.get("lag_s") or 0.0),
+            "max_attempts": int(r.get("max_attempts") or 0),
+        })
+    return result
+
+
+def purge_applied(connect, older_than_s: int = 24 * 3600) -> int:
+    """Dọn các dòng outbox đã áp dụng xong lâu rồi."""
+    conn = connect(primary_node())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM replication_outbox
+                WHERE applied_at IS NOT NULL
+                  AND applied_at < NOW(3) - INTERVAL %s SECOND
+                """,
+                (older_than_s,),
+            )
+            affected = cur.rowcount
+        conn.commit()
+        return affected
+    finally:
+        conn.close()
+
+
+def seed_replicas(connect, batch_size: int = 1000):
+    """
+    Copy conversations + conversation_members hiện có từ primary sang replica
+    (chỉ làm 1 lần cho mỗi replica, đánh dấu trong replication_state).
+    Các thay đổi sau đó đi qua outbox.
+    """
+    primary = connect(primary_node())
+    try:
+        with primary.cursor() as cur:
+            cur.execute("SELECT node_name FROM replication_state WHERE seeded_at IS NOT NULL")
+            seeded = {r["node_name"] for r in cur.fetchall()}
+        primary.commit()
+    finally:
+        primary.close()
+
+    for node in replica_nodes():
+        if node["name"] in seeded:
+            continue
+        for table, cols, op in (
+            ("conversations", "id, is_group, name, owner_id, group_avatar", "conv_upsert"),
+            ("conversation_members", "conversation_id, user_id", "member_add"),
+        ):
+            _copy_table(connect, node, table, cols, op, batch_size)
+
+        _mark_state(connect, node, "seeded_at")
+        print(f"[REPLICATION] Đã seed metadata sang {node['name']}")
+
+
+def _mark_state(connect, node: dict, column: str):
+    primary = connect(primary_node())
+    try:
+        with primary.cursor() as cur:
+            cur.execute(
+                "INSERT IGNORE INTO replication_state (node_name) VALUES (%s)",
+                (node["name"],),
+            )
+            cur.execute(
+                f"UPDATE replication_state SET {column} = NOW() WHERE node_name = %s",
+                (node["name"],),
+            )
+        primary.commit()
+    finally:
+        primary.close()
+
+
+def _read_usernames(connect, node: dict, batch_size: int) -> dict[int, str]:
+    users: dict[int, str] = {}
+    last_id = 0
+    conn = connect(node)
+    try:
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, username FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                    (last_id, batch_size),
+                )
+                rows = cur.fetchall()
+            conn.commit()
+            if not rows:
+                return users
+            for r in rows:
+                users[r["id"]] = r["username"]
+            last_id = rows[-1]["id"]
+    finally:
+        conn.close()
+
+
+def reconcile_users(connect, batch_size: int = 1000):
+    """
+    Đối chiếu bảng users của replica với primary, 1 lần cho mỗi replica
+    (đánh dấu users_reconciled_at), chạy TRƯỚC khi bật relay.
+    Bản cũ mỗi node tự INSERT users nên AUTO_INCREMENT có thể lệch: cùng
+    username khác id, hoặc cùng id khác người. Primary thắng: xóa các dòng
+    replica không khớp (id, username) của primary rồi chép lại mọi user
+    theo id của primary. messages / conversation_members vốn dùng id của
+    primary (get_user_by_username luôn đọc primary trước) nên không phải đổi.
+    """
+    primary = connect(primary_node())
+    try:
+        with primary.cursor() as cur:
+            cur.execute("SELECT node_name FROM replication_state WHERE users_reconciled_at IS NOT NULL")
+            done = {r["node_name"] for r in cur.fetchall()}
+        primary.commit()
+    finally:
+        primary.close()
+
+    pending = [n for n in replica_nodes() if n["name"] not in done]
+    if not pending:
+        return
+    primary_users = _read_usernames(connect, primary_node(), batch_size)
+
+    for node in pending:
+        stale = [
+            uid for uid, username in _read_usernames(connect, node, batch_size).items()
+            if primary_users.get(uid) != username
+        ]
+        dst = connect(node)
+        try:
+            with dst.cursor() as cur:
+                for i in range(0, len(stale), batch_size):
+                    chunk = stale[i:i + batch_size]
+                    cur.execute(
+                        "DELETE FROM users WHERE id IN (" + ", ".join(["%s"] * len(chunk)) + ")",
+                        chunk,
+                    )
+            dst.commit()
+        finally:
+            dst.close()
+
+        last_id = 0
+        while True:
+            src = connect(primary_node())
+            try:
+                with src.cursor() as cur:
+                    cur.execute(
+                        """
+                        SELECT id, username, password_hash, display_name, avatar_url, is_banned
+                        FROM users WHERE id > %s ORDER BY id LIMIT %s
+                        """,
+                        (last_id, batch_size),
+                    )
+                    rows = cur.fetchall()
+                src.commit()
+            finally:
+                src.close()
+            if not rows:
+                break
+            dst = connect(node)
+            try:
+                with dst.cursor() as cur:
+                    for r in rows:
+                        _apply_user_upsert(
+                            cur, [r["id"], r["username"], r["password_hash"], r["display_name"]]
+                        )
+                        cur.execute(
+                            "UPDATE users SET avatar_url = %s, is_banned = %s WHERE id = %s",
+                            (r["avatar_url"], r["is_banned"], r["id"]),
+                        )
+                dst.commit()
+            finally:
+                dst.close()
+            last_id = rows[-1]["id"]
+
+        _mark_state(connect, node, "users_reconciled_at")
+        print(f"[REPLICATION] Đã đối chiếu users với {node['name']} "
+              f"(xóa {len(stale)} dòng lệch, chép {len(primary_users)} user)")
+
+
+def _copy_table(connect, node, table: str, cols: str, op: str, batch_size: int):
+    offset = 0
+    while True:
+        src = connect(primary_node())
+        try:
+            with src.cursor() as cur:
+                cur.execute(
+                    f"SELECT {cols} FROM {table} ORDER BY {cols.split(',')[0]} "
+                    "LIMIT %s OFFSET %s",
+                    (batch_size, offset),
+                )
+                rows = cur.fetchall()
+        finally:
+            src.close()
+        if not rows:
+            return
+
+        names = [c.strip() for c in cols.split(",")]
+        dst = connect(node)
+        try:
+            with dst.cursor() as cur:
+                for r in rows:
+                    apply_op(cur, op, [r[n] for n in names])
+            dst.commit()
+        finally:
+            dst.close()
+        offset += len(rows)
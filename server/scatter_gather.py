@@ -0,0 +1,137 @@
+# server/scatter_gather.py
+#
+# Chạy cùng 1 thao tác trên nhiều node DB song song thay vì lần lượt,
+# để độ trễ ~ node chậm nhất (ghi) hoặc node nhanh nhất có dữ liệu (đọc),
+# không tăng tuyến tính theo số node.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from common.config import DB_NODES, DB_NODE_TIMEOUT_S
+
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(4, len(DB_NODES) * 4),
+                thread_name_prefix="db-scatter",
+            )
+        return _executor
+
+
+class ScatterResult:
+    """
+    Kết quả 1 lần scatter:
+      results: {node_name: giá trị trả về}
+      errors:  {node_name: exception} (kể cả TimeoutError khi quá hạn)
+    """
+
+    def __init__(self):
+        self.results: dict[str, object] = {}
+        self.errors: dict[str, BaseException] = {}
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.errors) and bool(self.results)
+
+    def __repr__(self):
+        return f"ScatterResult(ok={list(self.results)}, failed={list(self.errors)})"
+
+
+def scatter(fn, nodes: list[dict] | None = None,
+            timeout: float | None = None) -> ScatterResult:
+    """
+    Gọi fn(node) trên tất cả node cùng lúc, chờ tối đa `timeout` giây.
+    Node nào quá hạn được ghi vào errors với TimeoutError.
+    """
+    nodes = DB_NODES if nodes is None else nodes
+    timeout = DB_NODE_TIMEOUT_S if timeout is None else timeout
+
+    result = ScatterResult()
+    if not nodes:
+        return result
+
+    executor = _get_executor()
+    futures = {executor.submit(fn, node): node["name"] for node in nodes}
+    done, not_done = wait(futures, timeout=timeout)
+
+    for fut in done:
+        name = futures[fut]
+        try:
+            result.results[name] = fut.result()
+        except Exception as e:
+            result.errors[name] = e
+    for fut in not_done:
+        result.errors[futures[fut]] = TimeoutError(
+            f"node {futures[fut]} quá {timeout}s"
+        )
+    return result
+
+
+# trạng thái của gather_first
+FOUND = "found"
+NOT_FOUND = "not_found"
+UNKNOWN = "unknown"
+
+
+def gather_first(fn, nodes: list[dict] | None = None,
+                 timeout: float | None = None,
+                 authoritative: str | None = None) -> tuple[str, object]:
+    """
+    Đọc song song trên các node, trả về (trạng thái, giá trị):
+      (FOUND, v)        kết quả khác None đầu tiên, không chờ các node còn lại
+      (NOT_FOUND, None) chắc chắn không có: node `authoritative` (nơi dữ liệu
+                        được ghi trước, vd. primary) đã trả None - không chỉ
+                        định thì phải mọi node đều trả None
+      (UNKNOWN, lỗi)    chưa đủ căn cứ: node lỗi / quá hạn, chỉ có replica
+                        (có thể trễ) trả None. Caller báo lỗi "thử lại sau",
+                        KHÔNG coi như không có.
+    `timeout` là hạn chung cho cả lần đọc, không phải cho từng lượt chờ.
+    """
+    nodes = DB_NODES if nodes is None else nodes
+    timeout = DB_NODE_TIMEOUT_S if timeout is None else timeout
+    if not nodes:
+        return NOT_FOUND, None
+
+    executor = _get_executor()
+    futures = {executor.submit(fn, node): node["name"] for node in nodes}
+    pending = set(futures)
+    errors: list[BaseException] = []
+    answered: set[str] = set()
+    deadline = time.monotonic() + timeout
+
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for fut in done:
+            try:
+                value = fut.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if value is not None:
+                return FOUND, value
+            answered.add(futures[fut])
+        if authoritative is not None and authoritative in answered:
+            return NOT_FOUND, None
+
+    if authoritative is None and len(answered) == len(nodes):
+        return NOT_FOUND, None
+    for fut in pending:
+        errors.append(TimeoutError(f"node {futures[fut]} quá {timeout}s"))
+    if not errors:
+        errors.append(LookupError(f"node {authoritative} chưa trả lời"))
+    return UNKNOWN, errors[0]
@@ -0,0 +1,360 @@
+# server/schema.py
+#
+# Schema của mọi node, quản lý bằng migration có đánh số:
+#   - bảng schema_migrations trên từng node ghi các version đã chạy
+#   - init_schema() (db_access) chạy các version còn thiếu theo thứ tự,
+#     mỗi version 1 lần; SQLite backend chạy ngay khi mở file node lần đầu
+#   - mỗi migration có câu lệnh riêng cho "mysql" và "sqlite"
+# Thêm bảng / index mới = thêm 1 Migration ở CUỐI danh sách, không sửa
+# migration đã phát hành (node cũ sẽ không chạy lại).
+#
+# Index nào phục vụ câu query nào được ghi ngay cạnh lệnh tạo index;
+# server/plan_check.py kiểm tra các câu query nóng vẫn dùng index (không full scan).
+# FULLTEXT cho tìm tin nhắn tạo riêng ở thread nền (ensure_message_search_index).
+
+
+class Migration:
+    __slots__ = ("version", "name", "statements")
+
+    def __init__(self, version: int, name: str, mysql: list[str], sqlite: list[str]):
+        self.version = version
+        self.name = name
+        self.statements = {"mysql": mysql, "sqlite": sqlite}
+
+
+SCHEMA_MIGRATIONS_DDL = {
+    "mysql": """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version     INT          NOT NULL PRIMARY KEY,
+            name        VARCHAR(100) NOT NULL,
+            applied_at  DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    "sqlite": """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version     INTEGER  PRIMARY KEY,
+            name        TEXT     NOT NULL,
+            applied_at  DATETIME NOT NULL DEFAULT (datetime('now', 'localtime'))
+        )
+    """,
+}
+
+_SQLITE_NOW_MS = "(strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))"
+
+MIGRATIONS = [
+    Migration(
+        1, "base_tables",
+        mysql=[
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id             INT          NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                username       VARCHAR(50)  NOT NULL,
+                password_hash  VARCHAR(255) NOT NULL,
+                display_name   VARCHAR(100) NULL,
+                avatar_url     LONGTEXT     NULL,
+                is_banned      TINYINT(1)   NOT NULL DEFAULT 0,
+                created_at     DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE KEY uq_users_username (username)
+            ) DEFAULT CHARSET = utf8mb4
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id            INT          NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                is_group      TINYINT(1)   NOT NULL DEFAULT 0,
+                name          VARCHAR(100) NULL,
+                owner_id      INT          NULL,
+                group_avatar  LONGTEXT     NULL,
+                created_at    DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP
+            ) DEFAULT CHARSET = utf8mb4
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS conversation_members (
+                conversation_id  INT      NOT NULL,
+                user_id          INT      NOT NULL,
+                joined_at        DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (conversation_id, user_id)
+            ) DEFAULT CHARSET = utf8mb4
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id               BIGINT      NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                conversation_id  INT         NOT NULL,
+                sender_id        INT         NOT NULL,
+                msg_type         VARCHAR(20) NOT NULL DEFAULT 'text',
+                content          TEXT        NULL,
+                created_at       DATETIME    NOT NULL DEFAULT CURRENT_TIMESTAMP
+            ) DEFAULT CHARSET = utf8mb4
+            """,
+        ],
+        sqlite=[
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id             INTEGER  PRIMARY KEY AUTOINCREMENT,
+                username       TEXT     NOT NULL COLLATE NOCASE UNIQUE,
+                password_hash  TEXT     NOT NULL,
+                display_name   TEXT     NULL,
+                avatar_url     TEXT     NULL,
+                is_banned      INTEGER  NOT NULL DEFAULT 0,
+                created_at     DATETIME NOT NULL DEFAULT (datetime('now', 'localtime'))
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id            INTEGER  PRIMARY KEY AUTOINCREMENT,
+                is_group      INTEGER  NOT NULL DEFAULT 0,
+                name          TEXT     NULL,
+                owner_id      INTEGER  NULL,
+                group_avatar  TEXT     NULL,
+                created_at    DATETIME NOT NULL DEFAULT (datetime('now', 'localtime'))
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS conversation_members (
+                conversation_id  INTEGER  NOT NULL,
+                user_id          INTEGER  NOT NULL,
+                joined_at        DATETIME NOT NULL DEFAULT (datetime('now', 'localtime')),
+                PRIMARY KEY (conversation_id, user_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id               INTEGER  PRIMARY KEY,
+                conversation_id  INTEGER  NOT NULL,
+                sender_id        INTEGER  NOT NULL,
+                msg_type         TEXT     NOT NULL DEFAULT 'text',
+                content          TEXT     NULL,
+                created_at       DATETIME NOT NULL DEFAULT (datetime('now', 'localtime'))
+            )
+            """,
+        ],
+    ),
+    Migration(
+        2, "snowflake_message_ids",
+        # id Snowflake vượt INT (chỉ MySQL; INTEGER của SQLite đã 64 bit)
+        mysql=["ALTER TABLE messages MODIFY id BIGINT NOT NULL AUTO_INCREMENT"],
+        sqlite=[],
+    ),
+    Migration(
+        3, "hot_query_indexes",
+        mysql=[
+            # lịch sử theo keyset: WHERE conversation_id = ? AND id < ? ORDER BY id DESC
+            "CREATE INDEX IF NOT EXISTS idx_messages_conv_id ON messages (conversation_id, id)",
+            # conversation_members WHERE user_id = ? (seed / rebuild index theo user)
+            "CREATE INDEX IF NOT EXISTS idx_members_user ON conversation_members (user_id, conversation_id)",
+            # find_group_by_name: WHERE is_group = 1 AND name = ?
+            "CREATE INDEX IF NOT EXISTS idx_conversations_group_name ON conversations (is_group, name)",
+        ],
+        sqlite=[
+            "CREATE INDEX IF NOT EXISTS idx_messages_conv_id ON messages (conversation_id, id)",
+            "CREATE INDEX IF NOT EXISTS idx_members_user ON conversation_members (user_id, conversation_id)",
+            "CREATE INDEX IF NOT EXISTS idx_conversations_group_name ON conversations (is_group, name)",
+        ],
+    ),
+    Migration(
+        4, "conversation_summary",
+        # sidebar: 1 dòng / conversation thay cho MAX(created_at) trên messages
+        mysql=[
+            """
+            CREATE TABLE IF NOT EXISTS conversation_summary (
+                conversation_id  INT          NOT NULL PRIMARY KEY,
+                last_message_id  BIGINT       NULL,
+                last_time        DATETIME     NULL,
+                last_sender_id   INT          NULL,
+                last_preview     VARCHAR(255) NULL,
+                message_count    INT          NOT NULL DEFAULT 0,
+                KEY idx_summary_last_time (last_time)
+            ) DEFAULT CHARSET = utf8mb4
+            """,
+            "ALTER TABLE conversation_summary MODIFY last_message_id BIGINT NULL",
+        ],
+        sqlite=[
+            """
+            CREATE TABLE IF NOT EXISTS conversation_summary (
+                conversation_id  INTEGER  PRIMARY KEY,
+                last_message_id  INTEGER  NULL,
+                last_time        DATETIME NULL,
+                last_sender_id   INTEGER  NULL,
+                last_preview     TEXT     NULL,
+                message_count    INTEGER  NOT NULL DEFAULT 0
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_summary_last_time ON conversation_summary (last_time)",
+        ],
+    ),
+    Migration(
+        5, "user_conversations",
+        # index user -> conversation trên primary: sidebar, tìm chat 1-1 theo partner
+        mysql=[
+            """
+            CREATE TABLE IF NOT EXISTS user_conversations (
+                user_id         INT     NOT NULL,
+                conversation_id BIGINT  NOT NULL,
+                is_group        TINYINT NOT NULL DEFAULT 0,
+                partner_id      INT     NULL,
+                PRIMARY KEY (user_id, conversation_id),
+                KEY idx_uc_partner (user_id, partner_id),
+                KEY idx_uc_conv (conversation_id)
+            )
+            """,
+        ],
+        sqlite=[
+            """
+            CREATE TABLE IF NOT EXISTS user_conversations (
+                user_id          INTEGER NOT NULL,
+                conversation_id  INTEGER NOT NULL,
+                is_group         INTEGER NOT NULL DEFAULT 0,
+                partner_id       INTEGER NULL,
+                PRIMARY KEY (user_id, conversation_id)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_uc_partner ON user_conversations (user_id, partner_id)",
+            "CREATE INDEX IF NOT EXISTS idx_uc_conv ON user_conversations (conversation_id)",
+        ],
+    ),
+    Migration(
+        6, "replication_outbox",
+        mysql=[
+            """
+            CREATE TABLE IF NOT EXISTS replication_outbox (
+                id              BIGINT       NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                target_node     VARCHAR(64)  NOT NULL,
+                op              VARCHAR(64)  NOT NULL,
+                params          TEXT         NOT NULL,
+                created_at      DATETIME(3)  NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+                attempts        INT          NOT NULL DEFAULT 0,
+                next_attempt_at DATETIME(3)  NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+                last_error      VARCHAR(255) NULL,
+                applied_at      DATETIME(3)  NULL,
+                KEY idx_outbox_pending (target_node, applied_at, id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS replication_state (
+                node_name  VARCHAR(64) NOT NULL PRIMARY KEY,
+                seeded_at  DATETIME    NULL
+            )
+            """,
+        ],
+        sqlite=[
+            f"""
+            CREATE TABLE IF NOT EXISTS replication_outbox (
+                id               INTEGER  PRIMARY KEY AUTOINCREMENT,
+                target_node      TEXT     NOT NULL,
+                op               TEXT     NOT NULL,
+                params           TEXT     NOT NULL,
+                created_at       DATETIME NOT NULL DEFAULT {_SQLITE_NOW_MS},
+                attempts         INTEGER  NOT NULL DEFAULT 0,
+                next_attempt_at  DATETIME NOT NULL DEFAULT {_SQLITE_NOW_MS},
+                last_error       TEXT     NULL,
+                applied_at       DATETIME NULL
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_outbox_pending "
+            "ON replication_outbox (target_node, applied_at, id)",
+            """
+            CREATE TABLE IF NOT EXISTS replication_state (
+                node_name  TEXT PRIMARY KEY,
+                seeded_at  DATETIME NULL
+            )
+            """,
+        ],
+    ),
+    Migration(
+        7, "message_archive_index",
+        # archive_old_messages: SELECT DISTINCT conversation_id ... WHERE created_at >= ? AND created_at < ?
+        mysql=[
+            "CREATE INDEX IF NOT EXISTS idx_messages_created "
+            "ON messages (created_at, conversation_id)",
+        ],
+        sqlite=[
+            "CREATE INDEX IF NOT EXISTS idx_messages_created "
+            "ON messages (created_at, conversation_id)",
+        ],
+    ),
+    Migration(
+        8, "background_jobs",
+        mysql=[
+            """
+            CREATE TABLE IF NOT EXISTS background_jobs (
+                id           BIGINT       NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                kind         VARCHAR(64)  NOT NULL,
+                params       TEXT         NOT NULL,
+                status       VARCHAR(16)  NOT NULL DEFAULT 'pending',
+                progress     TEXT         NULL,
+                attempts     INT          NOT NULL DEFAULT 0,
+                worker       VARCHAR(64)  NULL,
+                run_after    DATETIME(3)  NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+                last_error   VARCHAR(255) NULL,
+                created_at   DATETIME(3)  NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+                finished_at  DATETIME(3)  NULL,
+                KEY idx_jobs_due (status, run_after)
+            )
+            """,
+            # job xóa tin của user bị ban: WHERE sender_id = ? AND id < ? ORDER BY id
+            "CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, id)",
+        ],
+        sqlite=[
+            f"""
+            CREATE TABLE IF NOT EXISTS background_jobs (
+                id           INTEGER  PRIMARY KEY AUTOINCREMENT,
+                kind         TEXT     NOT NULL,
+                params       TEXT     NOT NULL,
+                status       TEXT     NOT NULL DEFAULT 'pending',
+                progress     TEXT     NULL,
+                attempts     INTEGER  NOT NULL DEFAULT 0,
+                worker       TEXT     NULL,
+                run_after    DATETIME NOT NULL DEFAULT {_SQLITE_NOW_MS},
+                last_error   TEXT     NULL,
+                created_at   DATETIME NOT NULL DEFAULT {_SQLITE_NOW_MS},
+                finished_at  DATETIME NULL
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_jobs_due ON background_jobs (status, run_after)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, id)",
+        ],
+    ),
+    Migration(
+        9, "replication_users_reconciled",
+        # replication.reconcile_users: đối chiếu users 1 lần cho mỗi replica
+        mysql=[
+            "ALTER TABLE replication_state ADD COLUMN IF NOT EXISTS users_reconciled_at DATETIME NULL",
+        ],
+        sqlite=[
+            "ALTER TABLE replication_state ADD COLUMN users_reconciled_at DATETIME NULL",
+        ],
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def applied_versions(conn, dialect: str) -> set[int]:
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_MIGRATIONS_DDL[dialect])
+        cur.execute("SELECT version FROM schema_migrations")
+        versions = {int(r["version"]) for r in cur.fetchall()}
+    conn.commit()
+    return versions
+
+
+def apply_migrations(conn, dialect: str, node_name: str = "?") -> list[int]:
+    """
+    Chạy các migration chưa có trên node (theo thứ tự version), trả về các
+    version vừa chạy. Câu lệnh không có tham số -> chạy nguyên văn với cả
+    pymysql lẫn connection SQLite ở chế độ raw.
+    """
+    done = applied_versions(conn, dialect)
+    ran = []
+    for m in MIGRATIONS:
+        if m.version in done:
+            continue
+        with conn.cursor() as cur:
+            for stmt in m.statements[dialect]:
+                cur.execute(stmt)
+            cur.execute(
+                f"INSERT INTO schema_migrations (version, name) VALUES ({int(m.version)}, '{m.name}')"
+            )
+        conn.commit()
+        ran.append(m.version)
+        print(f"[SCHEMA] {node_name}: đã chạy migration {m.version:03d} {m.name}")
+    return ran
@@ -3,11 +3,20 @@ import socket
 import threading
 import json
 import hashlib
-import os
 import base64
 from pathlib import Path 
 from datetime import datetime
-from common.config import SERVER_HOST, SERVER_PORT, select_node_for_conversation
+from concurrent.futures import Future, ThreadPoolExecutor
+from common.config import (
+    SERVER_HOST,
+    SERVER_PORT,
+    select_node_for_conversation,
+    HISTORY_PAYLOAD_CACHE_ENABLED,
+    HISTORY_PAYLOAD_CACHE_MAX_BYTES,
+    AVATAR_FETCH_MAX,
+    SLOW_QUERY_TOP_N,
+    UPLOAD_COMPLETION_WORKERS,
+)
 from server.db_access import (
     create_user,
     get_user_by_username,
@@ -33,17 +42,51 @@ from server.db_access import (
     get_conversation_owner,
     set_user_ban_status,
     is_user_banned,
+    init_conversation_summary,
+    init_schema,
+    init_message_archive,
+    get_archive_status,
+    init_job_queue,
+    get_job_status,
+    purge_user_messages,
+    init_replication,
+    init_conversation_index,
+    init_node_health,
+    get_node_health_status,
+    get_replication_status,
+    on_conversation_changed,
+    search_messages,
+    ensure_message_search_index,
+    init_user_index,
+    avatar_ref,
+    get_avatars_b64,
+    migrate_legacy_avatars,
+    get_query_stats,
+    get_slow_queries,
+    DELETE_DONE,
+    DELETE_QUEUED,
+)
+from server.node_health import NodeUnavailableError
+from server.id_generator import next_message_id
+from server import read_router, replication
+from server.payload_cache import PagePayloadCache
+from server.attachments import (
+    STORAGE_DIR,
+    IMAGES_DIR,
+    VIDEOS_DIR,
+    FILES_DIR,
+    save_attachment,
+    get_disk_writer,
+    remove_attachment,
+    migrate_attachment_layout,
 )
+from server.attachment_gc import enqueue_attachment_gc
 
 
 
 
 # ====== STORAGE FOLDERS ======
 BASE_DIR = Path(__file__).resolve().parent
-STORAGE_DIR = BASE_DIR / "storage"
-IMAGES_DIR = STORAGE_DIR / "images"
-VIDEOS_DIR = STORAGE_DIR / "videos"
-FILES_DIR = STORAGE_DIR / "files"
 GROUP_AVATAR_DIR = STORAGE_DIR / "group_avatars"
 GROUP_AVATAR_DIR.mkdir(parents=True, exist_ok=True)
 for d in (IMAGES_DIR, VIDEOS_DIR, FILES_DIR):
@@ -56,6 +99,24 @@ ONLINE_USERS: dict[str, dict] = {}
 
 MAX_AVATAR_BYTES = 2 * 1024 * 1024  # 2MB sau khi decode
 
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+# trả cho client khi node shard của conversation đang lỗi (không ngắt kết nối)
+NODE_DOWN_MESSAGE = "Máy chủ dữ liệu đang lỗi, vui lòng thử lại sau"
+
+
+def send_node_down(conn: socket.socket, result_action: str, err: Exception, **extra):
+    """Báo lệnh không chạy được vì node DB lỗi (NodeUnavailableError), giữ kết nối."""
+    print(f"[DEGRADED] {result_action}: {err}")
+    send_to_conn(conn, result_action, {"ok": False, "error": NODE_DOWN_MESSAGE, **extra})
+
+# trang lịch sử đã encode sẵn, xóa khi conversation có insert / xóa tin
+history_pages: PagePayloadCache | None = None
+if HISTORY_PAYLOAD_CACHE_ENABLED:
+    history_pages = PagePayloadCache(HISTORY_PAYLOAD_CACHE_MAX_BYTES)
+    on_conversation_changed(history_pages.invalidate)
+
 
 
 def hash_password(raw: str) -> str:
@@ -71,6 +132,19 @@ def send_to_conn(conn: socket.socket, action: str, data: dict):
         print(f"[SERVER] Không gửi được tới client (socket chết): {e}")
         # Không raise, tránh làm hỏng thread server
 
+def send_with_payload(conn: socket.socket, action: str, data: dict, payload: bytes):
+    """
+    Như send_to_conn nhưng ghép thêm `payload` (các field JSON đã encode sẵn,
+    không có dấu ngoặc) vào trong data, không encode lại.
+    """
+    try:
+        head = json.dumps({"action": action, "data": data}, ensure_ascii=False)
+        # head kết thúc bằng "}}" -> chèn payload vào trước 2 dấu ngoặc cuối
+        sep = b", " if data else b""
+        conn.sendall(head[:-2].encode("utf-8") + sep + payload + b"}}\n")
+    except Exception as e:
+        print(f"[SERVER] Không gửi được tới client (socket chết): {e}")
+
 def send_to_user(username: str, action: str, data: dict) -> bool:
     """
     Gửi 1 gói cho user nếu đang online.
@@ -82,11 +156,243 @@ def send_to_user(username: str, action: str, data: dict) -> bool:
     send_to_conn(conn, action, data)
     return True
 
+def _parse_cursor(value) -> int | None:
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _page_args(data: dict) -> tuple:
+    before_id = _parse_cursor(data.get("before_id"))
+    after_id = _parse_cursor(data.get("after_id"))
+    limit = _parse_cursor(data.get("limit")) or HISTORY_PAGE_SIZE
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    return before_id, after_id, limit
+
+
+def load_history_page(conv_id: int, data: dict) -> dict:
+    """
+    Đọc 1 trang lịch sử theo cursor client gửi lên (before_id / after_id / limit).
+    Trả về dict gồm messages (đã format) + thông tin phân trang để gửi về client.
+    """
+    before_id, after_id, limit = _page_args(data)
+
+    # lấy dư 1 dòng để biết còn trang tiếp theo hay không
+    rows = get_messages_for_conversation(
+        conv_id, limit=limit + 1, before_id=before_id, after_id=after_id
+    )
+    has_more = len(rows) > limit
+    if has_more:
+        rows = rows[:limit] if after_id is not None else rows[1:]
+
+    msgs = []
+    for r in rows:
+        created_at = r.get("created_at")
+        if hasattr(created_at, "isoformat"):
+            created_at = created_at.isoformat(sep=" ", timespec="seconds")
+        else:
+            created_at = str(created_at)
+        msgs.append({
+            "id": r["id"],
+            "sender_username": r["sender_username"],
+            "msg_type": r.get("msg_type") or "text",
+            "content": r["content"],
+            "created_at": created_at,
+        })
+
+    return {
+        "messages": msgs,
+        "before_id": before_id,
+        "after_id": after_id,
+        "has_more": has_more,
+    }
+
+
+def load_history_payload(conv_id: int, data: dict) -> bytes:
+    """
+    Trang lịch sử dạng bytes JSON (các field của load_history_page, bỏ ngoặc),
+    lấy từ history_pages nếu có, dùng với send_with_payload.
+    """
+    if history_pages is None:
+        return json.dumps(load_history_page(conv_id, data), ensure_ascii=False)[1:-1].encode("utf-8")
+
+    key = (conv_id, *_page_args(data))
+    payload = history_pages.get(key)
+    if payload is not None:
+        return payload
+    token = history_pages.token(conv_id)
+    page = load_history_page(conv_id, data)
+    payload = json.dumps(page, ensure_ascii=False)[1:-1].encode("utf-8")
+    history_pages.put(key, payload, token)
+    return payload
+
+
+# hoàn tất upload (lưu tin + phản hồi + báo realtime) sau khi pool ghi đĩa
+# xong, để thread đọc socket của client không phải đứng chờ đĩa
+_upload_done_pool = ThreadPoolExecutor(
+    max_workers=UPLOAD_COMPLETION_WORKERS, thread_name_prefix="upload-done"
+)
+
+_READY: Future = Future()     # Future đã xong: lệnh gửi không phải chờ ghi file
+_READY.set_result(None)
+
+
+class SendOrder:
+    """
+    Giữ thứ tự các lệnh gửi tin (text / upload) của 1 connection.
+    id tin cấp ngay lúc nhận lệnh (next_message_id) nên lịch sử đúng thứ tự
+    gửi; phần lưu tin + phản hồi "*_result" của 1 lệnh chỉ chạy sau khi lệnh
+    gửi trước đó của cùng connection đã phản hồi xong -> gửi ảnh rồi gửi text
+    thì người gửi nhận kết quả ảnh trước, text sau.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tail: Future | None = None    # lệnh gửi cuối cùng, xong khi đã phản hồi
+
+    def busy(self) -> bool:
+        """Còn lệnh gửi chưa phản hồi xong (lệnh mới phải xếp sau nó)."""
+        with self._lock:
+            return self._tail is not None and not self._tail.done()
+
+    def then(self, ready: Future, conn: socket.socket, result_action: str, fn, *args):
+        """
+        Khi lệnh gửi trước đã phản hồi và `ready` (Future của save_attachment,
+        hoặc _READY) xong: ghi file lỗi -> báo lỗi cho người gửi, được -> chạy
+        fn(*args) trên pool upload-done. Tham số truyền hết qua args (không
+        dùng biến của vòng lặp handle_client, vì chúng đổi theo lệnh sau).
+        Lưu tin lỗi sau khi file đã ghi thì file thành mồ côi, GC sẽ dọn.
+        """
+        done: Future = Future()
+        with self._lock:
+            prev, self._tail = self._tail, done
+
+        def _complete():
+            try:
+                _run_send(ready, conn, result_action, fn, args)
+            finally:
+                done.set_result(None)
+
+        def _after_prev(_):
+            ready.add_done_callback(lambda _: _upload_done_pool.submit(_complete))
+
+        if prev is None:
+            _after_prev(None)
+        else:
+            prev.add_done_callback(_after_prev)
+
+
+def _run_send(ready: Future, conn: socket.socket, result_action: str, fn, args):
+    try:
+        ready.result()
+    except Exception as e:
+        send_to_conn(conn, result_action, {"ok": False, "error": str(e)})
+        return
+    try:
+        fn(*args)
+    except NodeUnavailableError as e:
+        send_node_down(conn, result_action, e)
+    except Exception as e:
+        print(f"[UPLOAD] Lưu tin sau khi ghi file lỗi: {e}")
+        send_to_conn(conn, result_action, {"ok": False, "error": str(e)})
+
+
+def _finish_text(conn, conv_id: int, sender_id: int, sender: str, receiver: str,
+                 content: str, msg_id: int):
+    insert_message(conv_id, sender_id, "text", content, message_id=msg_id)
+
+    # Gửi cho người nhận nếu đang online
+    if receiver in clients:
+        send_to_conn(clients[receiver], "incoming_text", {
+            "from": sender,
+            "content": content,
+            "message_id": msg_id,
+        })
+
+    # Xác nhận cho người gửi
+    send_to_conn(conn, "send_text_result", {
+        "ok": True,
+        "to": receiver,
+        "content": content,
+        "message_id": msg_id,
+    })
+
+
+def _finish_private_upload(conn, conv_id: int, sender_id: int, sender: str, receiver: str,
+                           msg_type: str, safe_name: str, result_action: str,
+                           incoming_action: str, extra: dict, msg_id: int):
+    insert_message(conv_id, sender_id, msg_type, safe_name, message_id=msg_id)
+
+    # Phản hồi cho người gửi
+    send_to_conn(conn, result_action, {
+        "ok": True,
+        "message_id": msg_id,
+        "to": receiver,
+        "filename": safe_name,
+        **extra,
+    })
+
+    # Gửi realtime cho người nhận (nếu online)
+    if receiver in clients:
+        send_to_conn(clients[receiver], incoming_action, {
+            "from": sender,
+            "filename": safe_name,
+            "message_id": msg_id,
+            **extra,
+        })
+
+
+def _finish_group_upload(conn, conv_id: int, sender_id: int, sender: str, msg_type: str,
+                         safe_name: str, result_action: str, file_type: str | None,
+                         msg_id: int):
+    insert_message(conv_id, sender_id, msg_type, safe_name, message_id=msg_id)
+
+    result = {
+        "ok": True,
+        "conversation_id": conv_id,
+        "filename": safe_name,
+        "message_id": msg_id,
+    }
+    if file_type is not None:
+        result["file_type"] = file_type
+    send_to_conn(conn, result_action, result)
+
+    # broadcast realtime tới member khác
+    if msg_type == "video":
+        incoming_action = "incoming_group_video"
+    elif msg_type == "image":
+        incoming_action = "incoming_group_image"
+    else:
+        incoming_action = "incoming_group_file"
+    try:
+        members = get_members_of_conversation(conv_id) or []
+    except Exception:
+        members = []
+
+    for m in members:
+        uname = m.get("username")
+        if not uname or uname == sender:
+            continue
+        if uname in clients:
+            try:
+                send_to_conn(clients[uname], incoming_action, {
+                    "conversation_id": conv_id,
+                    "from": sender,
+                    "filename": safe_name,
+                    "message_id": msg_id,
+                })
+            except Exception:
+                pass
+
+
 def handle_client(conn: socket.socket, addr):
     print(f"[+] New connection from {addr}")
     file = conn.makefile("r", encoding="utf-8")
 
     username: str | None = None  # username đã login trên connection này
+    send_order = SendOrder()     # thứ tự id + phản hồi các lệnh gửi tin
+    read_router.reset_session()  # watermark read-your-writes theo connection
 
     try:
         while True:
@@ -109,21 +415,37 @@ def handle_client(conn: socket.socket, addr):
                 password = data.get("password")
                 display_name = data.get("display_name") or username_try
 
-                if get_user_by_username(username_try):
+                try:
+                    existing = get_user_by_username(username_try)
+                except NodeUnavailableError as e:
+                    print(f"[AUTH] {e}")
+                    send_to_conn(conn, "register_result", {
+                        "ok": False,
+                        "error": NODE_DOWN_MESSAGE,
+                    })
+                    continue
+                pw_hash = hash_password(password)
+                if existing or create_user(username_try, pw_hash, display_name) is None:
                     send_to_conn(conn, "register_result", {
                         "ok": False,
                         "error": "Username already exists",
                     })
                     continue
 
-                pw_hash = hash_password(password)
-                create_user(username_try, pw_hash, display_name)
                 send_to_conn(conn, "register_result", {"ok": True})
 
             elif action == "login":
                 username_try = data.get("username")
                 password = data.get("password")
-                user = get_user_by_username(username_try)
+                try:
+                    user = get_user_by_username(username_try)
+                except NodeUnavailableError as e:
+                    print(f"[AUTH] {e}")
+                    send_to_conn(conn, "login_result", {
+                        "ok": False,
+                        "error": NODE_DOWN_MESSAGE,
+                    })
+                    continue
                 if not user:
                     send_to_conn(conn, "login_result", {
                         "ok": False,
@@ -153,13 +475,11 @@ def handle_client(conn: socket.socket, addr):
                     "display_name": user["display_name"],
                 }
 
-                avatar_b64 = user.get("avatar_url")
-
                 send_to_conn(conn, "login_result", {
                     "ok": True,
                     "user_id": user["id"],
                     "display_name": user["display_name"],
-                    "avatar_b64": avatar_b64,
+                    "avatar_hash": avatar_ref(user.get("avatar_url")),
                     "banned": banned,  # gửi cờ banned cho client
                 })
                 print(f"[+] {username} logged in (banned={banned})")
@@ -178,6 +498,8 @@ def handle_client(conn: socket.socket, addr):
 
                 # 🔹 GHI VÀO DB
                 set_user_ban_status(target_username, True)
+                # tùy chọn: xóa luôn tin user đã gửi (job nền, trả job_id để theo dõi)
+                job_id = purge_user_messages(target_username) if data.get("purge_messages") else None
 
                 # nếu đang online thì gửi thông báo cho client đã bị ban
                 info = ONLINE_USERS.get(target_username)
@@ -193,6 +515,7 @@ def handle_client(conn: socket.socket, addr):
                 send_to_conn(conn, "admin_ban_result", {
                     "ok": True,
                     "username": target_username,
+                    "job_id": job_id,
                 })
                 print(f"[ADMIN] BANNED {target_username} (saved in DB)")
 
@@ -250,6 +573,74 @@ def handle_client(conn: socket.socket, addr):
 
 
 
+            elif action == "admin_replication_status":
+                try:
+                    nodes = get_replication_status()
+                except Exception as e:
+                    send_to_conn(conn, "admin_replication_status_result", {
+                        "ok": False,
+                        "error": str(e),
+                    })
+                    continue
+                send_to_conn(conn, "admin_replication_status_result", {
+                    "ok": True,
+                    "nodes": nodes,
+                })
+
+            elif action == "admin_node_health":
+                send_to_conn(conn, "admin_node_health_result", {
+                    "ok": True,
+                    **get_node_health_status(),
+                })
+
+            elif action == "admin_query_stats":
+                send_to_conn(conn, "admin_query_stats_result", {
+                    "ok": True,
+                    **get_query_stats(),
+                })
+
+            elif action == "admin_slow_queries":
+                try:
+                    limit = int(data.get("limit") or SLOW_QUERY_TOP_N)
+                except (TypeError, ValueError):
+                    limit = SLOW_QUERY_TOP_N
+                send_to_conn(conn, "admin_slow_queries_result", {
+                    "ok": True,
+                    "items": get_slow_queries(
+                        max(1, min(limit, 200)), explain=data.get("explain", True)
+                    ),
+                })
+
+            elif action == "admin_archive_status":
+                send_to_conn(conn, "admin_archive_status_result", {
+                    "ok": True,
+                    **get_archive_status(),
+                })
+
+            elif action == "admin_jobs":
+                try:
+                    limit = int(data.get("limit") or 50)
+                except (TypeError, ValueError):
+                    limit = 50
+                send_to_conn(conn, "admin_jobs_result", {
+                    "ok": True,
+                    **get_job_status(max(1, min(limit, 200))),
+                })
+
+            elif action == "admin_attachment_gc":
+                # mặc định chỉ báo cáo; {"dry_run": false} mới xóa file mồ côi
+                job_id = enqueue_attachment_gc(dry_run=data.get("dry_run", True))
+                send_to_conn(conn, "admin_attachment_gc_result", {
+                    "ok": True,
+                    "job_id": job_id,
+                })
+
+            elif action == "admin_disk_writer_stats":
+                send_to_conn(conn, "admin_disk_writer_stats_result", {
+                    "ok": True,
+                    **get_disk_writer().stats(),
+                })
+
             elif action == "admin_kick":
                 target_username = data.get("username")
                 target_conn = None
@@ -340,35 +731,30 @@ def handle_client(conn: socket.socket, addr):
                 to_username = data.get("to")
                 content = data.get("content")
 
-                user_from = get_user_by_username(from_username)
-                user_to = get_user_by_username(to_username)
-                if not user_from or not user_to:
-                    send_to_conn(conn, "send_text_result", {
-                        "ok": False,
-                        "error": "User not found",
-                    })
-                    continue
-
-                conv_id = get_or_create_private_conversation(
-                    user_from["id"], user_to["id"]
-                )
-                msg_id = insert_message(conv_id, user_from["id"], "text", content)
-
-                # Gửi cho người nhận nếu đang online
-                if to_username in clients:
-                    send_to_conn(clients[to_username], "incoming_text", {
-                        "from": from_username,
-                        "content": content,
-                        "message_id": msg_id,
-                    })
+                try:
+                    user_from = get_user_by_username(from_username)
+                    user_to = get_user_by_username(to_username)
+                    if not user_from or not user_to:
+                        send_to_conn(conn, "send_text_result", {
+                            "ok": False,
+                            "error": "User not found",
+                        })
+                        continue
 
-                # Xác nhận cho người gửi
-                send_to_conn(conn, "send_text_result", {
-                    "ok": True,
-                    "to": to_username,
-                    "content": content,
-                    "message_id": msg_id,
-                })
+                    conv_id = get_or_create_private_conversation(
+                        user_from["id"], user_to["id"]
+                    )
+                    msg_id = next_message_id()
+                    text_args = (conn, conv_id, user_from["id"], from_username,
+                                 to_username, content, msg_id)
+                    if send_order.busy():
+                        # còn upload gửi trước chưa xong -> lưu + phản hồi sau nó
+                        send_order.then(_READY, conn, "send_text_result", _finish_text, *text_args)
+                    else:
+                        _finish_text(*text_args)
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "send_text_result", e)
+                    continue
 
             elif action == "send_image":
                 sender = data.get("from")
@@ -376,8 +762,12 @@ def handle_client(conn: socket.socket, addr):
                 filename = data.get("filename")
                 b64data = data.get("data")
 
-                user = get_user_by_username(sender)
-                partner = get_user_by_username(receiver)
+                try:
+                    user = get_user_by_username(sender)
+                    partner = get_user_by_username(receiver)
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "send_image_result", e)
+                    continue
 
                 if not user or not partner:
                     send_to_conn(conn, "send_image_result", {
@@ -396,13 +786,16 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                # Lưu file vào server/storage/images
+                # Lưu file vào server/storage/images/<xx>/<yy>/ (pool ghi đĩa),
+                # trong lúc chờ thì tra conversation
                 safe_name = f"{user['id']}_{partner['id']}_{filename}"
-                full_path = IMAGES_DIR / safe_name
 
                 try:
-                    with open(full_path, "wb") as f:
-                        f.write(raw)
+                    written = save_attachment("image", safe_name, raw)
+                    conv_id = get_or_create_private_conversation(user["id"], partner["id"])
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "send_image_result", e)
+                    continue
                 except Exception as e:
                     send_to_conn(conn, "send_image_result", {
                         "ok": False,
@@ -410,31 +803,15 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                # Lưu vào bảng messages: CHỈ LƯU TÊN FILE, KHÔNG LƯU BASE64
-                conv_id = get_or_create_private_conversation(user["id"], partner["id"])
-                msg_id = insert_message(
-                    conversation_id=conv_id,
-                    sender_id=user["id"],
-                    msg_type="image",
-                    content=safe_name,   # 👈 chỉ tên file
+                # file ghi xong mới lưu tin (CHỈ LƯU TÊN FILE, KHÔNG LƯU BASE64)
+                # và phản hồi; thread này đọc tiếp lệnh khác của client. id tin
+                # cấp ngay bây giờ để tin gửi sau (kể cả text) không xếp trước
+                send_order.then(
+                    written, conn, "send_image_result", _finish_private_upload,
+                    conn, conv_id, user["id"], sender, receiver, "image", safe_name,
+                    "send_image_result", "incoming_image", {}, next_message_id(),
                 )
 
-                # Phản hồi cho người gửi
-                send_to_conn(conn, "send_image_result", {
-                    "ok": True,
-                    "message_id": msg_id,
-                    "to": receiver,
-                    "filename": safe_name,
-                })
-
-                # Gửi realtime cho người nhận
-                if receiver in clients:
-                    send_to_conn(clients[receiver], "incoming_image", {
-                        "from": sender,
-                        "filename": safe_name,
-                        "message_id": msg_id,
-                    })
-
 
             elif action == "broadcast":
                 msg_text = data.get("message", "")
@@ -449,8 +826,12 @@ def handle_client(conn: socket.socket, addr):
                 b64data = data.get("data")
                 file_type = (data.get("file_type") or "file").lower()
 
-                user_from = get_user_by_username(from_username)
-                user_to = get_user_by_username(to_username)
+                try:
+                    user_from = get_user_by_username(from_username)
+                    user_to = get_user_by_username(to_username)
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "send_file_result", e)
+                    continue
                 if not user_from or not user_to:
                     send_to_conn(conn, "send_file_result", {
                         "ok": False,
@@ -470,21 +851,22 @@ def handle_client(conn: socket.socket, addr):
 
                 # Chọn thư mục & msg_type
                 if file_type == "video":
-                    folder = VIDEOS_DIR
                     msg_type = "video"
                 elif file_type == "image":
-                    folder = IMAGES_DIR
                     msg_type = "image"
                 else:
-                    folder = FILES_DIR
                     msg_type = "file"
 
                 safe_name = f"{user_from['id']}_{user_to['id']}_{filename}"
-                full_path = folder / safe_name
 
                 try:
-                    with open(full_path, "wb") as f:
-                        f.write(raw)
+                    written = save_attachment(msg_type, safe_name, raw)
+                    conv_id = get_or_create_private_conversation(
+                        user_from["id"], user_to["id"]
+                    )
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "send_file_result", e)
+                    continue
                 except Exception as e:
                     send_to_conn(conn, "send_file_result", {
                         "ok": False,
@@ -492,35 +874,24 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                conv_id = get_or_create_private_conversation(
-                    user_from["id"], user_to["id"]
+                send_order.then(
+                    written, conn, "send_file_result", _finish_private_upload,
+                    conn, conv_id, user_from["id"], from_username, to_username, msg_type,
+                    safe_name, "send_file_result", "incoming_file", {"file_type": file_type},
+                    next_message_id(),
                 )
-                msg_id = insert_message(conv_id, user_from["id"], msg_type, safe_name)
-
-                # Gửi confirm cho người gửi
-                send_to_conn(conn, "send_file_result", {
-                    "ok": True,
-                    "to": to_username,
-                    "filename": safe_name,
-                    "file_type": file_type,
-                    "message_id": msg_id,
-                })
-
-                # Gửi realtime cho người nhận (nếu online)
-                if to_username in clients:
-                    send_to_conn(clients[to_username], "incoming_file", {
-                        "from": from_username,
-                        "filename": safe_name,
-                        "file_type": file_type,
-                        "message_id": msg_id,
-                    })
 
             elif action == "load_history":
                 from_username = data.get("from")
                 to_username = data.get("to")
 
-                user_from = get_user_by_username(from_username)
-                user_to = get_user_by_username(to_username)
+                try:
+                    user_from = get_user_by_username(from_username)
+                    user_to = get_user_by_username(to_username)
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "history_result", e, messages=[],
+                                   before_id=data.get("before_id"))
+                    continue
                 if not user_from or not user_to:
                     send_to_conn(conn, "history_result", {
                         "ok": False,
@@ -529,36 +900,37 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                conv_id = get_or_create_private_conversation(
-                    user_from["id"], user_to["id"]
-                )
-                rows = get_messages_for_conversation(conv_id, limit=200)
-                msgs = []
-                for r in rows:
-                    created_at = r.get("created_at")
-                    if hasattr(created_at, "isoformat"):
-                        created_at = created_at.isoformat(sep=" ", timespec="seconds")
-                    else:
-                        created_at = str(created_at)
-                    msgs.append({
-                        "id": r["id"],
-                        "sender_username": r["sender_username"],
-                        "msg_type": r.get("msg_type") or "text",
-                        "content": r["content"],
-                        "created_at": created_at,
+                try:
+                    conv_id = get_or_create_private_conversation(
+                        user_from["id"], user_to["id"]
+                    )
+                    payload = load_history_payload(conv_id, data)
+                except NodeUnavailableError as e:
+                    print(f"[HISTORY] {e}")
+                    send_to_conn(conn, "history_result", {
+                        "ok": False,
+                        "error": NODE_DOWN_MESSAGE,
+                        "with": to_username,
+                        "messages": [],
+                        "before_id": data.get("before_id"),
                     })
+                    continue
 
-                send_to_conn(conn, "history_result", {
+                send_with_payload(conn, "history_result", {
                     "ok": True,
                     "with": to_username,
-                    "messages": msgs,
-                })
+                }, payload)
 
             elif action == "load_group_history":
                 conv_id = int(data.get("conversation_id") or 0)
                 username_req = (data.get("username") or "").strip()
 
-                user = get_user_by_username(username_req)
+                try:
+                    user = get_user_by_username(username_req)
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "group_history_result", e, conversation_id=conv_id,
+                                   messages=[], before_id=data.get("before_id"))
+                    continue
                 if not user:
                     send_to_conn(conn, "group_history_result", {
                         "ok": False,
@@ -568,34 +940,29 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                # kiểm tra user có trong group không
-                if not is_user_in_conversation(conv_id, user["id"]):
+                try:
+                    # kiểm tra user có trong group không
+                    if not is_user_in_conversation(conv_id, user["id"]):
+                        send_to_conn(conn, "group_history_result", {
+                            "ok": False,
+                            "error": "Bạn không thuộc nhóm này",
+                            "conversation_id": conv_id,
+                            "messages": [],
+                        })
+                        continue
+
+                    payload = load_history_payload(conv_id, data)
+                except NodeUnavailableError as e:
+                    print(f"[HISTORY] {e}")
                     send_to_conn(conn, "group_history_result", {
                         "ok": False,
-                        "error": "Bạn không thuộc nhóm này",
+                        "error": NODE_DOWN_MESSAGE,
                         "conversation_id": conv_id,
                         "messages": [],
+                        "before_id": data.get("before_id"),
                     })
                     continue
 
-                rows = get_messages_for_conversation(conv_id, limit=200)
-                msgs = []
-                for r in rows:
-                    created_at = r.get("created_at")
-                    if hasattr(created_at, "isoformat"):
-                        created_at = created_at.isoformat(
-                            sep=" ", timespec="seconds"
-                        )
-                    else:
-                        created_at = str(created_at)
-                    msgs.append({
-                        "id": r["id"],
-                        "sender_username": r["sender_username"],
-                        "msg_type": r.get("msg_type") or "text",
-                        "content": r["content"],
-                        "created_at": created_at,
-                    })
-
                 # --- xác định owner của nhóm để trả về cho client ---
                 try:
                     owner_id = get_conversation_owner(conv_id)
@@ -603,12 +970,11 @@ def handle_client(conn: socket.socket, addr):
                     owner_id = None
                 is_owner = (owner_id is not None and owner_id == user["id"])
 
-                send_to_conn(conn, "group_history_result", {
+                send_with_payload(conn, "group_history_result", {
                     "ok": True,
                     "conversation_id": conv_id,
-                    "messages": msgs,
                     "is_owner": is_owner,
-                })
+                }, payload)
 
             elif action == "list_group_members":
                 conv_id_raw = data.get("conversation_id")
@@ -624,20 +990,24 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                user = get_user_by_username(username_req)
-                if not user:
-                    send_to_conn(conn, "group_members_result", {
-                        "ok": False,
-                        "error": "User not found",
-                    })
-                    continue
+                try:
+                    user = get_user_by_username(username_req)
+                    if not user:
+                        send_to_conn(conn, "group_members_result", {
+                            "ok": False,
+                            "error": "User not found",
+                        })
+                        continue
 
-                # chỉ user trong nhóm mới xem được member
-                if not is_user_in_conversation(conv_id, user["id"]):
-                    send_to_conn(conn, "group_members_result", {
-                        "ok": False,
-                        "error": "Bạn không thuộc nhóm này",
-                    })
+                    # chỉ user trong nhóm mới xem được member
+                    if not is_user_in_conversation(conv_id, user["id"]):
+                        send_to_conn(conn, "group_members_result", {
+                            "ok": False,
+                            "error": "Bạn không thuộc nhóm này",
+                        })
+                        continue
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "group_members_result", e, conversation_id=conv_id)
                     continue
 
                 try:
@@ -734,80 +1104,82 @@ def handle_client(conn: socket.socket, addr):
                 conv_id_raw = data.get("conversation_id")
                 partner_username = (data.get("partner") or "").strip()
 
-                user_by = get_user_by_username(by_username)
-                if not user_by:
-                    send_to_conn(conn, "delete_result", {
-                        "ok": False,
-                        "error": "User not found",
-                    })
-                    continue
-
-                if conv_id_raw:
-                    try:
-                        conv_id = int(conv_id_raw)
-                    except (TypeError, ValueError):
-                        send_to_conn(conn, "delete_result", {
-                            "ok": False,
-                            "error": "Invalid conversation id",
-                        })
-                        continue
-                    if not is_user_in_conversation(conv_id, user_by["id"]):
-                        send_to_conn(conn, "delete_result", {
-                            "ok": False,
-                            "error": "Bạn không thuộc đoạn chat này",
-                        })
-                        continue
-                    partner_user = None
-                    is_group = True
-                else:
-                    if not partner_username:
+                try:
+                    user_by = get_user_by_username(by_username)
+                    if not user_by:
                         send_to_conn(conn, "delete_result", {
                             "ok": False,
-                            "error": "Thiếu partner để xác định đoạn chat",
+                            "error": "User not found",
                         })
                         continue
-                    partner_user = get_user_by_username(partner_username)
-                    if not partner_user:
+
+                    if conv_id_raw:
+                        try:
+                            conv_id = int(conv_id_raw)
+                        except (TypeError, ValueError):
+                            send_to_conn(conn, "delete_result", {
+                                "ok": False,
+                                "error": "Invalid conversation id",
+                            })
+                            continue
+                        if not is_user_in_conversation(conv_id, user_by["id"]):
+                            send_to_conn(conn, "delete_result", {
+                                "ok": False,
+                                "error": "Bạn không thuộc đoạn chat này",
+                            })
+                            continue
+                        partner_user = None
+                        is_group = True
+                    else:
+                        if not partner_username:
+                            send_to_conn(conn, "delete_result", {
+                                "ok": False,
+                                "error": "Thiếu partner để xác định đoạn chat",
+                            })
+                            continue
+                        partner_user = get_user_by_username(partner_username)
+                        if not partner_user:
+                            send_to_conn(conn, "delete_result", {
+                                "ok": False,
+                                "error": "Partner not found",
+                            })
+                            continue
+                        conv_id = get_or_create_private_conversation(
+                            user_by["id"], partner_user["id"]
+                        )
+                        is_group = False
+
+                    try:
+                        message_id_int = int(message_id)
+                    except (TypeError, ValueError):
                         send_to_conn(conn, "delete_result", {
                             "ok": False,
-                            "error": "Partner not found",
+                            "error": "Invalid message id",
                         })
                         continue
-                    conv_id = get_or_create_private_conversation(
-                        user_by["id"], partner_user["id"]
+
+                    # node shard lỗi: get_message_by_id chỉ thấy tin đã archive, lệnh
+                    # xóa vào journal (kiểm tra người gửi lúc replay); file kèm tin
+                    # để GC dọn sau khi tin thực sự bị xóa
+                    msg_row = get_message_by_id(conv_id, message_id_int)
+                    status = delete_message_for_user(
+                        conv_id, message_id_int, user_by["id"]
                     )
-                    is_group = False
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "delete_result", e)
+                    continue
 
-                try:
-                    message_id_int = int(message_id)
-                except (TypeError, ValueError):
+                if status == DELETE_QUEUED:
                     send_to_conn(conn, "delete_result", {
                         "ok": False,
-                        "error": "Invalid message id",
+                        "pending": True,
+                        "error": "Node đang lỗi, tin sẽ được xóa khi node hoạt động lại",
+                        "message_id": message_id_int,
+                        "conversation_id": conv_id,
                     })
-                    continue
-
-                msg_row = get_message_by_id(conv_id, message_id_int)
-                deleted = delete_message_for_user(
-                    conv_id, message_id_int, user_by["id"]
-                )
-
-                if deleted:
+                elif status == DELETE_DONE:
                     if msg_row:
-                        msg_type = (msg_row.get("msg_type") or "").lower()
-                        content = msg_row.get("content") or ""
-                        dir_path = None
-                        if msg_type in ("image", "photo"):
-                            dir_path = IMAGES_DIR
-                        elif msg_type == "video":
-                            dir_path = VIDEOS_DIR
-                        elif msg_type in ("file", "document"):
-                            dir_path = FILES_DIR
-                        if dir_path and content:
-                            try:
-                                os.remove(dir_path / content)
-                            except FileNotFoundError:
-                                pass
+                        remove_attachment(msg_row.get("msg_type"), msg_row.get("content"))
                     send_to_conn(conn, "delete_result", {
                         "ok": True,
                         "message_id": message_id_int,
@@ -825,23 +1197,26 @@ def handle_client(conn: socket.socket, addr):
 
             elif action == "list_conversations":
                 username_req = data.get("username")
-                user = get_user_by_username(username_req)
-                if not user:
-                    send_to_conn(conn, "conversations_result", {
-                        "ok": False,
-                        "error": "User not found",
-                        "items": [],
-                    })
-                    continue
+                try:
+                    user = get_user_by_username(username_req)
+                    if not user:
+                        send_to_conn(conn, "conversations_result", {
+                            "ok": False,
+                            "error": "User not found",
+                            "items": [],
+                        })
+                        continue
 
-                raw_privates = get_conversations_for_user(user["id"])
-                raw_groups = get_groups_for_user(user["id"])
+                    raw_privates = get_conversations_for_user(user["id"])
+                    raw_groups = get_groups_for_user(user["id"])
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "conversations_result", e, items=[])
+                    continue
 
                 items: list[dict] = []
 
                 # --- Các đoạn 1-1 ---
                 for it in raw_privates:
-                    avatar_b64 = it.get("partner_avatar_url")
                     items.append(
                         {
                             "conversation_id": it["conversation_id"],
@@ -849,14 +1224,15 @@ def handle_client(conn: socket.socket, addr):
                             "partner_username": it["partner_username"],
                             "title": it.get("partner_display_name") or it["partner_username"],
                             "last_time": it.get("last_time"),
-                            "avatar_b64": avatar_b64,
+                            "avatar_hash": avatar_ref(it.get("partner_avatar_url")),
+                            "last_preview": it.get("last_preview"),
+                            "message_count": it.get("message_count", 0),
                         }
                     )
 
                 # --- Các group ---
                 # groups
                 for g in raw_groups:
-                    avatar_b64 = g.get("group_avatar")
                     items.append(
                         {
                             "conversation_id": g["conversation_id"],
@@ -864,7 +1240,9 @@ def handle_client(conn: socket.socket, addr):
                             "partner_username": None,
                             "title": f"[Group] {g['group_name']}",
                             "last_time": g.get("last_time"),
-                            "avatar_b64": avatar_b64,
+                            "avatar_hash": avatar_ref(g.get("group_avatar")),
+                            "last_preview": g.get("last_preview"),
+                            "message_count": g.get("message_count", 0),
                         }
                     )
 
@@ -909,23 +1287,73 @@ def handle_client(conn: socket.socket, addr):
                     "items": items,
                 })
 
+            elif action == "search_messages":
+                # chỉ tìm trong conversation của user đã login trên connection này,
+                # không tin username client gửi lên (đọc được nội dung tin nhắn)
+                q = (data.get("query") or "").strip()
+                if not username:
+                    send_to_conn(conn, "search_messages_result", {
+                        "ok": False,
+                        "error": "Not logged in",
+                        "query": q,
+                        "items": [],
+                    })
+                    continue
+                try:
+                    user = get_user_by_username(username)
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "search_messages_result", e, query=q, items=[])
+                    continue
+                if not user:
+                    send_to_conn(conn, "search_messages_result", {
+                        "ok": False,
+                        "error": "User not found",
+                        "query": q,
+                        "items": [],
+                    })
+                    continue
+
+                conv_filter = _parse_cursor(data.get("conversation_id"))
+                limit = _parse_cursor(data.get("limit")) or 50
+                try:
+                    found = search_messages(user["id"], q, limit=limit,
+                                            conversation_id=conv_filter)
+                except Exception as e:
+                    send_to_conn(conn, "search_messages_result", {
+                        "ok": False,
+                        "error": str(e),
+                        "query": q,
+                        "items": [],
+                    })
+                    continue
+
+                send_to_conn(conn, "search_messages_result", {
+                    "ok": True,
+                    "query": q,
+                    **found,
+                })
+
             elif action == "delete_conversation":
                 by_username = (data.get("by") or "").strip()
                 partner_username = (data.get("partner") or "").strip()
 
-                user_by = get_user_by_username(by_username)
-                user_partner = get_user_by_username(partner_username)
+                try:
+                    user_by = get_user_by_username(by_username)
+                    user_partner = get_user_by_username(partner_username)
 
-                if not user_by or not user_partner:
-                    send_to_conn(conn, "delete_conversation_result", {
-                        "ok": False,
-                        "error": "User not found",
-                    })
-                    continue
+                    if not user_by or not user_partner:
+                        send_to_conn(conn, "delete_conversation_result", {
+                            "ok": False,
+                            "error": "User not found",
+                        })
+                        continue
 
-                deleted = delete_conversation_for_users(
-                    user_by["id"], user_partner["id"]
-                )
+                    deleted = delete_conversation_for_users(
+                        user_by["id"], user_partner["id"]
+                    )
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "delete_conversation_result", e, partner=partner_username)
+                    continue
                 if deleted:
                     send_to_conn(conn, "delete_conversation_result", {
                         "ok": True,
@@ -937,7 +1365,7 @@ def handle_client(conn: socket.socket, addr):
                         "error": "Conversation not found",
                     })
 
-            # ========== AVATAR (avatar_url = base64) ==========
+            # ========== AVATAR (avatar_url = hash trong kho avatar) ==========
 
             elif action == "update_avatar":
                 uname = (data.get("username") or "").strip()
@@ -967,17 +1395,17 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                update_user_avatar(user["id"], img_b64)
+                avatar_hash = update_user_avatar(user["id"], raw)
 
                 send_to_conn(conn, "update_avatar_result", {
                     "ok": True,
-                    "avatar_b64": img_b64,
+                    "avatar_hash": avatar_hash,
                 })
 
                 for uname_online, c_online in list(clients.items()):
                     send_to_conn(c_online, "avatar_changed", {
                         "username": user["username"],
-                        "avatar_b64": img_b64,
+                        "avatar_hash": avatar_hash,
                     })
             elif action == "update_group_avatar":
                 conv_id = int(data.get("conversation_id") or 0)
@@ -991,7 +1419,23 @@ def handle_client(conn: socket.socket, addr):
                     continue
 
                 try:
-                    update_group_avatar(conv_id, img_b64)
+                    raw = base64.b64decode(img_b64)
+                except Exception:
+                    send_to_conn(conn, "update_group_avatar_result", {
+                        "ok": False,
+                        "error": "Invalid image data",
+                    })
+                    continue
+
+                if len(raw) > MAX_AVATAR_BYTES:
+                    send_to_conn(conn, "update_group_avatar_result", {
+                        "ok": False,
+                        "error": "Image too large (>2MB)",
+                    })
+                    continue
+
+                try:
+                    avatar_hash = update_group_avatar(conv_id, raw)
                 except Exception as e:
                     print("update_group_avatar error:", e)
                     send_to_conn(conn, "update_group_avatar_result", {
@@ -1003,7 +1447,21 @@ def handle_client(conn: socket.socket, addr):
                 send_to_conn(conn, "update_group_avatar_result", {
                     "ok": True,
                     "conversation_id": conv_id,
-                    "avatar_b64": img_b64,
+                    "avatar_hash": avatar_hash,
+                })
+
+            elif action == "get_avatars":
+                # Client chỉ hỏi những hash chưa có trong cache của nó
+                hashes = [h for h in (data.get("hashes") or []) if isinstance(h, str)]
+                try:
+                    size = int(data.get("size") or 0)
+                except (TypeError, ValueError):
+                    size = 0
+                items = get_avatars_b64(list(dict.fromkeys(hashes))[:AVATAR_FETCH_MAX], size)
+                send_to_conn(conn, "avatars_result", {
+                    "ok": True,
+                    "size": size,
+                    "items": items,
                 })
 
 
@@ -1108,20 +1566,24 @@ def handle_client(conn: socket.socket, addr):
                 filename = data.get("filename")
                 b64data = data.get("data")
 
-                user = get_user_by_username(sender)
-                if not user:
-                    send_to_conn(conn, "send_group_image_result", {
-                        "ok": False,
-                        "error": "User not found",
-                    })
-                    continue
+                try:
+                    user = get_user_by_username(sender)
+                    if not user:
+                        send_to_conn(conn, "send_group_image_result", {
+                            "ok": False,
+                            "error": "User not found",
+                        })
+                        continue
 
-                # kiểm tra user thuộc group
-                if not is_user_in_conversation(conv_id, user["id"]):
-                    send_to_conn(conn, "send_group_image_result", {
-                        "ok": False,
-                        "error": "Bạn không thuộc nhóm này",
-                    })
+                    # kiểm tra user thuộc group
+                    if not is_user_in_conversation(conv_id, user["id"]):
+                        send_to_conn(conn, "send_group_image_result", {
+                            "ok": False,
+                            "error": "Bạn không thuộc nhóm này",
+                        })
+                        continue
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "send_group_image_result", e, conversation_id=conv_id)
                     continue
 
                 try:
@@ -1134,10 +1596,8 @@ def handle_client(conn: socket.socket, addr):
                     continue
 
                 safe_name = f"group_{conv_id}_{user['id']}_{filename}"
-                full_path = IMAGES_DIR / safe_name
                 try:
-                    with open(full_path, "wb") as f:
-                        f.write(raw)
+                    written = save_attachment("image", safe_name, raw)
                 except Exception as e:
                     send_to_conn(conn, "send_group_image_result", {
                         "ok": False,
@@ -1145,41 +1605,20 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                msg_id = insert_message(conv_id, user["id"], "image", safe_name)
-
-                # phản hồi cho người gửi
-                send_to_conn(conn, "send_group_image_result", {
-                    "ok": True,
-                    "conversation_id": conv_id,
-                    "filename": safe_name,
-                    "message_id": msg_id,
-                })
-
-                # broadcast realtime tới member khác
-                try:
-                    members = get_members_of_conversation(conv_id) or []
-                except Exception:
-                    members = []
-
-                for m in members:
-                    uname = m.get("username")
-                    if not uname or uname == sender:
-                        continue
-                    if uname in clients:
-                        try:
-                            send_to_conn(clients[uname], "incoming_group_image", {
-                                "conversation_id": conv_id,
-                                "from": sender,
-                                "filename": safe_name,
-                                "message_id": msg_id,
-                            })
-                        except Exception:
-                            pass
+                send_order.then(
+                    written, conn, "send_group_image_result", _finish_group_upload,
+                    conn, conv_id, user["id"], sender, "image", safe_name,
+                    "send_group_image_result", None, next_message_id(),
+                )
             elif action == "create_group":
                 owner_username = data.get("owner")
                 group_name = data.get("name")
 
-                user = get_user_by_username(owner_username)
+                try:
+                    user = get_user_by_username(owner_username)
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "create_group_result", e)
+                    continue
                 if not user:
                     send_to_conn(conn, "create_group_result", {
                         "ok": False,
@@ -1212,18 +1651,22 @@ def handle_client(conn: socket.socket, addr):
                 target_username = data.get("username")
                 by_username = data.get("by")
 
-                target_user = get_user_by_username(target_username)
-                if not target_user:
-                    send_to_conn(conn, "add_group_member_result", {
-                        "ok": False,
-                        "error": f"User '{target_username}' không tồn tại"
-                    })
-                    continue
+                try:
+                    target_user = get_user_by_username(target_username)
+                    if not target_user:
+                        send_to_conn(conn, "add_group_member_result", {
+                            "ok": False,
+                            "error": f"User '{target_username}' không tồn tại"
+                        })
+                        continue
 
-                # (Tuỳ chọn) Kiểm tra quyền: người 'by' có phải member nhóm không?
-                # Tạm thời bỏ qua để đơn giản, hoặc check is_user_in_conversation
+                    # (Tuỳ chọn) Kiểm tra quyền: người 'by' có phải member nhóm không?
+                    # Tạm thời bỏ qua để đơn giản, hoặc check is_user_in_conversation
 
-                success = add_user_to_conversation(conv_id, target_user["id"])
+                    success = add_user_to_conversation(conv_id, target_user["id"])
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "add_group_member_result", e, conversation_id=conv_id)
+                    continue
                 
                 if success:
                     # 1. Báo cho người yêu cầu (để UI cập nhật status)
@@ -1251,16 +1694,21 @@ def handle_client(conn: socket.socket, addr):
 
             elif action == "leave_group":
                 conv_id = int(data.get("conversation_id") or 0)
-                username = data.get("by")
+                by_username = data.get("by")
                 
-                user = get_user_by_username(username)
+                try:
+                    user = get_user_by_username(by_username)
+                    if user:
+                        remove_user_from_conversation(conv_id, user["id"])
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "leave_group_result", e, conversation_id=conv_id)
+                    continue
                 if user:
-                    remove_user_from_conversation(conv_id, user["id"])
                     send_to_conn(conn, "leave_group_result", {
                         "ok": True,
                         "conversation_id": conv_id
                     })
-                    print(f"[GROUP] {username} left group {conv_id}")
+                    print(f"[GROUP] {by_username} left group {conv_id}")
                 else:
                     send_to_conn(conn, "leave_group_result", {
                         "ok": False,
@@ -1270,19 +1718,23 @@ def handle_client(conn: socket.socket, addr):
             elif action == "join_group":
                 # Logic cho sidebar search -> enter -> join group theo tên
                 group_name = data.get("group_name")
-                username = data.get("username")
-                
-                user = get_user_by_username(username)
-                group = find_group_by_name(group_name) # Cần đảm bảo function này import từ db_access
+                join_username = data.get("username")
                 
-                if not user or not group:
-                    send_to_conn(conn, "join_group_result", {
-                        "ok": False,
-                        "error": "Nhóm hoặc User không tồn tại"
-                    })
+                try:
+                    user = get_user_by_username(join_username)
+                    group = find_group_by_name(group_name) # Cần đảm bảo function này import từ db_access
+
+                    if not user or not group:
+                        send_to_conn(conn, "join_group_result", {
+                            "ok": False,
+                            "error": "Nhóm hoặc User không tồn tại"
+                        })
+                        continue
+
+                    success = add_user_to_conversation(group["id"], user["id"])
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "join_group_result", e)
                     continue
-                
-                success = add_user_to_conversation(group["id"], user["id"])
                 if success:
                     send_to_conn(conn, "join_group_result", {
                         "ok": True,
@@ -1300,13 +1752,17 @@ def handle_client(conn: socket.socket, addr):
                 conv_id = int(data.get("conversation_id") or 0)
                 by_username = data.get("by")
                 
-                user = get_user_by_username(by_username)
-                if not user:
-                    continue
+                try:
+                    user = get_user_by_username(by_username)
+                    if not user:
+                        continue
 
-                # delete_group trong db_access đã check owner_id chưa? 
-                # Hàm delete_group bạn cung cấp có check owner_id.
-                ok = delete_group(conv_id, user["id"])
+                    # delete_group trong db_access đã check owner_id chưa?
+                    # Hàm delete_group bạn cung cấp có check owner_id.
+                    ok = delete_group(conv_id, user["id"])
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "delete_group_result", e, conversation_id=conv_id)
+                    continue
                 
                 if ok:
                     # Báo cho người xóa
@@ -1329,19 +1785,24 @@ def handle_client(conn: socket.socket, addr):
                 b64data = data.get("data")
                 file_type = (data.get("file_type") or "file").lower()
 
-                user = get_user_by_username(sender)
-                if not user:
-                    send_to_conn(conn, "send_group_file_result", {
-                        "ok": False,
-                        "error": "User not found",
-                    })
-                    continue
+                try:
+                    user = get_user_by_username(sender)
+                    if not user:
+                        send_to_conn(conn, "send_group_file_result", {
+                            "ok": False,
+                            "error": "User not found",
+                        })
+                        continue
 
-                if not is_user_in_conversation(conv_id, user["id"]):
-                    send_to_conn(conn, "send_group_file_result", {
-                        "ok": False,
-                        "error": "Bạn không thuộc nhóm này",
-                    })
+                    # kiểm tra user thuộc group
+                    if not is_user_in_conversation(conv_id, user["id"]):
+                        send_to_conn(conn, "send_group_file_result", {
+                            "ok": False,
+                            "error": "Bạn không thuộc nhóm này",
+                        })
+                        continue
+                except NodeUnavailableError as e:
+                    send_node_down(conn, "send_group_file_result", e, conversation_id=conv_id)
                     continue
 
                 try:
@@ -1354,21 +1815,16 @@ def handle_client(conn: socket.socket, addr):
                     continue
 
                 if file_type == "video":
-                    folder = VIDEOS_DIR
                     msg_type = "video"
                 elif file_type == "image":
-                    folder = IMAGES_DIR
                     msg_type = "image"
                 else:
-                    folder = FILES_DIR
                     msg_type = "file"
 
                 safe_name = f"group_{conv_id}_{user['id']}_{filename}"
-                full_path = folder / safe_name
 
                 try:
-                    with open(full_path, "wb") as f:
-                        f.write(raw)
+                    written = save_attachment(msg_type, safe_name, raw)
                 except Exception as e:
                     send_to_conn(conn, "send_group_file_result", {
                         "ok": False,
@@ -1376,51 +1832,12 @@ def handle_client(conn: socket.socket, addr):
                     })
                     continue
 
-                msg_id = insert_message(conv_id, user["id"], msg_type, safe_name)
-
-                send_to_conn(conn, "send_group_file_result", {
-                    "ok": True,
-                    "conversation_id": conv_id,
-                    "filename": safe_name,
-                    "file_type": file_type,
-                    "message_id": msg_id,
-                })
-
-                try:
-                    members = get_members_of_conversation(conv_id) or []
-                except Exception:
-                    members = []
+                send_order.then(
+                    written, conn, "send_group_file_result", _finish_group_upload,
+                    conn, conv_id, user["id"], sender, msg_type, safe_name,
+                    "send_group_file_result", file_type, next_message_id(),
+                )
 
-                for m in members:
-                    uname = m.get("username")
-                    if not uname or uname == sender:
-                        continue
-                    if uname in clients:
-                        try:
-                            if file_type == "video":
-                                send_to_conn(clients[uname], "incoming_group_video", {
-                                    "conversation_id": conv_id,
-                                    "from": sender,
-                                    "filename": safe_name,
-                                    "message_id": msg_id,
-                                })
-                            elif file_type == "image":
-                                send_to_conn(clients[uname], "incoming_group_image", {
-                                    "conversation_id": conv_id,
-                                    "from": sender,
-                                    "filename": safe_name,
-                                    "message_id": msg_id,
-                                })
-                            else:
-                                send_to_conn(clients[uname], "incoming_group_file", {
-                                    "conversation_id": conv_id,
-                                    "from": sender,
-                                    "filename": safe_name,
-                                    "message_id": msg_id,
-                                })
-                        except Exception:
-                            pass
-                        
     # end of big while/try handling client: add missing except/finally and main()
     except Exception as e:
         print("Error while handling client:", e)
@@ -1436,7 +1853,41 @@ def handle_client(conn: socket.socket, addr):
         print(f"[-] Connection closed: {addr}")
 
 
+def _init_step(label: str, fn, *args):
+    """Chạy 1 bước khởi động; lỗi chỉ làm hỏng bước đó, các bước sau vẫn chạy."""
+    try:
+        fn(*args)
+    except Exception as e:
+        print(f"[SERVER] Khởi động {label} lỗi, server chạy thiếu phần này: {e}")
+
+
+def _start_thread(target, name: str):
+    threading.Thread(target=target, name=name, daemon=True).start()
+
+
 def main():
+    # migration chạy trước mọi thứ; node lỗi được bỏ qua và chạy lại khi sống lại,
+    # riêng primary (users, outbox, job) thì không chạy tiếp được
+    pending = init_schema()
+    primary = replication.primary_node()["name"]
+    if primary in pending:
+        raise SystemExit(f"[SERVER] Không kết nối được primary {primary}, dừng")
+    if pending:
+        print(f"[SERVER] Chưa chạy migration trên {pending}, ghi vào đó đi journal tới khi node sống lại")
+
+    _init_step("node health", init_node_health)
+    _init_step("conversation summary", init_conversation_summary)
+    _init_step("replication", init_replication)
+    _init_step("conversation index", init_conversation_index)
+    _init_step("user index", init_user_index)
+    _init_step("message archive", init_message_archive)
+    _init_step("job queue", init_job_queue)
+    # file cũ để phẳng -> chuyển dần sang thư mục chia theo hash, không cần dừng server
+    _start_thread(migrate_attachment_layout, "attachment-layout")
+    _start_thread(migrate_legacy_avatars, "avatar-migrate")
+    # FULLTEXT index có thể tạo lâu trên bảng lớn -> chạy nền
+    _start_thread(ensure_message_search_index, "fulltext-index")
+
     print(f"[SERVER] Listening on {SERVER_HOST}:{SERVER_PORT}")
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
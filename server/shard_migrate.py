@@ -0,0 +1,396 @@
+# server/shard_migrate.py
+#
+# Chuyển messages + conversation_members của 1 conversation từ node này sang
+# node khác khi user
+# vẫn đang chat (online migration):
+#   1. đánh dấu "migrating" trong shard map -> server ghi kép sang node đích
+#   2. copy dần theo batch (giữ nguyên id), có giới hạn tốc độ, rồi copy bù
+#      phần ghi muộn - vẫn lúc node nguồn là node chính
+#   3. cutover: đổi routing sang node đích nhưng vẫn ghi kép ngược về node
+#      nguồn, chờ mọi server nạp map mới rồi mới tắt ghi kép
+#   4. xóa dần dữ liệu ở node nguồn
+#
+# Lệnh xóa tin cũng được ghi kép. Server còn giữ map cũ sau cutover vẫn xóa
+# được ở node đích vì map cũ còn "migrating"; còn tin bị xóa trong lúc đang
+# copy (đã SELECT ở nguồn nhưng chưa INSERT sang đích) thì _copy_rows so lại
+# với nguồn sau mỗi batch và xóa ở đích.
+#
+#   python -m server.shard_migrate --conversation 42 --to node3
+#   python -m server.shard_migrate --rebalance        (chuyển mọi conversation đang bị ghim)
+#
+# Tin nhắn mới dùng id Snowflake (server/id_generator.py) nên không trùng giữa
+# các node. Tin cũ (trước khi có Snowflake) vẫn mang id AUTO_INCREMENT riêng
+# từng node, nên trước khi copy vẫn đẩy AUTO_INCREMENT của node đích lên và
+# kiểm tra trùng id ở mỗi batch.
+
+import argparse
+import time
+
+from common.config import (
+    get_shard_store,
+    get_node_by_name,
+    SHARD_MAP_RELOAD_S,
+    MIGRATE_BATCH_SIZE,
+    MIGRATE_MAX_ROWS_PER_S,
+)
+from server.db_access import get_connection
+
+AUTO_INCREMENT_GAP = 1_000_000
+
+
+class MigrationError(Exception):
+    pass
+
+
+class ConversationMigration:
+    def __init__(self, conversation_id: int, target: str,
+                 batch_size: int = MIGRATE_BATCH_SIZE,
+                 max_rows_per_sec: float = MIGRATE_MAX_ROWS_PER_S,
+                 store=None):
+        self.conversation_id = conversation_id
+        self.target = target
+        self.batch_size = max(1, batch_size)
+        self.max_rows_per_sec = max_rows_per_sec
+        self.store = store or get_shard_store()
+
+        self.progress = {
+            "conversation_id": conversation_id,
+            "phase": "init",
+            "total": 0,
+            "copied": 0,
+            "deleted": 0,
+            "rows_per_sec": 0.0,
+        }
+        self._started = time.monotonic()
+
+    # ---------- tiện ích ----------
+
+    def _report(self):
+        p = self.progress
+        print(
+            f"[MIGRATE] conv {p['conversation_id']} {p['phase']}: "
+            f"copied {p['copied']}/{p['total']}, deleted {p['deleted']}, "
+            f"{p['rows_per_sec']:.0f} rows/s"
+        )
+
+    def _throttle(self, rows_done: int, batch_started: float):
+        elapsed = time.monotonic() - self._started
+        if elapsed > 0:
+            self.progress["rows_per_sec"] = rows_done / elapsed
+        if self.max_rows_per_sec and self.max_rows_per_sec > 0:
+            min_time = self.batch_size / self.max_rows_per_sec
+            spent = time.monotonic() - batch_started
+            if spent < min_time:
+                time.sleep(min_time - spent)
+
+    @staticmethod
+    def _wait_propagation():
+        # chờ mọi tiến trình server nạp lại shard map
+        time.sleep(SHARD_MAP_RELOAD_S * 2 + 0.5)
+
+    def _publish(self, **changes):
+        current = self.store.get()
+        self.store.publish(current.next_version(**changes))
+
+    # ---------- các bước ----------
+
+    def _prepare_target(self, src, dst):
+        conn = get_connection(src)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT COUNT(*) AS cnt FROM messages WHERE conversation_id = %s",
+                    (self.conversation_id,),
+                )
+                self.progress["total"] = (cur.fetchone() or {}).get("cnt", 0)
+                cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM messages")
+                src_max = (cur.fetchone() or {}).get("max_id", 0)
+        finally:
+            conn.close()
+
+        conn = get_connection(dst)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM messages")
+                dst_max = (cur.fetchone() or {}).get("max_id", 0)
+                if dst_max <= src_max:
+                    cur.execute(
+                        f"ALTER TABLE messages AUTO_INCREMENT = {int(src_max + AUTO_INCREMENT_GAP)}"
+                    )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _copy_rows(self, src, dst, after_id: int) -> int:
+        """Copy các dòng có id > after_id, trả về id lớn nhất đã copy."""
+        last_id = after_id
+        while True:
+            batch_started = time.monotonic()
+            conn = get_connection(src)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        SELECT id, conversation_id, sender_id, msg_type, content, created_at
+                        FROM messages
+                        WHERE conversation_id = %s AND id > %s
+                        ORDER BY id ASC
+                        LIMIT %s
+                        """,
+                        (self.conversation_id, last_id, self.batch_size),
+                    )
+                    rows = cur.fetchall()
+            finally:
+                conn.close()
+
+            if not rows:
+                return last_id
+
+            ids = [r["id"] for r in rows]
+            conn = get_connection(dst)
+            try:
+                with conn.cursor() as cur:
+                    cur.executemany(
+                        """
+                        INSERT IGNORE INTO messages
+                            (id, conversation_id, sender_id, msg_type, content, created_at)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        """,
+                        [
+                            (r["id"], r["conversation_id"], r["sender_id"],
+                             r["msg_type"], r["content"], r["created_at"])
+                            for r in rows
+                        ],
+                    )
+                    # id đã có ở node đích nhưng thuộc conversation khác -> trùng id
+                    cur.execute(
+                        "SELECT id FROM messages WHERE conversation_id <> %s AND id IN ("
+                        + ", ".join(["%s"] * len(ids)) + ")",
+                        [self.conversation_id, *ids],
+                    )
+                    clashes = [r["id"] for r in cur.fetchall()]
+                if clashes:
+                    conn.rollback()
+                    raise MigrationError(
+                        f"Trùng id tin nhắn ở node đích: {clashes[:10]}"
+                    )
+                conn.commit()
+            finally:
+                conn.close()
+            self._drop_deleted(src, dst, ids)
+
+            last_id = ids[-1]
+            self.progress["copied"] += len(rows)
+            self._throttle(self.progress["copied"], batch_started)
+            self._report()
+
+    def _drop_deleted(self, src, dst, ids: list[int]):
+        """
+        Tin bị xóa (ghi kép, nguồn trước rồi đích) sau khi batch đã được SELECT
+        ở nguồn nhưng trước khi INSERT IGNORE sang đích sẽ sống lại ở đích.
+        So lại với nguồn sau khi INSERT: id không còn ở nguồn thì xóa ở đích.
+        """
+        placeholders = ", ".join(["%s"] * len(ids))
+        conn = get_connection(src)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"SELECT id FROM messages WHERE conversation_id = %s AND id IN ({placeholders})",
+                    [self.conversation_id, *ids],
+                )
+                still_there = {r["id"] for r in cur.fetchall()}
+            conn.commit()
+        finally:
+            conn.close()
+
+        gone = [i for i in ids if i not in still_there]
+        if not gone:
+            return
+        conn = get_connection(dst)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM messages WHERE conversation_id = %s AND id IN ("
+                    + ", ".join(["%s"] * len(gone)) + ")",
+                    [self.conversation_id, *gone],
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _copy_members(self, src, dst):
+        """
+        Copy conversation_members sang node đích. Chỉ làm 1 lần sau khi đã bật
+        ghi kép: thêm/xóa member từ đó về sau đi vào cả 2 node, còn copy bù sau
+        cutover có thể làm sống lại member vừa bị xóa.
+        """
+        conn = get_connection(src)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT user_id FROM conversation_members WHERE conversation_id = %s",
+                    (self.conversation_id,),
+                )
+                user_ids = [r["user_id"] for r in cur.fetchall()]
+        finally:
+            conn.close()
+
+        if not user_ids:
+            return
+        conn = get_connection(dst)
+        try:
+            with conn.cursor() as cur:
+                cur.executemany(
+                    "INSERT IGNORE INTO conversation_members (conversation_id, user_id) "
+                    "VALUES (%s, %s)",
+                    [(self.conversation_id, uid) for uid in user_ids],
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _delete_members(self, node):
+        conn = get_connection(node)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM conversation_members WHERE conversation_id = %s",
+                    (self.conversation_id,),
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _delete_rows(self, node):
+        while True:
+            batch_started = time.monotonic()
+            conn = get_connection(node)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "DELETE FROM messages WHERE conversation_id = %s LIMIT %s",
+                        (self.conversation_id, self.batch_size),
+                    )
+                    affected = cur.rowcount
+                conn.commit()
+            finally:
+                conn.close()
+            if affected <= 0:
+                return
+            self.progress["deleted"] += affected
+            self._throttle(self.progress["copied"] + self.progress["deleted"], batch_started)
+            self._report()
+
+    def run(self) -> dict:
+        current = self.store.get()
+        conv_id = self.conversation_id
+        src_name = current.node_for(conv_id)
+
+        if conv_id in current.migrating:
+            raise MigrationError(f"Conversation {conv_id} đang được migrate")
+        if src_name == self.target:
+            self.progress["phase"] = "done"
+            return self.progress
+
+        src = get_node_by_name(src_name)
+        dst = get_node_by_name(self.target)
+
+        self.progress["phase"] = "prepare"
+        self._prepare_target(src, dst)
+
+        # 1) bật ghi kép
+        self._publish(migrating={**current.migrating, conv_id: self.target})
+        self._wait_propagation()
+
+        try:
+            # 2) copy, rồi copy bù những tin ghi muộn (server đang ghi dở lúc
+            #    bật ghi kép). Làm khi nguồn vẫn là node chính: sau cutover,
+            #    xóa đi vào node đích trước nên copy bù có thể làm sống lại tin.
+            self.progress["phase"] = "copy"
+            self._copy_members(src, dst)
+            last_id = self._copy_rows(src, dst, after_id=0)
+            self._wait_propagation()
+            self.progress["phase"] = "catch-up"
+            self._copy_rows(src, dst, after_id=last_id)
+
+            # 3) cutover: đổi routing sang đích, giữ ghi kép ngược về nguồn.
+            #    Server còn map cũ (ghi nguồn + đích) và server đã nạp map mới
+            #    (ghi đích + nguồn) cùng chạm cả 2 node, kể cả lệnh xóa.
+            self.progress["phase"] = "cutover"
+            m = self.store.get()
+            overrides = dict(m.overrides)
+            if m.ring_node_for(conv_id) == self.target:
+                overrides.pop(conv_id, None)
+            else:
+                overrides[conv_id] = self.target
+            self._publish(overrides=overrides, migrating={**m.migrating, conv_id: src_name})
+        except Exception:
+            # hủy: tắt ghi kép, xóa bản copy dở ở node đích (dữ liệu gốc vẫn ở nguồn)
+            m = self.store.get()
+            migrating = dict(m.migrating)
+            migrating.pop(conv_id, None)
+            self._publish(migrating=migrating)
+            self._delete_rows(dst)
+            self._delete_members(dst)
+            self.progress["phase"] = "aborted"
+            self._report()
+            raise
+
+        self._wait_propagation()
+
+        # mọi server đã route sang đích -> tắt ghi kép
+        m = self.store.get()
+        migrating = dict(m.migrating)
+        migrating.pop(conv_id, None)
+        self._publish(migrating=migrating)
+        self._wait_propagation()
+
+        # 4) không còn server nào ghi vào nguồn -> dọn nguồn
+        self.progress["phase"] = "cleanup"
+        self._delete_rows(src)
+        self._delete_members(src)
+
+        self.progress["phase"] = "done"
+        self._report()
+        return self.progress
+
+
+def rebalance(**kwargs) -> list[dict]:
+    """
+    Chuyển mọi conversation đang bị ghim (overrides) về node mà vòng hash chỉ định.
+    Dùng sau `python -m server.shard_tool apply`.
+    """
+    store = kwargs.get("store") or get_shard_store()
+    current = store.get()
+    results = []
+    for conv_id, pinned in sorted(current.overrides.items()):
+        target = current.ring_node_for(conv_id)
+        if pinned == target:
+            continue
+        results.append(ConversationMigration(conv_id, target, **kwargs).run())
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chuyển conversation giữa các node DB")
+    parser.add_argument("--conversation", type=int)
+    parser.add_argument("--to", dest="target")
+    parser.add_argument("--rebalance", action="store_true")
+    parser.add_argument("--batch", type=int, default=MIGRATE_BATCH_SIZE)
+    parser.add_argument("--rate", type=float, default=MIGRATE_MAX_ROWS_PER_S,
+                        help="số dòng/giây tối đa (0 = không giới hạn)")
+    args = parser.parse_args(argv)
+
+    opts = {"batch_size": args.batch, "max_rows_per_sec": args.rate}
+    if args.rebalance:
+        done = rebalance(**opts)
+        print(f"[MIGRATE] Đã chuyển {len(done)} conversation")
+        return
+    if args.conversation is None or not args.target:
+        parser.error("cần --conversation và --to, hoặc --rebalance")
+    get_node_by_name(args.target)
+    ConversationMigration(args.conversation, args.target, **opts).run()
+
+
+if __name__ == "__main__":
+    main()
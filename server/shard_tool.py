@@ -0,0 +1,179 @@
+# server/shard_tool.py
+#
+# Công cụ quản lý shard map:
+#   python -m server.shard_tool show
+#   python -m server.shard_tool plan  --add node3          (chỉ báo cáo, không đổi gì)
+#   python -m server.shard_tool apply --add node3          (ghi shard map version mới)
+#   python -m server.shard_migrate --rebalance              (chuyển dữ liệu theo map mới)
+#
+# "plan" đếm số conversation / tin nhắn đang nằm ở node nào và cho biết
+# bao nhiêu sẽ phải chuyển nếu áp dụng topology mới. Conversation có dữ liệu
+# trên nhiều node được liệt kê; "apply" từ chối cho tới khi dọn xong (hoặc --force).
+
+import argparse
+from collections import defaultdict
+
+from common.config import DB_NODES, get_shard_store
+from common.shard_map import ShardMap
+from server.db_access import get_connection
+
+CONFLICT_SAMPLE = 20        # số conversation trùng liệt kê khi in kế hoạch
+
+
+def build_proposed_map(current: ShardMap, add: list[str], remove: list[str],
+                       vnodes: int | None = None,
+                       strategy: str | None = None) -> ShardMap:
+    nodes = [n for n in current.nodes if n not in remove]
+    for name in add:
+        if name not in nodes:
+            nodes.append(name)
+    return current.next_version(
+        nodes=nodes,
+        strategy=strategy or current.strategy,
+        vnodes=vnodes or current.vnodes,
+    )
+
+
+def read_placement(current: ShardMap) -> tuple[dict[int, tuple[str, int]], dict[int, list[str]]]:
+    """
+    Đọc vị trí thực tế của dữ liệu: ({conversation_id: (node_name, số tin)}, conflicts).
+    Lấy hợp của messages và conversation_members: conversation chưa có tin
+    nào vẫn có member nằm trên 1 node, cũng phải ghim khi đổi topology.
+    conflicts: {conversation_id: [các node]} - conversation có tin trên nhiều
+    node mà không phải đang migrate (vd. migrate dở rồi bỏ), hoặc chưa có tin
+    mà member nằm ở nhiều node không gồm node hiện hành. Khi đó giữ node mà
+    shard map hiện hành trỏ tới, không có thì node nhiều tin nhất.
+    (Bản member thừa ở replica do seed_replicas cũ copy sang không tính là trùng.)
+    """
+    found: dict[int, dict[str, int]] = defaultdict(dict)
+    with_messages: dict[int, set[str]] = defaultdict(set)
+    for node in DB_NODES:
+        conn = get_connection(node)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT conversation_id, COUNT(*) AS cnt
+                    FROM messages
+                    GROUP BY conversation_id
+                    """
+                )
+                for r in cur.fetchall():
+                    found[r["conversation_id"]][node["name"]] = r["cnt"]
+                    with_messages[r["conversation_id"]].add(node["name"])
+                cur.execute("SELECT DISTINCT conversation_id FROM conversation_members")
+                for r in cur.fetchall():
+                    found[r["conversation_id"]].setdefault(node["name"], 0)
+        finally:
+            conn.close()
+
+    placement: dict[int, tuple[str, int]] = {}
+    conflicts: dict[int, list[str]] = {}
+    for conv_id, per_node in found.items():
+        owner = current.node_for(conv_id)
+        msg_nodes = with_messages.get(conv_id)
+        if conv_id not in current.migrating:
+            if msg_nodes and len(msg_nodes) > 1:
+                conflicts[conv_id] = sorted(msg_nodes)
+            elif not msg_nodes and len(per_node) > 1 and owner not in per_node:
+                conflicts[conv_id] = sorted(per_node)
+        if owner in per_node and (not msg_nodes or owner in msg_nodes):
+            src = owner
+        else:
+            src = max(per_node, key=per_node.get)
+        placement[conv_id] = (src, per_node[src])
+    return placement, conflicts
+
+
+def plan_moves(proposed: ShardMap, placement: dict[int, tuple[str, int]],
+               conflicts: dict[int, list[str]] | None = None) -> dict:
+    moves: dict[tuple[str, str], list[int]] = defaultdict(list)
+    moved_rows = 0
+    total_rows = 0
+    for conv_id, (src, cnt) in placement.items():
+        total_rows += cnt
+        dst = proposed.ring_node_for(conv_id)
+        if dst != src:
+            moves[(src, dst)].append(conv_id)
+            moved_rows += cnt
+    return {
+        "total_conversations": len(placement),
+        "moved_conversations": sum(len(v) for v in moves.values()),
+        "total_rows": total_rows,
+        "moved_rows": moved_rows,
+        "moves": dict(moves),
+        "conflicts": dict(conflicts or {}),
+    }
+
+
+def print_plan(current: ShardMap, proposed: ShardMap, report: dict):
+    print(f"Hiện tại : v{current.version} {current.strategy} {current.nodes}")
+    print(f"Đề xuất  : v{proposed.version} {proposed.strategy} {proposed.nodes}")
+    total_c = report["total_conversations"] or 1
+    total_r = report["total_rows"] or 1
+    print(
+        f"Conversation phải chuyển: {report['moved_conversations']}/"
+        f"{report['total_conversations']} ({100 * report['moved_conversations'] / total_c:.1f}%)"
+    )
+    print(
+        f"Tin nhắn phải chuyển    : {report['moved_rows']}/"
+        f"{report['total_rows']} ({100 * report['moved_rows'] / total_r:.1f}%)"
+    )
+    for (src, dst), conv_ids in sorted(report["moves"].items()):
+        print(f"  {src} -> {dst}: {len(conv_ids)} conversation")
+    conflicts = report.get("conflicts") or {}
+    if conflicts:
+        print(f"Conversation có dữ liệu trên nhiều node: {len(conflicts)}")
+        for conv_id, nodes in sorted(conflicts.items())[:CONFLICT_SAMPLE]:
+            print(f"  #{conv_id}: {', '.join(nodes)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quản lý shard map")
+    parser.add_argument("command", choices=["show", "plan", "apply"])
+    parser.add_argument("--add", action="append", default=[], help="thêm node (tên trong DB_NODES)")
+    parser.add_argument("--remove", action="append", default=[], help="bỏ node")
+    parser.add_argument("--vnodes", type=int, default=None)
+    parser.add_argument("--strategy", choices=["consistent", "modulo"], default=None)
+    parser.add_argument("--force", action="store_true",
+                        help="apply kể cả khi có conversation nằm trên nhiều node")
+    args = parser.parse_args(argv)
+
+    store = get_shard_store()
+    current = store.get()
+
+    if args.command == "show":
+        print(current.to_dict())
+        return
+
+    known = {n["name"] for n in DB_NODES}
+    unknown = [n for n in args.add if n not in known]
+    if unknown:
+        parser.error(f"Node chưa khai báo trong DB_NODES: {unknown}")
+
+    proposed = build_proposed_map(current, args.add, args.remove, args.vnodes, args.strategy)
+    placement, conflicts = read_placement(current)
+    report = plan_moves(proposed, placement, conflicts)
+    print_plan(current, proposed, report)
+
+    if args.command == "apply" and conflicts and not args.force:
+        print("Không ghi shard map: dọn các conversation trùng ở trên trước "
+              "(hoặc chạy lại với --force để ghim theo node đã chọn).")
+        raise SystemExit(1)
+
+    if args.command == "apply":
+        # ghim các conversation phải chuyển vào node hiện tại để không mất dữ liệu;
+        # shard_migrate --rebalance sẽ chuyển dần và gỡ ghim.
+        overrides = dict(proposed.overrides)
+        for (src, _dst), conv_ids in report["moves"].items():
+            for conv_id in conv_ids:
+                overrides[conv_id] = src
+        proposed.overrides = overrides
+        store.publish(proposed)
+        print(f"Đã ghi shard map v{proposed.version} "
+              f"({len(overrides)} conversation đang được ghim). "
+              "Chạy `python -m server.shard_migrate --rebalance` để chuyển dữ liệu.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+# server/sqlite_backend.py
+#
+# Backend sqlite3 (stdlib) cho db_access: mỗi node trong DB_NODES là 1 file
+# <SQLITE_DB_DIR>/<tên node>.db, WAL mode -> nhiều thread đọc song song với
+# 1 thread ghi. Sharding, outbox, migrate... giữ nguyên vì code phía trên
+# vẫn thấy nhiều node như với MySQL.
+#
+# Code db_access viết SQL kiểu MySQL; translate() dịch những cú pháp MySQL
+# đang dùng trong repo sang SQLite (INSERT IGNORE, ON DUPLICATE KEY UPDATE,
+# NOW(3) ± INTERVAL, GREATEST, DELETE ... LIMIT...). Câu DDL riêng của MySQL
+# (CREATE TABLE có KEY, FULLTEXT, ALTER ... AUTO_INCREMENT) bị bỏ qua:
+# schema SQLite do server/schema.py tạo trong init_node().
+
+import os
+import re
+import sqlite3
+import threading
+from datetime import date, datetime
+from functools import lru_cache
+from pathlib import Path
+
+from common.config import SQLITE_DB_DIR, SQLITE_BUSY_TIMEOUT_S
+from server import query_stats, schema
+from server.storage_backend import StorageBackend
+
+query_stats.skip_frames_from(os.path.abspath(__file__))
+
+class SQLiteNodeUnavailable(sqlite3.OperationalError):
+    """Không mở được file DB của node (coi như node chết, giống lỗi kết nối MySQL)."""
+
+
+# ---------- chuyển kiểu ----------
+
+def _convert_datetime(raw: bytes):
+    try:
+        return datetime.fromisoformat(raw.decode())
+    except ValueError:
+        return raw.decode()
+
+
+sqlite3.register_converter("DATETIME", _convert_datetime)
+
+
+def _param(v):
+    if isinstance(v, datetime):
+        return v.isoformat(sep=" ")
+    if isinstance(v, date):
+        return v.isoformat()
+    return v
+
+
+def _params(args):
+    if args is None:
+        return ()
+    if isinstance(args, dict):
+        return {k: _param(v) for k, v in args.items()}
+    if not isinstance(args, (list, tuple)):
+        args = (args,)
+    return tuple(_param(v) for v in args)
+
+
+def _literal(v) -> str:
+    if v is None:
+        return "NULL"
+    if isinstance(v, bool):
+        return str(int(v))
+    if isinstance(v, (int, float)):
+        return repr(v)
+    if isinstance(v, bytes):
+        return "X'" + v.hex() + "'"
+    return "'" + str(v).replace("'", "''") + "'"
+
+
+_LITERAL_OR_PARAM_RE = re.compile(r"'(?:[^']|'')*'|\?")
+
+
+def _inline(sql: str, params) -> str:
+    """Gắn giá trị tham số vào câu SQL (cho slow log / EXPLAIN, không dùng để chạy)."""
+    if not params or isinstance(params, dict):
+        return sql
+    it = iter(params)
+
+    def repl(m):
+        if m.group(0) != "?":
+            return m.group(0)
+        return _literal(next(it, None))
+
+    return _LITERAL_OR_PARAM_RE.sub(repl, sql)
+
+
+# ---------- dịch SQL MySQL -> SQLite ----------
+
+_NOW_MS = "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')"
+
+_SKIP_RE = re.compile(
+    r"^\s*(CREATE\s+TABLE\s+IF\s+NOT\s+EXISTS|CREATE\s+FULLTEXT\s+INDEX|"
+    r"ALTER\s+TABLE\s+\w+\s+AUTO_INCREMENT)\b",
+    re.I,
+)
+_PLACEHOLDER_RE = re.compile(r"%([s%])")
+_REWRITES = [
+    (re.compile(r"\bINSERT\s+IGNORE\s+INTO\b", re.I), "INSERT OR IGNORE INTO"),
+    (re.compile(r"\bGREATEST\(", re.I), "MAX("),
+    (re.compile(r"\bLEAST\(", re.I), "MIN("),
+    (re.compile(r"\bCHAR_LENGTH\(", re.I), "LENGTH("),
+    (
+        re.compile(r"\bTIMESTAMPDIFF\(\s*MICROSECOND\s*,\s*(.+?)\s*,\s*NOW\(3\)\s*\)", re.I),
+        r"((julianday('now', 'localtime') - julianday(\1)) * 86400000000.0)",
+    ),
+    (
+        re.compile(r"\bNOW\(3\)\s*([+-])\s*INTERVAL\s+(\?|\d+)\s+SECOND\b", re.I),
+        r"strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime', '\1' || \2 || ' seconds')",
+    ),
+    (re.compile(r"\bNOW\(3\)", re.I), _NOW_MS),
+    (re.compile(r"\bNOW\(\)", re.I), "datetime('now', 'localtime')"),
+    # MySQL mặc định escape bằng '\' trong LIKE, SQLite phải khai báo
+    (re.compile(r"\bLIKE\s+\?", re.I), r"LIKE ? ESCAPE '\\'"),
+]
+_ON_DUP_RE = re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.I)
+_VALUES_FN_RE = re.compile(r"\bVALUES\((\w+)\)", re.I)
+_DELETE_LIMIT_RE = re.compile(
+    r"^\s*DELETE\s+FROM\s+(\w+)\s+WHERE\s+(.+?)\s+LIMIT\s+(\?|\d+)\s*$", re.I | re.S
+)
+
+
+@lru_cache(maxsize=2048)
+def translate(sql: str, has_params: bool = True) -> str | None:
+    """Câu MySQL -> câu SQLite; None = câu chỉ có nghĩa với MySQL, bỏ qua."""
+    if _SKIP_RE.match(sql):
+        return None
+    if has_params:
+        sql = _PLACEHOLDER_RE.sub(lambda m: "?" if m.group(1) == "s" else "%", sql)
+    for pattern, repl in _REWRITES:
+        sql = pattern.sub(repl, sql)
+
+    m = _ON_DUP_RE.search(sql)
+    if m:
+        head, tail = sql[:m.start()], sql[m.end():]
+        sql = head + "ON CONFLICT DO UPDATE SET" + _VALUES_FN_RE.sub(r"excluded.\1", tail)
+
+    m = _DELETE_LIMIT_RE.match(sql)
+    if m:
+        table, where, limit = m.groups()
+        sql = (f"DELETE FROM {table} WHERE rowid IN "
+               f"(SELECT rowid FROM {table} WHERE {where} LIMIT {limit})")
+    return sql
+
+
+# ---------- connection / cursor kiểu pymysql ----------
+
+class _Cursor:
+    def __init__(self, conn: "_Connection", stream: bool = False):
+        self.connection = conn
+        self._cur = conn.raw.cursor()
+        # stream=True: không fetchall() lúc execute, fetch*() đọc dần từ sqlite3
+        self.stream = stream
+        self._cols: list[str] = []
+        self._rows: list[dict] = []
+        self._pos = 0
+        self._sql = None
+        self._params = ()
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._cur.close()
+
+    def execute(self, query, args=None):
+        return query_stats.timed_execute(
+            self,
+            self.connection.node_name,
+            lambda: self._execute(query, args),
+            lambda: _inline(self._sql or query, self._params),
+        )
+
+    def _execute(self, query, args):
+        if self.connection.raw_sql:
+            sql = query
+        else:
+            sql = translate(query, args is not None)
+        self._rows, self._pos = [], 0
+        self._sql, self._params = sql, _params(args)
+        if sql is None:
+            self.rowcount = 0
+            self.description = None
+            return 0
+
+        cur = self._cur
+        cur.execute(sql, self._params)
+        self.description = cur.description
+        if cur.description:
+            self._cols = [d[0] for d in cur.description]
+            if self.stream:
+                self.rowcount = -1
+                return self.rowcount
+            self._rows = [dict(zip(self._cols, r)) for r in cur.fetchall()]
+            self.rowcount = len(self._rows)
+        else:
+            self.rowcount = cur.rowcount
+        self.lastrowid = cur.lastrowid
+        return self.rowcount
+
+    def executemany(self, query, seq_of_args):
+        total = 0
+        for args in seq_of_args:
+            total += max(self.execute(query, args), 0)
+        self.rowcount = total
+        return total
+
+    def fetchone(self):
+        if self.stream:
+            r = self._cur.fetchone()
+            return None if r is None else dict(zip(self._cols, r))
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchmany(self, size: int = 1):
+        if self.stream:
+            return [dict(zip(self._cols, r)) for r in self._cur.fetchmany(size)]
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        if self.stream:
+            return [dict(zip(self._cols, r)) for r in self._cur.fetchall()]
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        if self.stream:
+            return (dict(zip(self._cols, r)) for r in self._cur)
+        return iter(self.fetchall())
+
+
+class _Connection:
+    def __init__(self, raw: sqlite3.Connection, node_name: str, raw_sql: bool = False):
+        self.raw = raw
+        self.node_name = node_name
+        # True: chạy câu SQL nguyên văn (DDL SQLite của migration), không dịch
+        self.raw_sql = raw_sql
+
+    def cursor(self, cursor_class=None):
+        return _Cursor(self)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+
+class SQLiteBackend(StorageBackend):
+    name = "sqlite"
+    supports_fulltext = False
+
+    Error = sqlite3.Error
+    OperationalError = sqlite3.OperationalError
+    IntegrityError = sqlite3.IntegrityError
+    ConnectError = SQLiteNodeUnavailable
+
+    def __init__(self, directory=SQLITE_DB_DIR):
+        self.directory = Path(directory)
+        self._ready: set[str] = set()
+        self._lock = threading.Lock()
+
+    def path_for(self, node_config: dict) -> Path:
+        return self.directory / f"{node_config['name']}.db"
+
+    def _open(self, node_config: dict, timeout: float) -> sqlite3.Connection:
+        try:
+            raw = sqlite3.connect(
+                self.path_for(node_config),
+                timeout=max(timeout, SQLITE_BUSY_TIMEOUT_S),
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                check_same_thread=False,
+            )
+        except sqlite3.OperationalError as e:
+            raise SQLiteNodeUnavailable(f"{node_config['name']}: {e}") from e
+        raw.execute("PRAGMA synchronous = NORMAL")
+        return raw
+
+    def init_node(self, node_config: dict):
+        with self._lock:
+            if node_config["name"] in self._ready:
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            raw = self._open(node_config, SQLITE_BUSY_TIMEOUT_S)
+            try:
+                raw.execute("PRAGMA journal_mode = WAL")
+                schema.apply_migrations(
+                    _Connection(raw, node_config["name"], raw_sql=True), "sqlite", node_config["name"]
+                )
+            finally:
+                raw.close()
+            self._ready.add(node_config["name"])
+
+    def connect(self, node_config: dict, timeout: float):
+        if node_config["name"] not in self._ready:
+            self.init_node(node_config)
+        return _Connection(self._open(node_config, timeout), node_config["name"])
+
+    def stream_cursor(self, conn):
+        return _Cursor(conn, stream=True)
+
+    def explain(self, conn, sql: str) -> list[dict]:
+        cur = conn.raw.execute("EXPLAIN QUERY PLAN " + sql)
+        cols = [d[0] for d in cur.description]
+        return [dict(zip(cols, r)) for r in cur.fetchall()]
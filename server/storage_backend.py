@@ -0,0 +1,131 @@
+# server/storage_backend.py
+#
+# Lớp lưu trữ bên dưới db_access. Mọi hàm db_access (và replication,
+# shard_migrate, write_batcher) chỉ dùng API kiểu DB-API của pymysql:
+#   conn = backend.connect(node) ; with conn.cursor() as cur: cur.execute(sql, params)
+#   cur.fetchone() / fetchall() -> dict ; cur.rowcount / lastrowid ; conn.commit() / rollback() / close()
+# nên đổi backend là đổi toàn bộ db_access, giữ nguyên sharding (mỗi node
+# trong DB_NODES vẫn là 1 kho riêng).
+#
+# Backend chọn bằng DB_BACKEND trong common/config.py:
+#   - "mysql"  : pymysql + MySQL/MariaDB (mặc định, cụm XAMPP hiện tại)
+#   - "sqlite" : sqlite3 của stdlib, 1 file / node (server/sqlite_backend.py) -
+#                chạy 1 node nhúng, CI, benchmark mà không cần MySQL
+
+import os
+
+from common.config import DB_BACKEND
+from server import query_stats
+
+query_stats.skip_frames_from(os.path.abspath(__file__))
+
+
+class StorageBackend:
+    """
+    Giao diện chung. Câu SQL viết theo cú pháp MySQL với placeholder %s;
+    backend khác tự dịch sang dialect của nó.
+    """
+
+    name = "base"
+    supports_fulltext = False
+
+    # lớp exception tương ứng của driver (db_access bắt theo các tên này)
+    Error = Exception
+    OperationalError = Exception
+    IntegrityError = Exception
+    # lỗi nghĩa là "node không dùng được" (circuit breaker / journal degraded)
+    ConnectError = Exception
+
+    def connect(self, node_config: dict, timeout: float):
+        """Connection mới tới node; connection.node_name = tên node."""
+        raise NotImplementedError
+
+    def stream_cursor(self, conn):
+        """
+        Cursor không buffer (kiểu SSCursor): fetchmany() lấy dần từ server, bộ nhớ
+        không tăng theo số dòng. Đọc hết (hoặc đóng cursor) trước khi chạy câu
+        khác trên cùng connection.
+        """
+        raise NotImplementedError
+
+    def explain(self, conn, sql: str) -> list[dict]:
+        """Kế hoạch thực thi của 1 câu SQL (đã gắn sẵn giá trị tham số)."""
+        raise NotImplementedError
+
+    def init_node(self, node_config: dict):
+        """Chuẩn bị kho của node trước lần kết nối đầu (tạo file, schema...)."""
+
+
+class MySQLBackend(StorageBackend):
+    name = "mysql"
+    supports_fulltext = True
+
+    def __init__(self):
+        import pymysql
+
+        self._pymysql = pymysql
+        self.Error = pymysql.MySQLError
+        self.OperationalError = pymysql.err.OperationalError
+        self.IntegrityError = pymysql.err.IntegrityError
+        self.ConnectError = pymysql.err.OperationalError
+        self._cursor_class = _instrumented_cursor(pymysql, pymysql.cursors.DictCursor)
+        self._stream_class = _instrumented_cursor(pymysql, pymysql.cursors.SSDictCursor)
+
+    def connect(self, node_config: dict, timeout: float):
+        conn = self._pymysql.connect(
+            host=node_config["host"],
+            port=node_config["port"],
+            user=node_config["user"],
+            password=node_config["password"],
+            database=node_config["database"],
+            # đo thời gian mọi câu SQL (server/query_stats.py)
+            cursorclass=self._cursor_class,
+            connect_timeout=timeout,
+        )
+        conn.node_name = node_config["name"]
+        return conn
+
+    def stream_cursor(self, conn):
+        return conn.cursor(self._stream_class)
+
+    def explain(self, conn, sql: str) -> list[dict]:
+        # cursor thường để EXPLAIN không tự đếm vào thống kê
+        with conn.cursor(self._pymysql.cursors.DictCursor) as cur:
+            cur.execute("EXPLAIN " + sql)
+            return cur.fetchall()
+
+
+def _instrumented_cursor(pymysql, base):
+    query_stats.skip_frames_from(os.path.dirname(pymysql.__file__))
+
+    class InstrumentedCursor(base):
+        """
+        DictCursor / SSDictCursor có bấm giờ. executemany() của pymysql gọi lại
+        execute() nên cũng được đo theo từng lô. Với SSDictCursor chỉ đo tới
+        lúc server trả dòng đầu (phần còn lại đọc dần bằng fetchmany).
+        """
+
+        def execute(self, query, args=None):
+            def describe():
+                executed = self._executed
+                if isinstance(executed, bytes):
+                    executed = executed.decode("utf-8", "replace")
+                return executed or str(query)
+
+            return query_stats.timed_execute(
+                self,
+                getattr(self.connection, "node_name", "?"),
+                lambda: super(InstrumentedCursor, self).execute(query, args),
+                describe,
+            )
+
+    return InstrumentedCursor
+
+
+def get_backend(name: str = DB_BACKEND) -> StorageBackend:
+    if name == "mysql":
+        return MySQLBackend()
+    if name == "sqlite":
+        from server.sqlite_backend import SQLiteBackend
+        return SQLiteBackend()
+    raise ValueError(f"DB_BACKEND không hợp lệ: {name!r} (mysql | sqlite)")
@@ -0,0 +1,179 @@
+# server/user_index.py
+#
+# Index trong RAM cho thanh tìm user ở sidebar, thay cho
+# `LIKE '%kw%'` (không dùng được index, quét cả bảng users mỗi lần gõ phím):
+#   - trigram -> tập user_id, lấy tập nhỏ nhất của các trigram trong từ khóa
+#     rồi kiểm tra lại substring
+#   - từ khóa 1-2 ký tự: tìm theo prefix trên danh sách key đã sort
+#     (username + từng chữ của display_name)
+# So khớp không phân biệt hoa thường / dấu tiếng Việt (giống collation *_ci).
+#
+# CoalescedCalls: nhiều request giống hệt nhau chạy cùng lúc chỉ gọi hàm thật 1 lần.
+
+import bisect
+import threading
+import unicodedata
+from concurrent.futures import Future
+
+
+def normalize(text: str) -> str:
+    text = (text or "").casefold().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class UserSearchIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # user_id -> (username, display_name, username chuẩn hóa, display_name chuẩn hóa)
+        self._entries: dict[int, tuple] = {}
+        self._grams: dict[str, set[int]] = {}
+        self._prefix_keys: list[tuple[str, int]] = []
+        self.max_id = 0
+        self.ready = False
+
+    # ---------- cập nhật ----------
+
+    def load(self, rows):
+        """Nạp toàn bộ users (lúc khởi động), rows: [{id, username, display_name}]."""
+        with self._lock:
+            self._entries.clear()
+            self._grams.clear()
+            self._prefix_keys = []
+            for r in rows:
+                self._add_locked(r["id"], r["username"], r.get("display_name"), sort=False)
+            self._prefix_keys.sort()
+            self.ready = True
+
+    def add(self, user_id: int, username: str, display_name: str | None):
+        with self._lock:
+            if user_id in self._entries:
+                self._remove_locked(user_id)
+            self._add_locked(user_id, username, display_name, sort=True)
+
+    def _keys_for(self, nu: str, nd: str) -> set[str]:
+        return {nu, *nd.split()}
+
+    def _add_locked(self, user_id, username, display_name, sort: bool):
+        nu = normalize(username)
+        nd = normalize(display_name or "")
+        self._entries[user_id] = (username, display_name, nu, nd)
+        for g in _trigrams(nu) | _trigrams(nd):
+            self._grams.setdefault(g, set()).add(user_id)
+        for key in self._keys_for(nu, nd):
+            if sort:
+                bisect.insort(self._prefix_keys, (key, user_id))
+            else:
+                self._prefix_keys.append((key, user_id))
+        if user_id > self.max_id:
+            self.max_id = user_id
+
+    def _remove_locked(self, user_id):
+        _, _, nu, nd = self._entries.pop(user_id)
+        for g in _trigrams(nu) | _trigrams(nd):
+            ids = self._grams.get(g)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del self._grams[g]
+        for key in self._keys_for(nu, nd):
+            pos = bisect.bisect_left(self._prefix_keys, (key, user_id))
+            if pos < len(self._prefix_keys) and self._prefix_keys[pos] == (key, user_id):
+                self._prefix_keys.pop(pos)
+
+    # ---------- tìm ----------
+
+    def _candidates(self, q: str, cap: int) -> set[int]:
+        """
+        Tập user_id có thể khớp (chưa kiểm tra lại substring).
+        q >= 3 ký tự: lấy danh sách trigram nhỏ nhất, các trigram khác chỉ để
+        loại sớm khi không user nào có. q ngắn: quét prefix, tối đa `cap` key.
+        """
+        if len(q) >= 3:
+            smallest = None
+            for g in _trigrams(q):
+                ids = self._grams.get(g)
+                if not ids:
+                    return set()
+                if smallest is None or len(ids) < len(smallest):
+                    smallest = ids
+            return smallest
+
+        keys = self._prefix_keys
+        i = bisect.bisect_left(keys, (q, -1))
+        result = set()
+        while i < len(keys) and len(result) < cap:
+            key, user_id = keys[i]
+            if not key.startswith(q):
+                break
+            result.add(user_id)
+            i += 1
+        return result
+
+    @staticmethod
+    def _rank(q: str, nu: str, nd: str) -> int | None:
+        """Thấp hơn = khớp tốt hơn; None = không khớp."""
+        if nu == q:
+            return 0
+        if nu.startswith(q):
+            return 1
+        if nd.startswith(q) or f" {q}" in nd:
+            return 2
+        if q in nu:
+            return 3
+        if q in nd:
+            return 4
+        return None
+
+    def search(self, keyword: str, limit: int = 20) -> list[dict]:
+        q = normalize(keyword).strip()
+        if not q:
+            return []
+        with self._lock:
+            scored = []
+            for user_id in self._candidates(q, cap=max(limit * 50, 1000)):
+                username, display_name, nu, nd = self._entries[user_id]
+                rank = self._rank(q, nu, nd)
+                if rank is not None:
+                    scored.append((rank, username, user_id, display_name))
+        scored.sort()
+        return [
+            {"id": user_id, "username": username, "display_name": display_name}
+            for _, username, user_id, display_name in scored[:limit]
+        ]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CoalescedCalls:
+    """
+    Gộp các lời gọi trùng key đang chạy đồng thời: lời gọi đầu tiên chạy fn,
+    các lời gọi sau cùng key chờ và nhận chung kết quả (hoặc chung exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: dict[object, Future] = {}
+
+    def call(self, key, fn):
+        with self._lock:
+            fut = self._inflight.get(key)
+            owner = fut is None
+            if owner:
+                fut = self._inflight[key] = Future()
+        if not owner:
+            return fut.result()
+
+        try:
+            fut.set_result(fn())
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return fut.result()
@@ -0,0 +1,156 @@
+# server/write_batcher.py
+#
+# Gom nhiều lệnh insert_message trên cùng 1 node thành 1 câu
+# INSERT nhiều dòng + 1 lần commit (group commit), giảm chi phí fsync
+# mỗi tin nhắn khi nhóm chat đông người.
+
+import threading
+import queue
+import time
+from concurrent.futures import Future
+
+
+class ShardWriteBatcher:
+    """
+    Mỗi node DB có 1 batcher + 1 thread ghi riêng.
+    submit() chặn caller cho tới khi batch chứa tin nhắn đó được commit,
+    rồi trả về đúng message_id của tin nhắn đó.
+    message_id do caller cấp sẵn (hoặc id_factory - Snowflake - lúc submit),
+    nên không phụ thuộc AUTO_INCREMENT của node, và caller ghi journal lại
+    đúng id đó khi batch lỗi (INSERT IGNORE, không sinh tin trùng).
+    Batch lỗi thì ghi lại từng dòng: 1 dòng hỏng không kéo cả lô hỏng theo.
+    """
+
+    def __init__(self, node_cfg: dict, connect, id_factory, max_batch: int = 100,
+                 max_delay_ms: float = 5.0, on_flush=None):
+        self.node_cfg = node_cfg
+        self._connect = connect
+        self._id_factory = id_factory
+        self.max_batch = max(1, int(max_batch))
+        self.max_delay = max(0.0, float(max_delay_ms)) / 1000.0
+        self._on_flush = on_flush   # callback(list[dict]) sau khi commit xong
+
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"write-batcher-{node_cfg.get('name')}",
+            daemon=True,
+        )
+        self._thread.start()
+
+        # thống kê đơn giản
+        self.batches_written = 0
+        self.rows_written = 0
+
+    def submit(self, conversation_id: int, sender_id: int, msg_type: str,
+               content: str, message_id: int | None = None) -> dict:
+        """
+        Đưa 1 tin nhắn vào hàng đợi và chờ kết quả.
+        Trả về dict {id, conversation_id, sender_id, msg_type, content, created_at}.
+        """
+        fut: Future = Future()
+        self._queue.put(({
+            "id": message_id if message_id is not None else self._id_factory(),
+            "conversation_id": conversation_id,
+            "sender_id": sender_id,
+            "msg_type": msg_type,
+            "content": content,
+        }, fut))
+        return fut.result()
+
+    # ---------- thread ghi ----------
+
+    def _collect(self) -> list:
+        first = self._queue.get()
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                results = self._write(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    results = [e]
+                else:
+                    print(f"[BATCHER] Batch {len(batch)} dòng lỗi ({self.node_cfg.get('name')}): "
+                          f"{e}, ghi lại từng dòng")
+                    results = [self._write_one(entry) for entry in batch]
+
+            rows = [r for r in results if not isinstance(r, Exception)]
+            if rows:
+                self.batches_written += 1
+                self.rows_written += len(rows)
+
+            # cập nhật ring / summary TRƯỚC khi trả kết quả: caller nhận id
+            # xong đọc lại lịch sử phải thấy tin vừa ghi
+            if rows and self._on_flush:
+                try:
+                    self._on_flush(rows)
+                except Exception as e:
+                    print(f"[BATCHER] on_flush lỗi ({self.node_cfg.get('name')}): {e}")
+
+            for (_, fut), res in zip(batch, results):
+                if isinstance(res, Exception):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
+
+    def _write_one(self, entry):
+        try:
+            return self._write([entry])[0]
+        except Exception as e:
+            return e
+
+    def _write(self, batch: list) -> list[dict]:
+        items = [item for item, _ in batch]
+        ids = [it["id"] for it in items]
+        placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(items))
+        params: list = []
+        for it in items:
+            params.extend((it["id"], it["conversation_id"], it["sender_id"],
+                           it["msg_type"], it["content"]))
+
+        conn = self._connect(self.node_cfg)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO messages (id, conversation_id, sender_id, msg_type, content) "
+                    f"VALUES {placeholders}",
+                    params,
+                )
+                cur.execute(
+                    "SELECT id, created_at FROM messages WHERE id IN ("
+                    + ", ".join(["%s"] * len(ids)) + ")",
+                    ids,
+                )
+                created = {r["id"]: r["created_at"] for r in cur.fetchall()}
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        rows = []
+        for it, msg_id in zip(items, ids):
+            rows.append({**it, "created_at": created.get(msg_id)})
+        return rows
+
+    def stats(self) -> dict:
+        return {
+            "node": self.node_cfg.get("name"),
+            "pending": self._queue.qsize(),
+            "batches_written": self.batches_written,
+            "rows_written": self.rows_written,
+        }
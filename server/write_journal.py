@@ -0,0 +1,124 @@
+# server/write_journal.py
+#
+# Journal ghi cục bộ cho chế độ degraded: khi node shard đang lỗi, lệnh ghi
+# (insert/xóa tin nhắn, thêm/xóa member) được nối vào file JSONL của node đó
+# thay vì báo lỗi cho client. Khi node sống lại, replay() chạy lại đúng thứ tự.
+#
+# Mọi lệnh trong journal phải idempotent (INSERT IGNORE với id cấp sẵn,
+# DELETE theo khóa) vì replay có thể bị ngắt giữa chừng và chạy lại.
+
+import json
+import os
+import threading
+from pathlib import Path
+
+
+class WriteJournal:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._locks: dict[str, threading.RLock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _path(self, node_name: str) -> Path:
+        return self.directory / f"{node_name}.jsonl"
+
+    def lock(self, node_name: str) -> threading.RLock:
+        """
+        Giữ lock này khi quyết định "ghi thẳng hay ghi journal" để không
+        chen ngang lúc replay đang chạy.
+        """
+        with self._locks_guard:
+            lk = self._locks.get(node_name)
+            if lk is None:
+                lk = self._locks[node_name] = threading.RLock()
+            return lk
+
+    def pending(self, node_name: str) -> bool:
+        path = self._path(node_name)
+        return path.exists() and path.stat().st_size > 0
+
+    def append(self, node_name: str, sql: str, params, conversation_id=None):
+        entry = json.dumps(
+            {"sql": sql, "params": list(params), "conversation_id": conversation_id},
+            ensure_ascii=False,
+            default=str,
+        )
+        with self.lock(node_name):
+            with open(self._path(node_name), "a", encoding="utf-8") as f:
+                f.write(entry + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _read(self, node_name: str) -> list[dict]:
+        path = self._path(node_name)
+        if not path.exists():
+            return []
+        entries = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # dòng cuối ghi dở khi crash -> bỏ
+                    continue
+        return entries
+
+    def _rewrite(self, node_name: str, entries: list[dict]):
+        path = self._path(node_name)
+        tmp = path.with_suffix(".jsonl.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for e in entries:
+                f.write(json.dumps(e, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def replay(self, node_cfg: dict, connect, batch_size: int = 200) -> set:
+        """
+        Chạy lại journal của node theo thứ tự, commit theo batch.
+        Lỗi giữa chừng: giữ lại phần chưa chạy trong file rồi raise.
+        Trả về tập conversation_id bị ảnh hưởng (để làm mới summary).
+        """
+        name = node_cfg["name"]
+        touched = set()
+        with self.lock(name):
+            entries = self._read(name)
+            if not entries:
+                return touched
+
+            done = 0
+            try:
+                conn = connect(node_cfg)
+                try:
+                    with conn.cursor() as cur:
+                        while done < len(entries):
+                            batch = entries[done:done + batch_size]
+                            for e in batch:
+                                cur.execute(e["sql"], e["params"])
+                            conn.commit()
+                            done += len(batch)
+                            touched.update(
+                                e["conversation_id"] for e in batch
+                                if e.get("conversation_id") is not None
+                            )
+                finally:
+                    conn.close()
+            finally:
+                if done >= len(entries):
+                    self._path(name).unlink(missing_ok=True)
+                elif done:
+                    self._rewrite(name, entries[done:])
+
+        print(f"[JOURNAL] Đã replay {done} lệnh ghi sang {name}")
+        return touched
+
+    def stats(self) -> dict:
+        result = {}
+        for p in self.directory.glob("*.jsonl"):
+            with open(p, "r", encoding="utf-8") as f:
+                result[p.stem] = sum(1 for line in f if line.strip())
+        return result
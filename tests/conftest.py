@@ -0,0 +1,49 @@
+# tests/conftest.py
+#
+# Chạy từ thư mục gốc repo: python -m pytest tests
+# Các test dùng backend SQLite trong thư mục tạm (không cần MySQL). Mọi file
+# server ghi ra (DB, shard map, journal, archive, storage, log) cũng nằm trong
+# thư mục tạm đó -> chạy test không để lại gì trong cây repo.
+
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_workdir = None
+
+
+def pytest_configure(config):
+    # phải đặt trước khi module test nào import common.config
+    global _workdir
+    _workdir = tempfile.mkdtemp(prefix="chat_tests_")
+    os.environ["CHAT_DB_BACKEND"] = "sqlite"
+    os.environ["CHAT_SQLITE_DIR"] = os.path.join(_workdir, "sqlite")
+    os.environ["CHAT_SHARD_MAP"] = os.path.join(_workdir, "shard_map.json")
+    os.environ["CHAT_JOURNAL_DIR"] = os.path.join(_workdir, "journal")
+    os.environ["CHAT_ARCHIVE_DIR"] = os.path.join(_workdir, "archive")
+    os.environ["CHAT_ARCHIVE"] = "1"
+    os.environ["CHAT_STORAGE_DIR"] = os.path.join(_workdir, "storage")
+    os.environ["CHAT_LOG_DIR"] = os.path.join(_workdir, "logs")
+
+
+def pytest_unconfigure(config):
+    if _workdir is not None:
+        shutil.rmtree(_workdir, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def collected():
+    """Cụm SQLite đã khởi tạo và chạy kịch bản plan_check: (db_access, statements)."""
+    from server import plan_check
+    return plan_check.collect(_workdir)
+
+
+@pytest.fixture(scope="session")
+def db(collected):
+    """db_access trên cụm SQLite tạm (dùng username / tên nhóm riêng cho từng test)."""
+    return collected[0]
@@ -0,0 +1,80 @@
+# tests/test_attachment_gc.py
+#
+# AttachmentGC (server/attachment_gc.py): chỉ xóa file cũ không tin nào trỏ
+# tới (cả bố cục mới lẫn thư mục phẳng cũ), và không chạy khi danh sách tin
+# có thể thiếu (conversation đang migrate, node còn journal chưa replay).
+
+import os
+import time
+
+import pytest
+
+from common.attachment_paths import IMAGES_DIR, attachment_path
+from common.shard_map import ShardMap
+
+
+def _write(path, old=True):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"data")
+    if old:
+        past = time.time() - 3600
+        os.utime(path, (past, past))
+    return path
+
+
+@pytest.fixture
+def gc_module(db):
+    from server import attachment_gc
+    return attachment_gc
+
+
+def test_sweep_deletes_only_old_unreferenced_files(db, gc_module):
+    for name in ("gc_mia", "gc_ned"):
+        db.create_user(name, "x", name)
+    mia, ned = (db.get_user_by_username(n)["id"] for n in ("gc_mia", "gc_ned"))
+    conv = db.get_or_create_private_conversation(mia, ned)
+    db.insert_message(conv, mia, "image", "gc_keep.jpg")
+    db.insert_message(conv, mia, "image", "gc_keep_flat.jpg")
+
+    keep = _write(attachment_path("image", "gc_keep.jpg"))
+    keep_flat = _write(IMAGES_DIR / "gc_keep_flat.jpg")
+    orphan = _write(attachment_path("image", "gc_orphan.jpg"))
+    orphan_flat = _write(IMAGES_DIR / "gc_orphan_flat.jpg")
+    fresh = _write(attachment_path("image", "gc_fresh.jpg"), old=False)
+
+    dry = gc_module.AttachmentGC(dry_run=True, max_rows_per_sec=0,
+                                 max_files_per_sec=0, min_age_s=60).run()
+    assert {str(orphan), str(orphan_flat)} <= set(dry["sample"])
+    assert orphan.exists() and orphan_flat.exists()
+
+    result = gc_module.AttachmentGC(dry_run=False, max_rows_per_sec=0,
+                                    max_files_per_sec=0, min_age_s=60).run()
+    assert result["deleted"] >= 2
+    assert not orphan.exists() and not orphan_flat.exists()
+    assert keep.exists() and keep_flat.exists() and fresh.exists()
+
+
+def test_refuses_while_a_conversation_is_migrating(gc_module, monkeypatch):
+    class Store:
+        def get(self):
+            return ShardMap(["node1", "node2"], migrating={1: "node2"})
+
+    monkeypatch.setattr(gc_module, "get_shard_store", Store)
+    with pytest.raises(gc_module.AttachmentGCError):
+        gc_module.AttachmentGC(max_rows_per_sec=0, max_files_per_sec=0).run()
+
+
+def test_refuses_while_a_node_has_unreplayed_journal(db, gc_module):
+    orphan = _write(attachment_path("image", "gc_journal_orphan.jpg"))
+    node = db.DB_NODES[-1]
+    journal = db._get_journal()
+    # giữ lock: probe nền không replay được journal trong lúc test
+    with journal.lock(node["name"]):
+        journal.append(node["name"], "SELECT 1", [])
+        try:
+            with pytest.raises(db.NodeUnavailableError):
+                gc_module.AttachmentGC(dry_run=False, max_rows_per_sec=0,
+                                       max_files_per_sec=0, min_age_s=0).run()
+        finally:
+            journal.replay(node, db.get_connection)
+    assert orphan.exists()
@@ -0,0 +1,52 @@
+# tests/test_attachments.py
+#
+# Đường dẫn file đính kèm (common/attachment_paths.py, server/attachments.py):
+# bố cục chia thư mục, tìm cả chỗ cũ trong lúc chuyển, xóa cả 2 bản.
+
+import pytest
+
+from common.attachment_paths import (
+    FILES_DIR,
+    IMAGES_DIR,
+    attachment_locations,
+    attachment_path,
+    fanout,
+    locate_attachment,
+)
+from server.attachments import migrate_attachment_layout, remove_attachment
+
+
+def test_paths_are_fanned_out_and_reject_non_file_content():
+    path = attachment_path("Photo", "att_anh.jpg")
+    assert path == IMAGES_DIR / fanout("att_anh.jpg") / "att_anh.jpg"
+    assert len(fanout("att_anh.jpg").parts) == 2
+    assert attachment_path("document", "att_hd.pdf").is_relative_to(FILES_DIR)
+
+    assert attachment_path("text", "att_anh.jpg") is None
+    assert attachment_path("image", "../users.db") is None
+    assert attachment_locations("image", "") == []
+
+
+def test_locate_follows_the_file_through_layout_migration():
+    new, flat = attachment_locations("image", "att_move.jpg")
+    flat.parent.mkdir(parents=True, exist_ok=True)
+    flat.write_bytes(b"cu")
+    assert locate_attachment("image", "att_move.jpg") == flat
+
+    assert migrate_attachment_layout(max_files_per_sec=0) >= 1
+    assert not flat.exists()
+    assert locate_attachment("image", "att_move.jpg") == new
+    assert new.read_bytes() == b"cu"
+    assert migrate_attachment_layout(max_files_per_sec=0) == 0
+
+
+@pytest.mark.parametrize("layouts", [("new",), ("flat",), ("new", "flat")])
+def test_remove_deletes_every_copy(layouts):
+    new, flat = attachment_locations("file", "att_rm.bin")
+    for path in (new if "new" in layouts else None, flat if "flat" in layouts else None):
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b"1234")
+
+    assert remove_attachment("file", "att_rm.bin") == 4 * len(layouts)
+    assert not new.exists() and not flat.exists()
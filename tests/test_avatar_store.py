@@ -0,0 +1,58 @@
+# tests/test_avatar_store.py
+#
+# server/avatar_store.py: lưu theo hash nội dung, ghi đồng thời, cache base64.
+
+import base64
+import hashlib
+import threading
+
+from server.avatar_store import AvatarStore, is_avatar_hash
+
+
+def test_put_is_content_addressed(tmp_path):
+    store = AvatarStore(tmp_path, variant_sizes=())
+    raw = b"\x89PNG fake avatar"
+    digest = store.put(raw)
+    assert digest == hashlib.sha256(raw).hexdigest()
+    assert is_avatar_hash(digest)
+    assert store.put(raw) == digest
+    assert store.get(digest) == raw
+    assert store.get("0" * 64) is None
+    assert store.get("../../etc/passwd") is None
+
+
+def test_concurrent_puts_of_same_image(tmp_path):
+    store = AvatarStore(tmp_path, variant_sizes=())
+    raw = b"same image from two users" * 1000
+    path = store._path(hashlib.sha256(raw).hexdigest())
+    path.parent.mkdir(parents=True)
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def upload():
+        barrier.wait()
+        try:
+            # bỏ qua kiểm tra "đã có" để các thread thật sự cùng ghi 1 file
+            store._write_atomic(path, raw)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=upload) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    digest = store.put(raw)
+    assert store.get(digest) == raw
+    leftovers = [p for p in tmp_path.rglob("*") if p.name.endswith(".tmp")]
+    assert leftovers == []
+
+
+def test_b64_cache_is_bounded(tmp_path):
+    store = AvatarStore(tmp_path, variant_sizes=(), cache_max_bytes=100)
+    digests = [store.put(bytes([i]) * 40) for i in range(5)]
+    for d in digests:
+        assert base64.b64decode(store.get_b64(d)) == store.get(d)
+    assert store.stats()["cached_bytes"] <= 100
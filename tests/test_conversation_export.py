@@ -0,0 +1,52 @@
+# tests/test_conversation_export.py
+#
+# server/conversation_export.py: export rồi import lại trên cụm SQLite tạm.
+
+import pytest
+
+from server import conversation_export as ce
+
+
+def _users(db, *names):
+    for name in names:
+        db.create_user(name, "x", name)
+    return [db.get_user_by_username(n)["id"] for n in names]
+
+
+def _count(db, conv_id):
+    return len(db.get_messages_for_conversation(conv_id, limit=1000))
+
+
+def test_group_clone_with_new_ids(db, tmp_path):
+    owner, member = _users(db, "export_gina", "export_hal")
+    group = db.create_group_conversation("nhóm export", owner, [owner, member])
+    for i in range(5):
+        db.insert_message(group, owner if i % 2 else member, "text", f"tin {i}")
+
+    out = tmp_path / "group.jsonl.gz"
+    ce.export_conversation(group, out)
+    result = ce.import_conversation(out, new_ids=True)
+
+    assert result["conversation_id"] != group
+    assert result["messages"] == 5 and result["skipped"] == 0
+    assert _count(db, result["conversation_id"]) == 5
+    assert _count(db, group) == 5
+
+
+def test_private_chat_refuses_new_ids(db, tmp_path):
+    a, b = _users(db, "export_ivy", "export_jon")
+    conv = db.get_or_create_private_conversation(a, b)
+    for i in range(3):
+        db.insert_message(conv, a, "text", f"riêng {i}")
+
+    out = tmp_path / "private.jsonl.gz"
+    ce.export_conversation(conv, out)
+    with pytest.raises(ce.ExportError):
+        ce.import_conversation(out, new_ids=True)
+    assert _count(db, conv) == 3
+
+    # khôi phục giữ id: tin đã có thì bỏ qua, không nhân đôi
+    result = ce.import_conversation(out)
+    assert result["conversation_id"] == conv
+    assert result["skipped"] == 3
+    assert _count(db, conv) == 3
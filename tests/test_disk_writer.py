@@ -0,0 +1,43 @@
+# tests/test_disk_writer.py
+#
+# DiskWriterPool (server/disk_writer.py): file chỉ xuất hiện khi đã ghi xong,
+# lỗi của 1 file không làm hỏng cả lô, batch fsync mỗi thư mục 1 lần.
+
+import pytest
+
+from server.disk_writer import DiskWriterPool
+
+
+def test_batch_writes_every_file_and_fsyncs_each_dir_once(tmp_path):
+    pool = DiskWriterPool(workers=1, fsync_policy="batch", batch_window_ms=200, batch_max=8)
+    futures = [pool.submit(tmp_path / f"f{i}.bin", bytes([i]) * (i + 1)) for i in range(4)]
+
+    assert [f.result(5) for f in futures] == [1, 2, 3, 4]
+    assert (tmp_path / "f3.bin").read_bytes() == b"\x03" * 4
+    # 4 file + 1 thư mục, không còn file tạm
+    assert pool.stats()["fsyncs"] == 5
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["f0.bin", "f1.bin", "f2.bin", "f3.bin"]
+
+
+def test_failed_file_does_not_fail_the_batch(tmp_path):
+    pool = DiskWriterPool(workers=1, fsync_policy="batch", batch_window_ms=200, batch_max=8)
+    ok = pool.submit(tmp_path / "ok.bin", b"ok")
+    bad = pool.submit(tmp_path / "missing_dir" / "bad.bin", b"x")
+
+    assert ok.result(5) == 2
+    with pytest.raises(FileNotFoundError):
+        bad.result(5)
+    stats = pool.stats()
+    assert (stats["files_written"], stats["errors"]) == (1, 1)
+
+
+def test_none_policy_overwrites_in_place_without_fsync(tmp_path):
+    target = tmp_path / "same.bin"
+    target.write_bytes(b"old")
+    pool = DiskWriterPool(workers=2, fsync_policy="none")
+
+    assert pool.write(target, b"new") == 3
+    assert target.read_bytes() == b"new"
+    assert pool.stats()["fsyncs"] == 0
+    with pytest.raises(ValueError):
+        DiskWriterPool(fsync_policy="sometimes")
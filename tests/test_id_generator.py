@@ -0,0 +1,48 @@
+# tests/test_id_generator.py
+#
+# SnowflakeGenerator (server/id_generator.py): id tăng dần kể cả khi đồng hồ
+# bị lùi, hết sequence thì chờ sang ms kế, tách lại được thời điểm / worker.
+
+from server.id_generator import (
+    MAX_SEQUENCE,
+    SnowflakeGenerator,
+    first_id_at,
+    id_timestamp_ms,
+    id_worker,
+)
+
+EPOCH = 1_000_000
+
+
+def _generator(clock, worker_id=5):
+    gen = SnowflakeGenerator(worker_id, epoch_ms=EPOCH)
+    gen._now_ms = lambda: next(clock)
+    return gen
+
+
+def test_ids_stay_monotonic_when_clock_goes_back():
+    clock = iter([EPOCH + 1000, EPOCH + 1000, EPOCH + 900, EPOCH + 950, EPOCH + 1001])
+    gen = _generator(clock)
+    ids = gen.next_ids(5)
+
+    assert ids == sorted(ids) and len(set(ids)) == 5
+    # trong lúc đồng hồ lùi, id vẫn mang mốc thời gian cũ
+    assert [id_timestamp_ms(i, EPOCH) for i in ids] == [EPOCH + 1000] * 4 + [EPOCH + 1001]
+
+
+def test_sequence_overflow_waits_for_next_millisecond():
+    ticks = [EPOCH + 10] * (MAX_SEQUENCE + 2) + [EPOCH + 11] * 2
+    gen = _generator(iter(ticks))
+    ids = gen.next_ids(MAX_SEQUENCE + 2)
+
+    assert ids == sorted(ids) and len(set(ids)) == len(ids)
+    assert id_timestamp_ms(ids[-2], EPOCH) == EPOCH + 10
+    assert id_timestamp_ms(ids[-1], EPOCH) == EPOCH + 11
+
+
+def test_worker_and_time_bounds_round_trip():
+    gen = _generator(iter([EPOCH + 500]), worker_id=77)
+    msg_id = gen.next_id()
+
+    assert id_worker(msg_id) == 77
+    assert first_id_at(EPOCH + 500, EPOCH) <= msg_id < first_id_at(EPOCH + 501, EPOCH)
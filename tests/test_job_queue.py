@@ -0,0 +1,81 @@
+# tests/test_job_queue.py
+#
+# JobQueue (server/job_queue.py) trên bảng background_jobs của cụm SQLite
+# tạm: job hết lease được worker khác nhận lại, worker cũ không ghi đè kết
+# quả; lỗi thì backoff rồi thất bại hẳn sau max_attempts.
+
+import pytest
+
+from server.job_queue import JobQueue
+from server.replication import primary_node
+
+
+@pytest.fixture
+def queues(db):
+    # chạy hết job thật còn treo để 2 queue dưới chỉ thấy job của test
+    while db.job_queue.run_once():
+        pass
+
+    def make(**kw):
+        return JobQueue(db.get_connection, **kw)
+    return make
+
+
+def _make_due(db, job_id):
+    conn = db.get_connection(primary_node())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE background_jobs SET run_after = NOW(3) - INTERVAL 1 SECOND WHERE id = %s",
+                (job_id,),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_expired_lease_is_reclaimed_and_old_worker_stops(db, queues):
+    first, second = queues(lease_s=0), queues(lease_s=0)
+    runs = []
+
+    def handler(job):
+        runs.append(job.attempts)
+        if len(runs) == 1:
+            # worker 1 "treo" quá lease: worker 2 nhận lại job và làm xong
+            assert second.run_once()
+        job.report(step=len(runs))
+
+    for q in (first, second):
+        q.register("test_lease", handler)
+    job_id = first.enqueue("test_lease", {"n": 1})
+
+    assert first.run_once()
+    job = first.get(job_id)
+    assert runs == [1, 2]
+    assert job["status"] == "done"
+    assert job["attempts"] == 2
+    assert job["progress"] == {"step": 2}
+    assert first.done_total == 0 and second.done_total == 1
+
+
+def test_failing_job_backs_off_then_fails_for_good(db, queues):
+    def handler(job):
+        raise RuntimeError("hỏng")
+
+    q = queues(max_attempts=2)
+    q.register("test_fail", handler)
+    job_id = q.enqueue("test_fail", {})
+
+    assert q.run_once()
+    job = q.get(job_id)
+    assert (job["status"], job["last_error"]) == ("pending", "hỏng")
+    assert not q.run_once()     # đang chờ backoff
+
+    _make_due(db, job_id)
+    assert q.run_once()
+    assert q.get(job_id)["status"] == "failed"
+
+
+def test_enqueue_rejects_unknown_kind(queues):
+    with pytest.raises(ValueError):
+        queues().enqueue("no_such_job", {})
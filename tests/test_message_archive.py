@@ -0,0 +1,70 @@
+# tests/test_message_archive.py
+#
+# Kho lạnh (server/message_archive.py): đọc qua nhiều segment / block,
+# tombstone còn sau khi mở lại, và lịch sử đọc liền mạch qua ranh giới
+# archive / bảng messages (db_access._merge_archived).
+
+from datetime import datetime, timedelta
+
+from server.message_archive import MessageArchive
+
+
+def _rows(ids):
+    return [{"id": i, "sender_id": 1, "sender_username": "u1", "msg_type": "text",
+             "content": f"tin {i}", "created_at": datetime(2020, 1, 1)} for i in ids]
+
+
+def _ids(rows):
+    return [r["id"] for r in rows]
+
+
+def test_reads_cross_segments_and_blocks(tmp_path):
+    archive = MessageArchive(tmp_path, block_rows=2)
+    assert archive.append(5, _rows([1, 2, 3, 4, 5])) == 5
+    assert archive.append(5, _rows([4, 5, 6, 7])) == 2     # id <= max_id bị bỏ
+
+    assert _ids(archive.read_before(5, None, 3)) == [5, 6, 7]
+    assert _ids(archive.read_before(5, 6, 4)) == [2, 3, 4, 5]
+    assert _ids(archive.read_after(5, 1, 4)) == [2, 3, 4, 5]
+    assert _ids(archive.iter_rows(5, batch_size=2)) == [1, 2, 3, 4, 5, 6, 7]
+    assert archive.get(5, 6)["created_at"] == datetime(2020, 1, 1)
+
+
+def test_tombstones_survive_reopen(tmp_path):
+    archive = MessageArchive(tmp_path, block_rows=2)
+    archive.append(5, _rows([1, 2, 3]))
+    assert archive.tombstone(5, 2)
+    assert not archive.tombstone(5, 2)
+    assert not archive.tombstone(5, 99)
+
+    reopened = MessageArchive(tmp_path, block_rows=2)
+    assert reopened.get(5, 2) is None
+    assert _ids(reopened.read_after(5, 0, 10)) == [1, 3]
+    assert reopened.count(5) == 2
+
+    reopened.drop(5)
+    assert MessageArchive(tmp_path).max_id(5) is None
+
+
+def test_history_reads_across_the_hot_cold_boundary(db):
+    for name in ("arch_kai", "arch_lin"):
+        db.create_user(name, "x", name)
+    kai, lin = (db.get_user_by_username(n)["id"] for n in ("arch_kai", "arch_lin"))
+    conv = db.get_or_create_private_conversation(kai, lin)
+    ids = [db.insert_message(conv, kai, "text", f"tin {i}") for i in range(6)]
+
+    # 4 tin đầu sang archive, 2 tin sau ở lại bảng messages
+    node = db.select_node_for_conversation(conv)
+    moved = db._archive_conversation(node, conv, ids[4], datetime.now() + timedelta(days=1), 100)
+    assert moved == 4
+    assert db.message_archive.max_id(conv) == ids[3]
+
+    def history(**kw):
+        return _ids(db.get_messages_for_conversation(conv, **kw))
+
+    assert history(limit=3) == ids[3:6]
+    assert history(limit=3, before_id=ids[4]) == ids[1:4]
+    assert history(limit=4, after_id=ids[0]) == ids[1:5]
+
+    assert db.delete_message_for_user(conv, ids[2], kai) == db.DELETE_DONE
+    assert history(limit=10) == [ids[0], ids[1], ids[3], ids[4], ids[5]]
@@ -0,0 +1,65 @@
+# tests/test_message_cache.py
+#
+# RecentMessageCache (server/message_cache.py): chỉ trả lời khi ring đủ dữ
+# liệu, bỏ qua prime() bị ghi chen ngang, LRU theo max_bytes.
+
+from server.message_cache import RecentMessageCache
+
+
+def _row(msg_id, sender=1, content="x"):
+    return {"id": msg_id, "sender_id": sender, "sender_username": f"u{sender}",
+            "msg_type": "text", "content": content, "created_at": None}
+
+
+def _ids(rows):
+    return None if rows is None else [r["id"] for r in rows]
+
+
+def test_window_answers_only_inside_the_ring():
+    cache = RecentMessageCache(per_conversation=5, max_bytes=1 << 20)
+    cache.prime(1, [_row(i) for i in range(10, 15)], complete=False, token=cache.token(1))
+
+    assert _ids(cache.window(1, 3)) == [12, 13, 14]
+    assert cache.window(1, 3)[0]["sender_username"] == "u1"
+    assert _ids(cache.window(1, 2, before_id=13)) == [11, 12]
+    # trang cũ hơn tin cũ nhất trong ring -> phải hỏi DB
+    assert cache.window(1, 3, before_id=12) is None
+    assert cache.window(1, 10) is None
+    assert _ids(cache.window(1, 10, after_id=12)) == [13, 14]
+
+
+def test_prime_is_skipped_after_a_concurrent_write():
+    cache = RecentMessageCache(per_conversation=5, max_bytes=1 << 20)
+    token = cache.token(1)
+    cache.append(1, _row(20))       # ghi chen vào giữa lúc đọc DB
+    cache.prime(1, [_row(10)], complete=True, token=token)
+
+    assert cache.window(1, 1) is None
+
+
+def test_append_remove_keep_ring_bounded_and_complete_flag():
+    cache = RecentMessageCache(per_conversation=3, max_bytes=1 << 20)
+    cache.prime(1, [_row(1), _row(2)], complete=True, token=cache.token(1))
+    assert _ids(cache.window(1, 10)) == [1, 2]
+
+    cache.append(1, _row(3, sender=2))
+    cache.append(1, _row(4, sender=2))
+    # tin 1 bị đẩy ra -> ring không còn là toàn bộ lịch sử
+    assert cache.window(1, 10) is None
+    assert _ids(cache.window(1, 3)) == [2, 3, 4]
+
+    cache.remove(1, 2)
+    assert cache.stats()["usernames"] == 1
+    assert _ids(cache.window(1, 2)) == [3, 4]
+
+
+def test_least_recently_used_conversation_is_evicted():
+    cache = RecentMessageCache(per_conversation=5, max_bytes=1000)
+    for conv in (1, 2, 3):
+        cache.prime(conv, [_row(conv, content="y" * 200)], complete=True,
+                    token=cache.token(conv))
+        cache.window(1, 1)          # conversation 1 luôn được dùng gần nhất
+
+    assert cache.window(1, 1) is not None
+    assert cache.window(2, 1) is None
+    assert cache.stats()["bytes"] <= 1000
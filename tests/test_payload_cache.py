@@ -0,0 +1,42 @@
+# tests/test_payload_cache.py
+#
+# PagePayloadCache (server/payload_cache.py): invalidate theo conversation,
+# put() cũ bị bỏ qua sau khi có ghi chen vào, LRU theo max_bytes.
+
+from server.payload_cache import PagePayloadCache
+
+
+def test_invalidate_drops_only_that_conversation():
+    cache = PagePayloadCache(max_bytes=1000)
+    cache.put((1, None, None, 50), b"trang 1", cache.token(1))
+    cache.put((1, 99, None, 50), b"trang 1 cu", cache.token(1))
+    cache.put((2, None, None, 50), b"trang 2", cache.token(2))
+
+    cache.invalidate(1)
+    assert cache.get((1, None, None, 50)) is None
+    assert cache.get((1, 99, None, 50)) is None
+    assert cache.get((2, None, None, 50)) == b"trang 2"
+    assert cache.stats()["bytes"] == len(b"trang 2")
+
+
+def test_put_built_before_a_write_is_ignored():
+    cache = PagePayloadCache(max_bytes=1000)
+    token = cache.token(1)
+    cache.invalidate(1)         # tin mới tới khi trang đang được dựng
+    cache.put((1, None, None, 50), b"trang cu", token)
+
+    assert cache.get((1, None, None, 50)) is None
+
+
+def test_least_recently_used_page_is_evicted():
+    cache = PagePayloadCache(max_bytes=10)
+    cache.put((1, None, None, 1), b"aaaa", cache.token(1))
+    cache.put((2, None, None, 1), b"bbbb", cache.token(2))
+    cache.get((1, None, None, 1))
+    cache.put((3, None, None, 1), b"cccc", cache.token(3))
+    cache.put((4, None, None, 1), b"x" * 11, cache.token(4))    # lớn hơn cả cache
+
+    assert cache.get((1, None, None, 1)) == b"aaaa"
+    assert cache.get((2, None, None, 1)) is None
+    assert cache.get((3, None, None, 1)) == b"cccc"
+    assert cache.get((4, None, None, 1)) is None
@@ -0,0 +1,22 @@
+# tests/test_plan_check.py
+#
+# Kịch bản của server/plan_check.py trên cụm SQLite tạm: các câu query nóng
+# phải đi theo index (không SCAN cả bảng ngoài INTENTIONAL_SCANS).
+
+from server import plan_check
+
+
+def test_workload_records_statements(collected):
+    _, statements = collected
+    funcs = {func for func, _ in statements.values()}
+    for func in ("insert_message", "get_messages_for_conversation", "get_user_by_username"):
+        assert any(f.endswith(func) for f in funcs), func
+
+
+def test_hot_queries_use_indexes(collected):
+    db, statements = collected
+    failures = plan_check.check(db, statements)
+    assert not failures, "\n".join(
+        f"{f['func']}@{f['node']}: {'; '.join(f['scans'])}\n    {f['sql'][:200]}"
+        for f in failures
+    )
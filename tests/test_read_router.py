@@ -0,0 +1,59 @@
+# tests/test_read_router.py
+#
+# pick_read_node (server/read_router.py): chỉ đọc replica đã áp dụng tới
+# watermark của session và còn đủ mới, không thì đọc primary.
+
+import threading
+import time
+
+import pytest
+
+from common.config import READ_REPLICA_MAX_LAG_S
+from server import read_router, replication
+
+PRIMARY = {"name": "p"}
+REPLICA = {"name": "r"}
+
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setattr(replication, "primary_node", lambda: PRIMARY)
+    monkeypatch.setattr(replication, "replica_nodes", lambda: [REPLICA])
+    monkeypatch.setattr(read_router, "applied_upto", {})
+    monkeypatch.setattr(read_router, "caught_up_at", {})
+    read_router.reset_session()
+    yield read_router
+    read_router.reset_session()
+
+
+def _picks(router, n=4):
+    return {router.pick_read_node()["name"] for _ in range(n)}
+
+
+def test_fresh_replica_shares_reads_with_primary(router):
+    router.mark_applied("r", 10, caught_up=True)
+    assert _picks(router) == {"p", "r"}
+
+
+def test_session_waits_for_its_own_write(router):
+    router.mark_applied("r", 10, caught_up=True)
+    router.note_write({"r": 11})
+    assert _picks(router) == {"p"}
+
+    # session khác (thread khác) không bị watermark này giữ lại
+    other = []
+    t = threading.Thread(target=lambda: other.extend(_picks(router)))
+    t.start()
+    t.join()
+    assert set(other) == {"p", "r"}
+
+    router.mark_applied("r", 11, caught_up=False)
+    assert _picks(router) == {"p", "r"}
+
+
+def test_lagging_replica_is_skipped(router):
+    router.mark_applied("r", 10, caught_up=False)
+    assert _picks(router) == {"p"}
+
+    router.caught_up_at["r"] = time.monotonic() - READ_REPLICA_MAX_LAG_S - 1
+    assert _picks(router) == {"p"}
@@ -0,0 +1,64 @@
+# tests/test_replication.py
+#
+# Outbox replicate users (server/replication.py) trên cụm SQLite tạm:
+# user tạo trên primary tới được replica qua OutboxRelay, và upsert không
+# bao giờ ghi đè 1 user khác đang trùng id / username trên replica.
+
+import time
+
+import pytest
+
+from server import replication
+
+
+def _replica_user(db, node, username):
+    conn = db.get_connection(node)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, display_name FROM users WHERE username = %s", (username,))
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+
+def test_created_user_reaches_every_replica(db):
+    user_id = db.create_user("repl_una", "x", "Una")
+    deadline = time.monotonic() + 10
+    for node in replication.replica_nodes():
+        row = _replica_user(db, node, "repl_una")
+        while row is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+            row = _replica_user(db, node, "repl_una")
+        assert row == {"id": user_id, "display_name": "Una"}
+
+    pending = {s["node"]: s["pending"] for s in replication.replication_status(db.get_connection)}
+    assert set(pending) == {n["name"] for n in replication.replica_nodes()}
+
+
+def test_upsert_refuses_to_overwrite_a_different_user(db):
+    node = replication.replica_nodes()[0]
+    conn = db.get_connection(node)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO users (id, username, password_hash, display_name) "
+                "VALUES (%s, %s, %s, %s)",
+                (990001, "repl_old", "x", "Cũ"),
+            )
+            with pytest.raises(replication.ReplicationConflictError):
+                replication.apply_op(cur, "user_upsert", [990001, "repl_new", "y", "Mới"])
+            with pytest.raises(replication.ReplicationConflictError):
+                replication.apply_op(cur, "user_upsert", [990002, "repl_old", "y", "Mới"])
+
+            # đúng cặp (id, username) -> cập nhật bình thường
+            replication.apply_op(cur, "user_upsert", [990001, "repl_old", "y", "Mới"])
+            cur.execute("SELECT display_name FROM users WHERE id = %s", (990001,))
+            assert cur.fetchone()["display_name"] == "Mới"
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_enqueue_rejects_unknown_op():
+    with pytest.raises(ValueError):
+        replication.enqueue(None, "drop_everything", [])
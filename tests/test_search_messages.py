@@ -0,0 +1,33 @@
+# tests/test_search_messages.py
+#
+# search_messages (server/db_access.py): dựng câu FULLTEXT / LIKE và tìm
+# trên cụm SQLite tạm (SQLite không có FULLTEXT -> đi đường LIKE).
+
+
+def test_fulltext_query_keeps_short_terms_out_of_match(db):
+    sql, params = db._search_sql(1, ["hello", "ok"], use_fulltext=True)
+    assert sql.count("MATCH(m.content)") == 1
+    assert sql.count("m.content LIKE %s") == 1
+    assert "+hello*" in params
+    assert "%ok%" in params
+    assert not any("+ok*" in str(p) for p in params)
+
+
+def test_like_query_escapes_wildcards(db):
+    sql, params = db._search_sql(2, ["50%", "a_b"], use_fulltext=False)
+    assert "MATCH" not in sql
+    assert params[-2:] == ["%50\\%%", "%a\\_b%"]
+
+
+def test_search_only_sees_own_conversations(db):
+    names = ("search_ann", "search_ben", "search_cid")
+    for name in names:
+        db.create_user(name, "x", name)
+    ann, ben, cid = (db.get_user_by_username(n)["id"] for n in names)
+    conv = db.get_or_create_private_conversation(ann, ben)
+    db.insert_message(conv, ann, "text", "hẹn gặp ở quán cà phê ok")
+    db.insert_message(conv, ben, "text", "quán nào vậy")
+
+    found = db.search_messages(ann, "quán ok")
+    assert [m["content"] for m in found["items"]] == ["hẹn gặp ở quán cà phê ok"]
+    assert db.search_messages(cid, "quán")["items"] == []
@@ -0,0 +1,70 @@
+# tests/test_send_order.py
+#
+# Gửi ảnh rồi gửi text trên cùng connection: ảnh ghi đĩa xong sau nhưng vẫn
+# có id nhỏ hơn, và người gửi nhận send_image_result trước send_text_result.
+
+import base64
+import json
+import socket
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+
+@pytest.fixture
+def slow_disk(db, monkeypatch):
+    from server import server_main
+
+    pending: list[Future] = []
+
+    def save_attachment(msg_type, content, data):
+        fut = Future()
+        pending.append(fut)
+        return fut
+
+    monkeypatch.setattr(server_main, "save_attachment", save_attachment)
+    return server_main, pending
+
+
+def _send(sock, action, data):
+    sock.sendall((json.dumps({"action": action, "data": data}) + "\n").encode())
+
+
+def test_text_after_image_keeps_send_order(db, slow_disk):
+    server_main, pending = slow_disk
+    for name in ("order_kim", "order_lee"):
+        db.create_user(name, "x", name)
+
+    server_side, client_side = socket.socketpair()
+    worker = threading.Thread(target=server_main.handle_client,
+                              args=(server_side, "test"), daemon=True)
+    worker.start()
+    client_file = client_side.makefile("r", encoding="utf-8")
+    try:
+        _send(client_side, "send_image", {
+            "from": "order_kim", "to": "order_lee", "filename": "a.jpg",
+            "data": base64.b64encode(b"img").decode(),
+        })
+        _send(client_side, "send_text", {"from": "order_kim", "to": "order_lee", "content": "sau ảnh"})
+        # lệnh text đã được đọc (handler xử lý tuần tự) trước khi file ảnh ghi xong
+        _send(client_side, "search_messages", {"query": "x"})
+        assert json.loads(client_file.readline())["action"] == "search_messages_result"
+
+        pending[0].set_result(3)
+        image = json.loads(client_file.readline())
+        text = json.loads(client_file.readline())
+    finally:
+        client_file.close()
+        client_side.close()
+        worker.join(timeout=5)
+
+    assert image["action"] == "send_image_result" and image["data"]["ok"]
+    assert text["action"] == "send_text_result" and text["data"]["ok"]
+    assert image["data"]["message_id"] < text["data"]["message_id"]
+
+    kim = db.get_user_by_username("order_kim")["id"]
+    lee = db.get_user_by_username("order_lee")["id"]
+    conv = db.get_or_create_private_conversation(kim, lee)
+    history = db.get_messages_for_conversation(conv)
+    assert [m["msg_type"] for m in history] == ["image", "text"]
@@ -0,0 +1,57 @@
+# tests/test_server_degraded.py
+#
+# Node DB lỗi (NodeUnavailableError) giữa lúc xử lý lệnh: server trả
+# {"ok": False, "error": NODE_DOWN_MESSAGE} và giữ kết nối, không chết thread.
+
+import json
+import socket
+import threading
+
+import pytest
+
+from server.node_health import NodeUnavailableError
+
+
+@pytest.fixture
+def server_main(db, monkeypatch):
+    from server import server_main
+
+    def node_down(*args, **kwargs):
+        raise NodeUnavailableError("node1", ConnectionError("down"))
+
+    monkeypatch.setattr(server_main, "get_user_by_username", node_down)
+    return server_main
+
+
+def _roundtrip(sock_file, sock, action, data):
+    sock.sendall((json.dumps({"action": action, "data": data}) + "\n").encode())
+    return json.loads(sock_file.readline())
+
+
+@pytest.mark.parametrize("action, data, result_action", [
+    ("send_text", {"from": "a", "to": "b", "content": "hi"}, "send_text_result"),
+    ("send_image", {"from": "a", "to": "b", "filename": "x.jpg", "data": ""}, "send_image_result"),
+    ("send_group_file", {"conversation_id": 1, "from": "a", "data": ""}, "send_group_file_result"),
+    ("create_group", {"owner": "a", "name": "g"}, "create_group_result"),
+    ("join_group", {"username": "a", "group_name": "g"}, "join_group_result"),
+    ("list_conversations", {"username": "a"}, "conversations_result"),
+])
+def test_node_down_reply_keeps_connection(server_main, action, data, result_action):
+    server_side, client_side = socket.socketpair()
+    worker = threading.Thread(target=server_main.handle_client,
+                              args=(server_side, "test"), daemon=True)
+    worker.start()
+    client_file = client_side.makefile("r", encoding="utf-8")
+    try:
+        reply = _roundtrip(client_file, client_side, action, data)
+        assert reply["action"] == result_action
+        assert reply["data"]["ok"] is False
+        assert reply["data"]["error"] == server_main.NODE_DOWN_MESSAGE
+
+        # kết nối vẫn sống: lệnh sau vẫn được trả lời
+        reply = _roundtrip(client_file, client_side, "search_messages", {"query": "x"})
+        assert reply["data"]["error"] == "Not logged in"
+    finally:
+        client_file.close()
+        client_side.close()
+        worker.join(timeout=5)
@@ -0,0 +1,72 @@
+# tests/test_shard_map.py
+#
+# common/shard_map.py: tra node, overrides, version và ghi file an toàn.
+
+import threading
+
+import pytest
+
+from common.shard_map import ShardMap, ShardMapStore
+
+
+def test_modulo_matches_legacy_placement():
+    m = ShardMap(["node1", "node2"], strategy="modulo")
+    assert [m.node_for(i) for i in range(4)] == ["node1", "node2", "node1", "node2"]
+
+
+def test_consistent_hash_moves_few_conversations():
+    before = ShardMap(["node1", "node2", "node3"])
+    after = ShardMap(["node1", "node2", "node3", "node4"])
+    moved = sum(before.node_for(i) != after.node_for(i) for i in range(10_000))
+    # thêm 1 node vào 3 -> khoảng 1/4 conversation đổi chỗ, không phải phần lớn
+    assert moved < 10_000 * 0.35
+    for i in range(10_000):
+        if before.node_for(i) != after.node_for(i):
+            assert after.node_for(i) == "node4"
+
+
+def test_overrides_and_migrating_survive_round_trip(tmp_path):
+    m = ShardMap(["node1", "node2"], overrides={7: "node2"}, migrating={9: "node1"})
+    path = str(tmp_path / "map.json")
+    m.save(path)
+    loaded = ShardMap.load(path)
+    assert loaded.node_for(7) == "node2"
+    assert loaded.migration_target(9) == "node1"
+    assert loaded.migration_target(7) is None
+
+
+def test_publish_requires_higher_version(tmp_path):
+    path = str(tmp_path / "map.json")
+    store = ShardMapStore(path, lambda: ShardMap(["node1", "node2"]), reload_interval=0)
+    first = store.get()
+    store.publish(first.next_version(overrides={"1": "node2"}))
+    assert store.get().node_for(1) == "node2"
+    with pytest.raises(ValueError):
+        store.publish(first)
+
+    # tiến trình khác đọc file thấy bản mới
+    other = ShardMapStore(path, lambda: ShardMap(["node1"]), reload_interval=0)
+    assert other.get().version == first.version + 1
+
+
+def test_concurrent_saves_do_not_collide(tmp_path):
+    path = str(tmp_path / "map.json")
+    errors = []
+    barrier = threading.Barrier(8)
+
+    def save(version):
+        barrier.wait()
+        try:
+            ShardMap(["node1", "node2"], version=version).save(path)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(v,)) for v in range(1, 9)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert 1 <= ShardMap.load(path).version <= 8
+    assert [p.name for p in tmp_path.iterdir()] == ["map.json"]
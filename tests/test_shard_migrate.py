@@ -0,0 +1,82 @@
+# tests/test_shard_migrate.py
+#
+# server/shard_migrate.py trên cụm SQLite tạm: cutover 2 bước (đổi routing
+# rồi mới tắt ghi kép) và tin bị xóa giữa lúc copy không sống lại ở node đích.
+
+from common.config import DB_NODES, get_node_by_name, get_shard_store
+from server import shard_migrate
+from server.shard_migrate import ConversationMigration
+
+
+def _conversation(db, prefix):
+    names = (f"{prefix}_a", f"{prefix}_b")
+    for name in names:
+        db.create_user(name, "x", name)
+    a, b = (db.get_user_by_username(n)["id"] for n in names)
+    conv = db.get_or_create_private_conversation(a, b)
+    ids = [db.insert_message(conv, a, "text", f"tin {i}") for i in range(4)]
+    return conv, a, ids
+
+
+def _ids_on(db, node_name, conv):
+    conn = db.get_connection(get_node_by_name(node_name))
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id FROM messages WHERE conversation_id = %s ORDER BY id", (conv,)
+            )
+            return [r["id"] for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+def _migration(conv, batch_size=100):
+    src = get_shard_store().get().node_for(conv)
+    target = next(n["name"] for n in DB_NODES if n["name"] != src)
+    mig = ConversationMigration(conv, target, batch_size=batch_size, max_rows_per_sec=0)
+    mig._wait_propagation = lambda: None
+    return mig, src, target
+
+
+def test_cutover_flips_routing_before_dual_write_stops(db, monkeypatch):
+    conv, _, ids = _conversation(db, "mig_flip")
+    mig, src, target = _migration(conv)
+    store = get_shard_store()
+    published = []
+    real_publish = store.publish
+
+    def publish(new_map):
+        published.append((new_map.node_for(conv), new_map.migration_target(conv)))
+        real_publish(new_map)
+
+    monkeypatch.setattr(store, "publish", publish)
+    assert mig.run()["phase"] == "done"
+
+    # bật ghi kép -> đổi routing nhưng vẫn ghi kép về nguồn -> tắt ghi kép
+    assert published == [(src, target), (target, src), (target, None)]
+    assert _ids_on(db, target, conv) == ids
+    assert _ids_on(db, src, conv) == []
+
+
+def test_delete_during_copy_is_not_resurrected(db, monkeypatch):
+    conv, sender, ids = _conversation(db, "mig_race")
+    victim = ids[1]
+    mig, src, target = _migration(conv, batch_size=1)
+    real_get_connection = shard_migrate.get_connection
+    calls = []
+
+    def get_connection(node):
+        # batch chứa victim đã SELECT ở nguồn, sắp INSERT sang đích:
+        # user xóa tin đúng lúc này (ghi kép nguồn rồi đích)
+        if (node["name"] == target and calls and calls[-1] == src
+                and mig.progress["copied"] == 1 and "fired" not in calls):
+            calls.append("fired")
+            assert db.delete_message_for_user(conv, victim, sender) == db.DELETE_DONE
+        calls.append(node["name"])
+        return real_get_connection(node)
+
+    monkeypatch.setattr(shard_migrate, "get_connection", get_connection)
+    mig.run()
+
+    assert "fired" in calls
+    assert _ids_on(db, target, conv) == [i for i in ids if i != victim]
@@ -0,0 +1,56 @@
+# tests/test_sqlite_backend.py
+#
+# translate() (server/sqlite_backend.py): các cú pháp MySQL dùng trong repo
+# dịch sang SQLite và chạy ra cùng kết quả trên sqlite3 trong RAM.
+
+import sqlite3
+
+import pytest
+
+from server.sqlite_backend import translate
+
+
+@pytest.fixture
+def raw():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT, n INTEGER)")
+    yield conn
+    conn.close()
+
+
+def _run(conn, sql, params=()):
+    return conn.execute(translate(sql), params)
+
+
+def test_mysql_only_ddl_is_skipped():
+    assert translate("CREATE TABLE IF NOT EXISTS t (id INT, KEY k (id))") is None
+    assert translate("ALTER TABLE messages AUTO_INCREMENT = 5", False) is None
+    assert translate("SELECT 1", False) == "SELECT 1"
+
+
+def test_insert_ignore_and_on_duplicate_key_update(raw):
+    sql = "INSERT IGNORE INTO t (id, name, n) VALUES (%s, %s, %s)"
+    _run(raw, sql, (1, "a", 1))
+    _run(raw, sql, (1, "b", 2))
+    assert raw.execute("SELECT name, n FROM t").fetchall() == [("a", 1)]
+
+    _run(raw, "INSERT INTO t (id, name, n) VALUES (%s, %s, %s) "
+              "ON DUPLICATE KEY UPDATE n = GREATEST(n, VALUES(n))", (1, "a", 7))
+    assert raw.execute("SELECT n FROM t").fetchall() == [(7,)]
+
+
+def test_delete_with_limit_removes_one_batch(raw):
+    raw.executemany("INSERT INTO t (id, name, n) VALUES (?, 'x', 0)", [(i,) for i in range(5)])
+    cur = _run(raw, "DELETE FROM t WHERE name = %s LIMIT %s", ("x", 2))
+    assert cur.rowcount == 2
+    assert raw.execute("SELECT COUNT(*) FROM t").fetchone() == (3,)
+
+
+def test_like_escapes_and_literal_percent():
+    sql = translate("SELECT id FROM t WHERE name LIKE %s AND n %% 2 = 0")
+    assert sql == "SELECT id FROM t WHERE name LIKE ? ESCAPE '\\' AND n % 2 = 0"
+
+
+def test_now_interval_compares_as_time(raw):
+    row = _run(raw, "SELECT NOW(3) - INTERVAL %s SECOND < NOW(3) AS older", (5,)).fetchone()
+    assert row == (1,)
@@ -0,0 +1,72 @@
+# tests/test_user_index.py
+#
+# UserSearchIndex / CoalescedCalls (server/user_index.py): tìm không phân
+# biệt hoa thường / dấu, xếp hạng, cập nhật user, gộp lời gọi trùng.
+
+import threading
+
+from server.user_index import CoalescedCalls, UserSearchIndex
+
+
+def _index():
+    index = UserSearchIndex()
+    index.load([
+        {"id": 1, "username": "minh", "display_name": "Trần Minh"},
+        {"id": 2, "username": "dung99", "display_name": "Đặng Dũng"},
+        {"id": 3, "username": "anhminh", "display_name": "Anh Minh"},
+    ])
+    return index
+
+
+def _ids(rows):
+    return [r["id"] for r in rows]
+
+
+def test_trigram_search_ignores_case_and_accents():
+    index = _index()
+    assert _ids(index.search("DŨNG")) == [2]
+    assert _ids(index.search("dang dung")) == [2]
+    # khớp đúng username trước, rồi chứa trong username
+    assert _ids(index.search("minh")) == [1, 3]
+
+
+def test_short_query_matches_name_prefixes():
+    index = _index()
+    assert _ids(index.search("mi")) == [1, 3]
+    assert _ids(index.search("đ")) == [2]
+    assert index.search("  ") == []
+
+
+def test_add_replaces_the_old_names():
+    index = _index()
+    index.add(2, "dung99", "Hoàng Dũng")
+    assert _ids(index.search("hoang")) == [2]
+    assert index.search("dang") == []
+    assert len(index) == 3
+
+
+def test_coalesced_calls_run_once_for_concurrent_callers():
+    calls = CoalescedCalls()
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def slow():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return "kết quả"
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(calls.call("k", slow)))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: results.append(calls.call("k", slow)))
+    second.start()
+    second.join(0.2)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert results == ["kết quả", "kết quả"]
+    assert runs == [1]
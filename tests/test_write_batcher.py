@@ -0,0 +1,123 @@
+# tests/test_write_batcher.py
+#
+# ShardWriteBatcher (server/write_batcher.py) với kết nối giả: gom nhiều
+# submit vào 1 lô, lô lỗi thì ghi lại từng dòng, on_flush chạy trước khi
+# caller nhận kết quả.
+
+import itertools
+import threading
+
+import pytest
+
+from server.write_batcher import ShardWriteBatcher
+
+
+class FakeNode:
+    """Bảng messages trong RAM; content == "bad" làm câu INSERT lỗi."""
+
+    def __init__(self):
+        self.rows = {}
+        self.inserts = []
+        self.lock = threading.Lock()
+
+    def connect(self, node_cfg):
+        return _FakeConn(self)
+
+
+class _FakeConn:
+    def __init__(self, node):
+        self.node = node
+        self.pending = {}
+        self.result = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        if sql.startswith("INSERT"):
+            rows = [params[i:i + 5] for i in range(0, len(params), 5)]
+            self.node.inserts.append(len(rows))
+            if any(r[4] == "bad" for r in rows):
+                raise RuntimeError("hỏng dòng")
+            for r in rows:
+                self.pending[r[0]] = r
+        else:
+            self.result = [{"id": i, "created_at": f"t{i}"} for i in params if i in self.pending]
+
+    def fetchall(self):
+        return self.result
+
+    def commit(self):
+        with self.node.lock:
+            self.node.rows.update(self.pending)
+
+    def rollback(self):
+        self.pending = {}
+
+    def close(self):
+        pass
+
+
+def _submit_all(batcher, contents):
+    results = [None] * len(contents)
+
+    def worker(i, content):
+        try:
+            results[i] = batcher.submit(1, 7, "text", content)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i, c)) for i, c in enumerate(contents)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+@pytest.fixture
+def node():
+    return FakeNode()
+
+
+def test_submits_are_grouped_into_one_commit(node):
+    ids = itertools.count(100)
+    batcher = ShardWriteBatcher({"name": "fake"}, node.connect, lambda: next(ids),
+                                max_batch=10, max_delay_ms=200)
+    results = _submit_all(batcher, [f"tin {i}" for i in range(5)])
+
+    assert node.inserts == [5]
+    assert sorted(r["id"] for r in results) == list(range(100, 105))
+    assert all(r["created_at"] == f"t{r['id']}" for r in results)
+    assert batcher.stats()["batches_written"] == 1
+
+
+def test_bad_row_fails_alone_and_keeps_its_id(node):
+    ids = itertools.count(200)
+    batcher = ShardWriteBatcher({"name": "fake"}, node.connect, lambda: next(ids),
+                                max_batch=10, max_delay_ms=200)
+    results = _submit_all(batcher, ["ok 1", "bad", "ok 2"])
+
+    failed = [r for r in results if isinstance(r, Exception)]
+    written = [r for r in results if not isinstance(r, Exception)]
+    assert len(failed) == 1 and str(failed[0]) == "hỏng dòng"
+    assert {r["content"] for r in written} == {"ok 1", "ok 2"}
+    # lô 3 dòng lỗi rồi ghi lại từng dòng
+    assert node.inserts[0] == 3 and node.inserts[1:] == [1, 1, 1]
+    assert set(node.rows) == {r["id"] for r in written}
+
+
+def test_caller_id_is_kept_and_on_flush_runs_before_result(node):
+    flushed = []
+    batcher = ShardWriteBatcher({"name": "fake"}, node.connect, lambda: 1,
+                                on_flush=lambda rows: flushed.extend(r["id"] for r in rows))
+    row = batcher.submit(1, 7, "text", "hi", message_id=999)
+
+    assert row["id"] == 999
+    assert flushed == [999]
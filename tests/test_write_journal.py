@@ -0,0 +1,111 @@
+# tests/test_write_journal.py
+#
+# Chế độ degraded: circuit breaker (server/node_health.py) và journal ghi
+# tạm (server/write_journal.py) - replay đúng thứ tự, dừng giữa chừng thì
+# giữ phần còn lại, chạy lại lệnh đã replay không sinh dòng trùng.
+
+import pytest
+
+from server.id_generator import next_message_id
+from server.node_health import HealthMonitor, NodeUnavailableError
+from server.write_journal import WriteJournal
+
+
+class _FailingConn:
+    """Kết nối giả: lệnh thứ `fail_at` (tính từ 0) báo lỗi."""
+
+    def __init__(self, log, fail_at):
+        self.log = log
+        self.fail_at = fail_at
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        if len(self.log) == self.fail_at:
+            raise ConnectionError("node rớt giữa chừng")
+        self.log.append(params[0])
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_interrupted_replay_keeps_the_rest_in_order(tmp_path):
+    journal = WriteJournal(tmp_path)
+    for i in range(5):
+        journal.append("n1", "SQL %s", [i], conversation_id=100 + i)
+    with open(tmp_path / "n1.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"sql": "ghi dở')    # dòng cuối hỏng khi crash
+
+    log = []
+    with pytest.raises(ConnectionError):
+        journal.replay({"name": "n1"}, lambda node: _FailingConn(log, fail_at=3), batch_size=2)
+    assert log == [0, 1, 2]
+    assert journal.stats() == {"n1": 3}
+
+    touched = journal.replay({"name": "n1"}, lambda node: _FailingConn(log, fail_at=-1))
+    assert log == [0, 1, 2, 2, 3, 4]
+    assert touched == {102, 103, 104}
+    assert not journal.pending("n1")
+
+
+def test_replaying_a_message_twice_writes_it_once(db, tmp_path):
+    for name in ("journal_ivy", "journal_jon"):
+        db.create_user(name, "x", name)
+    ivy, jon = (db.get_user_by_username(n)["id"] for n in ("journal_ivy", "journal_jon"))
+    conv = db.get_or_create_private_conversation(ivy, jon)
+    node = db.select_node_for_conversation(conv)
+    msg_id = next_message_id()
+    params = [msg_id, conv, ivy, "text", "ghi lúc node lỗi", "2026-01-01 00:00:00"]
+
+    journal = WriteJournal(tmp_path)
+    for _ in range(2):
+        journal.append(node["name"], db._INSERT_MESSAGE_IGNORE_SQL, params, conversation_id=conv)
+        assert journal.replay(node, db.get_connection) == {conv}
+
+    conn = db.get_connection(node)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) AS cnt FROM messages WHERE id = %s", (msg_id,))
+            assert cur.fetchone()["cnt"] == 1
+    finally:
+        conn.close()
+
+
+def test_breaker_opens_after_threshold_and_fires_recover():
+    recovered = []
+    monitor = HealthMonitor([{"name": "n1"}], probe=lambda node: None,
+                            failure_threshold=2, retry_after=60)
+    monitor.add_recover_listener(recovered.append)
+
+    monitor.record_failure("n1", "timeout")
+    monitor.before_connect("n1")
+    monitor.record_failure("n1", "timeout")
+    assert not monitor.is_available("n1")
+    with pytest.raises(NodeUnavailableError):
+        monitor.before_connect("n1")
+
+    monitor.probe_once()
+    assert monitor.is_available("n1")
+    assert recovered == ["n1"]
+
+
+def test_open_breaker_lets_one_trial_through_after_retry_after():
+    monitor = HealthMonitor([{"name": "n1"}], probe=lambda node: None,
+                            failure_threshold=1, retry_after=0)
+    monitor.record_failure("n1", "timeout")
+
+    monitor.before_connect("n1")        # 1 request thử
+    with pytest.raises(NodeUnavailableError):
+        monitor.before_connect("n1")    # request khác vẫn bị chặn khi thử chưa xong
+    monitor.record_success("n1")
+    monitor.before_connect("n1")